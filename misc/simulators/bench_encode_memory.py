@@ -0,0 +1,90 @@
+from __future__ import print_function
+
+"""
+Measure the time and peak memory footprint of encoding a file with the
+immutable Encoder, sending the shares to shareholders which throw them
+away. Since peak RSS can only go up, each run should be in a fresh process:
+
+python bench_encode_memory.py [SIZE_MB [SEGMENT_KiB [K N]]]
+"""
+
+import os, resource, sys, tempfile, time
+
+from zope.interface import implementer
+from twisted.internet import defer, task
+
+from allmydata.immutable import encode, upload
+from allmydata.interfaces import IStorageBucketWriter
+
+@implementer(IStorageBucketWriter)
+class NullBucketWriter(object):
+    def __init__(self, peerid):
+        self.peerid = peerid
+        self.bytes_received = 0
+    def get_peerid(self):
+        return self.peerid
+    def put_header(self):
+        return defer.succeed(None)
+    def put_block(self, segmentnum, data):
+        self.bytes_received += len(data)
+        return defer.succeed(None)
+    def put_crypttext_hashes(self, hashes):
+        return defer.succeed(None)
+    def put_block_hashes(self, blockhashes):
+        return defer.succeed(None)
+    def put_share_hashes(self, sharehashes):
+        return defer.succeed(None)
+    def put_uri_extension(self, uri_extension):
+        return defer.succeed(None)
+    def close(self):
+        return defer.succeed(None)
+    def abort(self):
+        pass
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+@defer.inlineCallbacks
+def run(reactor, size, segment_size, k, n):
+    (fd, fn) = tempfile.mkstemp()
+    with os.fdopen(fd, "wb") as f:
+        for i in range(0, size, 1000000):
+            f.write("\x5a" * min(1000000, size - i))
+    rss_before = peak_rss_mb()
+    u = upload.FileName(fn, convergence="")
+    u.set_default_encoding_parameters({'max_segment_size': segment_size,
+                                       'k': k, 'happy': n, 'n': n})
+    e = encode.Encoder()
+    yield e.set_encrypted_uploadable(upload.EncryptAnUploadable(u))
+    shareholders = {}
+    servermap = {}
+    for shnum in range(n):
+        shareholders[shnum] = NullBucketWriter("peer%d" % shnum)
+        servermap[shnum] = set(["peer%d" % shnum])
+    e.set_shareholders(shareholders, servermap)
+    start = time.time()
+    yield e.start()
+    elapsed = time.time() - start
+    os.unlink(fn)
+    sent = sum([sh.bytes_received for sh in shareholders.values()])
+    print("%d MB in %d KiB segments, %d-of-%d: %.3fs (%.1f MB/s),"
+          " peak RSS %.1f MB (%.1f MB above baseline), %d bytes of blocks"
+          % (size // 1000000, segment_size // 1024, k, n, elapsed,
+             size / elapsed / 1e6, peak_rss_mb(), peak_rss_mb() - rss_before,
+             sent))
+
+def main():
+    size_mb = 64
+    segment_kib = 1024
+    k, n = 3, 10
+    if len(sys.argv) > 1:
+        size_mb = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        segment_kib = int(sys.argv[2])
+    if len(sys.argv) > 4:
+        k, n = int(sys.argv[3]), int(sys.argv[4])
+    task.react(run, (size_mb*1000*1000, segment_kib*1024, k, n))
+
+if __name__ == '__main__':
+    main()
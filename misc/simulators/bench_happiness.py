@@ -0,0 +1,76 @@
+from __future__ import print_function
+
+"""
+Measure how long upload server selection spends computing share placements
+(happiness_upload.share_placement) and servers-of-happiness
+(happinessutil.servers_of_happiness), which Tahoe2ServerSelector does on
+the reactor thread in every round of queries, for synthetic grids of
+different sizes and with different distributions of existing shares.
+
+python bench_happiness.py [N [PEERS [REPEATS]]]
+"""
+
+import random, sys, time
+
+from allmydata.immutable.happiness_upload import share_placement
+from allmydata.util.happinessutil import servers_of_happiness
+
+def layouts(peers, shares, rng):
+    """Yield (name, readonly_peers, peers_to_shares) for some typical
+    states of a grid."""
+    yield ("new file", set(), {})
+    # an earlier upload of the same file placed one share on each of the
+    # first len(shares) servers
+    yield ("re-upload", set(),
+           dict([(p, set([sh])) for (p, sh) in zip(peers, shares)]))
+    # a third of the servers have a couple of shares each, and a third of
+    # those have since become read-only (or full)
+    existing = {}
+    for p in peers[::3]:
+        existing[p] = set(rng.sample(shares, min(2, len(shares))))
+    yield ("scattered", set(peers[::9]), existing)
+    # a file that was uploaded to a much smaller grid: its shares are
+    # piled up on a few servers, and need spreading out
+    few = peers[:max(1, len(peers) // 20)]
+    piled = {}
+    for sh in shares:
+        piled.setdefault(rng.choice(few), set()).add(sh)
+    yield ("repair", set(), piled)
+
+def run(n, num_peers, repeats):
+    rng = random.Random(0)
+    peers = ["peer%04d" % i for i in range(num_peers)]
+    shares = range(n)
+    for (name, readonly_peers, peers_to_shares) in layouts(peers, shares, rng):
+        elapsed = []
+        for i in range(repeats):
+            start = time.time()
+            placements = share_placement(set(peers), readonly_peers,
+                                         set(shares), peers_to_shares)
+            sharemap = dict([(sh, set([p]))
+                             for (sh, p) in placements.items()])
+            happiness = servers_of_happiness(sharemap)
+            elapsed.append(time.time() - start)
+        print("N=%3d peers=%4d %-10s happiness=%3d  %8.2fms (best of %d)"
+              % (n, num_peers, name, happiness, min(elapsed) * 1000,
+                 repeats))
+
+def main():
+    repeats = 3
+    if len(sys.argv) > 1:
+        sizes = [(int(sys.argv[1]),
+                  int(sys.argv[2]) if len(sys.argv) > 2
+                  else 2 * int(sys.argv[1]))]
+        if len(sys.argv) > 3:
+            repeats = int(sys.argv[3])
+    else:
+        # the default 3-of-10, a wide 30-of-100, and the maximum 255
+        # shares, each with 2N servers (which is as many as the selector
+        # considers) and with a small grid
+        sizes = [(10, 20), (10, 5), (100, 200), (100, 30), (255, 510),
+                 (255, 60)]
+    for (n, num_peers) in sizes:
+        run(n, num_peers, repeats)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+from __future__ import print_function
+
+"""
+Measure the write amplification of growing a mutable share a segment at a
+time, as publishing a large MDMF file does, with and without preallocation
+of container slack ([storage]mutable.growth_factor).
+
+python bench_mutable_growth.py [SIZE_MB [SEGMENT_KiB [EXTRA_LEASES]]]
+"""
+
+import os, shutil, sys, tempfile, time
+
+from allmydata.storage.mutable import MutableShareFile
+
+class CountingFile(object):
+    """I wrap a file, counting the bytes written through me."""
+    def __init__(self, f):
+        self._f = f
+        self.written = 0
+        self.writes = 0
+    def write(self, data):
+        self.written += len(data)
+        self.writes += 1
+        return self._f.write(data)
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+class LoggingParent(object):
+    def log(self, *args, **kwargs):
+        pass
+
+def run(basedir, growth_factor, size, segment_size, extra_leases):
+    fn = os.path.join(basedir, "share-%s" % growth_factor)
+    msf = MutableShareFile(fn, LoggingParent(), growth_factor=growth_factor)
+    msf.create("\x00"*20, "\x01"*32)
+    f = open(fn, "rb+")
+    # the extra leases are what has to move whenever the container grows
+    msf._write_num_extra_leases(f, extra_leases)
+    f.seek(msf._read_extra_lease_offset(f) + 4)
+    f.write("\xff" * (extra_leases * msf.LEASE_SIZE))
+    cf = CountingFile(f)
+    segment = os.urandom(segment_size)
+    relocations = 0
+    start = time.time()
+    for offset in range(0, size, segment_size):
+        container_size = msf._get_container_size(cf)
+        msf._write_share_data(cf, offset, segment)
+        if msf._get_container_size(cf) != container_size:
+            relocations += 1
+    f.close()
+    elapsed = time.time() - start
+    data_written = len(range(0, size, segment_size)) * segment_size
+    overhead = cf.written - data_written
+    print("growth_factor=%-4s relocations=%5d writes=%7d"
+          " overhead=%9d bytes amplification=%.5f slack=%9d bytes %.3fs"
+          % (growth_factor, relocations, cf.writes, overhead,
+             float(cf.written) / data_written,
+             os.path.getsize(fn) - msf.DATA_OFFSET - data_written
+             - 4 - extra_leases * msf.LEASE_SIZE,
+             elapsed))
+
+def main():
+    size_mb = 100
+    segment_kib = 128
+    extra_leases = 16
+    if len(sys.argv) > 1:
+        size_mb = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        segment_kib = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        extra_leases = int(sys.argv[3])
+    print("%d MB share, written in %d KiB segments, with %d extra leases"
+          % (size_mb, segment_kib, extra_leases))
+    basedir = tempfile.mkdtemp()
+    try:
+        for growth_factor in [1.0, 1.25, 1.5, 2.0]:
+            run(basedir, growth_factor, size_mb*1000*1000, segment_kib*1024,
+                extra_leases)
+    finally:
+        shutil.rmtree(basedir)
+
+if __name__ == '__main__':
+    main()
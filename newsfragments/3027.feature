@@ -0,0 +1 @@
+Storage servers can keep leases in an SQLite database instead of in each share file, with [storage]leasedb.enabled, so that expiring leases no longer needs a scan of every share.
@@ -0,0 +1 @@
+Storage servers can remember which shares they hold in memory, with [storage]inventory.enabled, which avoids directory lookups when answering share queries.
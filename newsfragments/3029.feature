@@ -0,0 +1 @@
+Storage servers now support get_buckets_multi(), and clients use it to send the share queries of concurrent checks and downloads in one round trip.
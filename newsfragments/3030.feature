@@ -0,0 +1 @@
+Storage servers can keep recently read share files open, with [storage]handle_cache.enabled, instead of opening and closing them for every read.
@@ -0,0 +1 @@
+Storage servers can do share reads and writes in a pool of threads, with [storage]threaded_io.enabled, so that a slow disk no longer blocks every other client.
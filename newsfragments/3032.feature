@@ -0,0 +1 @@
+Storage server latency statistics now use fixed-size histograms, and are also reported for the last minute and the last five minutes.
@@ -0,0 +1 @@
+Storage servers track the space reserved by uploads in progress incrementally, and can reuse their free-space measurement for a while, with [storage]space_cache.enabled.
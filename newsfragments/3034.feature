@@ -0,0 +1 @@
+A storage server can now spread its shares over several directories, for example one per disk, with [storage]extra_share_dirs and [storage]share_placement.
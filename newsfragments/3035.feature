@@ -0,0 +1 @@
+Storage servers can store small immutable shares in large pack files, with [storage]packed_shares.enabled, instead of using a file and a directory for each share.
@@ -0,0 +1 @@
+Storage servers can now make each closed immutable share durable before acknowledging it, either on its own or in groups of closes, with [storage]close_sync.
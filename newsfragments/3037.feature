@@ -0,0 +1 @@
+Storage servers can verify the immutable shares they hold in the background, with [storage]scrubber.enabled, and report any corrupt ones on the storage status page.
@@ -0,0 +1 @@
+Storage servers can keep a journal of share changes, with [storage]journal.enabled, so that the crawlers only need to visit the buckets that changed.
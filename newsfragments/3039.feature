@@ -0,0 +1 @@
+The storage crawlers now save their state and the lease checker history incrementally, instead of rewriting the whole file after every time slice.
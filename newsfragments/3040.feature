@@ -0,0 +1 @@
+Storage servers can limit the uploads that each client has in progress, with [storage]admission.enabled, and tell clients when to try again. Uploads avoid busy servers while enough others are available.
@@ -0,0 +1 @@
+Storage servers can leave room for growth when they enlarge a mutable share, with [storage]mutable.growth_factor, so publishing a large file moves its leases less often.
@@ -0,0 +1 @@
+Storage servers can keep the partial shares of an interrupted upload for a while, with [storage]resumable_uploads.enabled, so that uploading the file again only sends the missing data.
@@ -0,0 +1 @@
+Downloads now read several parts of a share in one request to servers that support immutable readv().
@@ -0,0 +1 @@
+Immutable uploads now encode the next segment while the previous one is still being sent to the servers.
@@ -0,0 +1 @@
+Clients can do erasure coding, encryption and hashing on several cores, with [client]worker_pool.enabled.
@@ -0,0 +1 @@
+Immutable uploads now copy each segment less often while encoding it, which lowers their memory use.
@@ -0,0 +1 @@
+Uploads now adapt how much data they send ahead to each server to its bandwidth and round-trip time, up to a total of [client]upload.pipeline_max_bytes.
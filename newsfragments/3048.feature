@@ -0,0 +1 @@
+Clients can upload many files at once with Uploader.upload_many() or POST /uri?t=upload-many, which share server queries between the files.
@@ -0,0 +1 @@
+Uploads now remember which servers were full and how fast each server answered, and use that to choose servers for later uploads.
@@ -0,0 +1 @@
+Clients now cache the order in which servers are tried for recently used files.
@@ -0,0 +1 @@
+Choosing servers for an upload is now much faster on large grids and with many shares.
@@ -26,6 +26,7 @@ from allmydata.util.abbreviate import parse_abbreviated_size
 from allmydata.util.time_format import parse_duration, parse_date
 from allmydata.util.i2p_provider import create as create_i2p_provider
 from allmydata.util.tor_provider import create as create_tor_provider
+from allmydata.util.workerpool import WorkerPool
 from allmydata.stats import StatsProvider
 from allmydata.history import History
 from allmydata.interfaces import IStatsProducer, SDMF_VERSION, MDMF_VERSION
@@ -53,6 +54,10 @@ def _valid_config_sections():
             "shares.needed",
             "shares.total",
             "stats_gatherer.furl",
+            "upload.pipeline_max_bytes",
+            "worker_pool.enabled",
+            "worker_pool.max_workers",
+            "worker_pool.processes",
         ),
         "drop_upload": (  # deprecated already?
             "enabled",
@@ -64,6 +69,13 @@ def _valid_config_sections():
             "port",
         ),
         "storage": (
+            "admission.enabled",
+            "admission.max_bytes",
+            "admission.max_client_buckets",
+            "admission.max_client_bytes",
+            "close_sync",
+            "close_sync.max_batch",
+            "close_sync.window",
             "debug_discard",
             "enabled",
             "expire.cutoff_date",
@@ -73,9 +85,31 @@ def _valid_config_sections():
             "expire.mode",
             "expire.mutable",
             "expire.override_lease_duration",
+            "extra_share_dirs",
+            "handle_cache.enabled",
+            "handle_cache.max_handles",
+            "inventory.enabled",
+            "inventory.max_buckets",
+            "journal.enabled",
+            "journal.full_scan_interval",
+            "leasedb.enabled",
+            "mutable.growth_factor",
+            "packed_shares.enabled",
+            "packed_shares.max_share_size",
+            "packed_shares.pack_size",
             "readonly",
             "reserved_space",
+            "resumable_uploads.enabled",
+            "resumable_uploads.grace_period",
+            "scrubber.cpu_percentage",
+            "scrubber.enabled",
+            "share_placement",
+            "space_cache.enabled",
+            "space_cache.refresh_bytes",
+            "space_cache.refresh_interval",
             "storage_dir",
+            "threaded_io.enabled",
+            "threaded_io.max_threads",
         ),
         "sftpd": (
             "accounts.file",
@@ -564,6 +598,126 @@ class _Client(node.Node, pollmixin.PollMixin):
             sharetypes.append("mutable")
         expiration_sharetypes = tuple(sharetypes)
 
+        leasedb = self.config.get_config("storage", "leasedb.enabled", False,
+                                         boolean=True)
+        inventory = self.config.get_config("storage", "inventory.enabled",
+                                           False, boolean=True)
+        inventory_max_buckets = self.config.get_config(
+            "storage", "inventory.max_buckets", None)
+        if inventory_max_buckets is not None:
+            inventory_max_buckets = int(inventory_max_buckets)
+        handle_cache = self.config.get_config("storage", "handle_cache.enabled",
+                                              False, boolean=True)
+        handle_cache_max_handles = self.config.get_config(
+            "storage", "handle_cache.max_handles", None)
+        if handle_cache_max_handles is not None:
+            handle_cache_max_handles = int(handle_cache_max_handles)
+        threaded_io = self.config.get_config("storage", "threaded_io.enabled",
+                                             False, boolean=True)
+        threaded_io_max_threads = self.config.get_config(
+            "storage", "threaded_io.max_threads", None)
+        if threaded_io_max_threads is not None:
+            threaded_io_max_threads = int(threaded_io_max_threads)
+        space_cache = self.config.get_config("storage", "space_cache.enabled",
+                                             False, boolean=True)
+        space_cache_refresh_interval = self.config.get_config(
+            "storage", "space_cache.refresh_interval", None)
+        if space_cache_refresh_interval is not None:
+            space_cache_refresh_interval = int(space_cache_refresh_interval)
+        data = self.config.get_config("storage", "space_cache.refresh_bytes",
+                                      None)
+        try:
+            space_cache_refresh_bytes = parse_abbreviated_size(data)
+        except ValueError:
+            log.msg("[storage]space_cache.refresh_bytes= contains unparseable"
+                    " value %s" % data)
+            raise
+        extra_share_dirs = []
+        data = self.config.get_config("storage", "extra_share_dirs", "")
+        for d in data.decode('utf-8').split(","):
+            if d.strip():
+                extra_share_dirs.append(self.config.get_config_path(d.strip()))
+        share_placement = self.config.get_config("storage", "share_placement",
+                                                 "most-free")
+        packed_shares = self.config.get_config("storage",
+                                               "packed_shares.enabled",
+                                               False, boolean=True)
+        data = self.config.get_config("storage",
+                                      "packed_shares.max_share_size", None)
+        try:
+            packed_shares_max_size = parse_abbreviated_size(data)
+        except ValueError:
+            log.msg("[storage]packed_shares.max_share_size= contains"
+                    " unparseable value %s" % data)
+            raise
+        data = self.config.get_config("storage", "packed_shares.pack_size",
+                                      None)
+        try:
+            packed_shares_pack_size = parse_abbreviated_size(data)
+        except ValueError:
+            log.msg("[storage]packed_shares.pack_size= contains unparseable"
+                    " value %s" % data)
+            raise
+        close_sync = self.config.get_config("storage", "close_sync", "none")
+        close_sync_window = self.config.get_config("storage",
+                                                   "close_sync.window", None)
+        if close_sync_window is not None:
+            close_sync_window = float(close_sync_window)
+        close_sync_max_batch = self.config.get_config("storage",
+                                                      "close_sync.max_batch",
+                                                      None)
+        if close_sync_max_batch is not None:
+            close_sync_max_batch = int(close_sync_max_batch)
+        scrubber = self.config.get_config("storage", "scrubber.enabled", False,
+                                          boolean=True)
+        scrubber_cpu_percentage = self.config.get_config(
+            "storage", "scrubber.cpu_percentage", None)
+        if scrubber_cpu_percentage is not None:
+            scrubber_cpu_percentage = float(scrubber_cpu_percentage) / 100
+        journal = self.config.get_config("storage", "journal.enabled", False,
+                                         boolean=True)
+        journal_full_scan_interval = self.config.get_config(
+            "storage", "journal.full_scan_interval", None)
+        if journal_full_scan_interval is not None:
+            journal_full_scan_interval = parse_duration(
+                journal_full_scan_interval)
+        admission = self.config.get_config("storage", "admission.enabled",
+                                           False, boolean=True)
+        data = self.config.get_config("storage", "admission.max_client_bytes",
+                                      None)
+        try:
+            admission_max_client_bytes = parse_abbreviated_size(data)
+        except ValueError:
+            log.msg("[storage]admission.max_client_bytes= contains"
+                    " unparseable value %s" % data)
+            raise
+        admission_max_client_buckets = self.config.get_config(
+            "storage", "admission.max_client_buckets", None)
+        if admission_max_client_buckets is not None:
+            admission_max_client_buckets = int(admission_max_client_buckets)
+        data = self.config.get_config("storage", "admission.max_bytes", None)
+        try:
+            admission_max_bytes = parse_abbreviated_size(data)
+        except ValueError:
+            log.msg("[storage]admission.max_bytes= contains unparseable"
+                    " value %s" % data)
+            raise
+        mutable_growth_factor = self.config.get_config(
+            "storage", "mutable.growth_factor", None)
+        if mutable_growth_factor is not None:
+            mutable_growth_factor = float(mutable_growth_factor)
+            if mutable_growth_factor < 1.0:
+                raise ValueError("[storage]mutable.growth_factor= must be"
+                                 " at least 1.0, not %r"
+                                 % (mutable_growth_factor,))
+        resumable_uploads = self.config.get_config(
+            "storage", "resumable_uploads.enabled", False, boolean=True)
+        resumable_uploads_grace_period = self.config.get_config(
+            "storage", "resumable_uploads.grace_period", None)
+        if resumable_uploads_grace_period is not None:
+            resumable_uploads_grace_period = float(
+                resumable_uploads_grace_period)
+
         ss = StorageServer(storedir, self.nodeid,
                            reserved_space=reserved,
                            discard_storage=discard,
@@ -573,7 +727,36 @@ class _Client(node.Node, pollmixin.PollMixin):
                            expiration_mode=mode,
                            expiration_override_lease_duration=o_l_d,
                            expiration_cutoff_date=cutoff_date,
-                           expiration_sharetypes=expiration_sharetypes)
+                           expiration_sharetypes=expiration_sharetypes,
+                           leasedb_enabled=leasedb,
+                           inventory_enabled=inventory,
+                           inventory_max_buckets=inventory_max_buckets,
+                           handle_cache_enabled=handle_cache,
+                           handle_cache_max_handles=handle_cache_max_handles,
+                           threaded_io_enabled=threaded_io,
+                           threaded_io_max_threads=threaded_io_max_threads,
+                           space_cache_enabled=space_cache,
+                           space_cache_refresh_interval=space_cache_refresh_interval,
+                           space_cache_refresh_bytes=space_cache_refresh_bytes,
+                           extra_share_dirs=extra_share_dirs,
+                           share_placement=share_placement,
+                           packed_shares_enabled=packed_shares,
+                           packed_shares_max_size=packed_shares_max_size,
+                           packed_shares_pack_size=packed_shares_pack_size,
+                           close_sync=close_sync,
+                           close_sync_window=close_sync_window,
+                           close_sync_max_batch=close_sync_max_batch,
+                           scrubber_enabled=scrubber,
+                           scrubber_cpu_percentage=scrubber_cpu_percentage,
+                           journal_enabled=journal,
+                           journal_full_scan_interval=journal_full_scan_interval,
+                           admission_enabled=admission,
+                           admission_max_client_bytes=admission_max_client_bytes,
+                           admission_max_client_buckets=admission_max_client_buckets,
+                           admission_max_bytes=admission_max_bytes,
+                           mutable_growth_factor=mutable_growth_factor,
+                           resumable_uploads_enabled=resumable_uploads,
+                           resumable_uploads_grace_period=resumable_uploads_grace_period)
         ss.setServiceParent(self)
 
         furl_file = self.config.get_private_path("storage.furl").encode(get_filesystem_encoding())
@@ -600,15 +783,40 @@ class _Client(node.Node, pollmixin.PollMixin):
         self.history = History(self.stats_provider)
         self.terminator = Terminator()
         self.terminator.setServiceParent(self)
+        self.init_worker_pool()
+        data = self.config.get_config("client", "upload.pipeline_max_bytes",
+                                      None)
+        try:
+            pipeline_max_bytes = parse_abbreviated_size(data)
+        except ValueError:
+            log.msg("[client]upload.pipeline_max_bytes= contains unparseable"
+                    " value %s" % data)
+            raise
         uploader = Uploader(
             helper_furl,
             self.stats_provider,
             self.history,
+            pipeline_max_bytes=pipeline_max_bytes,
         )
         uploader.setServiceParent(self)
         self.init_blacklist()
         self.init_nodemaker()
 
+    def init_worker_pool(self):
+        self.worker_pool = None
+        if not self.config.get_config("client", "worker_pool.enabled", False,
+                                      boolean=True):
+            return
+        max_workers = self.config.get_config("client",
+                                             "worker_pool.max_workers", None)
+        if max_workers is not None:
+            max_workers = int(max_workers)
+        use_processes = self.config.get_config("client",
+                                               "worker_pool.processes", True,
+                                               boolean=True)
+        self.worker_pool = WorkerPool(max_workers, use_processes)
+        self.worker_pool.setServiceParent(self)
+
     def get_auth_token(self):
         """
         This returns a local authentication token, which is just some
@@ -830,3 +1038,7 @@ class _Client(node.Node, pollmixin.PollMixin):
     def upload(self, uploadable, reactor=None):
         uploader = self.getServiceNamed("uploader")
         return uploader.upload(uploadable, reactor=reactor)
+
+    def upload_many(self, uploadables, reactor=None):
+        uploader = self.getServiceNamed("uploader")
+        return uploader.upload_many(uploadables, reactor=reactor)
@@ -2,7 +2,7 @@
 
 from zope.interface import implementer
 from twisted.internet import defer
-from allmydata.util import mathutil
+from allmydata.util import mathutil, workerpool
 from allmydata.util.assertutil import precondition
 from allmydata.interfaces import ICodecEncoder, ICodecDecoder
 import zfec
@@ -41,6 +41,11 @@ class CRSEncoder(object):
 
         for inshare in inshares:
             assert len(inshare) == self.share_size, (len(inshare), self.share_size, self.data_size, self.required_shares)
+        if workerpool.get_worker_pool():
+            d = workerpool.run(workerpool.fec_encode, self.required_shares,
+                               self.max_shares, inshares, desired_share_ids)
+            d.addCallback(lambda shares: (shares, desired_share_ids))
+            return d
         shares = self.encoder.encode(inshares, desired_share_ids)
 
         return defer.succeed((shares, desired_share_ids))
@@ -66,8 +71,11 @@ class CRSDecoder(object):
                      len(some_shares), len(their_shareids))
         precondition(len(some_shares) == self.required_shares,
                      len(some_shares), self.required_shares)
-        data = self.decoder.decode(some_shares,
-                                   [int(s) for s in their_shareids])
+        their_shareids = [int(s) for s in their_shareids]
+        if workerpool.get_worker_pool():
+            return workerpool.run(workerpool.fec_decode, self.required_shares,
+                                  self.max_shares, some_shares, their_shareids)
+        data = self.decoder.decode(some_shares, their_shareids)
         return defer.succeed(data)
 
 def parse_params(serializedparams):
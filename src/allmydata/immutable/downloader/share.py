@@ -15,6 +15,9 @@ from allmydata.immutable.layout import make_write_bucket_proxy
 from allmydata.util.observer import EventStreamObserver
 from common import COMPLETE, CORRUPT, DEAD, BADSEGNUM
 
+# the most ranges that one RIBucketReader.readv() call may ask for (the
+# default maxLength of a ListOf constraint)
+MAX_READV_SPANS = 30
 
 class LayoutInvalid(Exception):
     pass
@@ -734,6 +737,7 @@ class Share:
         # Reconsider the removal: maybe bring it back.
         ds = self._download_status
 
+        requests = []
         for (start, length) in ask:
             # TODO: quantize to reasonably-large blocks
             self._pending.add(start, length)
@@ -744,18 +748,58 @@ class Share:
                          level=log.NOISY, parent=self._lp, umid="sgVAyA")
             block_ev = ds.add_block_request(self._server, self._shnum,
                                             start, length, now())
+            requests.append((start, length, block_ev, lp))
+
+        if len(requests) > 1 and self._server_supports_readv():
+            # everything we want from this share goes in one message (or a
+            # few, since a read vector holds at most MAX_READV_SPANS ranges)
+            for i in range(0, len(requests), MAX_READV_SPANS):
+                d = self._send_readv(requests[i:i+MAX_READV_SPANS])
+                d.addCallback(self._trigger_loop)
+                d.addErrback(self._unhandled_error)
+            return
+        for (start, length, block_ev, lp) in requests:
             d = self._send_request(start, length)
             d.addCallback(self._got_data, start, length, block_ev, lp)
             d.addErrback(self._got_error, start, length, block_ev, lp)
             d.addCallback(self._trigger_loop)
-            d.addErrback(lambda f:
-                         log.err(format="unhandled error during send_request",
-                                 failure=f, parent=self._lp,
-                                 level=log.WEIRD, umid="qZu0wg"))
+            d.addErrback(self._unhandled_error)
+
+    def _unhandled_error(self, f):
+        log.err(format="unhandled error during send_request",
+                failure=f, parent=self._lp,
+                level=log.WEIRD, umid="qZu0wg")
+
+    def _server_supports_readv(self):
+        version = self._server.get_version() or {}
+        v1 = version.get("http://allmydata.org/tahoe/protocols/storage/v1", {})
+        return v1.get("supports-immutable-readv", False)
 
     def _send_request(self, start, length):
         return self._rref.callRemote("read", start, length)
 
+    def _send_readv(self, requests):
+        readv = [(start, length) for (start, length, block_ev, lp) in requests]
+        d = self._rref.callRemote("readv", readv)
+        def _got_datav(datav):
+            for (data, (start, length, block_ev, lp)) in zip(datav, requests):
+                self._got_data(data, start, length, block_ev, lp)
+        def _got_errorv(f):
+            for (start, length, block_ev, lp) in requests:
+                block_ev.error(now())
+                self._pending.remove(start, length)
+            log.msg(format="error requesting %(count)d ranges"
+                    " from %(server)s for si %(si)s",
+                    count=len(requests),
+                    server=self._server.get_name(), si=self._si_prefix,
+                    failure=f, parent=self._lp, level=log.UNUSUAL,
+                    umid="Qx3nDw")
+            # one failed message retires our observers once, not once for
+            # each range that it asked for
+            self._fail(f, log.UNUSUAL)
+        d.addCallbacks(_got_datav, _got_errorv)
+        return d
+
     def _got_data(self, data, start, length, block_ev, lp):
         block_ev.finished(len(data), now())
         if not self._alive:
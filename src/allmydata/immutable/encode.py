@@ -1,13 +1,15 @@
 # -*- test-case-name: allmydata.test.test_encode -*-
 
 import time
+from collections import deque
 from zope.interface import implementer
 from twisted.internet import defer
 from foolscap.api import fireEventually
 from allmydata import uri
 from allmydata.storage.server import si_b2a
 from allmydata.hashtree import HashTree
-from allmydata.util import mathutil, hashutil, base32, log, happinessutil
+from allmydata.util import mathutil, hashutil, base32, log, happinessutil, \
+     workerpool
 from allmydata.util.assertutil import _assert, precondition
 from allmydata.codec import CRSEncoder
 from allmydata.interfaces import IEncoder, IStorageBucketWriter, \
@@ -38,9 +40,13 @@ log(number of segments)).
 Each segment (A,B,C) is read into memory, encrypted, and encoded into
 blocks. The 'share' (say, share #1) that makes it out to a host is a
 collection of these blocks (block A1, B1, C1), plus some hash-tree
-information necessary to validate the data upon retrieval. Only one segment
-is handled at a time: all blocks for segment A are delivered before any
-work is begun on segment B.
+information necessary to validate the data upon retrieval. Segments are
+read and encoded one at a time, in order, but the encoder does not wait for
+the blocks of segment A to be acknowledged before it starts on segment B: up
+to 'max_segments_in_flight' segments may be encoded or on their way to the
+shareholders at once, so that encoding overlaps with the network round
+trips. Setting it to 1 makes the encoder deliver all blocks for segment A
+before any work is begun on segment B.
 
 As blocks are created, we retain the hash of each one. The list of block hashes
 for a single share (say, hash(A1), hash(B1), hash(C1)) is used to form the base
@@ -77,8 +83,16 @@ PiB=1024*TiB
 @implementer(IEncoder)
 class Encoder(object):
 
-    def __init__(self, log_parent=None, upload_status=None, progress=None):
+    # how many segments may be held in memory at once: the one being encoded
+    # plus those whose blocks have been sent but not yet acknowledged
+    max_segments_in_flight = 2
+
+    def __init__(self, log_parent=None, upload_status=None, progress=None,
+                 max_segments_in_flight=None):
         object.__init__(self)
+        if max_segments_in_flight is not None:
+            precondition(max_segments_in_flight >= 1, max_segments_in_flight)
+            self.max_segments_in_flight = max_segments_in_flight
         self.uri_extension_data = {}
         self._codec = None
         self._status = None
@@ -224,6 +238,9 @@ class Encoder(object):
         # to landlord[i]. This list contains a hash of each segment_share
         # that we sent to that landlord.
         self.share_root_hashes = [None] * self.num_shares
+        self._segments_acked = set()
+        self._segments_pushed = 0 # every segment before this one is acked
+        self._removed_shareholders = set()
 
         self._times = {
             "cumulative_encoding": 0.0,
@@ -236,20 +253,7 @@ class Encoder(object):
         d = fireEventually()
 
         d.addCallback(lambda res: self.start_all_shareholders())
-
-        for i in range(self.num_segments-1):
-            # note to self: this form doesn't work, because lambda only
-            # captures the slot, not the value
-            #d.addCallback(lambda res: self.do_segment(i))
-            # use this form instead:
-            d.addCallback(lambda res, i=i: self._encode_segment(i))
-            d.addCallback(self._send_segment, i)
-            d.addCallback(self._turn_barrier)
-        last_segnum = self.num_segments - 1
-        d.addCallback(lambda res: self._encode_tail_segment(last_segnum))
-        d.addCallback(self._send_segment, last_segnum)
-        d.addCallback(self._turn_barrier)
-
+        d.addCallback(lambda res: self._encode_and_send_segments())
         d.addCallback(lambda res: self.finish_hashing())
 
         d.addCallback(lambda res:
@@ -294,6 +298,37 @@ class Encoder(object):
         return fireEventually(res)
 
 
+    @defer.inlineCallbacks
+    def _encode_and_send_segments(self):
+        # Each segment is encoded only after the previous one has been handed
+        # to the shareholders (reading the ciphertext and hashing it must
+        # happen in order), but we only wait for a segment's blocks to be
+        # acknowledged once max_segments_in_flight segments are outstanding.
+        in_flight = deque() # Deferreds from _send_segment, oldest first
+        try:
+            last_segnum = self.num_segments - 1
+            for segnum in range(self.num_segments):
+                if segnum == last_segnum:
+                    encoded = yield self._encode_tail_segment(segnum)
+                else:
+                    encoded = yield self._encode_segment(segnum)
+                block_hashes = yield workerpool.run(workerpool.hash_blocks,
+                                                    encoded[0])
+                in_flight.append(self._send_segment(encoded, segnum,
+                                                    block_hashes))
+                del encoded, block_hashes
+                while len(in_flight) >= self.max_segments_in_flight:
+                    yield in_flight.popleft()
+                yield self._turn_barrier(None)
+            while in_flight:
+                yield in_flight.popleft()
+        finally:
+            # if we are giving up (because of an abort or an earlier
+            # failure), the segments still in flight no longer matter, but
+            # their failures have already been logged by _remove_shareholder
+            for d in in_flight:
+                d.addErrback(lambda f: None)
+
     def start_all_shareholders(self):
         self.log("starting shareholders", level=log.NOISY)
         self.set_status("Starting shareholders")
@@ -333,8 +368,10 @@ class Encoder(object):
         # given time. We build up a segment's worth of cryptttext, then hand
         # it to the encoder. Assuming 3-of-10 encoding (3.3x expansion) and
         # 1MiB max_segment_size, we get a peak memory footprint of 4.3*1MiB =
-        # 4.3MiB. Lowering max_segment_size to, say, 100KiB would drop the
-        # footprint to 430KiB at the expense of more hash-tree overhead.
+        # 4.3MiB (per segment in flight). Lowering max_segment_size to, say,
+        # 100KiB would drop the footprint to 430KiB at the expense of more
+        # hash-tree overhead. The ciphertext is not copied on the way: see
+        # _gather_data.
 
         d = self._gather_data(self.required_shares, input_piece_size,
                               crypttext_segment_hasher)
@@ -392,8 +429,9 @@ class Encoder(object):
         # who defines read_encrypted?
         #  offloaded.LocalCiphertextReader: real disk file: exact
         #  upload.EncryptAnUploadable: Uploadable, but a wrapper that makes
-        #    it exact. The return value is a list of 50KiB chunks, to reduce
-        #    the memory footprint of the encryption process.
+        #    it exact. The return value is a list of chunks, one for each of
+        #    the pieces we cut the segment into, so that they can be handed
+        #    to the codec without being copied.
         #  repairer.Repairer: immutable.filenode.CiphertextFileNode: exact
         #
         # This has been redefined to require read_encrypted() to behave like
@@ -410,22 +448,58 @@ class Encoder(object):
             assert isinstance(data, (list,tuple))
             if self._aborted:
                 raise UploadAborted()
-            data = "".join(data)
-            precondition(len(data) <= read_size, len(data), read_size)
-            if not allow_short:
-                precondition(len(data) == read_size, len(data), read_size)
-            crypttext_segment_hasher.update(data)
-            self._crypttext_hasher.update(data)
-            if allow_short and len(data) < read_size:
-                # padding
-                data += "\x00" * (read_size - len(data))
-            encrypted_pieces = [data[i:i+input_chunk_size]
-                                for i in range(0, len(data), input_chunk_size)]
-            return encrypted_pieces
+            return self._assemble_pieces(data, num_chunks, input_chunk_size,
+                                         crypttext_segment_hasher,
+                                         allow_short)
         d.addCallback(_got)
         return d
 
-    def _send_segment(self, (shares, shareids), segnum):
+    def _assemble_pieces(self, data, num_chunks, input_chunk_size,
+                         crypttext_segment_hasher, allow_short):
+        # Cut the ciphertext strings in 'data' into 'num_chunks' pieces of
+        # input_chunk_size bytes each, copying as little as possible.
+        # EncryptAnUploadable ends its strings at piece boundaries, so
+        # usually each piece is made of whole strings, and a piece made of
+        # just one of them is that string itself (which zfec also hands back
+        # as the primary share): no copies at all. Strings which straddle a
+        # boundary (from other IEncryptedUploadables) are sliced, which
+        # copies each byte once.
+        read_size = num_chunks * input_chunk_size
+        total = 0
+        pieces = []
+        parts = []
+        parts_size = 0
+        for chunk in data:
+            crypttext_segment_hasher.update(chunk)
+            self._crypttext_hasher.update(chunk)
+            total += len(chunk)
+            offset = 0
+            while offset < len(chunk):
+                wanted = input_chunk_size - parts_size
+                if offset == 0 and len(chunk) <= wanted:
+                    part = chunk
+                else:
+                    part = chunk[offset:offset+wanted]
+                parts.append(part)
+                parts_size += len(part)
+                offset += len(part)
+                if parts_size == input_chunk_size:
+                    pieces.append("".join(parts))
+                    parts = []
+                    parts_size = 0
+        precondition(total <= read_size, total, read_size)
+        if not allow_short:
+            precondition(total == read_size, total, read_size)
+        if parts:
+            # padding
+            parts.append("\x00" * (input_chunk_size - parts_size))
+            pieces.append("".join(parts))
+        if len(pieces) < num_chunks:
+            padding = "\x00" * input_chunk_size
+            pieces.extend([padding] * (num_chunks - len(pieces)))
+        return pieces
+
+    def _send_segment(self, (shares, shareids), segnum, block_hashes):
         # To generate the URI, we must generate the roothash, so we must
         # generate all shares, even if we aren't actually giving them to
         # anybody. This means that the set of shares we create will be equal
@@ -445,7 +519,7 @@ class Encoder(object):
             d = self.send_block(shareid, segnum, block, lognum)
             dl.append(d)
 
-            block_hash = hashutil.block_hash(block)
+            block_hash = block_hashes[i]
             #from allmydata.util import base32
             #log.msg("creating block (shareid=%d, blocknum=%d) "
             #        "len=%d %r .. %r: %s" %
@@ -456,7 +530,15 @@ class Encoder(object):
         dl = self._gather_responses(dl)
 
         def do_progress(ign):
-            done = self.segment_size * (segnum + 1)
+            # with several segments in flight, they may be acknowledged out
+            # of order: only count those whose predecessors are all done
+            self._segments_acked.add(segnum)
+            if self._segments_pushed not in self._segments_acked:
+                return ign
+            while self._segments_pushed in self._segments_acked:
+                self._segments_acked.remove(self._segments_pushed)
+                self._segments_pushed += 1
+            done = self.segment_size * self._segments_pushed
             if self._progress:
                 self._progress.set_progress(done)
             return ign
@@ -503,6 +585,13 @@ class Encoder(object):
             self.servermap[shareid].remove(peerid)
             if not self.servermap[shareid]:
                 del self.servermap[shareid]
+            self._removed_shareholders.add(shareid)
+        elif shareid in self._removed_shareholders:
+            # a later segment which was already in flight when we lost this
+            # shareholder: we have dealt with it already
+            self.log("shareholder was already removed", parent=ln,
+                     level=log.NOISY)
+            return
         else:
             # even more UNUSUAL
             self.log("they weren't in our list of landlords", parent=ln,
@@ -1,4 +1,5 @@
 
+from collections import deque
 from Queue import PriorityQueue
 
 
@@ -77,6 +78,97 @@ def residual_network(graph, f):
     return (new_graph, cf)
 
 
+def maximum_matching(graph):
+    """
+    I return a maximum matching of the bipartite graph inside the flow
+    network represented by my graph argument, as a dict mapping each
+    matched share index to the peer index it is matched with. I assume
+    that the source node is at index 0 of graph, with an edge to every
+    peer; that each peer has edges only to shares; that each share has an
+    edge only to the sink; and that the sink node is at the last index.
+
+    Since every edge has a capacity of 1, a flow in such a network is just
+    a matching, so this is the Edmonds-Karp algorithm (as in
+    augmenting_path_for() and residual_network()) without the |V|x|V|
+    flow and residual capacity tables, or the residual network that is
+    rebuilt after every augmentation. Instead, each augmenting path is
+    applied to the matching in place, and the residual edges are read off
+    the matching as the BFS comes to each node. The BFS finds the same
+    paths as bfs() would on the residual network, so the matching is the
+    same; but it stops as soon as it knows how it will reach the sink, or
+    that it won't, and there is no last, fruitless, BFS once every peer or
+    every share has been matched.
+    """
+    if not graph:
+        return {}
+    unmatched_peers = list(graph[0])
+    shares = set()
+    for peer in unmatched_peers:
+        shares.update(graph[peer])
+    peer_for_share = {} # share index -> peer index
+    limit = min(len(unmatched_peers), len(shares))
+    while len(peer_for_share) < limit:
+        path = _augmenting_path(graph, unmatched_peers, peer_for_share,
+                                len(shares))
+        if path is None:
+            break
+        # path is [peer, share, peer, share, ..., peer, share]: each share
+        # on it is now matched with the peer before it (which was either
+        # unmatched, or matched with the share before that)
+        for i in xrange(0, len(path), 2):
+            peer_for_share[path[i+1]] = path[i]
+        unmatched_peers.remove(path[0])
+    return peer_for_share
+
+def _augmenting_path(graph, unmatched_peers, peer_for_share, num_shares):
+    """
+    I return the shortest augmenting path for the matching described by
+    unmatched_peers and peer_for_share, as a list of alternating peer and
+    share indices (leaving out the source and the sink), or None if there
+    is no augmenting path. See maximum_matching().
+    """
+    # In the residual network, the source has an edge to every unmatched
+    # peer; a peer has an edge to every share it could hold, other than the
+    # one it is matched with (which is how the BFS got to it); and a share
+    # has an edge either back to the peer it is matched with, or to the
+    # sink. So the BFS explores all of the unmatched peers first, then
+    # each matched peer in the order in which it came to their shares; and
+    # the first unmatched share it comes to is the one it will reach the
+    # sink through, since every node queued ahead of that share only leads
+    # to nodes that will be queued behind it.
+    predecessor = {}
+    queue = deque() # matched peers
+    unseen_shares = num_shares
+    unexplored = iter(unmatched_peers)
+    while True:
+        peer = next(unexplored, None)
+        if peer is not None:
+            predecessor[peer] = 0
+        elif queue:
+            peer = queue.popleft()
+        else:
+            return None
+        for share in graph[peer]:
+            if share in predecessor:
+                continue
+            predecessor[share] = peer
+            matched_peer = peer_for_share.get(share)
+            if matched_peer is None:
+                path = [share]
+                n = peer
+                while n != 0:
+                    path.append(n)
+                    n = predecessor[n]
+                path.reverse()
+                return path
+            predecessor[matched_peer] = share
+            queue.append(matched_peer)
+            unseen_shares -= 1
+        if not unseen_shares:
+            # every share the peers could hold is already matched
+            return None
+
+
 def calculate_happiness(mappings):
     """
     :param mappings: a dict mapping 'share' -> 'peer'
@@ -125,7 +217,7 @@ def _compute_maximum_graph(graph, shareIndices):
     a maximum flow in a flow network applied to a bipartite graph.
     Specifically, it is the Edmonds-Karp algorithm, since it uses a
     BFS to find the shortest augmenting path at each iteration, if one
-    exists.
+    exists: see maximum_matching().
 
     The implementation here is an adapation of an algorithm described in
     "Introduction to Algorithms", Cormen et al, 2nd ed., pp 658-662.
@@ -134,32 +226,11 @@ def _compute_maximum_graph(graph, shareIndices):
     if graph == []:
         return {}
 
-    dim = len(graph)
-    flow_function = [[0 for sh in xrange(dim)] for s in xrange(dim)]
-    residual_graph, residual_function = residual_network(graph, flow_function)
-
-    while augmenting_path_for(residual_graph):
-        path = augmenting_path_for(residual_graph)
-        # Delta is the largest amount that we can increase flow across
-        # all of the edges in path. Because of the way that the residual
-        # function is constructed, f[u][v] for a particular edge (u, v)
-        # is the amount of unused capacity on that edge. Taking the
-        # minimum of a list of those values for each edge in the
-        # augmenting path gives us our delta.
-        delta = min(map(lambda (u, v), rf=residual_function: rf[u][v],
-                        path))
-        for (u, v) in path:
-            flow_function[u][v] += delta
-            flow_function[v][u] -= delta
-            residual_graph, residual_function = residual_network(graph,flow_function)
+    matching = maximum_matching(graph)
 
     new_mappings = {}
     for shareIndex in shareIndices:
-        peer = residual_graph[shareIndex]
-        if peer == [dim - 1]:
-            new_mappings.setdefault(shareIndex, None)
-        else:
-            new_mappings.setdefault(shareIndex, peer[0])
+        new_mappings.setdefault(shareIndex, matching.get(shareIndex))
 
     return new_mappings
 
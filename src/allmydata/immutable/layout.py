@@ -1,4 +1,4 @@
-import struct
+import struct, time
 from zope.interface import implementer
 from twisted.internet import defer
 from allmydata.interfaces import IStorageBucketWriter, IStorageBucketReader, \
@@ -100,7 +100,8 @@ class WriteBucketProxy(object):
     fieldstruct = ">L"
 
     def __init__(self, rref, server, data_size, block_size, num_segments,
-                 num_share_hashes, uri_extension_size_max, pipeline_size=50000):
+                 num_share_hashes, uri_extension_size_max, pipeline_size=50000,
+                 window=None):
         self._rref = rref
         self._server = server
         self._data_size = data_size
@@ -120,8 +121,25 @@ class WriteBucketProxy(object):
         # k=3, max_segment_size=128KiB gives us a typical segment of 43691
         # bytes. Setting the default pipeline_size to 50KB lets us get two
         # segments onto the wire but not a third, which would keep the pipe
-        # filled.
+        # filled. If we are given an AdaptiveWindow, it sets the size
+        # instead, from how quickly the server acknowledges our writes.
         self._pipeline = pipeline.Pipeline(pipeline_size)
+        self._window = window
+        if window is not None:
+            window.add_pipeline(self._pipeline)
+        # writes which fall entirely within the first _resume_offset bytes
+        # of the share are skipped, because the server already has them
+        self._resume_offset = 0
+        self.skipped_bytes = 0
+
+    def set_resume_offset(self, offset):
+        """Tell me that the server already holds the first 'offset' bytes of
+        the share (because this upload is resuming an earlier one which was
+        interrupted), so that I need not send them again."""
+        self._resume_offset = offset
+
+    def get_written_size(self):
+        return self._rref.callRemote("get_written_size")
 
     def get_allocated_size(self):
         return (self._offsets['uri_extension'] + self.fieldsize +
@@ -227,21 +245,39 @@ class WriteBucketProxy(object):
         return self._write(offset, length+data)
 
     def _write(self, offset, data):
+        if offset + len(data) <= self._resume_offset:
+            self.skipped_bytes += len(data)
+            return defer.succeed(None)
         # use a Pipeline to pipeline several writes together. TODO: another
         # speedup would be to coalesce small writes into a single call: this
         # would reduce the foolscap CPU overhead per share, but wouldn't
         # reduce the number of round trips, so it might not be worth the
         # effort.
 
+        if self._window is not None:
+            return self._pipeline.add(len(data), self._timed_write,
+                                      offset, data)
         return self._pipeline.add(len(data),
                                   self._rref.callRemote, "write", offset, data)
 
+    def _timed_write(self, offset, data):
+        d = self._rref.callRemote("write", offset, data)
+        d.addCallback(self._window.acked, len(data), time.time())
+        return d
+
+    def _done_writing(self, res):
+        if self._window is not None:
+            self._window.remove_pipeline(self._pipeline)
+        return res
+
     def close(self):
         d = self._pipeline.add(0, self._rref.callRemote, "close")
         d.addCallback(lambda ign: self._pipeline.flush())
+        d.addBoth(self._done_writing)
         return d
 
     def abort(self):
+        self._done_writing(None)
         return self._rref.callRemoteOnly("abort")
 
 
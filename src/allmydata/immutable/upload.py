@@ -9,19 +9,26 @@ from allmydata.util.hashutil import file_renewal_secret_hash, \
      file_cancel_secret_hash, bucket_renewal_secret_hash, \
      bucket_cancel_secret_hash, plaintext_hasher, \
      storage_index_hash, plaintext_segment_hasher, convergence_hasher
-from allmydata.util.deferredutil import timeout_call
+from allmydata.util.deferredutil import timeout_call, gatherResults
+from allmydata.util.pipeline import WindowBudget
 from allmydata import hashtree, uri
 from allmydata.storage.server import si_b2a
 from allmydata.immutable import encode
-from allmydata.util import base32, dictutil, idlib, log, mathutil
+from allmydata.util import base32, dictutil, idlib, log, mathutil, \
+     workerpool
 from allmydata.util.happinessutil import servers_of_happiness, \
     merge_servers, failure_message
 from allmydata.util.assertutil import precondition, _assert
 from allmydata.util.rrefutil import add_version_to_remote_reference
+from allmydata.storage_client import is_server_busy, note_server_busy, \
+     get_buckets, allocate_buckets, note_allocation, is_server_full, \
+     get_allocation_latency
+from allmydata.util.limiter import ConcurrencyLimiter
 from allmydata.interfaces import IUploadable, IUploader, IUploadResults, \
      IEncryptedUploadable, RIEncryptedUploadable, IUploadStatus, \
      NoServersError, InsufficientVersionError, UploadUnhappinessError, \
-     DEFAULT_MAX_SEGMENT_SIZE, IProgress, IPeerSelector
+     DEFAULT_MAX_SEGMENT_SIZE, IProgress, IPeerSelector, \
+     IBatchUploadResults
 from allmydata.immutable import layout
 from pycryptopp.cipher.aes import AES
 
@@ -214,6 +221,41 @@ class UploadResults(object):
     def get_verifycapstr(self):
         return self._verifycapstr
 
+@implementer(IBatchUploadResults)
+class BatchUploadResults(object):
+
+    def __init__(self, num_files):
+        self._results = [None] * num_files
+        self._timings = {}
+
+    def set_result(self, res, i):
+        self._results[i] = res
+
+    def set_total_time(self, elapsed):
+        self._timings = {"total": elapsed}
+        for r in self._results:
+            if isinstance(r, failure.Failure):
+                continue
+            for (name, t) in r.get_timings().items():
+                if name != "total" and isinstance(t, (int, float)):
+                    self._timings[name] = self._timings.get(name, 0.0) + t
+
+    def get_results(self):
+        return self._results
+    def get_uris(self):
+        uris = []
+        for r in self._results:
+            if isinstance(r, failure.Failure):
+                uris.append(None)
+            else:
+                uris.append(r.get_uri())
+        return uris
+    def get_total_size(self):
+        return sum([r.get_file_size() for r in self._results
+                    if not isinstance(r, failure.Failure)])
+    def get_timings(self):
+        return self._timings
+
 # our current uri_extension is 846 bytes for small files, a few bytes
 # more for larger ones (since the filesize is encoded in decimal in a
 # few places). Ask for a little bit more just in case we need it. If
@@ -230,8 +272,10 @@ class ServerTracker(object):
     def __init__(self, server,
                  sharesize, blocksize, num_segments, num_share_hashes,
                  storage_index,
-                 bucket_renewal_secret, bucket_cancel_secret):
+                 bucket_renewal_secret, bucket_cancel_secret,
+                 window_budget=None):
         self._server = server
+        self._window_budget = window_budget
         self.buckets = {} # k: shareid, v: IRemoteBucketWriter
         self.sharesize = sharesize
 
@@ -261,33 +305,74 @@ class ServerTracker(object):
         return self._server.get_name()
 
     def query(self, sharenums):
+        # concurrent uploads share a round trip, if the server supports it
         rref = self._server.get_rref()
-        d = rref.callRemote("allocate_buckets",
-                            self.storage_index,
-                            self.renew_secret,
-                            self.cancel_secret,
-                            sharenums,
-                            self.allocated_size,
-                            canary=Referenceable())
+        started = time.time()
+        d = allocate_buckets(rref,
+                             self.storage_index,
+                             self.renew_secret,
+                             self.cancel_secret,
+                             sharenums,
+                             self.allocated_size)
+        def _note_allocation((alreadygot, buckets, retry_after)):
+            # tell later uploads whether this server has room, and how
+            # quickly it answers. Shares refused because we are too busy
+            # there say nothing about its space.
+            refused = set(sharenums) - set(alreadygot) - set(buckets)
+            if retry_after is not None:
+                note_server_busy(rref, retry_after)
+                refused = set()
+            note_allocation(rref, self.allocated_size, len(buckets),
+                            len(refused), time.time() - started)
+            return (alreadygot, buckets, retry_after)
+        d.addCallback(_note_allocation)
         d.addCallback(self._buckets_allocated)
         return d
 
     def ask_about_existing_shares(self):
-        rref = self._server.get_rref()
-        return rref.callRemote("get_buckets", self.storage_index)
+        return get_buckets(self._server.get_rref(), self.storage_index)
 
-    def _buckets_allocated(self, (alreadygot, buckets)):
+    def _buckets_allocated(self, (alreadygot, buckets, retry_after)):
         #log.msg("%s._got_reply(%s)" % (self, (alreadygot, buckets)))
         b = {}
+        window = None
+        if self._window_budget is not None:
+            window = self._window_budget.get_window(self.get_serverid(),
+                                                    self.get_name())
         for sharenum, rref in buckets.iteritems():
             bp = self.wbp_class(rref, self._server, self.sharesize,
                                 self.blocksize,
                                 self.num_segments,
                                 self.num_share_hashes,
-                                EXTENSION_SIZE)
+                                EXTENSION_SIZE,
+                                window=window)
             b[sharenum] = bp
         self.buckets.update(b)
-        return (alreadygot, set(b.keys()))
+        d = self._find_resume_offsets(b)
+        d.addCallback(lambda ign: (alreadygot, set(b.keys()), retry_after))
+        return d
+
+    def _find_resume_offsets(self, buckets):
+        # a server which keeps the partial shares of interrupted uploads
+        # may have given us some of our own back: ask how much of each it
+        # already has, so that the encoder need not send that part again
+        version = getattr(self._server.get_rref(), "version", None) or {}
+        v1 = version.get("http://allmydata.org/tahoe/protocols/storage/v1", {})
+        if not buckets or not v1.get("supports-resumable-uploads", False):
+            return defer.succeed(None)
+        dl = []
+        for sharenum, bp in buckets.iteritems():
+            d = bp.get_written_size()
+            d.addCallback(bp.set_resume_offset)
+            d.addErrback(self._no_resume_offset, sharenum)
+            dl.append(d)
+        return defer.DeferredList(dl)
+
+    def _no_resume_offset(self, f, sharenum):
+        # if we can't tell, we send everything
+        log.msg("unable to get written size of sh%d from %s"
+                % (sharenum, self.get_name()), failure=f,
+                level=log.UNUSUAL, umid="Hj3Lq8")
 
 
     def abort(self):
@@ -376,24 +461,28 @@ class _QueryStatistics(object):
         self.bad = 0
         self.full = 0
         self.error = 0
+        self.busy = 0
         self.contacted = 0
 
     def __str__(self):
         return "QueryStatistics(total={} good={} bad={} full={} " \
-            "error={} contacted={})".format(
+            "error={} busy={} contacted={})".format(
                 self.total,
                 self.good,
                 self.bad,
                 self.full,
                 self.error,
+                self.busy,
                 self.contacted,
             )
 
 
 class Tahoe2ServerSelector(log.PrefixingLogMixin):
 
-    def __init__(self, upload_id, logparent=None, upload_status=None, reactor=None):
+    def __init__(self, upload_id, logparent=None, upload_status=None, reactor=None,
+                 window_budget=None):
         self.upload_id = upload_id
+        self._window_budget = window_budget
         self._query_stats = _QueryStatistics()
         self.last_failure_msg = None
         self._status = IUploadStatus(upload_status)
@@ -424,6 +513,30 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
             server for server in candidate_servers
             if _get_maxsize(server) >= allocated_size
         ]
+        # servers which have recently told us that they are too busy for us,
+        # or that they have no room for a share this big, are only asked
+        # about their existing shares, as long as there are enough others to
+        # be happy without them
+        for (what, avoid) in [("busy", is_server_busy),
+                              ("full", lambda rref:
+                               is_server_full(rref, allocated_size))]:
+            avoided = [
+                server for server in writeable_servers
+                if avoid(server.get_rref())
+            ]
+            if (avoided and
+                len(writeable_servers) - len(avoided) >= self.min_happiness):
+                self.log("avoiding %s servers %s" %
+                         (what, ", ".join([s.get_name() for s in avoided])),
+                         level=log.NOISY)
+                writeable_servers = [
+                    server for server in writeable_servers
+                    if server not in avoided
+                ]
+        # ask the ones which have been answering quickly first (the sort is
+        # stable, so otherwise they stay in permuted order)
+        writeable_servers.sort(
+            key=lambda s: get_allocation_latency(s.get_rref()) or 0)
         readonly_servers = set(candidate_servers) - set(writeable_servers)
 
         for server in readonly_servers:
@@ -522,6 +635,7 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
             return ServerTracker(
                 server, share_size, block_size, num_segments, num_share_hashes,
                 storage_index, renew, cancel,
+                window_budget=self._window_budget,
             )
 
         readonly_trackers, write_trackers = self._create_trackers(
@@ -575,7 +689,8 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
             self.log("asking server %s for any existing shares" %
                      (tracker.get_name(),), level=log.NOISY)
 
-        trackers = set(write_trackers) | set(readonly_trackers)
+        # the write trackers first, in the order _create_trackers() put them
+        trackers = write_trackers + readonly_trackers
 
         # these will always be (True, None) because errors are handled
         # in the _handle_existing_write_response etc callbacks
@@ -618,7 +733,7 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
         effective_happiness = -1
         while effective_happiness < min_happiness and \
               (last_happiness is None or len(write_trackers)):
-            errors_before = self._query_stats.bad
+            errors_before = self._query_stats.bad + self._query_stats.busy
             self._share_placements = self.peer_selector.get_share_placements()
 
             placements = []
@@ -648,7 +763,7 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                 # print("effective happiness still {}".format(last_happiness))
                 # we haven't improved over the last iteration; give up
                 break;
-            if errors_before == self._query_stats.bad:
+            if errors_before == self._query_stats.bad + self._query_stats.busy:
                 break;
             last_happiness = effective_happiness
             # print("write trackers left: {}".format(len(write_trackers)))
@@ -749,13 +864,18 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                     self.total_shares,
                     len(self.homeless_shares)))
         assert self._query_stats.bad == (self._query_stats.full + self._query_stats.error)
+        if self._query_stats.busy:
+            msg_busy = (", and {busy} placed none because the server was"
+                        " busy".format(busy=self._query_stats.busy))
+        else:
+            msg_busy = ""
         return (
             msg + "want to place shares on at least {happy} servers such that "
             "any {needed} of them have enough shares to recover the file, "
             "sent {queries} queries to {servers} servers, "
             "{good} queries placed some shares, {bad} placed none "
             "(of which {full} placed none due to the server being"
-            " full and {error} placed none due to an error)".format(
+            " full and {error} placed none due to an error){busy}".format(
                 happy=self.min_happiness,
                 needed=self.needed_shares,
                 queries=self._query_stats.total,
@@ -763,7 +883,8 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                 good=self._query_stats.good,
                 bad=self._query_stats.bad,
                 full=self._query_stats.full,
-                error=self._query_stats.error
+                error=self._query_stats.error,
+                busy=msg_busy,
             )
         )
 
@@ -811,7 +932,7 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
             return res
 
         else:
-            (alreadygot, allocated) = res
+            (alreadygot, allocated, retry_after) = res
             self.log("response to allocate_buckets() from server %s: alreadygot=%s, allocated=%s"
                     % (tracker.get_name(),
                        tuple(sorted(alreadygot)), tuple(sorted(allocated))),
@@ -851,12 +972,27 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                 # Since they were unable to accept all of our requests, so it
                 # is safe to assume that asking them again won't help.
 
+                if retry_after is not None:
+                    # The server is fine, but we (or this client) have too
+                    # many uploads in flight there already. Place these
+                    # shares elsewhere: the ServerTracker has already told
+                    # later uploads to leave it alone for a while.
+                    self.log("%s is busy, retry after %.1fs"
+                             % (tracker, retry_after), level=log.OPERATIONAL)
+                    try:
+                        self.peer_selector.mark_readonly_peer(tracker.get_serverid())
+                    except KeyError:
+                        pass
+
             if progress:
                 # They accepted at least one of the shares that we asked
                 # them to accept, or they had a share that we didn't ask
                 # them to accept but that we hadn't placed yet, so this
                 # was a productive query
                 self._query_stats.good += 1
+            elif retry_after is not None:
+                # they might have room, but not for us, yet
+                self._query_stats.busy += 1
             else:
                 # if we asked for some allocations, but the server
                 # didn't return any at all (i.e. empty dict) it must
@@ -890,6 +1026,10 @@ class EncryptAnUploadable(object):
         self.original = IUploadable(original)
         self._log_number = log_parent
         self._encryptor = None
+        self._key = None
+        # with a worker pool, chunks are encrypted there, each one on its
+        # own, rather than by self._encryptor
+        self._worker_pool = workerpool.get_worker_pool()
         self._plaintext_hasher = plaintext_hasher()
         self._plaintext_segment_hasher = None
         self._plaintext_segment_hashes = []
@@ -946,6 +1086,7 @@ class EncryptAnUploadable(object):
         def _got(key):
             e = AES(key)
             self._encryptor = e
+            self._key = key
 
             storage_index = storage_index_hash(key)
             assert isinstance(storage_index, str)
@@ -1025,7 +1166,13 @@ class EncryptAnUploadable(object):
         # reading just a chunk (say 50kB) at a time. This only really matters
         # when hash_only==True (i.e. resuming an interrupted upload), since
         # that's the case where we will be skipping over a lot of data.
-        size = min(remaining, self.CHUNKSIZE)
+        # Otherwise, each chunk is one of the pieces that the Encoder cuts a
+        # segment into (or as much of it as is left), so that it can be
+        # handed to the codec as it is, without being copied.
+        if hash_only:
+            size = min(remaining, self.CHUNKSIZE)
+        else:
+            size = min(remaining, self._get_piece_left())
         remaining = remaining - size
         # read a chunk of plaintext..
         d = defer.maybeDeferred(self.original.read, size)
@@ -1037,17 +1184,36 @@ class EncryptAnUploadable(object):
         def _good(plaintext):
             # and encrypt it..
             # o/' over the fields we go, hashing all the way, sHA! sHA! sHA! o/'
-            ct = self._hash_and_encrypt_plaintext(plaintext, hash_only)
-            ciphertext.extend(ct)
-            self._read_encrypted(remaining, ciphertext, hash_only,
-                                 fire_when_done)
+            d2 = defer.maybeDeferred(self._hash_and_encrypt_plaintext,
+                                     plaintext, hash_only)
+            def _encrypted(ct):
+                ciphertext.extend(ct)
+                self._read_encrypted(remaining, ciphertext, hash_only,
+                                     fire_when_done)
+            d2.addCallback(_encrypted)
+            return d2
         def _err(why):
             fire_when_done.errback(why)
         d.addCallback(_good)
         d.addErrback(_err)
         return None
 
+    def _get_piece_left(self):
+        # how many bytes are left before the end of the current piece: each
+        # segment is cut into k pieces of segsize/k bytes (the short tail
+        # segment into pieces of its own size/k, rounded up)
+        (k, happy, n, segsize) = self._encoding_parameters
+        offset = self._ciphertext_bytes_read
+        segment_start = offset - (offset % segsize)
+        this_segment = min(segsize, self._file_size - segment_start)
+        piece_size = mathutil.div_ceil(this_segment, k)
+        if not piece_size:
+            return self.CHUNKSIZE
+        return piece_size - ((offset - segment_start) % piece_size)
+
     def _hash_and_encrypt_plaintext(self, data, hash_only):
+        # returns a list of ciphertext strings, or (with a worker pool) a
+        # Deferred that fires with one
         assert isinstance(data, (tuple, list)), type(data)
         data = list(data)
         cryptdata = []
@@ -1058,9 +1224,18 @@ class EncryptAnUploadable(object):
             chunk = data.pop(0)
             self.log(" read_encrypted handling %dB-sized chunk" % len(chunk),
                      level=log.NOISY)
+            offset = self._ciphertext_bytes_read + bytes_processed
             bytes_processed += len(chunk)
             self._plaintext_hasher.update(chunk)
             self._update_segment_hash(chunk)
+            if self._worker_pool:
+                # AES-CTR can start anywhere in the stream, so there is
+                # nothing to do for chunks which are only being hashed
+                if not hash_only:
+                    cryptdata.append(self._worker_pool.run(
+                        workerpool.aes_ctr, self._key, offset, chunk))
+                del chunk
+                continue
             # TODO: we have to encrypt the data (even if hash_only==True)
             # because pycryptopp's AES-CTR implementation doesn't offer a
             # way to change the counter value. Once pycryptopp acquires
@@ -1077,6 +1252,8 @@ class EncryptAnUploadable(object):
         if self._status:
             progress = float(self._ciphertext_bytes_read) / self._file_size
             self._status.set_progress(1, progress)
+        if self._worker_pool:
+            return gatherResults(cryptdata)
         return cryptdata
 
 
@@ -1119,6 +1296,7 @@ class UploadStatus(object):
         self.results = None
         self.counter = self.statusid_counter.next()
         self.started = time.time()
+        self.write_windows = []
 
     def get_started(self):
         return self.started
@@ -1138,6 +1316,12 @@ class UploadStatus(object):
         return self.results
     def get_counter(self):
         return self.counter
+    def get_write_windows(self):
+        """Return a list of (servername, effective window, throughput,
+        round-trip time) for the servers this upload is writing to. The
+        throughput and time are None until they have been measured."""
+        return [(w.name, w.get_effective_window(), w.get_throughput(),
+                 w.get_rtt()) for w in self.write_windows]
 
     def set_storage_index(self, si):
         self.storage_index = si
@@ -1154,13 +1338,18 @@ class UploadStatus(object):
         self.active = value
     def set_results(self, value):
         self.results = value
+    def add_write_window(self, window):
+        self.write_windows.append(window)
 
 class CHKUploader(object):
 
-    def __init__(self, storage_broker, secret_holder, progress=None, reactor=None):
+    def __init__(self, storage_broker, secret_holder, progress=None, reactor=None,
+                 window_budget=None):
         # server_selector needs storage_broker and secret_holder
         self._storage_broker = storage_broker
         self._secret_holder = secret_holder
+        # a WindowBudget lets the write pipeline to each server adapt to it
+        self._window_budget = window_budget
         self._log_number = self.log("CHKUploader starting", parent=None)
         self._encoder = None
         self._storage_index = None
@@ -1248,6 +1437,7 @@ class CHKUploader(object):
             self._log_number,
             self._upload_status,
             reactor=self._reactor,
+            window_budget=self._window_budget,
         )
 
         share_size = encoder.get_param("share_size")
@@ -1294,6 +1484,10 @@ class CHKUploader(object):
             for shnum in tracker.buckets:
                 self._server_trackers[shnum] = tracker
                 servermap.setdefault(shnum, set()).add(tracker.get_serverid())
+            if self._window_budget is not None and tracker.buckets:
+                window = self._window_budget.get_window(tracker.get_serverid(),
+                                                        tracker.get_name())
+                self._upload_status.add_write_window(window)
         assert len(buckets) == sum([len(tracker.buckets)
                                     for tracker in upload_trackers]), \
             "%s (%s) != %s (%s)" % (
@@ -1793,9 +1987,13 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
     """
     name = "uploader"
     URI_LIT_SIZE_THRESHOLD = 55
+    MAX_CONCURRENT_UPLOADS = 10 # per upload_many() call
 
-    def __init__(self, helper_furl=None, stats_provider=None, history=None, progress=None):
+    def __init__(self, helper_furl=None, stats_provider=None, history=None, progress=None,
+                 pipeline_max_bytes=None):
         self._helper_furl = helper_furl
+        # the write pipelines of all our uploads share this
+        self.window_budget = WindowBudget(pipeline_max_bytes)
         self.stats_provider = stats_provider
         self._history = history
         self._helper = None
@@ -1870,7 +2068,8 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
                 else:
                     storage_broker = self.parent.get_storage_broker()
                     secret_holder = self.parent._secret_holder
-                    uploader = CHKUploader(storage_broker, secret_holder, progress=progress, reactor=reactor)
+                    uploader = CHKUploader(storage_broker, secret_holder, progress=progress, reactor=reactor,
+                                           window_budget=self.window_budget)
                     d2.addCallback(lambda x: uploader.start(eu))
 
                 self._all_uploads[uploader] = None
@@ -1894,3 +2093,31 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
             return res
         d.addBoth(_done)
         return d
+
+    def upload_many(self, uploadables, max_concurrent=None, reactor=None):
+        """
+        Upload each of 'uploadables', up to 'max_concurrent' at a time.
+        While some of them wait for servers, others are being hashed and
+        encoded. Their queries to each server are coalesced (see
+        storage_client.allocate_buckets), and their write pipelines all
+        share our WindowBudget.
+
+        Returns a Deferred that will fire with a BatchUploadResults
+        instance.
+        """
+        if max_concurrent is None:
+            max_concurrent = self.MAX_CONCURRENT_UPLOADS
+        limiter = ConcurrencyLimiter(max_concurrent)
+        results = BatchUploadResults(len(uploadables))
+        started = time.time()
+        dl = []
+        for (i, uploadable) in enumerate(uploadables):
+            d = limiter.add(self.upload, uploadable, reactor=reactor)
+            d.addBoth(results.set_result, i)
+            dl.append(d)
+        d = defer.DeferredList(dl)
+        def _done(ign):
+            results.set_total_time(time.time() - started)
+            return results
+        d.addCallback(_done)
+        return d
@@ -18,6 +18,7 @@ StorageIndex = StringConstraint(16)
 URI = StringConstraint(300) # kind of arbitrary
 
 MAX_BUCKETS = 256  # per peer -- zfec offers at most 256 shares per file
+MAX_BUCKET_QUERIES = 100 # storage indexes per get_buckets_multi() call
 
 DEFAULT_MAX_SEGMENT_SIZE = 128*1024
 
@@ -48,12 +49,38 @@ class RIBucketWriter(RemoteInterface):
         """Abandon all the data that has been written.
         """
         return None
+    def get_written_size():
+        """Return how many bytes at the start of the share have already
+        been written. This is zero for a new upload, but an upload which has
+        been resumed (see RIStorageServer.allocate_buckets) may already have
+        some of its data, which the client need not send again.
+
+        This method is only available on servers which announce
+        'supports-resumable-uploads' in their version dictionary.
+        """
+        return Offset
+
+
+ReadVector = ListOf(TupleOf(Offset, ReadSize))
+ReadData = ListOf(ShareData)
+# returns data[offset:offset+length] for each element of TestVector
 
 
 class RIBucketReader(RemoteInterface):
     def read(offset=Offset, length=ReadSize):
         return ShareData
 
+    def readv(readv=ReadVector):
+        """Like read(), but for several (offset, length) ranges of the share
+        at once, so that a downloader which wants a block and some of the
+        hashes that validate it can fetch them all in a single round trip.
+        Returns a list with the data for each range, in order.
+
+        Servers which implement this method announce it by setting
+        'supports-immutable-readv' in their version dictionary.
+        """
+        return ReadData
+
     def advise_corrupt_share(reason=str):
         """Clients who discover hash failures in shares that they have
         downloaded from me will use this method to inform me about the
@@ -79,9 +106,6 @@ TestAndWriteVectorsForShares = DictOf(int,
                                               DataVector,
                                               ChoiceOf(None, Offset), # new_length
                                               ))
-ReadVector = ListOf(TupleOf(Offset, ReadSize))
-ReadData = ListOf(ShareData)
-# returns data[offset:offset+length] for each element of TestVector
 
 
 class RIStorageServer(RemoteInterface):
@@ -112,14 +136,55 @@ class RIStorageServer(RemoteInterface):
                               must still be a unique value identifying the
                               lease. XXX stop relying on it to be unique.
         @param canary: If the canary is lost before close(), the bucket is
-                       deleted.
+                       deleted (or, on a server which announces
+                       'supports-resumable-uploads', kept for a while so
+                       that the same client can finish it: asking for the
+                       same share again, with the same renew_secret and
+                       allocated_size, returns the old bucket).
         @return: tuple of (alreadygot, allocated), where alreadygot is what we
                  already have and allocated is what we hereby agree to accept.
                  New leases are added for shares in both lists.
+
+        A server which limits how much each client may upload at once
+        raises ServerBusyError when none of the new shares can be accepted
+        for that reason, and it holds none of the shares already. The error
+        suggests how long the client should wait before asking again.
+        allocate_buckets_multi() reports the same hint without losing the
+        rest of the answer.
         """
         return TupleOf(SetOf(int, maxLength=MAX_BUCKETS),
                        DictOf(int, RIBucketWriter, maxKeys=MAX_BUCKETS))
 
+    def allocate_buckets_multi(requests=ListOf(TupleOf(StorageIndex,
+                                                       LeaseRenewSecret,
+                                                       LeaseCancelSecret,
+                                                       SetOf(int, maxLength=MAX_BUCKETS),
+                                                       Offset),
+                                               maxLength=MAX_BUCKET_QUERIES),
+                               canary=Referenceable):
+        """
+        Like allocate_buckets(), but for several storage indexes at once, so
+        that a client which is uploading many files can ask a server for
+        space for all of them in a single round trip. Each request is a tuple
+        of (storage_index, renew_secret, cancel_secret, sharenums,
+        allocated_size), and they all share the one canary.
+
+        Returns a list with one (alreadygot, allocated, retry_after) tuple
+        for each request, in the same order. 'alreadygot' and 'allocated' are
+        as for allocate_buckets(). 'retry_after' is None, unless some of the
+        requested shares were refused because the client has too much in
+        flight here, in which case it is the number of seconds the client
+        should wait before asking again. 'alreadygot' and 'allocated' are
+        still filled in when that happens.
+
+        Servers which implement this method announce it by setting
+        'supports-allocate-buckets-multi' in their version dictionary.
+        """
+        return ListOf(TupleOf(SetOf(int, maxLength=MAX_BUCKETS),
+                              DictOf(int, RIBucketWriter, maxKeys=MAX_BUCKETS),
+                              ChoiceOf(None, float)),
+                      maxLength=MAX_BUCKET_QUERIES)
+
     def add_lease(storage_index=StorageIndex,
                   renew_secret=LeaseRenewSecret,
                   cancel_secret=LeaseCancelSecret):
@@ -149,6 +214,48 @@ class RIStorageServer(RemoteInterface):
     def get_buckets(storage_index=StorageIndex):
         return DictOf(int, RIBucketReader, maxKeys=MAX_BUCKETS)
 
+    def get_buckets_multi(storage_indexes=ListOf(StorageIndex,
+                                                 maxLength=MAX_BUCKET_QUERIES)):
+        """
+        Like get_buckets(), but for several storage indexes at once, so that
+        a client which is checking or downloading many files can ask a server
+        about all of them in a single round trip. Returns a dictionary that
+        maps storage index to the get_buckets() result for that storage
+        index. Storage indexes for which the server holds no shares are
+        omitted.
+
+        Servers which implement this method announce it by setting
+        'supports-get-buckets-multi' in their version dictionary.
+        """
+        return DictOf(StorageIndex,
+                      DictOf(int, RIBucketReader, maxKeys=MAX_BUCKETS),
+                      maxKeys=MAX_BUCKET_QUERIES)
+
+    def get_scrub_results(storage_indexes=ListOf(StorageIndex,
+                                                 maxLength=MAX_BUCKET_QUERIES)):
+        """
+        Report what the server's share scrubber found when it last read and
+        verified each of its immutable shares for the given storage indexes.
+        Returns a dictionary that maps storage index to a dictionary that
+        maps share number to a dictionary with these keys:
+
+         ok: True if every block matched the share's block hash tree, and the
+             share hash chain and ciphertext hash tree matched its UEB
+         checked: when the share was last scrubbed, in seconds since epoch
+         ueb-hash: the uri_extension_hash of the share's UEB, or None if it
+                   could not be read. Clients should only rely on a result
+                   if this matches their verify-cap.
+         reason: why the share is corrupt, or None
+
+        Storage indexes for which no share has been scrubbed are omitted.
+
+        Servers which run a scrubber announce it by setting
+        'supports-scrub-results' in their version dictionary.
+        """
+        return DictOf(StorageIndex,
+                      DictOf(int, DictOf(str, Any()), maxKeys=MAX_BUCKETS),
+                      maxKeys=MAX_BUCKET_QUERIES)
+
 
 
     def slot_readv(storage_index=StorageIndex,
@@ -2101,6 +2208,30 @@ class IUploadResults(Interface):
         """Return the (string) verify-cap URI for the uploaded object."""
 
 
+class IBatchUploadResults(Interface):
+    """I am returned by upload_many(), and contain the results of uploading
+    each of its files, in the order they were given."""
+
+    def get_results():
+        """Return a list with an IUploadResults instance for each file that
+        was uploaded, or a Failure for each one that could not be."""
+
+    def get_uris():
+        """Return a list of the (string) URIs of the files, with None for
+        each one that could not be uploaded."""
+
+    def get_total_size():
+        """Return the number of bytes in the files that were uploaded."""
+
+    def get_timings():
+        """Return dict of timing information, mapping name to seconds.
+        'total' is the time taken by the whole batch, start to finish. The
+        other names are those of IUploadResults.get_timings(), and each
+        gives the sum of that time over all the files which were uploaded
+        (since the files are uploaded concurrently, these sums may add up to
+        more than the total)."""
+
+
 class IDownloadResults(Interface):
     """I am created internally by download() methods. I contain a number of
     public attributes that contain details about the download process.::
@@ -2132,6 +2263,15 @@ class IUploader(Interface):
         returns a Deferred that fires with an IUploadResults instance, from
         which the URI of the file can be obtained as results.uri ."""
 
+    def upload_many(uploadables, max_concurrent=None):
+        """Upload several files. Each of 'uploadables' must implement
+        IUploadable. Up to 'max_concurrent' of them are uploaded at a time,
+        and the queries that they make of each storage server are combined
+        into as few calls as possible. This returns a Deferred that fires
+        with an IBatchUploadResults instance once all of them are finished.
+        A file which cannot be uploaded does not stop the others: its
+        failure is reported in the results."""
+
 
 class ICheckable(Interface):
     def check(monitor, verify=False, add_lease=False):
@@ -2513,6 +2653,13 @@ class IClient(Interface):
                  To get the URI for this file, use results.uri .
         """
 
+    def upload_many(uploadables):
+        """Upload several files into CHKs at once, sharing the work of
+        talking to the storage servers between them.
+        @param uploadables: a list of things that implement IUploadable
+        @return: a Deferred that fires with an IBatchUploadResults instance.
+        """
+
     def create_mutable_file(contents=""):
         """Create a new mutable file (with initial) contents, get back the
         new node instance.
@@ -2666,6 +2813,15 @@ class IUploadStatus(Interface):
         number. This provides a handle to this particular upload, so a web
         page can generate a suitable hyperlink."""
 
+    def get_write_windows():
+        """Return a list of (servername, window, throughput, rtt) tuples,
+        one for each server that shares are being written to, describing
+        how the write pipeline to that server has adapted: how many bytes
+        may be in flight to it, how many bytes per second it has been
+        accepting, and how many seconds a write takes to be acknowledged
+        (the last two are None until they have been measured). The list is
+        empty if the pipelines do not adapt."""
+
 
 class IDownloadStatus(Interface):
     def get_started():
@@ -2719,6 +2875,21 @@ class NotCapableError(Exception):
 class BadWriteEnablerError(Exception):
     pass
 
+class ServerBusyError(Exception):
+    """A storage server refused to start an upload because the client
+    already has too much in flight there. The client should use other
+    servers, and not ask this one again for 'retry_after' seconds.
+
+    When this arrives from a remote server, only the message survives, so
+    use allmydata.util.rrefutil.get_retry_after() to read the hint."""
+
+    def __init__(self, retry_after):
+        Exception.__init__(self, retry_after)
+        self.retry_after = retry_after
+
+    def __str__(self):
+        return "server busy, retry after %.1f seconds" % self.retry_after
+
 
 class RIControlClient(RemoteInterface):
     def wait_for_client_connections(num_clients=int):
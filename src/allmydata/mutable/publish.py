@@ -8,6 +8,7 @@ from allmydata.interfaces import IPublishStatus, SDMF_VERSION, MDMF_VERSION, \
                                  IMutableUploadable
 from allmydata.util import base32, hashutil, mathutil, log
 from allmydata.util.dictutil import DictOfSets
+from allmydata.util.histogram import Histogram
 from allmydata import hashtree, codec
 from allmydata.storage.server import si_b2a
 from pycryptopp.cipher.aes import AES
@@ -33,7 +34,7 @@ class PublishStatus(object):
     statusid_counter = count(0)
     def __init__(self):
         self.timings = {}
-        self.timings["send_per_server"] = {}
+        self.timings["send_per_server"] = {} # server -> Histogram
         self.timings["encrypt"] = 0.0
         self.timings["encode"] = 0.0
         self.servermap = None
@@ -50,8 +51,8 @@ class PublishStatus(object):
 
     def add_per_server_time(self, server, elapsed):
         if server not in self.timings["send_per_server"]:
-            self.timings["send_per_server"][server] = []
-        self.timings["send_per_server"][server].append(elapsed)
+            self.timings["send_per_server"][server] = Histogram()
+        self.timings["send_per_server"][server].add(elapsed)
     def accumulate_encode_time(self, elapsed):
         self.timings["encode"] += elapsed
     def accumulate_encrypt_time(self, elapsed):
@@ -11,8 +11,9 @@ from foolscap.api import eventually, fireEventually, DeadReferenceError, \
 from allmydata.interfaces import IRetrieveStatus, NotEnoughSharesError, \
      DownloadStopped, MDMF_VERSION, SDMF_VERSION
 from allmydata.util.assertutil import _assert, precondition
-from allmydata.util import hashutil, log, mathutil, deferredutil
+from allmydata.util import hashutil, log, mathutil, deferredutil, workerpool
 from allmydata.util.dictutil import DictOfSets
+from allmydata.util.histogram import Histogram
 from allmydata import hashtree, codec
 from allmydata.storage.server import si_b2a
 from pycryptopp.cipher.aes import AES
@@ -27,7 +28,7 @@ class RetrieveStatus(object):
     statusid_counter = count(0)
     def __init__(self):
         self.timings = {}
-        self.timings["fetch_per_server"] = {}
+        self.timings["fetch_per_server"] = {} # server -> Histogram
         self.timings["decode"] = 0.0
         self.timings["decrypt"] = 0.0
         self.timings["cumulative_verify"] = 0.0
@@ -65,8 +66,8 @@ class RetrieveStatus(object):
 
     def add_fetch_timing(self, server, elapsed):
         if server not in self.timings["fetch_per_server"]:
-            self.timings["fetch_per_server"][server] = []
-        self.timings["fetch_per_server"][server].append(elapsed)
+            self.timings["fetch_per_server"][server] = Histogram()
+        self.timings["fetch_per_server"][server].add(elapsed)
     def accumulate_decode_time(self, elapsed):
         self.timings["decode"] += elapsed
     def accumulate_decrypt_time(self, elapsed):
@@ -899,6 +900,13 @@ class Retrieve(object):
         self.log("decrypting segment %d" % self._current_segment)
         started = time.time()
         key = hashutil.ssk_readkey_data_hash(salt, self._node.get_readkey())
+        if workerpool.get_worker_pool():
+            d = workerpool.run(workerpool.aes_ctr, key, 0, segment)
+            def _decrypted(plaintext):
+                self._status.accumulate_decrypt_time(time.time() - started)
+                return plaintext
+            d.addCallback(_decrypted)
+            return d
         decryptor = AES(key)
         plaintext = decryptor.process(segment)
         self._status.accumulate_decrypt_time(time.time() - started)
@@ -10,6 +10,7 @@ from foolscap.api import DeadReferenceError, RemoteException, eventually, \
                          fireEventually
 from allmydata.util import base32, hashutil, log, deferredutil
 from allmydata.util.dictutil import DictOfSets
+from allmydata.util.histogram import Histogram
 from allmydata.storage.server import si_b2a
 from allmydata.interfaces import IServermapUpdaterStatus
 from pycryptopp.publickey import rsa
@@ -23,7 +24,9 @@ class UpdateStatus(object):
     statusid_counter = count(0)
     def __init__(self):
         self.timings = {}
-        self.timings["per_server"] = defaultdict(list)
+        # server -> op -> Histogram
+        self.timings["per_server"] = defaultdict(lambda:
+                                                 defaultdict(Histogram))
         self.timings["cumulative_verify"] = 0.0
         self.privkey_from = None
         self.problems = {}
@@ -38,7 +41,7 @@ class UpdateStatus(object):
 
     def add_per_server_time(self, server, op, sent, elapsed):
         assert op in ("query", "late", "privkey")
-        self.timings["per_server"][server].append((op,sent,elapsed))
+        self.timings["per_server"][server][op].add(elapsed)
 
     def get_started(self):
         return self.started
@@ -0,0 +1,149 @@
+import time, weakref
+from collections import deque
+
+from allmydata.interfaces import ServerBusyError
+
+# clients which cannot be identified (local callers, and canaries which do
+# not come from a Tub) are all charged to this one
+ANONYMOUS_CLIENT = "anonymous"
+
+class AdmissionController(object):
+    """I decide whether a client may start more uploads on a StorageServer,
+    so that one busy client (running a backup or a repair, say) cannot
+    crowd out everyone else.
+
+    Each client is identified by the Tub ID of the canary it passes to
+    allocate_buckets(). For each one, I keep track of the uploads it has in
+    flight (BucketWriters which have been allocated but not yet closed or
+    aborted) and of the space allocated to them. A new bucket is refused if
+    it would take the client past 'max_client_buckets' uploads or
+    'max_client_bytes' bytes.
+
+    Beyond those caps, the server as a whole has 'max_bytes' bytes of
+    uploads in flight to share out. While that is not used up, anybody may
+    have more. Once it is, each client which is active is entitled to an
+    equal share of it: a client which is below its share is still let in
+    (so a quiet client is never locked out by a greedy one), and a client
+    which is above it is refused until its uploads finish.
+
+    A refusal raises ServerBusyError, carrying a hint of how many seconds
+    the client should wait before asking again. The hint is an estimate of
+    how long it will take for enough of the client's uploads to finish, at
+    the rate that uploads have recently been finishing, kept between
+    'min_retry_after' and 'max_retry_after'.
+    """
+
+    max_client_buckets = 1000
+    max_client_bytes = None # no limit, beyond the fair share
+    max_bytes = 2*1000*1000*1000
+    min_retry_after = 1.0 # seconds
+    max_retry_after = 60.0
+    rate_window = 60.0 # seconds of finished uploads to measure the rate by
+
+    def __init__(self, max_client_bytes=None, max_client_buckets=None,
+                 max_bytes=None):
+        if max_client_bytes is not None:
+            self.max_client_bytes = max_client_bytes
+        if max_client_buckets is not None:
+            self.max_client_buckets = max_client_buckets
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        self._clients = {} # client -> [buckets, bytes]
+        self._charges = {} # id(owner) -> (weakref to owner, client, size)
+        self._total_bytes = 0
+        self._finished = deque() # (when, size) for recently finished uploads
+        self.admitted = 0
+        self.refused = 0
+
+    def get_client(self, canary):
+        """Return the name of the client which sent 'canary'."""
+        try:
+            return canary.getRemoteTubID()
+        except Exception:
+            return ANONYMOUS_CLIENT
+
+    def check(self, client, size):
+        """Raise ServerBusyError unless 'client' may start another upload of
+        'size' bytes."""
+        (buckets, nbytes) = self._clients.get(client, (0, 0))
+        busy = False
+        excess = 0 # bytes of this client's uploads which must finish first
+        if buckets + 1 > self.max_client_buckets:
+            # wait for one upload's worth of bytes to drain
+            busy = True
+            excess = max(excess, nbytes // max(buckets, 1))
+        if (self.max_client_bytes is not None
+            and nbytes + size > self.max_client_bytes):
+            busy = True
+            excess = max(excess, nbytes + size - self.max_client_bytes)
+        if self._total_bytes + size > self.max_bytes:
+            active = len(self._clients)
+            if client not in self._clients:
+                active += 1
+            fair_share = self.max_bytes // active
+            if nbytes + size > fair_share:
+                busy = True
+                excess = max(excess, nbytes + size - fair_share)
+        if busy:
+            self.refused += 1
+            raise ServerBusyError(self.get_retry_after(excess))
+
+    def charge(self, client, owner, size):
+        """Record that 'owner' (usually a BucketWriter) is an upload of
+        'size' bytes by 'client', until release(owner) is called or the
+        owner goes away."""
+        self.release(owner)
+        key = id(owner)
+        ref = weakref.ref(owner, lambda ref: self._forget(key, False))
+        self._charges[key] = (ref, client, size)
+        counts = self._clients.setdefault(client, [0, 0])
+        counts[0] += 1
+        counts[1] += size
+        self._total_bytes += size
+        self.admitted += 1
+
+    def release(self, owner):
+        """Record that the upload by 'owner' has been closed or aborted."""
+        self._forget(id(owner), True)
+
+    def _forget(self, key, finished):
+        if key not in self._charges:
+            return
+        (ref, client, size) = self._charges.pop(key)
+        counts = self._clients[client]
+        counts[0] -= 1
+        counts[1] -= size
+        if not counts[0]:
+            del self._clients[client]
+        self._total_bytes -= size
+        if finished:
+            now = time.time()
+            self._finished.append((now, size))
+            self._prune_finished(now)
+
+    def _prune_finished(self, now):
+        cutoff = now - self.rate_window
+        while self._finished and self._finished[0][0] < cutoff:
+            self._finished.popleft()
+
+    def get_retry_after(self, excess):
+        """Estimate how many seconds it will take for 'excess' bytes of
+        uploads to finish."""
+        self._prune_finished(time.time())
+        finished = sum([size for (when, size) in self._finished])
+        if not finished:
+            return self.max_retry_after
+        rate = float(finished) / self.rate_window
+        return min(self.max_retry_after,
+                   max(self.min_retry_after, excess / rate))
+
+    def get_client_usage(self, client):
+        """Return (uploads, bytes) that 'client' has in flight."""
+        return tuple(self._clients.get(client, (0, 0)))
+
+    def get_stats(self):
+        return {"clients": len(self._clients),
+                "in_flight_bytes": self._total_bytes,
+                "admitted": self.admitted,
+                "refused": self.refused,
+                }
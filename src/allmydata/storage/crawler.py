@@ -1,10 +1,11 @@
 
 import os, time, struct
-import cPickle as pickle
 from twisted.internet import reactor
 from twisted.application import service
 from allmydata.storage.common import si_b2a
-from allmydata.util import fileutil
+from allmydata.storage.journal import JournalTruncated
+from allmydata.storage.statefile import StateFile
+from allmydata.util import log
 
 class TimeSliceExceeded(Exception):
     pass
@@ -33,6 +34,12 @@ class ShareCrawler(service.MultiService):
     prefix. On this server, each prefixdir took 130ms-200ms to list the first
     time, and 17ms to list the second time.
 
+    If the server has several share directories (one per disk), the crawler
+    walks all of them in step: each prefix is listed on every disk before
+    moving on to the next one, so that all disks are crawled at the same
+    pace, and every disk's share of the work is spread evenly over the
+    cycle rather than being done one disk after another.
+
     To use a crawler, create a subclass which implements the process_bucket()
     method. It will be called with a prefixdir and a base32 storage index
     string. process_bucket() must run synchronously. Any keys added to
@@ -55,8 +62,24 @@ class ShareCrawler(service.MultiService):
     middle of a time slice will lose progress: the next time the node is
     started, the crawler will repeat some unknown amount of work.
 
+    Only the parts of the state which have changed since the last save are
+    written (see allmydata.storage.statefile), so saving after every time
+    slice stays cheap even when the state holds large tables. Subclasses
+    should still keep the state bounded: lists and dicts which grow with the
+    number of shares make every save compare (and every load read) more.
+
     The crawler instance must be started with startService() before it will
     do any work. To make it stop doing work, call stopService().
+
+    If the server keeps a share journal (see allmydata.storage.journal), a
+    crawler whose wants_journal() method returns True can skip most of its
+    work: after its first full cycle, each cycle is 'incremental', and only
+    visits the prefixes and buckets that the journal says have changed since
+    the previous one. A full cycle is still done at least once every
+    'full_scan_interval' seconds, and whenever the journal has lost some of
+    the events that the crawler needed (the journal is bounded in size, and
+    a crash can lose its last few events), to catch anything that the
+    journal missed.
     """
 
     slow_start = 300 # don't start crawling for 5 minutes after startup
@@ -64,6 +87,7 @@ class ShareCrawler(service.MultiService):
     allowed_cpu_percentage = .10 # use up to 10% of the CPU, on average
     cpu_slice = 1.0 # use up to 1.0 seconds before yielding
     minimum_cycle_time = 300 # don't run a cycle faster than this
+    full_scan_interval = 7*24*60*60 # with a journal, crawl everything weekly
 
     def __init__(self, server, statefile, allowed_cpu_percentage=None):
         service.MultiService.__init__(self)
@@ -71,19 +95,27 @@ class ShareCrawler(service.MultiService):
             self.allowed_cpu_percentage = allowed_cpu_percentage
         self.server = server
         self.sharedir = server.sharedir
+        self.sharedirs = server.sharedirs
         self.statefile = statefile
+        self._state_file = StateFile(statefile)
         self.prefixes = [si_b2a(struct.pack(">H", i << (16-10)))[:2]
                          for i in range(2**10)]
         self.prefixes.sort()
         self.timer = None
-        self.bucket_cache = (None, [])
+        self.bucket_cache = (None, [], None)
         self.current_sleep_time = None
         self.next_wake_time = None
         self.last_prefix_finished_time = None
         self.last_prefix_elapsed_time = None
         self.last_cycle_started_time = None
         self.last_cycle_elapsed_time = None
+        self._journal_changes = None # (since, until, prefix -> set(buckets))
         self.load_state()
+        self.journal = None
+        if server.journal is not None and self.wants_journal():
+            self.journal = server.journal
+            self.journal.set_checkpoint(self.statefile,
+                                        self._get_journal_needed())
 
     def minus_or_none(self, a, b):
         if a is None:
@@ -190,11 +222,20 @@ class ShareCrawler(service.MultiService):
         #  ["last-complete-bucket"]: str, base32 storage index bucket name
         #                            of the last bucket to be processed, or
         #                            None if we are sleeping between cycles
-        try:
-            f = open(self.statefile, "rb")
-            state = pickle.load(f)
-            f.close()
-        except Exception:
+        #  ["current-cycle-incremental"]: bool, True if this cycle only
+        #                                 visits the buckets that the share
+        #                                 journal says have changed
+        #  ["last-full-cycle-start-time"]: seconds-since-epoch when the last
+        #                                  (or current) full cycle started,
+        #                                  or None
+        #  ["journal-checkpoint"]: int, the last journal event that was
+        #                          taken into account by the last complete
+        #                          cycle, or None
+        #  ["journal-pending-checkpoint"]: int, the last journal event that
+        #                                  the current cycle takes into
+        #                                  account, or None
+        state = self._state_file.load()
+        if state is None:
             state = {"version": 1,
                      "last-cycle-finished": None,
                      "current-cycle": None,
@@ -202,6 +243,10 @@ class ShareCrawler(service.MultiService):
                      "last-complete-bucket": None,
                      }
         state.setdefault("current-cycle-start-time", time.time()) # approximate
+        state.setdefault("current-cycle-incremental", False)
+        state.setdefault("last-full-cycle-start-time", None)
+        state.setdefault("journal-checkpoint", None)
+        state.setdefault("journal-pending-checkpoint", None)
         self.state = state
         lcp = state["last-complete-prefix"]
         if lcp == None:
@@ -229,11 +274,7 @@ class ShareCrawler(service.MultiService):
         else:
             last_complete_prefix = self.prefixes[lcpi]
         self.state["last-complete-prefix"] = last_complete_prefix
-        tmpfile = self.statefile + ".tmp"
-        f = open(tmpfile, "wb")
-        pickle.dump(self.state, f)
-        f.close()
-        fileutil.move_into_place(tmpfile, self.statefile)
+        self._state_file.save(self.state)
 
     def startService(self):
         # arrange things to look like we were just sleeping, so
@@ -300,24 +341,42 @@ class ShareCrawler(service.MultiService):
                 state["current-cycle"] = 0
             else:
                 state["current-cycle"] = state["last-cycle-finished"] + 1
+            incremental = self.should_be_incremental(
+                self.last_cycle_started_time)
+            state["current-cycle-incremental"] = incremental
+            if not incremental:
+                state["last-full-cycle-start-time"] = \
+                    self.last_cycle_started_time
+            if self.journal is not None:
+                state["journal-pending-checkpoint"] = \
+                    self.journal.get_last_seq()
+                self.journal.set_checkpoint(self.statefile,
+                                            self._get_journal_needed())
             self.started_cycle(state["current-cycle"])
         cycle = state["current-cycle"]
+        self.prepare_cycle(cycle, start_slice)
+        changes = None
+        if state["current-cycle-incremental"]:
+            changes = self.get_journal_changes()
 
         for i in range(self.last_complete_prefix_index+1, len(self.prefixes)):
             # if we want to yield earlier, just raise TimeSliceExceeded()
             prefix = self.prefixes[i]
+            if changes is not None and prefix not in changes:
+                # nothing has happened here since the last cycle
+                self.last_complete_prefix_index = i
+                continue
             prefixdir = os.path.join(self.sharedir, prefix)
-            if i == self.bucket_cache[0]:
-                buckets = self.bucket_cache[1]
+            if i != self.bucket_cache[0]:
+                self.bucket_cache = (i,) + self.list_prefix(prefix)
+            buckets = self.bucket_cache[1]
+            if changes is None:
+                self.process_prefixdir(cycle, prefix, prefixdir,
+                                       buckets, start_slice)
             else:
-                try:
-                    buckets = os.listdir(prefixdir)
-                    buckets.sort()
-                except EnvironmentError:
-                    buckets = []
-                self.bucket_cache = (i, buckets)
-            self.process_prefixdir(cycle, prefix, prefixdir,
-                                   buckets, start_slice)
+                self.process_changed_prefix(cycle, prefix, prefixdir,
+                                            buckets, changes[prefix],
+                                            start_slice)
             self.last_complete_prefix_index = i
 
             now = time.time()
@@ -339,12 +398,92 @@ class ShareCrawler(service.MultiService):
         state["last-complete-bucket"] = None
         state["last-cycle-finished"] = cycle
         state["current-cycle"] = None
+        if self.journal is not None:
+            state["journal-checkpoint"] = state["journal-pending-checkpoint"]
+            self.journal.set_checkpoint(self.statefile,
+                                        self._get_journal_needed())
+        self._journal_changes = None
         self.finished_cycle(cycle)
         self.save_state()
 
+    def _get_journal_needed(self):
+        # the crawler will need every journal event after this one
+        state = self.state
+        if (state["current-cycle"] is not None
+            and not state["current-cycle-incremental"]):
+            return state["journal-pending-checkpoint"]
+        return state["journal-checkpoint"]
+
+    def should_be_incremental(self, now):
+        """Decide whether the cycle which is starting now can be an
+        incremental one."""
+        if self.journal is None:
+            return False
+        checkpoint = self.state["journal-checkpoint"]
+        last_full = self.state["last-full-cycle-start-time"]
+        if checkpoint is None or last_full is None:
+            return False
+        if now - last_full >= self.full_scan_interval:
+            return False
+        if not self.journal.has_since(checkpoint):
+            return False
+        return self.ready_for_incremental_cycle()
+
+    def get_journal_changes(self):
+        """Return a dict mapping each prefix that the current (incremental)
+        cycle must visit to the set of its buckets that have changed. If the
+        journal no longer has the events that are needed, the rest of the
+        cycle becomes a full one, and None is returned."""
+        since = self.state["journal-checkpoint"]
+        until = self.state["journal-pending-checkpoint"]
+        if (self._journal_changes is not None
+            and self._journal_changes[:2] == (since, until)):
+            return self._journal_changes[2]
+        changes = {}
+        try:
+            for (seq, event, si_s, shnum) in self.journal.get_events(since,
+                                                                     until):
+                changes.setdefault(si_s[:2], set()).add(si_s)
+        except JournalTruncated:
+            log.msg("share journal events %d..%d are gone, so %s will finish"
+                    " this cycle with a full crawl" % (since, until, self),
+                    facility="tahoe.storage", level=log.UNUSUAL)
+            self.state["current-cycle-incremental"] = False
+            # and the next cycle will be a full one too, since the prefixes
+            # before this one were only visited if they had changed
+            self.state["last-full-cycle-start-time"] = None
+            return None
+        self._journal_changes = (since, until, changes)
+        return changes
+
+    def list_prefix(self, prefix):
+        """Return a sorted list of the names of the buckets in the given
+        prefix, and a dict which maps each of them to the list of prefixdirs
+        that hold it (or None, if the server has only one share
+        directory)."""
+        if len(self.sharedirs) == 1:
+            try:
+                buckets = os.listdir(os.path.join(self.sharedir, prefix))
+                buckets.sort()
+            except EnvironmentError:
+                buckets = []
+            return (buckets, None)
+        locations = {}
+        for sharedir in self.sharedirs:
+            prefixdir = os.path.join(sharedir, prefix)
+            try:
+                buckets = os.listdir(prefixdir)
+            except EnvironmentError:
+                buckets = []
+            for bucket in buckets:
+                locations.setdefault(bucket, []).append(prefixdir)
+        return (sorted(locations), locations)
+
     def process_prefixdir(self, cycle, prefix, prefixdir, buckets, start_slice):
         """This gets a list of bucket names (i.e. storage index strings,
-        base32-encoded) in sorted order.
+        base32-encoded) in sorted order. If the server has several share
+        directories, this includes the buckets of all of them, and
+        'prefixdir' is the one in the first share directory.
 
         You can override this if your crawler doesn't care about the actual
         shares, for example a crawler which merely keeps track of how many
@@ -354,16 +493,58 @@ class ShareCrawler(service.MultiService):
         method along, and implement process_bucket() instead.
         """
 
+        locations = self.bucket_cache[2]
         for bucket in buckets:
             if bucket <= self.state["last-complete-bucket"]:
                 continue
-            self.process_bucket(cycle, prefix, prefixdir, bucket)
+            if locations is None:
+                self.process_bucket(cycle, prefix, prefixdir, bucket)
+            else:
+                # normally a bucket lives on a single disk, but if it was
+                # ever copied onto more than one, each copy is processed
+                for bucket_prefixdir in locations[bucket]:
+                    self.process_bucket(cycle, prefix, bucket_prefixdir,
+                                        bucket)
             self.state["last-complete-bucket"] = bucket
             if time.time() >= start_slice + self.cpu_slice:
                 raise TimeSliceExceeded()
 
+    def process_changed_prefix(self, cycle, prefix, prefixdir, buckets,
+                               changed, start_slice):
+        """In an incremental cycle, this is called instead of
+        process_prefixdir() for each prefix in which the share journal
+        reports changes. 'buckets' lists every bucket in the prefix, as for
+        process_prefixdir(), and 'changed' is the set of buckets that the
+        journal mentions (some of which may no longer exist).
+
+        By default, process_prefixdir() is called with just the buckets that
+        have changed.
+        """
+        buckets = [b for b in buckets if b in changed]
+        self.process_prefixdir(cycle, prefix, prefixdir, buckets, start_slice)
+
     # the remaining methods are explictly for subclasses to implement.
 
+    def wants_journal(self):
+        """Return True if this crawler can do incremental cycles, using the
+        server's share journal. A crawler which only cares about shares that
+        are created, written, deleted or have their leases changed can do
+        so. One which must see every share each cycle (because, for example,
+        the passage of time is enough to change what it does) cannot.
+
+        This method is for subclasses to override. No upcall is necessary.
+        """
+        return False
+
+    def ready_for_incremental_cycle(self):
+        """Return False if the cycle which is about to start must be a full
+        one, for example because the last cycle did not leave the state
+        that an incremental one would build upon.
+
+        This method is for subclasses to override. No upcall is necessary.
+        """
+        return True
+
     def started_cycle(self, cycle):
         """Notify a subclass that the crawler is about to start a cycle.
 
@@ -371,6 +552,18 @@ class ShareCrawler(service.MultiService):
         """
         pass
 
+    def prepare_cycle(self, cycle, start_slice):
+        """Do any work that must be finished before the current cycle starts
+        crawling buckets. I am called at the start of every time slice of
+        the cycle, so I must remember (in self.state) what I have already
+        done, and return quickly once it is all done. I may raise
+        TimeSliceExceeded (once time.time() >= start_slice+self.cpu_slice)
+        to continue in the next slice.
+
+        This method is for subclasses to override. No upcall is necessary.
+        """
+        pass
+
     def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
         """Examine a single bucket. Subclasses should do whatever they want
         to do to the shares therein, then update self.state as necessary.
@@ -459,6 +652,29 @@ class BucketCountingCrawler(ShareCrawler):
         self.state.setdefault("last-complete-bucket-count", None)
         self.state.setdefault("storage-index-samples", {})
 
+    def wants_journal(self):
+        return True
+
+    def ready_for_incremental_cycle(self):
+        last = self.state["last-cycle-finished"]
+        last_counts = self.state["bucket-counts"].get(last, {})
+        return len(last_counts) == len(self.prefixes)
+
+    def started_cycle(self, cycle):
+        if self.state["current-cycle-incremental"]:
+            # only the prefixes which have changed will be counted again
+            last = self.state["last-cycle-finished"]
+            self.state["bucket-counts"][cycle] = \
+                self.state["bucket-counts"][last].copy()
+            samples = self.state["storage-index-samples"]
+            for prefix, (old_cycle, buckets) in samples.items():
+                samples[prefix] = (cycle, buckets)
+
+    def process_changed_prefix(self, cycle, prefix, prefixdir, buckets,
+                               changed, start_slice):
+        # count every bucket in the prefix again
+        self.process_prefixdir(cycle, prefix, prefixdir, buckets, start_slice)
+
     def process_prefixdir(self, cycle, prefix, prefixdir, buckets, start_slice):
         # we override process_prefixdir() because we don't want to look at
         # the individual buckets. We'll save state after each one. On my
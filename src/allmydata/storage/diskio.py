@@ -0,0 +1,90 @@
+import time
+
+from twisted.application import service
+from twisted.internet import defer, threads
+from twisted.python.threadpool import ThreadPool
+
+class DiskIOPool(service.Service):
+    """I run share-file I/O for a StorageServer on a small pool of threads,
+    so that a slow disk does not stall the reactor (and with it, every other
+    client of the server).
+
+    Each job is submitted with a key, which names the share (or mutable
+    slot) that it touches. Jobs with the same key run one at a time, in the
+    order in which they were submitted, so a client which pipelines several
+    writes and then a close for the same share sees them applied in order.
+    Jobs with different keys run in parallel, up to 'max_threads' at a time.
+
+    The job functions run in a worker thread, so they must only do file I/O:
+    anything that touches server state which is shared with the reactor
+    thread (the lease database, the share inventory, the latency records)
+    must be done in a callback on the returned Deferred.
+
+    If 'observer' is provided, it is called (in the reactor thread) as
+    observer(category, value) with the 'io-queue-depth' (the number of
+    unfinished jobs) each time a job is submitted, and with the 'io-wait'
+    time (how long it waited before a thread picked it up) each time a job
+    finishes.
+    """
+
+    max_threads = 4
+
+    def __init__(self, max_threads=None, observer=None, reactor=None):
+        if max_threads is not None:
+            self.max_threads = max_threads
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._observer = observer
+        self._pool = ThreadPool(1, self.max_threads, name="storage-diskio")
+        self._queues = {} # key -> list of jobs, the first of which is running
+        self._unfinished = 0
+
+    def startService(self):
+        service.Service.startService(self)
+        self._pool.start()
+
+    def stopService(self):
+        self._pool.stop()
+        return service.Service.stopService(self)
+
+    def _observe(self, category, value):
+        if self._observer:
+            self._observer(category, value)
+
+    def run(self, key, f, *args, **kwargs):
+        """Run f(*args, **kwargs) in a worker thread, after all previously
+        submitted jobs with the same key have finished. Return a Deferred
+        that fires (in the reactor thread) with its result."""
+        d = defer.Deferred()
+        q = self._queues.setdefault(key, [])
+        q.append((f, args, kwargs, d, time.time()))
+        self._unfinished += 1
+        self._observe("io-queue-depth", self._unfinished)
+        if len(q) == 1:
+            self._start(key)
+        return d
+
+    def _start(self, key):
+        (f, args, kwargs, d, queued_at) = self._queues[key][0]
+        started = []
+        def _work():
+            started.append(time.time())
+            return f(*args, **kwargs)
+        d2 = threads.deferToThreadPool(self._reactor, self._pool, _work)
+        def _finished(res):
+            self._unfinished -= 1
+            if started:
+                self._observe("io-wait", started[0] - queued_at)
+            q = self._queues[key]
+            q.pop(0)
+            if q:
+                self._start(key)
+            else:
+                del self._queues[key]
+            return res
+        d2.addBoth(_finished)
+        d2.chainDeferred(d)
+
+    def get_queue_depth(self):
+        return self._unfinished
@@ -0,0 +1,172 @@
+import os, itertools
+from collections import OrderedDict
+
+from allmydata.storage.common import storage_index_to_dir
+from allmydata.storage.space import SpaceAccountant
+
+PLACEMENT_POLICIES = ("most-free", "round-robin")
+
+class ShareDisks(object):
+    """I manage the share directories of a StorageServer which spreads its
+    shares over several disks (JBOD), so that one node (with one tub and
+    one announcement) can use all of them.
+
+    Every share directory has the usual layout (prefix and bucket
+    directories, plus an incoming/ directory for uploads in progress), and
+    all of the shares of a given storage index live in the same one. New
+    buckets are placed according to 'placement': 'most-free' puts them on
+    the disk with the most remaining space, and 'round-robin' takes each
+    disk in turn, skipping any that are too full.
+
+    locate() answers "which disk holds this bucket" from an in-memory
+    index, filled by probing each disk the first time a storage index is
+    asked about. Buckets which we do not hold are remembered too, so most
+    DYHB queries for other servers' files cost nothing. At most
+    'max_buckets' storage indexes are remembered, least-recently-used
+    first. As with the share inventory, buckets which are copied onto a
+    disk behind the server's back may not be noticed until the node is
+    restarted.
+
+    Each disk has its own SpaceAccountant, created with 'reserved_space',
+    'readonly' and the space cache parameters.
+
+    With a single share directory, no index is kept: every bucket is on
+    disk 0.
+    """
+
+    max_buckets = 100000
+
+    def __init__(self, sharedirs, placement="most-free", reserved_space=0,
+                 readonly=False, max_age=0, max_delta=None,
+                 max_buckets=None):
+        if placement not in PLACEMENT_POLICIES:
+            raise ValueError("share placement policy '%s' must be one of %s"
+                             % (placement, ", ".join(PLACEMENT_POLICIES)))
+        self.sharedirs = list(sharedirs)
+        self.incomingdirs = [os.path.join(d, "incoming")
+                             for d in self.sharedirs]
+        self.placement = placement
+        if max_buckets is not None:
+            self.max_buckets = max_buckets
+        self.spaces = [SpaceAccountant(d, reserved_space, readonly,
+                                       max_age, max_delta)
+                       for d in self.sharedirs]
+        self._index = OrderedDict() # storage_index -> disk number, or None
+        self._next_disk = itertools.cycle(range(len(self.sharedirs)))
+
+    def is_single(self):
+        return len(self.sharedirs) == 1
+
+    def locate(self, storage_index):
+        """Return the number of the disk which holds the bucket for
+        'storage_index', or None if no disk does."""
+        if self.is_single():
+            return 0
+        if storage_index in self._index:
+            disknum = self._index.pop(storage_index)
+        else:
+            si_dir = storage_index_to_dir(storage_index)
+            disknum = None
+            for i, sharedir in enumerate(self.sharedirs):
+                if os.path.isdir(os.path.join(sharedir, si_dir)):
+                    disknum = i
+                    break
+        self._remember(storage_index, disknum)
+        return disknum
+
+    def _remember(self, storage_index, disknum):
+        # (re)insert at the most-recently-used end
+        self._index.pop(storage_index, None)
+        self._index[storage_index] = disknum
+        while len(self._index) > self.max_buckets:
+            self._index.popitem(last=False)
+
+    def add_bucket(self, storage_index, disknum):
+        """Note that a bucket directory for 'storage_index' has been created
+        on the given disk."""
+        if not self.is_single():
+            self._remember(storage_index, disknum)
+
+    def get_bucket_dir(self, storage_index):
+        """Return the pathname of the bucket directory for 'storage_index',
+        or None if we do not hold it."""
+        disknum = self.locate(storage_index)
+        if disknum is None:
+            return None
+        return os.path.join(self.sharedirs[disknum],
+                            storage_index_to_dir(storage_index))
+
+    def place(self, storage_index, size=0):
+        """Return the number of the disk on which new shares for
+        'storage_index' (each of which will need 'size' bytes) should be
+        written: the one which already holds the bucket, if any, or else
+        one chosen by the placement policy."""
+        disknum = self.locate(storage_index)
+        if disknum is not None:
+            return disknum
+        if self.placement == "round-robin":
+            for i in range(len(self.sharedirs)):
+                disknum = self._next_disk.next()
+                remaining = self.get_remaining_space(disknum)
+                if remaining is None or remaining >= size:
+                    return disknum
+            # they are all too full, so the allocation will be refused
+            return disknum
+        assert self.placement == "most-free"
+        best = None
+        for disknum in range(len(self.sharedirs)):
+            remaining = self.get_remaining_space(disknum)
+            if remaining is None:
+                # no way to tell, so treat it as infinite
+                return disknum
+            if best is None or remaining > best[0]:
+                best = (remaining, disknum)
+        return best[1]
+
+    # space accounting
+
+    def get_remaining_space(self, disknum):
+        return self.spaces[disknum].get_remaining_space()
+
+    def get_available_space(self):
+        """Return the total free space on all disks (less the reserved
+        space on each), or None if it cannot be determined."""
+        total = 0
+        for space in self.spaces:
+            avail = space.get_available_space()
+            if avail is None:
+                return None
+            total += avail
+        return total
+
+    def get_largest_available_space(self):
+        """Return the most space that a single share could use, or None if
+        it cannot be determined."""
+        largest = 0
+        for space in self.spaces:
+            avail = space.get_available_space()
+            if avail is None:
+                return None
+            largest = max(largest, avail)
+        return largest
+
+    def get_reserved(self):
+        return sum([space.get_reserved() for space in self.spaces])
+
+    def reserve(self, disknum, owner, size):
+        self.spaces[disknum].reserve(owner, size)
+
+    def release(self, owner):
+        """Give back the space reserved for 'owner', and return the number
+        of the disk it was on (or None)."""
+        for disknum, space in enumerate(self.spaces):
+            if space.has_reservation(owner):
+                space.release(owner)
+                return disknum
+        return None
+
+    def consumed(self, disknum, size):
+        self.spaces[disknum].consumed(size)
+
+    def is_caching(self):
+        return self.spaces[0].is_caching()
@@ -0,0 +1,147 @@
+import threading, time
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+from allmydata.util import fileutil
+
+CLOSE_SYNC_POLICIES = ("none", "fsync", "group")
+
+class CloseSyncer(object):
+    """I make closed immutable shares durable before the close is
+    acknowledged, according to a StorageServer's [storage]close_sync policy.
+
+    With the 'none' policy, the server does not use me at all: a closed
+    share is moved into place and left for the operating system to write
+    out whenever it likes, so a crash soon after an upload can lose shares
+    that the client thinks are safe.
+
+    With 'fsync', each BucketWriter does it all by itself when it is closed:
+    the share data is fsync()ed, the share is moved into place, and then the
+    directories (or, for a packed share, the pack and its index) that now
+    hold it are fsync()ed too. That is three synchronous disk writes per
+    share.
+
+    With 'group', closes are collected for up to 'window' seconds (or until
+    'max_batch' of them are waiting), and then moved into place together.
+    Each directory and pack file that they landed in is fsync()ed once for
+    the whole batch, so a burst of small uploads (most of which land in the
+    same few pack files, or in the same incoming and prefix directories)
+    shares a handful of fsync() calls. The data of each non-packed share is
+    still fsync()ed separately, before its close joins a batch, so that it
+    is never moved into place before it is safely on disk.
+
+    If 'diskio' (a DiskIOPool) is provided, batches are committed in its
+    threads. If 'observer' is provided, it is called (in the reactor thread)
+    as observer(category, value) with the time taken by the fsync() calls of
+    each batch ('sync') and with the number of closes in it
+    ('sync-batch-size').
+    """
+
+    window = 0.005 # seconds
+    max_batch = 100
+
+    def __init__(self, policy, window=None, max_batch=None, diskio=None,
+                 observer=None, reactor=None):
+        if policy not in CLOSE_SYNC_POLICIES:
+            raise ValueError("close_sync policy '%s' must be one of %s"
+                             % (policy, ", ".join(CLOSE_SYNC_POLICIES)))
+        self.policy = policy
+        if window is not None:
+            self.window = window
+        if max_batch is not None:
+            self.max_batch = max_batch
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._diskio = diskio
+        self._observer = observer
+        self._pending = [] # (BucketWriter, Deferred)
+        self._timer = None
+        self._lock = threading.Lock()
+        self.closes = 0
+        self.batches = 0
+        self.fsyncs = 0
+
+    def is_grouped(self):
+        return self.policy == "group"
+
+    def _observe(self, category, value):
+        if self._observer:
+            self._observer(category, value)
+
+    def sync_paths(self, paths):
+        """fsync() each of the given files and directories, and return the
+        time that took. This may be called from any thread."""
+        start = time.time()
+        for path in sorted(paths):
+            fileutil.fsync_path(path)
+        with self._lock:
+            self.fsyncs += len(paths)
+        return time.time() - start
+
+    def add(self, bw):
+        """Queue a BucketWriter, whose share data has already been synced,
+        to be moved into place by the next batch. Return a Deferred that
+        fires with the size of the share once that batch has been made
+        durable."""
+        d = defer.Deferred()
+        self._pending.append((bw, d))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = self._reactor.callLater(self.window, self._flush)
+        return d
+
+    def _flush(self):
+        if self._timer is not None:
+            if self._timer.active():
+                self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        writers = [bw for (bw, d) in batch]
+        if self._diskio is not None:
+            d = self._diskio.run("close-sync", self.commit, writers)
+        else:
+            d = defer.maybeDeferred(self.commit, writers)
+        def _committed(res):
+            (results, elapsed) = res
+            self._observe("sync", elapsed)
+            self._observe("sync-batch-size", len(batch))
+            for (bw, bw_d), (ok, res) in zip(batch, results):
+                if ok:
+                    bw_d.callback(res)
+                else:
+                    bw_d.errback(res)
+        def _failed(f):
+            # the fsync() calls failed, so none of them are durable
+            for (bw, bw_d) in batch:
+                bw_d.errback(f)
+        d.addCallbacks(_committed, _failed)
+
+    def commit(self, writers):
+        """Move the shares of the given BucketWriters into place, and fsync()
+        everything that holds them. Return a list with an (ok, size or
+        Failure) tuple for each writer, and the time spent in fsync(). This
+        may be called from any thread."""
+        results = []
+        paths = set()
+        for bw in writers:
+            try:
+                filelen = bw.move_files()
+                paths.update(bw.get_sync_paths())
+                results.append((True, filelen))
+            except Exception:
+                results.append((False, Failure()))
+        elapsed = self.sync_paths(paths)
+        with self._lock:
+            self.closes += len(writers)
+            self.batches += 1
+        return (results, elapsed)
+
+    def get_stats(self):
+        with self._lock:
+            return {"closes": self.closes,
+                    "batches": self.batches,
+                    "fsyncs": self.fsyncs,
+                    }
@@ -1,10 +1,20 @@
-import time, os, pickle, struct
-from allmydata.storage.crawler import ShareCrawler
+import time, os, copy, struct
+from allmydata.storage.crawler import ShareCrawler, TimeSliceExceeded
+from allmydata.storage.statefile import StateFile
 from allmydata.storage.shares import get_share_file
+from allmydata.storage.packs import RECORD_HEADER_SIZE
 from allmydata.storage.common import UnknownMutableContainerVersionError, \
-     UnknownImmutableContainerVersionError
+     UnknownImmutableContainerVersionError, si_a2b
 from twisted.python import log as twlog
 
+class PackedShareStat(object):
+    """I stand in for the os.stat() result of a packed share, which has no
+    file of its own."""
+    def __init__(self, size):
+        self.st_size = size
+        # the record, rounded up to whole blocks
+        self.st_blocks = (size + RECORD_HEADER_SIZE + 511) // 512
+
 class LeaseCheckingCrawler(ShareCrawler):
     """I examine the leases on all shares, determining which are still valid
     and which have expired. I can remove the expired leases (if so
@@ -25,28 +35,43 @@ class LeaseCheckingCrawler(ShareCrawler):
     Prediction of space that will be recovered during the rest of this cycle
     Prediction of space that will be recovered by the entire current cycle.
 
-    Space recovered during the last 10 cycles  <-- saved in separate pickle
+    Space recovered during the last 10 cycles  <-- saved in separate history file
 
     Shares/buckets examined:
      this cycle-so-far
      prediction of rest of cycle
-     during last 10 cycles <-- separate pickle
-    start/finish time of last 10 cycles  <-- separate pickle
-    expiration time used for last 10 cycles <-- separate pickle
+     during last 10 cycles <-- separate history file
+    start/finish time of last 10 cycles  <-- separate history file
+    expiration time used for last 10 cycles <-- separate history file
 
     Histogram of leases-per-share:
      this-cycle-to-date
-     last 10 cycles <-- separate pickle
+     last 10 cycles <-- separate history file
     Histogram of lease ages, buckets = 1day
      cycle-to-date
-     last 10 cycles <-- separate pickle
+     last 10 cycles <-- separate history file
 
     All cycle-to-date values remain valid until the start of the next cycle.
 
+    If the server has a lease database, I use it instead of the lease records
+    in the share files. At the start of each cycle, expired leases are found
+    with a range scan over its expiration-time index (see
+    expire_from_leasedb), so shares are deleted promptly rather than when
+    the crawl happens to reach them. They are cancelled 'expire_batch_size'
+    at a time, one database transaction per batch, within the crawler's
+    usual time slices, so a large backlog of expired leases is worked off
+    over several slices. The crawl itself then only gathers
+    statistics, and migrates any buckets that the database has not yet seen.
+    If the server also keeps a share journal, most cycles are incremental:
+    they only visit the buckets that have changed, so their statistics
+    describe just those buckets (the history records which cycles were
+    incremental).
+
     """
 
     slow_start = 360 # wait 6 minutes after startup
     minimum_cycle_time = 12*60*60 # not more than twice per day
+    expire_batch_size = 100 # leases cancelled per database transaction
 
     def __init__(self, server, statefile, historyfile,
                  expiration_enabled, mode,
@@ -54,6 +79,7 @@ class LeaseCheckingCrawler(ShareCrawler):
                  cutoff_date, # used if expiration_mode=="cutoff-date"
                  sharetypes):
         self.historyfile = historyfile
+        self._history_file = StateFile(historyfile)
         self.expiration_enabled = expiration_enabled
         self.mode = mode
         self.override_lease_duration = None
@@ -80,13 +106,17 @@ class LeaseCheckingCrawler(ShareCrawler):
         # the keys individually
         for k in so_far:
             self.state["cycle-to-date"].setdefault(k, so_far[k])
-
-        # initialize history
-        if not os.path.exists(self.historyfile):
-            history = {} # cyclenum -> dict
-            f = open(self.historyfile, "wb")
-            pickle.dump(history, f)
-            f.close()
+        # the time at which the current cycle started expiring leases from
+        # the lease database, or None once it has finished
+        self.state.setdefault("expiring-as-of", None)
+
+        # initialize history. Only the newest cycle is written when it is
+        # added, and the file is compacted now and then, so it stays about
+        # the size of the ten cycles that it holds.
+        self.history = self._history_file.load() # cyclenum -> dict
+        if self.history is None:
+            self.history = {}
+            self._history_file.save(self.history)
 
     def create_empty_cycle_dict(self):
         recovered = self.create_empty_recovered_dict()
@@ -106,8 +136,96 @@ class LeaseCheckingCrawler(ShareCrawler):
                 recovered[a+"-"+b+"-immutable"] = 0
         return recovered
 
+    def wants_journal(self):
+        # without the lease database, leases can only be expired by looking
+        # at every share
+        return self.server.leasedb is not None
+
     def started_cycle(self, cycle):
         self.state["cycle-to-date"] = self.create_empty_cycle_dict()
+        if self.expiration_enabled and self.server.leasedb is not None:
+            self.state["expiring-as-of"] = time.time()
+
+    def prepare_cycle(self, cycle, start_slice):
+        now = self.state["expiring-as-of"]
+        if now is None:
+            return
+        while True:
+            expired = self.expire_from_leasedb(now, self.expire_batch_size)
+            if time.time() >= start_slice + self.cpu_slice:
+                raise TimeSliceExceeded()
+            if not expired:
+                break
+        if self.server.packs is not None:
+            # reclaim the space of the packed shares that just expired
+            self.server.packs.compact()
+        self.state["expiring-as-of"] = None
+
+    def get_expiration_cutoff(self, now):
+        """Return the time T such that, according to our configured policy,
+        a lease is expired if and only if its expiration time is less than
+        T. This lets the lease database answer 'what has expired' with an
+        index range scan."""
+        # leases are granted for 31 days, see LeaseInfo.get_grant_renew_time
+        lease_duration = 31*24*60*60
+        if self.mode == "age":
+            if self.override_lease_duration is not None:
+                # now - (exp - duration) > override
+                return now + lease_duration - self.override_lease_duration
+            # process_share() compares the age against the original
+            # expiration time: now - (exp - duration) > exp
+            return (now + lease_duration) / 2.0
+        assert self.mode == "cutoff-date"
+        # exp - duration < cutoff_date
+        return self.cutoff_date + lease_duration
+
+    def expire_from_leasedb(self, now, limit=None):
+        """Cancel the leases that the lease database says had expired at
+        'now' (no more than 'limit' of them, if given), and delete the
+        shares that are left without any leases. The leases are cancelled
+        in a single transaction, and the shares are only deleted once it
+        has been committed. Return the number of leases cancelled."""
+        leasedb = self.server.leasedb
+        cutoff = self.get_expiration_cutoff(now)
+        expiring = list(leasedb.get_expiring_leases(cutoff,
+                                                    self.sharetypes_to_expire,
+                                                    limit))
+        removed = [] # (si_s, shnum, sharefile or None if packed)
+        for (si_s, shnum, li) in expiring:
+            bucketdir = self.server.disks.get_bucket_dir(si_a2b(si_s))
+            if bucketdir is None:
+                bucketdir = os.path.join(self.sharedir, si_s[:2], si_s)
+            sharefile = os.path.join(bucketdir, str(shnum))
+            try:
+                remaining = leasedb.cancel_lease(si_s, shnum, li.cancel_secret,
+                                                 commit=False)
+            except IndexError:
+                continue # already cancelled along with an earlier lease
+            if remaining:
+                continue
+            sharetype = leasedb.get_shares(si_s).get(shnum)
+            leasedb.remove_share(si_s, shnum, commit=False)
+            packs = self.server.packs
+            if packs is not None and packs.has_share(si_a2b(si_s), shnum):
+                s = PackedShareStat(packs.get_share_size(si_a2b(si_s), shnum))
+                sharefile = None
+            else:
+                try:
+                    s = self.stat(sharefile)
+                except EnvironmentError:
+                    continue # already gone from disk
+            if li.get_expiration_time() < now:
+                self.increment_space("original", s, sharetype)
+            self.increment_space("configured", s, sharetype)
+            self.increment_space("actual", s, sharetype)
+            removed.append((si_s, shnum, sharefile))
+        leasedb.commit()
+        for (si_s, shnum, sharefile) in removed:
+            if sharefile is not None:
+                self._close_handle(sharefile)
+                os.unlink(sharefile)
+            self.server.share_removed(si_a2b(si_s), shnum)
+        return len(expiring)
 
     def stat(self, fn):
         return os.stat(fn)
@@ -118,6 +236,10 @@ class LeaseCheckingCrawler(ShareCrawler):
         would_keep_shares = []
         wks = None
 
+        if self.server.leasedb is not None:
+            # migrate any shares that the lease database has not yet seen
+            self.server._sync_leasedb(si_a2b(storage_index_b32))
+
         for fn in os.listdir(bucketdir):
             try:
                 shnum = int(fn)
@@ -125,7 +247,11 @@ class LeaseCheckingCrawler(ShareCrawler):
                 continue # non-numeric means not a sharefile
             sharefile = os.path.join(bucketdir, fn)
             try:
-                wks = self.process_share(sharefile)
+                if self.server.leasedb is not None:
+                    wks = self.process_share_with_leasedb(storage_index_b32,
+                                                          shnum, sharefile)
+                else:
+                    wks = self.process_share(sharefile)
             except (UnknownMutableContainerVersionError,
                     UnknownImmutableContainerVersionError,
                     struct.error):
@@ -159,8 +285,43 @@ class LeaseCheckingCrawler(ShareCrawler):
 
     def process_share(self, sharefilename):
         # first, find out what kind of a share it is
-        sf = get_share_file(sharefilename)
-        sharetype = sf.sharetype
+        sf = get_share_file(sharefilename, handles=self.server.handles)
+        def cancel_lease(cancel_secret):
+            sf.cancel_lease(cancel_secret)
+            # the share file is deleted along with its last lease
+            if not os.path.exists(sharefilename):
+                self._share_deleted(sharefilename)
+        return self._process_leases(sharefilename, sf.sharetype,
+                                    sf.get_leases(), cancel_lease)
+
+    def _close_handle(self, sharefilename):
+        # the server may be holding the share open for reads, which would
+        # stop us from deleting it on windows
+        if self.server.handles is not None:
+            self.server.handles.invalidate(sharefilename)
+
+    def _share_deleted(self, sharefilename):
+        (bucketdir, shnum_s) = os.path.split(sharefilename)
+        storage_index_b32 = os.path.basename(bucketdir)
+        self.server.share_removed(si_a2b(storage_index_b32), int(shnum_s))
+
+    def process_share_with_leasedb(self, si_s, shnum, sharefilename):
+        leasedb = self.server.leasedb
+        sharetype = leasedb.get_shares(si_s).get(shnum)
+        if sharetype is None:
+            # it is not a share that _sync_leasedb could recognize
+            sharetype = get_share_file(sharefilename).sharetype
+        def cancel_lease(cancel_secret):
+            if not leasedb.cancel_lease(si_s, shnum, cancel_secret):
+                leasedb.remove_share(si_s, shnum)
+                self._close_handle(sharefilename)
+                os.unlink(sharefilename)
+                self._share_deleted(sharefilename)
+        return self._process_leases(sharefilename, sharetype,
+                                    leasedb.get_leases(si_s, shnum),
+                                    cancel_lease)
+
+    def _process_leases(self, sharefilename, sharetype, leases, cancel_lease):
         now = time.time()
         s = self.stat(sharefilename)
 
@@ -169,7 +330,7 @@ class LeaseCheckingCrawler(ShareCrawler):
         num_valid_leases_configured = 0
         expired_leases_configured = []
 
-        for li in sf.get_leases():
+        for li in leases:
             num_leases += 1
             original_expiration_time = li.get_expiration_time()
             grant_renew_time = li.get_grant_renew_time_time()
@@ -208,7 +369,7 @@ class LeaseCheckingCrawler(ShareCrawler):
 
         if self.expiration_enabled:
             for li in expired_leases_configured:
-                sf.cancel_lease(li.cancel_secret)
+                cancel_lease(li.cancel_secret)
 
         if num_valid_leases_original == 0:
             would_keep_share[0] = 0
@@ -282,6 +443,7 @@ class LeaseCheckingCrawler(ShareCrawler):
         now = time.time()
         h["cycle-start-finish-times"] = (start, now)
         h["expiration-enabled"] = self.expiration_enabled
+        h["incremental"] = self.state["current-cycle-incremental"]
         h["configured-expiration-mode"] = (self.mode,
                                            self.override_lease_duration,
                                            self.cutoff_date,
@@ -303,14 +465,12 @@ class LeaseCheckingCrawler(ShareCrawler):
         # copy() needs to become a deepcopy
         h["space-recovered"] = s["space-recovered"].copy()
 
-        history = pickle.load(open(self.historyfile, "rb"))
+        history = self.history
         history[cycle] = h
         while len(history) > 10:
             oldcycles = sorted(history.keys())
             del history[oldcycles[0]]
-        f = open(self.historyfile, "wb")
-        pickle.dump(history, f)
-        f.close()
+        self._history_file.save(history)
 
     def get_state(self):
         """In addition to the crawler state described in
@@ -343,6 +503,7 @@ class LeaseCheckingCrawler(ShareCrawler):
          history: maps cyclenum to a dict with the following keys:
           cycle-start-finish-times
           expiration-enabled
+          incremental (True if only changed buckets were visited)
           configured-expiration-mode
           lease-age-histogram
           leases-per-share-histogram
@@ -379,8 +540,7 @@ class LeaseCheckingCrawler(ShareCrawler):
         progress = self.get_progress()
 
         state = ShareCrawler.get_state(self) # does a shallow copy
-        history = pickle.load(open(self.historyfile, "rb"))
-        state["history"] = history
+        state["history"] = copy.deepcopy(self.history)
 
         if not progress["cycle-in-progress"]:
             del state["cycle-to-date"]
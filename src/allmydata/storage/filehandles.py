@@ -0,0 +1,111 @@
+import threading
+from collections import OrderedDict
+
+class FileHandleCache(object):
+    """I keep share files open for reading, so that a client which streams
+    a large file out of a StorageServer (one remote_read() or slot_readv()
+    per segment) does not cost an open() and close() per request.
+
+    Handles are keyed by share file pathname and opened read-only and
+    unbuffered, so reads always see data written through other handles.
+    Readers check a handle out with get() and hand it back with release(),
+    so a handle is never shared by two readers, and never closed while it is
+    in use. At most 'max_handles' idle files are kept open, and the
+    least-recently-used ones are closed first. All methods may be called
+    from any thread.
+
+    Code which deletes a share file, or moves data around inside it (lease
+    truncation, resizing a mutable container), must call invalidate() first.
+    ShareFile and MutableShareFile do this themselves. Share files which are
+    replaced behind the server's back will not be noticed while their handle
+    stays cached.
+    """
+
+    max_handles = 64
+
+    def __init__(self, max_handles=None):
+        if max_handles is not None:
+            self.max_handles = max_handles
+        self._lock = threading.Lock()
+        self._handles = OrderedDict() # pathname -> idle file
+        self._in_use = {} # pathname -> number of checked-out handles
+        self._stale = set() # checked-out pathnames invalidated since
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, filename):
+        """Return an open read-only file object for 'filename'. The caller
+        must seek before reading, and must pass it to release() when done
+        instead of closing it."""
+        with self._lock:
+            f = self._handles.pop(filename, None)
+            if f is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            self._in_use[filename] = self._in_use.get(filename, 0) + 1
+        if f is None:
+            try:
+                f = open(filename, 'rb', 0)
+            except EnvironmentError:
+                with self._lock:
+                    self._checked_in(filename)
+                raise
+        return f
+
+    def _checked_in(self, filename):
+        # must be called with the lock held. Returns True if the share was
+        # invalidated while this handle was checked out.
+        self._in_use[filename] -= 1
+        stale = filename in self._stale
+        if not self._in_use[filename]:
+            del self._in_use[filename]
+            self._stale.discard(filename)
+        return stale
+
+    def release(self, filename, f):
+        """Return a handle that was obtained from get()."""
+        doomed = [f]
+        with self._lock:
+            stale = self._checked_in(filename)
+            if not stale and filename not in self._handles:
+                doomed = []
+                # (re)insert at the most-recently-used end
+                self._handles[filename] = f
+                while len(self._handles) > self.max_handles:
+                    (ign, old) = self._handles.popitem(last=False)
+                    doomed.append(old)
+                    self.evictions += 1
+        for old in doomed:
+            old.close()
+
+    def invalidate(self, filename):
+        """Close the cached handle for 'filename', if there is one. Handles
+        which are checked out will be closed when they are released."""
+        with self._lock:
+            f = self._handles.pop(filename, None)
+            if filename in self._in_use:
+                self._stale.add(filename)
+            if f is not None:
+                self.invalidations += 1
+        if f is not None:
+            f.close()
+
+    def close_all(self):
+        with self._lock:
+            doomed = self._handles.values()
+            self._handles.clear()
+        for f in doomed:
+            f.close()
+
+    def get_stats(self):
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "invalidations": self.invalidations,
+                    "open_handles": (len(self._handles)
+                                     + sum(self._in_use.values())),
+                    }
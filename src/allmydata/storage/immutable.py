@@ -1,12 +1,14 @@
 import os, stat, struct, time
 
 from foolscap.api import Referenceable
+from twisted.internet import defer
 
 from zope.interface import implementer
 from allmydata.interfaces import RIBucketWriter, RIBucketReader
 from allmydata.util import base32, fileutil, log
 from allmydata.util.assertutil import precondition
 from allmydata.util.hashutil import timing_safe_compare
+from allmydata.util.spans import Spans
 from allmydata.storage.lease import LeaseInfo
 from allmydata.storage.common import UnknownImmutableContainerVersionError, \
      DataTooLargeError
@@ -40,11 +42,12 @@ class ShareFile:
     LEASE_SIZE = struct.calcsize(">L32s32sL")
     sharetype = "immutable"
 
-    def __init__(self, filename, max_size=None, create=False):
-        """ If max_size is not None then I won't allow more than max_size to be written to me. If create=True and max_size must not be None. """
+    def __init__(self, filename, max_size=None, create=False, handles=None):
+        """ If max_size is not None then I won't allow more than max_size to be written to me. If create=True and max_size must not be None. If handles (a FileHandleCache) is provided, reads will use its open handles. """
         precondition((max_size is not None) or (not create), max_size, create)
         self.home = filename
         self._max_size = max_size
+        self._handles = handles
         if create:
             # touch the file, so later callers will see that we're working on
             # it. Also construct the metadata.
@@ -65,10 +68,11 @@ class ShareFile:
             self._lease_offset = max_size + 0x0c
             self._num_leases = 0
         else:
-            f = open(self.home, 'rb')
+            f = self._open_for_reading()
             filesize = os.path.getsize(self.home)
+            f.seek(0)
             (version, unused, num_leases) = struct.unpack(">LLL", f.read(0xc))
-            f.close()
+            self._done_reading(f)
             if version != 1:
                 msg = "sharefile %s had version %d but we wanted 1" % \
                       (filename, version)
@@ -77,7 +81,23 @@ class ShareFile:
             self._lease_offset = filesize - (num_leases * self.LEASE_SIZE)
         self._data_offset = 0xc
 
+    def _open_for_reading(self):
+        if self._handles is not None:
+            return self._handles.get(self.home)
+        return open(self.home, 'rb')
+
+    def _done_reading(self, f):
+        if self._handles is not None:
+            self._handles.release(self.home, f)
+        else:
+            f.close()
+
+    def _invalidate_handle(self):
+        if self._handles is not None:
+            self._handles.invalidate(self.home)
+
     def unlink(self):
+        self._invalidate_handle()
         os.unlink(self.home)
 
     def read_share_data(self, offset, length):
@@ -88,9 +108,12 @@ class ShareFile:
         actuallength = max(0, min(length, self._lease_offset-seekpos))
         if actuallength == 0:
             return ""
-        f = open(self.home, 'rb')
-        f.seek(seekpos)
-        return f.read(actuallength)
+        f = self._open_for_reading()
+        try:
+            f.seek(seekpos)
+            return f.read(actuallength)
+        finally:
+            self._done_reading(f)
 
     def write_share_data(self, offset, data):
         length = len(data)
@@ -120,6 +143,7 @@ class ShareFile:
         f.write(struct.pack(">L", num_leases))
 
     def _truncate_leases(self, f, num_leases):
+        self._invalidate_handle()
         f.truncate(self._lease_offset + num_leases * self.LEASE_SIZE)
 
     def get_leases(self):
@@ -197,15 +221,35 @@ class ShareFile:
 @implementer(RIBucketWriter)
 class BucketWriter(Referenceable):
 
-    def __init__(self, ss, incominghome, finalhome, max_size, lease_info, canary):
+    def __init__(self, ss, incominghome, finalhome, max_size, lease_info, canary,
+                 storage_index=None, shnum=None, diskio=None, packs=None,
+                 syncer=None, suspender=None):
         self.ss = ss
         self.incominghome = incominghome
         self.finalhome = finalhome
+        self.storage_index = storage_index
+        self.shnum = shnum
+        self._lease_info = lease_info
         self._max_size = max_size # don't allow the client to write more than this
         self._canary = canary
         self._disconnect_marker = canary.notifyOnDisconnect(self._disconnected)
         self.closed = False
         self.throw_out_all_data = False
+        # if diskio (a DiskIOPool) is provided, file I/O for writes, close,
+        # and abort is done in its threads, in the order it was requested
+        self._diskio = diskio
+        # if packs (a PackStore) is provided, the finished share is appended
+        # to a pack file instead of being moved to finalhome
+        self._packs = packs
+        self.packed = packs is not None
+        # if syncer (a CloseSyncer) is provided, the share is made durable
+        # before the close is acknowledged
+        self._syncer = syncer
+        self._sync_time = None
+        # if suspender (a SuspendedUploads) is provided, losing the client's
+        # connection suspends the upload rather than aborting it
+        self._suspender = suspender
+        self._written = Spans()
         self._sharefile = ShareFile(incominghome, create=True, max_size=max_size)
         # also, add our lease to the file now, so that other ones can be
         # added by simultaneous uploaders
@@ -214,19 +258,89 @@ class BucketWriter(Referenceable):
     def allocated_size(self):
         return self._max_size
 
+    def get_lease_info(self):
+        return self._lease_info
+
     def remote_write(self, offset, data):
         start = time.time()
         precondition(not self.closed)
         if self.throw_out_all_data:
             return
+        def _written(res):
+            self._written.add(offset, len(data))
+            self.ss.add_latency("write", time.time() - start)
+            self.ss.count("write")
+        if self._diskio is not None:
+            d = self._diskio.run(self.incominghome,
+                                 self._sharefile.write_share_data, offset, data)
+            d.addCallback(_written)
+            return d
         self._sharefile.write_share_data(offset, data)
-        self.ss.add_latency("write", time.time() - start)
-        self.ss.count("write")
+        _written(None)
+
+    def get_written_size(self):
+        """Return how many bytes at the start of the share have been
+        written."""
+        for (start, length) in self._written:
+            if start == 0:
+                return length
+            break
+        return 0
+
+    def remote_get_written_size(self):
+        return self.get_written_size()
 
     def remote_close(self):
         precondition(not self.closed)
         start = time.time()
-
+        if self._syncer is not None and self._syncer.is_grouped():
+            # the share is moved into place by a batch of closes, which
+            # share their fsync() calls
+            self.closed = True
+            if self._diskio is not None:
+                d = self._diskio.run(self.incominghome, self._sync_data)
+            else:
+                d = defer.maybeDeferred(self._sync_data)
+            d.addCallback(lambda ign: self._syncer.add(self))
+            d.addCallback(self._closed, start)
+            return d
+        if self._diskio is not None:
+            # refuse any further writes, and ignore a disconnect: the close
+            # will be finished once the earlier writes have landed
+            self.closed = True
+            d = self._diskio.run(self.incominghome, self._close_files)
+            d.addCallback(self._closed, start)
+            return d
+        self._closed(self._close_files(), start)
+
+    def _close_files(self):
+        # move the finished share into place (durably, if we have a
+        # syncer), and return its size
+        if self._syncer is None:
+            return self.move_files()
+        self._sync_data()
+        [(ok, res)], self._sync_time = self._syncer.commit([self])
+        if not ok:
+            res.raiseException()
+        return res
+
+    def _sync_data(self):
+        if self._packs is None:
+            self._syncer.sync_paths([self.incominghome])
+
+    def get_sync_paths(self):
+        """Return the files and directories which must be fsync()ed to make
+        the moved share durable."""
+        if self._packs is not None:
+            return self._packs.get_sync_paths(self.storage_index, self.shnum)
+        # the bucket directory, and the prefix directory in case the bucket
+        # is new
+        bucketdir = os.path.dirname(self.finalhome)
+        return [bucketdir, os.path.dirname(bucketdir)]
+
+    def move_files(self):
+        if self._packs is not None:
+            return self._pack_files()
         fileutil.make_dirs(os.path.dirname(self.finalhome))
         fileutil.rename(self.incominghome, self.finalhome)
         try:
@@ -253,52 +367,97 @@ class BucketWriter(Referenceable):
             # exceptions, those are normal consequences of the
             # above-mentioned conditions.
             pass
+        return os.stat(self.finalhome)[stat.ST_SIZE]
+
+    def _pack_files(self):
+        data = self._sharefile.read_share_data(0, self._max_size)
+        # unwritten holes at the end read back as zeros, as they would from
+        # a sparse share file
+        data += "\x00" * (self._max_size - len(data))
+        size = self._packs.add_share(self.storage_index, self.shnum, data)
+        self._remove_files()
+        return size
+
+    def _closed(self, filelen, start):
         self._sharefile = None
         self.closed = True
         self._canary.dontNotifyOnDisconnect(self._disconnect_marker)
 
-        filelen = os.stat(self.finalhome)[stat.ST_SIZE]
         self.ss.bucket_writer_closed(self, filelen)
+        if self._sync_time is not None:
+            self.ss.add_latency("sync", self._sync_time)
         self.ss.add_latency("close", time.time() - start)
         self.ss.count("close")
 
     def _disconnected(self):
         if not self.closed:
-            self._abort()
+            if self._suspender is not None:
+                self._suspender.suspend(self)
+            else:
+                self._abort()
+
+    def resume(self, canary):
+        """Carry on with a suspended upload, for a client that has come back
+        with a new connection (and canary)."""
+        precondition(not self.closed)
+        self._canary = canary
+        self._disconnect_marker = canary.notifyOnDisconnect(self._disconnected)
+
+    def abort_suspended(self):
+        log.msg("storage: giving up on suspended sharefile %s"
+                % self.incominghome, facility="tahoe.storage")
+        return self._abort()
 
     def remote_abort(self):
         log.msg("storage: aborting sharefile %s" % self.incominghome,
                 facility="tahoe.storage", level=log.UNUSUAL)
         if not self.closed:
             self._canary.dontNotifyOnDisconnect(self._disconnect_marker)
-        self._abort()
+        d = self._abort()
         self.ss.count("abort")
+        return d
 
     def _abort(self):
         if self.closed:
             return
 
+        # We are now considered closed for further writing.
+        self.closed = True
+        if self._diskio is not None:
+            d = self._diskio.run(self.incominghome, self._remove_files)
+            d.addCallback(lambda ign: self._aborted())
+            return d
+        self._remove_files()
+        self._aborted()
+
+    def _remove_files(self):
         os.remove(self.incominghome)
         # if we were the last share to be moved, remove the incoming/
         # directory that was our parent
         parentdir = os.path.split(self.incominghome)[0]
         if not os.listdir(parentdir):
             os.rmdir(parentdir)
+
+    def _aborted(self):
         self._sharefile = None
 
-        # We are now considered closed for further writing. We must tell
-        # the storage server about this so that it stops expecting us to
-        # use the space it allocated for us earlier.
-        self.closed = True
+        # We must tell the storage server about this so that it stops
+        # expecting us to use the space it allocated for us earlier.
         self.ss.bucket_writer_closed(self, 0)
 
 
 @implementer(RIBucketReader)
 class BucketReader(Referenceable):
 
-    def __init__(self, ss, sharefname, storage_index=None, shnum=None):
+    def __init__(self, ss, sharefname, storage_index=None, shnum=None,
+                 handles=None, diskio=None, sharefile=None):
+        """If 'sharefile' is provided, it is read from instead of a
+        ShareFile for 'sharefname'."""
         self.ss = ss
-        self._share_file = ShareFile(sharefname)
+        if sharefile is None:
+            sharefile = ShareFile(sharefname, handles=handles)
+        self._share_file = sharefile
+        self._diskio = diskio
         self.storage_index = storage_index
         self.shnum = shnum
 
@@ -309,10 +468,33 @@ class BucketReader(Referenceable):
 
     def remote_read(self, offset, length):
         start = time.time()
-        data = self._share_file.read_share_data(offset, length)
-        self.ss.add_latency("read", time.time() - start)
-        self.ss.count("read")
-        return data
+        def _read(data):
+            self.ss.add_latency("read", time.time() - start)
+            self.ss.count("read")
+            return data
+        if self._diskio is not None:
+            d = self._diskio.run(self._share_file.home,
+                                 self._share_file.read_share_data,
+                                 offset, length)
+            d.addCallback(_read)
+            return d
+        return _read(self._share_file.read_share_data(offset, length))
+
+    def remote_readv(self, readv):
+        start = time.time()
+        def _read(datav):
+            self.ss.add_latency("read", time.time() - start)
+            self.ss.count("read")
+            return datav
+        if self._diskio is not None:
+            d = self._diskio.run(self._share_file.home, self._readv, readv)
+            d.addCallback(_read)
+            return d
+        return _read(self._readv(readv))
+
+    def _readv(self, readv):
+        return [self._share_file.read_share_data(offset, length)
+                for (offset, length) in readv]
 
     def remote_advise_corrupt_share(self, reason):
         return self.ss.remote_advise_corrupt_share("immutable",
@@ -0,0 +1,84 @@
+from collections import OrderedDict
+
+class ShareInventory(object):
+    """I remember which shares a StorageServer holds for recently-queried
+    storage indexes, so that the read-only hot paths (DYHB queries via
+    remote_get_buckets, the 'already have it' checks in
+    remote_allocate_buckets, and mutable slot reads) do not need to call
+    listdir() and stat() on every request.
+
+    Entries are loaded lazily from disk on a miss, using the 'loader'
+    function (which must return an iterable of share numbers for a storage
+    index), and are then kept exact by the server's write and delete paths,
+    which call add_share() and remove_share(). Negative results (buckets
+    that we do not hold at all, which is what most DYHB queries ask about)
+    are cached too. At most 'max_buckets' storage indexes are remembered,
+    and the least-recently-used ones are discarded first.
+
+    I also keep track of the shares which are currently being uploaded into
+    incoming/, which are not visible in the share directory yet.
+
+    Share files which are added or removed behind the server's back (by
+    copying them in from another server, for example) will not be noticed
+    until their bucket is evicted or the node is restarted.
+    """
+
+    max_buckets = 100000
+
+    def __init__(self, loader, max_buckets=None):
+        self._loader = loader
+        if max_buckets is not None:
+            self.max_buckets = max_buckets
+        self._buckets = OrderedDict() # storage_index -> set(shnums)
+        self._incoming = set() # (storage_index, shnum)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_shnums(self, storage_index):
+        """Return the set of share numbers that we hold for the given
+        storage index. The caller must not modify it."""
+        shnums = self._buckets.pop(storage_index, None)
+        if shnums is None:
+            self.misses += 1
+            shnums = set(self._loader(storage_index))
+        else:
+            self.hits += 1
+        # (re)insert at the most-recently-used end
+        self._buckets[storage_index] = shnums
+        while len(self._buckets) > self.max_buckets:
+            self._buckets.popitem(last=False)
+            self.evictions += 1
+        return shnums
+
+    def add_share(self, storage_index, shnum):
+        # if the bucket is not cached, the next lookup will find the new
+        # share on disk
+        if storage_index in self._buckets:
+            self._buckets[storage_index].add(shnum)
+
+    def remove_share(self, storage_index, shnum):
+        if storage_index in self._buckets:
+            self._buckets[storage_index].discard(shnum)
+
+    def invalidate(self, storage_index):
+        """Forget what I know about the given storage index, so that the
+        next lookup will go to disk."""
+        self._buckets.pop(storage_index, None)
+
+    def add_incoming(self, storage_index, shnum):
+        self._incoming.add((storage_index, shnum))
+
+    def remove_incoming(self, storage_index, shnum):
+        self._incoming.discard((storage_index, shnum))
+
+    def is_incoming(self, storage_index, shnum):
+        return (storage_index, shnum) in self._incoming
+
+    def get_stats(self):
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "cached_buckets": len(self._buckets),
+                "incoming_shares": len(self._incoming),
+                }
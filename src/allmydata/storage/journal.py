@@ -0,0 +1,194 @@
+import os, re
+
+from allmydata.storage.common import si_b2a
+from allmydata.util import fileutil, log
+
+# The share journal is an append-only record of the changes that a
+# StorageServer makes to its shares, so that crawlers can visit just the
+# buckets that changed since their last cycle instead of walking every
+# prefix directory. Each event is one line of text:
+#
+#  SEQNUM EVENT STORAGEINDEX SHNUM
+#
+# where SEQNUM counts up from 1, EVENT is one of EVENTS, STORAGEINDEX is in
+# base32, and SHNUM is '-' for events (such as lease renewals) which apply
+# to every share of the bucket. The journal is split into segment files,
+# named after the number of their first event, and old segments are deleted
+# once every reader has gone past them, or once there are too many of them
+# (in which case the readers which were left behind fall back to a full
+# crawl).
+
+EVENTS = ("create", "write", "delete", "lease")
+
+SEGMENT_RE = re.compile(r"^([0-9]{20})\.journal$")
+
+class JournalTruncated(Exception):
+    """The events that were asked for have already been deleted."""
+
+
+class ShareJournal(object):
+    """I append share events to the journal segments in 'journaldir', and
+    read them back for crawlers.
+
+    Each reader (usually a ShareCrawler, identified by a name of its
+    choosing) tells me how far it has got with set_checkpoint(). Segments
+    which every reader has finished with are deleted. At most
+    'max_segments' of 'segment_events' events each are kept, whatever the
+    readers say, so the journal's size is bounded even if a reader stops
+    reading.
+
+    Events are flushed to the operating system as they are written, but are
+    not fsync()ed: a crash can lose the last few, which the readers'
+    periodic full crawls will make up for.
+    """
+
+    segment_events = 100000
+    max_segments = 20
+
+    def __init__(self, journaldir, segment_events=None, max_segments=None):
+        if segment_events is not None:
+            self.segment_events = segment_events
+        if max_segments is not None:
+            self.max_segments = max_segments
+        self.journaldir = journaldir
+        fileutil.make_dirs(journaldir)
+        self._segments = sorted([int(m.group(1)) for m in
+                                 map(SEGMENT_RE.match, os.listdir(journaldir))
+                                 if m])
+        self._checkpoints = {} # reader name -> seqnum
+        self._next_seq = 1
+        self._segment_count = 0 # events in the current segment
+        self._f = None
+        if self._segments:
+            self._recover()
+        else:
+            self._start_segment()
+
+    def _segment_path(self, first_seq):
+        return os.path.join(self.journaldir, "%020d.journal" % first_seq)
+
+    def _recover(self):
+        # find the next seqnum from the last segment, discarding any partly
+        # written event at the end of it
+        first_seq = self._segments[-1]
+        path = self._segment_path(first_seq)
+        good = 0
+        count = 0
+        with open(path, "rb") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                good += len(line)
+                count += 1
+        if good != os.path.getsize(path):
+            log.msg("discarding partial event at the end of %s" % path,
+                    facility="tahoe.storage", level=log.UNUSUAL)
+            with open(path, "rb+") as f:
+                f.truncate(good)
+        self._next_seq = first_seq + count
+        self._segment_count = count
+        self._f = open(path, "ab")
+
+    def _start_segment(self):
+        if self._f is not None:
+            self._f.close()
+        self._segments.append(self._next_seq)
+        self._segment_count = 0
+        self._f = open(self._segment_path(self._next_seq), "ab")
+        while len(self._segments) > self.max_segments:
+            self._delete_oldest()
+
+    def _delete_oldest(self):
+        first_seq = self._segments.pop(0)
+        fileutil.remove_if_possible(self._segment_path(first_seq))
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+    def record(self, event, storage_index, shnum=None):
+        """Append an event about one share (or, if 'shnum' is None, about
+        all of the shares) of the given storage index."""
+        assert event in EVENTS, event
+        if self._segment_count >= self.segment_events:
+            self._start_segment()
+        if shnum is None:
+            shnum_s = "-"
+        else:
+            shnum_s = "%d" % shnum
+        self._f.write("%d %s %s %s\n" % (self._next_seq, event,
+                                          si_b2a(storage_index), shnum_s))
+        self._f.flush()
+        self._next_seq += 1
+        self._segment_count += 1
+
+    def get_last_seq(self):
+        """Return the number of the last event written, or 0 if there have
+        been none."""
+        return self._next_seq - 1
+
+    def get_first_seq(self):
+        """Return the number of the oldest event that can still be read."""
+        return self._segments[0]
+
+    def has_since(self, seq):
+        """Return True if every event after 'seq' can still be read."""
+        return seq + 1 >= self.get_first_seq()
+
+    def get_events(self, since, until=None):
+        """Yield (seqnum, event, si_b32, shnum) for each event after 'since'
+        and up to 'until' (or the end of the journal). 'shnum' is None for
+        events about a whole bucket. Raise JournalTruncated if some of them
+        have been deleted."""
+        if until is None:
+            until = self.get_last_seq()
+        if not self.has_since(since):
+            raise JournalTruncated(since, self.get_first_seq())
+        self._f.flush()
+        segments = self._segments[:]
+        for i, first_seq in enumerate(segments):
+            if i+1 < len(segments) and segments[i+1] <= since + 1:
+                continue # every event in this one is too old
+            if first_seq > until:
+                break
+            try:
+                f = open(self._segment_path(first_seq), "rb")
+            except EnvironmentError:
+                raise JournalTruncated(since, self.get_first_seq())
+            with f:
+                for line in f:
+                    if not line.endswith("\n"):
+                        break
+                    (seq_s, event, si_s, shnum_s) = line.split()
+                    seq = int(seq_s)
+                    if seq <= since:
+                        continue
+                    if seq > until:
+                        return
+                    shnum = None
+                    if shnum_s != "-":
+                        shnum = int(shnum_s)
+                    yield (seq, event, si_s, shnum)
+
+    def set_checkpoint(self, reader, seq):
+        """Record that 'reader' has processed every event up to 'seq', and
+        delete the segments that no reader needs any more. A 'seq' of None
+        means that the reader has not yet read anything, and will start
+        with a full crawl: it does not hold back any segments."""
+        if seq is None:
+            self._checkpoints.pop(reader, None)
+        else:
+            self._checkpoints[reader] = seq
+        if not self._checkpoints:
+            return
+        done = min(self._checkpoints.values())
+        # keep the current segment, and any which hold unread events
+        while (len(self._segments) > 1
+               and self._segments[1] <= done + 1):
+            self._delete_oldest()
+
+    def get_stats(self):
+        return {"events": self.get_last_seq(),
+                "segments": len(self._segments),
+                }
@@ -0,0 +1,304 @@
+import sys
+
+from allmydata.util.dbutil import get_db, DBError
+from allmydata.util.hashutil import timing_safe_compare
+from allmydata.storage.lease import LeaseInfo
+
+# The lease database is an optional replacement for the lease records that
+# are stored inside each share file. When it is enabled, it is the source of
+# truth for all lease lookups, additions and renewals: remote_add_lease()
+# and remote_renew_lease() update a single row instead of opening every
+# share file of the bucket and walking its lease slots, and the lease
+# checker can find expired leases with a range scan over the
+# leases_by_expiration index instead of reading every share on disk.
+#
+# Share files still receive the lease that was granted when they were
+# created (so that a share file is self-describing if it is moved to
+# another server or the database is lost), but renewals and additional
+# leases are only recorded here. Shares that predate the database are
+# migrated lazily: whenever the server touches a bucket that the database
+# does not know about yet, the leases are copied out of the share files.
+
+# lease db schema version 1
+SCHEMA_v1 = """
+CREATE TABLE version
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE shares
+(
+ storage_index VARCHAR(26) NOT NULL,  -- base32 storage index
+ shnum         INTEGER NOT NULL,
+ sharetype     VARCHAR(16) NOT NULL,  -- 'immutable' or 'mutable'
+ PRIMARY KEY (storage_index, shnum)
+);
+
+CREATE TABLE leases
+(
+ storage_index   VARCHAR(26) NOT NULL,
+ shnum           INTEGER NOT NULL,
+ owner_num       INTEGER NOT NULL,
+ renew_secret    BLOB NOT NULL,
+ cancel_secret   BLOB NOT NULL,
+ expiration_time INTEGER NOT NULL,  -- seconds since epoch
+ nodeid          BLOB,              -- NULL for immutable leases
+ FOREIGN KEY (storage_index, shnum) REFERENCES shares (storage_index, shnum)
+   ON DELETE CASCADE
+);
+
+CREATE INDEX leases_by_share ON leases (storage_index, shnum);
+CREATE INDEX leases_by_expiration ON leases (expiration_time);
+"""
+
+
+def get_leasedb(dbfile, stderr=sys.stderr,
+                create_version=(SCHEMA_v1, 1), just_create=False):
+    # Open or create the given leasedb file. The parent directory must
+    # exist. Unlike the backupdb, a lease database that cannot be opened is
+    # a fatal configuration problem for a storage server, so DBError is
+    # allowed to propagate.
+    (sqlite3, db) = get_db(dbfile, stderr, create_version,
+                           just_create=just_create, dbname="leasedb",
+                           journal_mode="WAL", synchronous="NORMAL")
+    return LeaseDB(sqlite3, db)
+
+
+def _blob(s):
+    if s is None:
+        return None
+    return buffer(s)
+
+def _str(b):
+    if b is None:
+        return None
+    return str(b)
+
+
+class LeaseDB(object):
+    VERSION = 1
+
+    def __init__(self, sqlite_module, connection):
+        self.sqlite_module = sqlite_module
+        self.connection = connection
+        self.cursor = connection.cursor()
+
+    def close(self):
+        self.connection.close()
+
+    def commit(self):
+        """Commit the changes made by calls that were given commit=False."""
+        self.connection.commit()
+
+    # shares
+
+    def add_share(self, si_s, shnum, sharetype):
+        self.cursor.execute("INSERT OR IGNORE INTO shares VALUES (?,?,?)",
+                            (si_s, shnum, sharetype))
+        self.connection.commit()
+
+    def remove_share(self, si_s, shnum, commit=True):
+        # the leases go with it, thanks to ON DELETE CASCADE
+        self.cursor.execute("DELETE FROM shares"
+                            " WHERE storage_index=? AND shnum=?",
+                            (si_s, shnum))
+        if commit:
+            self.connection.commit()
+
+    def get_shares(self, si_s):
+        """Return a dict mapping shnum to sharetype for every share of the
+        given (base32) storage index that the database knows about."""
+        self.cursor.execute("SELECT shnum, sharetype FROM shares"
+                            " WHERE storage_index=?",
+                            (si_s,))
+        return dict([(shnum, str(sharetype))
+                     for (shnum, sharetype) in self.cursor.fetchall()])
+
+    def get_all_shares(self):
+        """Yield (si_s, shnum, sharetype) for every known share."""
+        c = self.connection.cursor()
+        c.execute("SELECT storage_index, shnum, sharetype FROM shares"
+                  " ORDER BY storage_index, shnum")
+        for (si_s, shnum, sharetype) in c:
+            yield (str(si_s), shnum, str(sharetype))
+
+    def get_share_count(self):
+        self.cursor.execute("SELECT COUNT(*) FROM shares")
+        return self.cursor.fetchone()[0]
+
+    # leases
+
+    def _insert_lease(self, si_s, shnum, lease_info):
+        self.cursor.execute("INSERT INTO leases VALUES (?,?,?,?,?,?,?)",
+                            (si_s, shnum, lease_info.owner_num,
+                             _blob(lease_info.renew_secret),
+                             _blob(lease_info.cancel_secret),
+                             int(lease_info.expiration_time),
+                             _blob(lease_info.nodeid)))
+
+    def _lease_from_row(self, row):
+        (owner_num, renew_secret, cancel_secret, expiration_time,
+         nodeid) = row
+        return LeaseInfo(owner_num, _str(renew_secret), _str(cancel_secret),
+                         expiration_time, _str(nodeid))
+
+    def get_leases(self, si_s, shnum):
+        """Return a list of LeaseInfo instances for the given share, in the
+        order in which they were added."""
+        self.cursor.execute("SELECT owner_num, renew_secret, cancel_secret,"
+                            "       expiration_time, nodeid"
+                            " FROM leases"
+                            " WHERE storage_index=? AND shnum=?"
+                            " ORDER BY rowid",
+                            (si_s, shnum))
+        return [self._lease_from_row(row) for row in self.cursor.fetchall()]
+
+    def add_or_renew_leases(self, si_s, shnums, lease_info):
+        """For each of the given shares, renew the lease whose renew secret
+        matches lease_info, or add lease_info as a new lease if there is
+        none. All shares are updated in a single transaction."""
+        for shnum in shnums:
+            if not self._renew(si_s, shnum, lease_info.renew_secret,
+                               lease_info.expiration_time):
+                self._insert_lease(si_s, shnum, lease_info)
+        self.connection.commit()
+
+    def _renew(self, si_s, shnum, renew_secret, new_expire_time):
+        # Leases never get shorter: like ShareFile.renew_lease, we only
+        # move the expiration time forwards. Returns True if a matching
+        # lease was found.
+        self.cursor.execute("SELECT rowid, renew_secret, expiration_time"
+                            " FROM leases"
+                            " WHERE storage_index=? AND shnum=?",
+                            (si_s, shnum))
+        for (rowid, rs, expiration_time) in self.cursor.fetchall():
+            if timing_safe_compare(_str(rs), renew_secret):
+                if new_expire_time > expiration_time:
+                    self.cursor.execute("UPDATE leases SET expiration_time=?"
+                                        " WHERE rowid=?",
+                                        (int(new_expire_time), rowid))
+                return True
+        return False
+
+    def renew_leases(self, si_s, shnums, renew_secret, new_expire_time):
+        """Renew the lease with the given renew secret on each of the given
+        shares. Return a list of the shnums which had no such lease (and
+        were therefore not renewed)."""
+        missing = [shnum for shnum in shnums
+                   if not self._renew(si_s, shnum, renew_secret,
+                                      new_expire_time)]
+        self.connection.commit()
+        return missing
+
+    def get_lease_nodeids(self, si_s, shnum):
+        """Return the set of nodeids which accepted the leases on the given
+        share. This is used to help clients find migrated mutable shares."""
+        self.cursor.execute("SELECT nodeid FROM leases"
+                            " WHERE storage_index=? AND shnum=?",
+                            (si_s, shnum))
+        return set([_str(nodeid) for (nodeid,) in self.cursor.fetchall()
+                    if nodeid is not None])
+
+    def cancel_lease(self, si_s, shnum, cancel_secret, commit=True):
+        """Remove every lease on the share with the given cancel secret.
+        Return the number of leases that remain. Raise IndexError if there
+        was no such lease. With commit=False, the change is left for a
+        later commit(), so that many leases can be cancelled in one
+        transaction."""
+        self.cursor.execute("SELECT rowid, cancel_secret FROM leases"
+                            " WHERE storage_index=? AND shnum=?",
+                            (si_s, shnum))
+        rows = self.cursor.fetchall()
+        doomed = [rowid for (rowid, cs) in rows
+                  if timing_safe_compare(_str(cs), cancel_secret)]
+        if not doomed:
+            raise IndexError("unable to find matching lease to cancel")
+        self.cursor.executemany("DELETE FROM leases WHERE rowid=?",
+                                [(rowid,) for rowid in doomed])
+        if commit:
+            self.connection.commit()
+        return len(rows) - len(doomed)
+
+    def get_expiring_leases(self, cutoff_time, sharetypes=None, limit=None):
+        """Yield (si_s, shnum, LeaseInfo) for every lease that expires before
+        cutoff_time, using the expiration-time index rather than examining
+        every share. If sharetypes is provided, only leases on shares of
+        those types are returned. If limit is provided, only that many of
+        the leases which expired first are returned."""
+        query = ("SELECT l.storage_index, l.shnum,"
+                 "       l.owner_num, l.renew_secret, l.cancel_secret,"
+                 "       l.expiration_time, l.nodeid"
+                 " FROM leases l JOIN shares s"
+                 "  ON l.storage_index = s.storage_index"
+                 "  AND l.shnum = s.shnum"
+                 " WHERE l.expiration_time < ?")
+        args = [int(cutoff_time)]
+        if sharetypes is not None:
+            if not sharetypes:
+                return
+            query += (" AND s.sharetype IN (%s)"
+                      % ",".join(["?"] * len(sharetypes)))
+            args.extend(sharetypes)
+        query += " ORDER BY l.expiration_time"
+        if limit is not None:
+            query += " LIMIT ?"
+            args.append(limit)
+        c = self.connection.cursor()
+        c.execute(query, args)
+        for row in c.fetchall():
+            (si_s, shnum) = row[:2]
+            yield (str(si_s), shnum, self._lease_from_row(row[2:]))
+
+    # migration
+
+    def import_share(self, si_s, shnum, sharetype, leases):
+        """Record a pre-existing share, and the leases that were found in its
+        share file. This is idempotent: a share that is already known is
+        left alone."""
+        self.cursor.execute("SELECT COUNT(*) FROM shares"
+                            " WHERE storage_index=? AND shnum=?",
+                            (si_s, shnum))
+        if self.cursor.fetchone()[0]:
+            return False
+        self.cursor.execute("INSERT INTO shares VALUES (?,?,?)",
+                            (si_s, shnum, sharetype))
+        for lease_info in leases:
+            self._insert_lease(si_s, shnum, lease_info)
+        self.connection.commit()
+        return True
+
+
+def compare_leases(leasedb, si_s, sharefiles):
+    """Check the lease database against the share files of one bucket.
+
+    'sharefiles' maps shnum to a ShareFile or MutableShareFile instance for
+    every share that is present on disk. Return a list of human-readable
+    problem descriptions, which is empty if the two agree. Since renewals are
+    only recorded in the database, the share files are allowed to hold older
+    expiration times, but every lease (identified by its renew secret) that
+    is present in a share file must also be present in the database, and the
+    set of shares must be the same."""
+    problems = []
+    known = leasedb.get_shares(si_s)
+    for shnum in sorted(set(known) - set(sharefiles)):
+        problems.append("%s sh%d: in leasedb but missing from disk"
+                        % (si_s, shnum))
+    for shnum in sorted(sharefiles):
+        if shnum not in known:
+            problems.append("%s sh%d: on disk but missing from leasedb"
+                            % (si_s, shnum))
+            continue
+        sf = sharefiles[shnum]
+        if known[shnum] != sf.sharetype:
+            problems.append("%s sh%d: leasedb says %s, share file is %s"
+                            % (si_s, shnum, known[shnum], sf.sharetype))
+        db_secrets = set([l.renew_secret
+                          for l in leasedb.get_leases(si_s, shnum)])
+        for lease in sf.get_leases():
+            if lease.renew_secret not in db_secrets:
+                problems.append("%s sh%d: lease (owner %d) in share file"
+                                " but missing from leasedb"
+                                % (si_s, shnum, lease.owner_num))
+    return problems
+
+_pyflakes_hush = [DBError] # re-exported
@@ -53,12 +53,26 @@ class MutableShareFile:
     MAX_SIZE = MAX_MUTABLE_SHARE_SIZE
     # TODO: decide upon a policy for max share size
 
-    def __init__(self, filename, parent=None):
+    # When a write needs a bigger container, the container is made at least
+    # this many times as big as it was, leaving slack between the data and
+    # the extra leases. A share which grows a piece at a time (as an MDMF
+    # share does while it is published) then only moves its extra leases a
+    # few times, instead of at every write. 1.0 means that containers are
+    # made exactly as big as the data.
+    growth_factor = 1.0
+
+    def __init__(self, filename, parent=None, handles=None,
+                 growth_factor=None):
         self.home = filename
+        self._handles = handles # a FileHandleCache, or None
+        if growth_factor is not None:
+            self.growth_factor = growth_factor
         if os.path.exists(self.home):
             # we don't cache anything, just check the magic
-            f = open(self.home, 'rb')
+            f = self._open_for_reading()
+            f.seek(0)
             data = f.read(self.HEADER_SIZE)
+            self._done_reading(f)
             (magic,
              write_enabler_nodeid, write_enabler,
              data_length, extra_least_offset) = \
@@ -92,7 +106,23 @@ class MutableShareFile:
         # extra leases go here, none at creation
         f.close()
 
+    def _open_for_reading(self):
+        if self._handles is not None:
+            return self._handles.get(self.home)
+        return open(self.home, 'rb')
+
+    def _done_reading(self, f):
+        if self._handles is not None:
+            self._handles.release(self.home, f)
+        else:
+            f.close()
+
+    def _invalidate_handle(self):
+        if self._handles is not None:
+            self._handles.invalidate(self.home)
+
     def unlink(self):
+        self._invalidate_handle()
         os.unlink(self.home)
 
     def _read_data_length(self, f):
@@ -138,6 +168,14 @@ class MutableShareFile:
         f.seek(extra_lease_offset)
         f.write(struct.pack(">L", num_leases))
 
+    def _get_container_size(self, f):
+        return self._read_extra_lease_offset(f) - self.DATA_OFFSET
+
+    def _choose_container_size(self, f, needed):
+        # how big to make the container, when 'needed' bytes won't fit
+        grown = int(self._get_container_size(f) * self.growth_factor)
+        return max(needed, min(grown, self.MAX_SIZE))
+
     def _change_container_size(self, f, new_container_size):
         if new_container_size > self.MAX_SIZE:
             raise DataTooLargeError()
@@ -146,6 +184,7 @@ class MutableShareFile:
         if new_extra_lease_offset < old_extra_lease_offset:
             # TODO: allow containers to shrink. For now they remain large.
             return
+        self._invalidate_handle()
         num_extra_leases = self._read_num_extra_leases(f)
         f.seek(old_extra_lease_offset)
         leases_size = 4 + num_extra_leases * self.LEASE_SIZE
@@ -180,7 +219,9 @@ class MutableShareFile:
                 # have to move the leases. With luck, they're expanding it
                 # more than the size of the extra lease block, which will
                 # minimize the corrupt-the-share window
-                self._change_container_size(f, offset+length)
+                new_container_size = self._choose_container_size(
+                    f, offset+length)
+                self._change_container_size(f, new_container_size)
                 extra_lease_offset = self._read_extra_lease_offset(f)
 
                 # an interrupt here is ok.. the container has been enlarged
@@ -372,10 +413,12 @@ class MutableShareFile:
 
     def readv(self, readv):
         datav = []
-        f = open(self.home, 'rb')
-        for (offset, length) in readv:
-            datav.append(self._read_share_data(f, offset, length))
-        f.close()
+        f = self._open_for_reading()
+        try:
+            for (offset, length) in readv:
+                datav.append(self._read_share_data(f, offset, length))
+        finally:
+            self._done_reading(f)
         return datav
 
 #    def remote_get_length(self):
@@ -454,9 +497,10 @@ class EmptyShare:
                 break
         return test_good
 
-def create_mutable_sharefile(filename, my_nodeid, write_enabler, parent):
+def create_mutable_sharefile(filename, my_nodeid, write_enabler, parent,
+                             handles=None, growth_factor=None):
     ms = MutableShareFile(filename, parent)
     ms.create(my_nodeid, write_enabler)
     del ms
-    return MutableShareFile(filename, parent)
+    return MutableShareFile(filename, parent, handles, growth_factor)
 
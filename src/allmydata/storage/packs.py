@@ -0,0 +1,358 @@
+import os, re, struct, threading
+
+from allmydata.util import fileutil, log
+from allmydata.util.assertutil import precondition
+from allmydata.storage.common import si_b2a
+from allmydata.storage.filehandles import FileHandleCache
+
+# storage/packs/
+# storage/packs/$PACKNUM.pack
+# storage/packs/$PACKNUM.idx
+# storage/packs/$PACKNUM.dead
+
+# Each pack file is a sequence of records, each of which holds the data of
+# one immutable share (the part that BucketReader.remote_read() serves, with
+# no container header or lease records):
+#  0x00: magic, four bytes, "shr1"
+#  0x04: storage index, 16 bytes
+#  0x14: share number, four bytes big-endian
+#  0x18: share data length, eight bytes big-endian = A
+#  0x20: share data
+#  A+0x20: next record
+# Records are only ever appended. New shares go into the newest pack, until
+# it is larger than the pack size, and then a new pack is started.
+
+# The .idx file next to each pack is its index: one fixed-size entry per
+# record (storage index, share number, record offset, share data length),
+# appended once the record itself has been written. The .dead file lists
+# the offsets of the records whose shares have since been deleted. Both are
+# read when the server starts, so that the pack files themselves need not
+# be. If the server crashed before indexing the last records of the newest
+# pack, they are recovered by scanning its tail, and a partly-written final
+# record is truncated away.
+
+RECORD_MAGIC = "shr1"
+RECORD_HEADER = ">4s16sLQ"
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_HEADER)
+INDEX_ENTRY = ">16sLQQ"
+INDEX_ENTRY_SIZE = struct.calcsize(INDEX_ENTRY)
+DEAD_ENTRY = ">Q"
+DEAD_ENTRY_SIZE = struct.calcsize(DEAD_ENTRY)
+
+PACK_RE = re.compile("^([0-9]+)\.pack$")
+
+DEFAULT_MAX_SHARE_SIZE = 64*1024
+DEFAULT_PACK_SIZE = 16*1024*1024
+# a pack is compacted once at least this fraction of it is dead
+DEFAULT_COMPACT_THRESHOLD = 0.5
+
+class PackedShareFile(object):
+    """I look like a ShareFile to a BucketReader, but my data lives in a
+    PackStore."""
+
+    sharetype = "immutable"
+
+    def __init__(self, packs, storage_index, shnum):
+        self._packs = packs
+        self.storage_index = storage_index
+        self.shnum = shnum
+        # BucketReader uses this as the DiskIOPool key
+        self.home = "%s:%s/%d" % (packs.packdir, si_b2a(storage_index), shnum)
+
+    def read_share_data(self, offset, length):
+        return self._packs.read_share_data(self.storage_index, self.shnum,
+                                           offset, length)
+
+    def get_size(self):
+        return self._packs.get_share_size(self.storage_index, self.shnum)
+
+
+class PackStore(object):
+    """I keep small immutable shares in a few large append-only pack files
+    (see the layout description above) instead of one file per share, which
+    saves an inode, a directory entry and a seek or two for each of them.
+
+    Shares of at most 'max_share_size' bytes are eligible. The storage
+    server decides which uploads to send here; add_share() is given the
+    complete share data when the upload is closed. Leases are not stored in
+    the packs at all: they live in the lease database. A deleted share is
+    only marked as dead, and its space is reclaimed by compact(), which
+    copies the live shares out of any pack that is at least
+    'compact_threshold' dead into the newest pack, and deletes the old one.
+
+    All methods may be called from any thread.
+    """
+
+    def __init__(self, packdir, max_share_size=None, pack_size=None,
+                 compact_threshold=DEFAULT_COMPACT_THRESHOLD):
+        self.packdir = packdir
+        self.max_share_size = max_share_size
+        if self.max_share_size is None:
+            self.max_share_size = DEFAULT_MAX_SHARE_SIZE
+        self.pack_size = pack_size
+        if self.pack_size is None:
+            self.pack_size = DEFAULT_PACK_SIZE
+        self.compact_threshold = compact_threshold
+        self._lock = threading.RLock()
+        self._handles = FileHandleCache(max_handles=16)
+        self._index = {} # storage_index -> {shnum: (packnum, offset, length)}
+        self._sizes = {} # packnum -> size of the pack file
+        self._live = {} # packnum -> bytes of live records in it
+        self._current = None # the pack that new records are appended to
+        self.compactions = 0
+        fileutil.make_dirs(packdir)
+        self._load()
+
+    def _path(self, packnum, suffix):
+        return os.path.join(self.packdir, "%08d.%s" % (packnum, suffix))
+
+    def _load(self):
+        packnums = []
+        for name in os.listdir(self.packdir):
+            mo = PACK_RE.match(name)
+            if mo:
+                packnums.append(int(mo.group(1)))
+        packnums.sort()
+        for packnum in packnums:
+            entries = self._read_entries(packnum)
+            if packnum == packnums[-1]:
+                entries.extend(self._recover(packnum, entries))
+            dead = self._read_dead(packnum)
+            self._sizes[packnum] = os.path.getsize(self._path(packnum, "pack"))
+            self._live[packnum] = 0
+            for (storage_index, shnum, offset, length) in entries:
+                if offset not in dead:
+                    # a later copy (left behind by an interrupted
+                    # compaction) replaces an earlier one
+                    self._set(storage_index, shnum, (packnum, offset, length))
+        if packnums:
+            self._current = packnums[-1]
+
+    def _read_entries(self, packnum):
+        entries = []
+        try:
+            data = fileutil.read(self._path(packnum, "idx"))
+        except EnvironmentError:
+            data = ""
+        # ignore a partly-written final entry
+        for i in range(len(data) // INDEX_ENTRY_SIZE):
+            entry = data[i*INDEX_ENTRY_SIZE:(i+1)*INDEX_ENTRY_SIZE]
+            entries.append(struct.unpack(INDEX_ENTRY, entry))
+        return entries
+
+    def _read_dead(self, packnum):
+        try:
+            data = fileutil.read(self._path(packnum, "dead"))
+        except EnvironmentError:
+            return set()
+        return set([struct.unpack(DEAD_ENTRY,
+                                  data[i*DEAD_ENTRY_SIZE:(i+1)*DEAD_ENTRY_SIZE])[0]
+                    for i in range(len(data) // DEAD_ENTRY_SIZE)])
+
+    def _recover(self, packnum, entries):
+        # index any records that were written after the last index entry,
+        # and cut off a partial record at the end
+        filename = self._path(packnum, "pack")
+        offset = 0
+        if entries:
+            (ign, ign, last_offset, last_length) = entries[-1]
+            offset = last_offset + RECORD_HEADER_SIZE + last_length
+        # rewrite the index too, in case it ends with a partial entry
+        idx_size = len(entries) * INDEX_ENTRY_SIZE
+        recovered = []
+        f = open(filename, "rb+")
+        try:
+            filesize = os.fstat(f.fileno()).st_size
+            while offset < filesize:
+                f.seek(offset)
+                header = f.read(RECORD_HEADER_SIZE)
+                if len(header) < RECORD_HEADER_SIZE:
+                    break
+                (magic, storage_index, shnum, length) = \
+                        struct.unpack(RECORD_HEADER, header)
+                end = offset + RECORD_HEADER_SIZE + length
+                if magic != RECORD_MAGIC or end > filesize:
+                    break
+                recovered.append((storage_index, shnum, offset, length))
+                offset = end
+            if offset < filesize:
+                log.msg("truncating partial record in %s at %d"
+                        % (filename, offset), level=log.UNUSUAL)
+                f.truncate(offset)
+        finally:
+            f.close()
+        f = open(self._path(packnum, "idx"), "ab")
+        try:
+            f.truncate(idx_size)
+            for entry in recovered:
+                f.write(struct.pack(INDEX_ENTRY, *entry))
+        finally:
+            f.close()
+        return recovered
+
+    def _set(self, storage_index, shnum, location):
+        old = self._index.get(storage_index, {}).get(shnum)
+        if old is not None:
+            self._live[old[0]] -= RECORD_HEADER_SIZE + old[2]
+        self._index.setdefault(storage_index, {})[shnum] = location
+        self._live[location[0]] += RECORD_HEADER_SIZE + location[2]
+
+    def _append(self, storage_index, shnum, data):
+        # must be called with the lock held
+        if (self._current is None
+            or self._sizes[self._current] >= self.pack_size):
+            if self._current is None:
+                self._current = 0
+            else:
+                self._current += 1
+            self._sizes[self._current] = 0
+            self._live[self._current] = 0
+        packnum = self._current
+        offset = self._sizes[packnum]
+        f = open(self._path(packnum, "pack"), "ab")
+        try:
+            f.write(struct.pack(RECORD_HEADER, RECORD_MAGIC, storage_index,
+                                shnum, len(data)))
+            f.write(data)
+        finally:
+            f.close()
+        fileutil.write(self._path(packnum, "idx"),
+                       struct.pack(INDEX_ENTRY, storage_index, shnum, offset,
+                                   len(data)),
+                       mode="ab")
+        self._sizes[packnum] = offset + RECORD_HEADER_SIZE + len(data)
+        self._set(storage_index, shnum, (packnum, offset, len(data)))
+        return RECORD_HEADER_SIZE + len(data)
+
+    def add_share(self, storage_index, shnum, data):
+        """Store the complete data of a share, and return the number of
+        bytes that it added to the packs."""
+        precondition(len(storage_index) == 16, storage_index)
+        with self._lock:
+            if self.has_share(storage_index, shnum):
+                self._remove(storage_index, shnum)
+            return self._append(storage_index, shnum, data)
+
+    def has_share(self, storage_index, shnum):
+        with self._lock:
+            return shnum in self._index.get(storage_index, {})
+
+    def get_shnums(self, storage_index):
+        with self._lock:
+            return sorted(self._index.get(storage_index, {}))
+
+    def get_share_size(self, storage_index, shnum):
+        with self._lock:
+            return self._index[storage_index][shnum][2]
+
+    def get_sync_paths(self, storage_index, shnum):
+        """Return the files which must be fsync()ed to make the given share
+        durable: its pack, then the pack's index. The pack directory is
+        included when the pack is new."""
+        with self._lock:
+            (packnum, offset, length) = self._index[storage_index][shnum]
+            paths = [self._path(packnum, "pack"), self._path(packnum, "idx")]
+            if offset == 0:
+                paths.append(self.packdir)
+            return paths
+
+    def read_share_data(self, storage_index, shnum, offset, length):
+        precondition(offset >= 0)
+        with self._lock:
+            location = self._index.get(storage_index, {}).get(shnum)
+            if location is None:
+                raise IndexError("share %s/%d is not in a pack"
+                                 % (si_b2a(storage_index), shnum))
+            (packnum, record_offset, datalength) = location
+            # reads beyond the end of the data are truncated, as with
+            # ShareFile
+            actuallength = max(0, min(length, datalength - offset))
+            if actuallength == 0:
+                return ""
+            filename = self._path(packnum, "pack")
+            f = self._handles.get(filename)
+            try:
+                f.seek(record_offset + RECORD_HEADER_SIZE + offset)
+                return f.read(actuallength)
+            finally:
+                self._handles.release(filename, f)
+
+    def remove_share(self, storage_index, shnum):
+        """Delete a share. Its space is not reclaimed until its pack is
+        compacted."""
+        with self._lock:
+            self._remove(storage_index, shnum)
+
+    def _remove(self, storage_index, shnum):
+        shares = self._index.get(storage_index, {})
+        if shnum not in shares:
+            return
+        (packnum, offset, length) = shares.pop(shnum)
+        if not shares:
+            del self._index[storage_index]
+        self._live[packnum] -= RECORD_HEADER_SIZE + length
+        fileutil.write(self._path(packnum, "dead"),
+                       struct.pack(DEAD_ENTRY, offset), mode="ab")
+
+    def compact(self):
+        """Rewrite every pack (except the one currently being filled) in
+        which at least 'compact_threshold' of the bytes belong to deleted
+        shares, and return the number of bytes reclaimed."""
+        reclaimed = 0
+        with self._lock:
+            for packnum in sorted(self._sizes):
+                if packnum == self._current:
+                    continue
+                size = self._sizes[packnum]
+                dead = size - self._live[packnum]
+                if dead < size * self.compact_threshold:
+                    continue
+                reclaimed += self._compact_pack(packnum)
+        return reclaimed
+
+    def _compact_pack(self, packnum):
+        # must be called with the lock held, so that no share is added to,
+        # read from or removed from this pack while it is being copied
+        moving = []
+        for storage_index, shares in self._index.items():
+            for shnum, (p, offset, length) in shares.items():
+                if p == packnum:
+                    moving.append((offset, storage_index, shnum, length))
+        moving.sort()
+        reclaimed = self._sizes[packnum] - self._live[packnum]
+        filename = self._path(packnum, "pack")
+        f = self._handles.get(filename)
+        try:
+            for (offset, storage_index, shnum, length) in moving:
+                f.seek(offset + RECORD_HEADER_SIZE)
+                self._append(storage_index, shnum, f.read(length))
+        finally:
+            self._handles.release(filename, f)
+        self._handles.invalidate(filename)
+        del self._sizes[packnum]
+        del self._live[packnum]
+        for suffix in ("pack", "idx", "dead"):
+            fileutil.remove_if_possible(self._path(packnum, suffix))
+        self.compactions += 1
+        log.msg("compacted pack %d: moved %d shares, reclaimed %d bytes"
+                % (packnum, len(moving), reclaimed), facility="tahoe.storage")
+        return reclaimed
+
+    def close(self):
+        self._handles.close_all()
+
+    def get_bucket_count(self):
+        with self._lock:
+            return len(self._index)
+
+    def get_stats(self):
+        with self._lock:
+            total = sum(self._sizes.values())
+            live = sum(self._live.values())
+            return {"packs": len(self._sizes),
+                    "shares": sum([len(shares)
+                                   for shares in self._index.values()]),
+                    "bytes": total,
+                    "dead_bytes": total - live,
+                    "compactions": self.compactions,
+                    }
@@ -0,0 +1,93 @@
+from allmydata.storage.common import si_b2a
+from allmydata.util import log
+from allmydata.util.hashutil import timing_safe_compare
+
+class SuspendedUploads(object):
+    """I hold on to the BucketWriters of immutable uploads whose client went
+    away before closing them, so that the client can pick up where it left
+    off instead of starting again from the beginning.
+
+    When a client's connection is lost, each of its unfinished BucketWriters
+    is given to me instead of being aborted. Its partial share stays in
+    incoming/, and the space allocated to it stays reserved, for up to
+    'grace_period' seconds. If the client asks to allocate the same share
+    again in that time, with the same lease renewal secret (which only the
+    client that started the upload knows) and the same allocated size,
+    allocate_buckets() hands it the old BucketWriter, whose
+    get_written_size() tells it how much of the share is already stored.
+    Otherwise, once the grace period is over, the upload is aborted as it
+    would have been at the disconnect.
+
+    Suspended uploads do not survive a restart of the server, since
+    incoming/ is emptied at startup.
+    """
+
+    grace_period = 60*60 # seconds
+
+    def __init__(self, grace_period=None, reactor=None):
+        if grace_period is not None:
+            self.grace_period = grace_period
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._suspended = {} # (storage_index, shnum) -> (BucketWriter, timer)
+        self.suspends = 0
+        self.resumes = 0
+        self.expirations = 0
+
+    def suspend(self, bw):
+        """Keep 'bw' for a while, in case its client comes back."""
+        key = (bw.storage_index, bw.shnum)
+        if key in self._suspended:
+            # can't happen: allocate_buckets() never makes two writers for
+            # the same share
+            self._expire(key)
+        log.msg("storage: suspending upload of %s:%d (%d bytes written)"
+                % (si_b2a(bw.storage_index), bw.shnum,
+                   bw.get_written_size()),
+                facility="tahoe.storage")
+        timer = self._reactor.callLater(self.grace_period, self._expire, key)
+        self._suspended[key] = (bw, timer)
+        self.suspends += 1
+
+    def is_suspended(self, storage_index, shnum):
+        return (storage_index, shnum) in self._suspended
+
+    def resume(self, storage_index, shnum, lease_info, allocated_size):
+        """Return the suspended BucketWriter for the given share, if the
+        client which asks for it (described by 'lease_info' and
+        'allocated_size') is the one that started it. Otherwise, return
+        None."""
+        key = (storage_index, shnum)
+        if key not in self._suspended:
+            return None
+        (bw, timer) = self._suspended[key]
+        old_lease = bw.get_lease_info()
+        if (not timing_safe_compare(old_lease.renew_secret,
+                                    lease_info.renew_secret)
+            or bw.allocated_size() != allocated_size):
+            return None
+        del self._suspended[key]
+        if timer.active():
+            timer.cancel()
+        self.resumes += 1
+        return bw
+
+    def _expire(self, key):
+        (bw, timer) = self._suspended.pop(key)
+        if timer.active():
+            timer.cancel()
+        self.expirations += 1
+        return bw.abort_suspended()
+
+    def close(self):
+        """Abort every suspended upload."""
+        for key in list(self._suspended):
+            self._expire(key)
+
+    def get_stats(self):
+        return {"suspended": len(self._suspended),
+                "suspends": self.suspends,
+                "resumes": self.resumes,
+                "expirations": self.expirations,
+                }
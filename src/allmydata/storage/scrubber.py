@@ -0,0 +1,468 @@
+import os, re, struct, sys, time
+
+from allmydata.interfaces import HASH_SIZE
+from allmydata.hashtree import IncompleteHashTree, BadHashError, \
+     NotEnoughHashesError
+from allmydata.util import log, mathutil
+from allmydata.util.dbutil import get_db
+from allmydata.util.hashutil import block_hash, uri_extension_hash
+from allmydata.storage.common import si_b2a, \
+     UnknownMutableContainerVersionError, UnknownImmutableContainerVersionError
+from allmydata.storage.crawler import ShareCrawler, TimeSliceExceeded
+from allmydata.storage.shares import get_share_file
+
+# The scrubber reads every immutable share on this server and checks it
+# against the hashes that it carries, so that bit rot is noticed without a
+# client having to download (and verify) every block over the network. It
+# cannot tell whether the UEB itself is the one that a given cap refers to,
+# since the server never sees caps, so it reports the hash of each share's
+# UEB: a client whose verify-cap has the same uri_extension_hash can trust
+# the result (as far as it trusts the server) as if it had verified the
+# share itself.
+
+# $SHARENUM matches this regex:
+NUM_RE = re.compile("^[0-9]+$")
+
+# actual UEBs are closer to 419 bytes, see immutable.layout.ReadBucketProxy
+MAX_UEB_SIZE = 2000
+
+# scrubber db schema version 1
+SCHEMA_v1 = """
+CREATE TABLE version
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE results
+(
+ storage_index VARCHAR(26) NOT NULL,  -- base32 storage index
+ shnum         INTEGER NOT NULL,
+ checked       INTEGER NOT NULL,      -- seconds since epoch
+ ok            INTEGER NOT NULL,      -- 1 if every hash matched
+ ueb_hash      BLOB,                  -- NULL if the UEB was unreadable
+ reason        TEXT,                  -- why the share is corrupt, or NULL
+ PRIMARY KEY (storage_index, shnum)
+);
+
+CREATE INDEX results_by_checked ON results (checked);
+CREATE INDEX results_by_ok ON results (ok);
+"""
+
+
+def get_scrubberdb(dbfile, stderr=sys.stderr,
+                   create_version=(SCHEMA_v1, 1), just_create=False):
+    # Open or create the given scrubber db file. The parent directory must
+    # exist. As with the lease database, DBError is allowed to propagate.
+    (sqlite3, db) = get_db(dbfile, stderr, create_version,
+                           just_create=just_create, dbname="scrubberdb",
+                           journal_mode="WAL", synchronous="NORMAL")
+    return ScrubberDB(sqlite3, db)
+
+
+def _blob(s):
+    if s is None:
+        return None
+    return buffer(s)
+
+def _str(b):
+    if b is None:
+        return None
+    return str(b)
+
+
+class ScrubberDB(object):
+    """I remember the outcome of the last scrub of each share. Results are
+    not committed until commit() is called, which the scrubber does each
+    time it saves its crawler state."""
+
+    VERSION = 1
+
+    def __init__(self, sqlite_module, connection):
+        self.sqlite_module = sqlite_module
+        self.connection = connection
+        self.cursor = connection.cursor()
+
+    def close(self):
+        self.connection.close()
+
+    def commit(self):
+        self.connection.commit()
+
+    def add_result(self, si_s, shnum, checked, ok, ueb_hash, reason):
+        self.cursor.execute("INSERT OR REPLACE INTO results"
+                            " VALUES (?,?,?,?,?,?)",
+                            (si_s, shnum, int(checked), int(bool(ok)),
+                             _blob(ueb_hash), reason))
+
+    def remove_share(self, si_s, shnum):
+        self.cursor.execute("DELETE FROM results"
+                            " WHERE storage_index=? AND shnum=?",
+                            (si_s, shnum))
+        self.connection.commit()
+
+    def remove_results_before(self, when):
+        """Forget every share that has not been scrubbed since 'when'. Once
+        a cycle is finished, those are the shares that have gone away."""
+        self.cursor.execute("DELETE FROM results WHERE checked < ?",
+                            (int(when),))
+        self.connection.commit()
+
+    def get_results(self, si_s):
+        """Return a dict mapping shnum to a dict with 'checked', 'ok',
+        'ueb-hash' and 'reason' keys, for every scrubbed share of the given
+        (base32) storage index."""
+        self.cursor.execute("SELECT shnum, checked, ok, ueb_hash, reason"
+                            " FROM results WHERE storage_index=?",
+                            (si_s,))
+        results = {}
+        for (shnum, checked, ok, ueb_hash, reason) in self.cursor.fetchall():
+            results[shnum] = {"checked": checked,
+                              "ok": bool(ok),
+                              "ueb-hash": _str(ueb_hash),
+                              "reason": _str(reason),
+                              }
+        return results
+
+    def get_corrupt_shares(self, limit=None):
+        """Return a list of (si_s, shnum, reason) tuples for the shares that
+        failed their last scrub."""
+        if limit is None:
+            limit = -1
+        self.cursor.execute("SELECT storage_index, shnum, reason FROM results"
+                            " WHERE ok=0 ORDER BY storage_index, shnum"
+                            " LIMIT ?", (limit,))
+        return [(str(si_s), shnum, str(reason))
+                for (si_s, shnum, reason) in self.cursor.fetchall()]
+
+    def get_corrupt_share_count(self):
+        self.cursor.execute("SELECT COUNT(*) FROM results WHERE ok=0")
+        return self.cursor.fetchone()[0]
+
+
+class CorruptShare(Exception):
+    """The share could not be parsed, or one of its hashes did not match."""
+
+
+class ShareVerifier(object):
+    """I check that a single immutable share is consistent with its own UEB,
+    much as the client-side Verifier does, but reading the share locally.
+
+    check_hashes() parses the share and validates its share hash chain,
+    block hash tree and ciphertext hash tree against the roots in the UEB.
+    After that, check_block() can be called for each block, in any order
+    and in as many sittings as are convenient. Both raise CorruptShare if
+    anything is wrong.
+
+    'sharefile' is anything with a read_share_data(offset, length) method,
+    such as a ShareFile.
+    """
+
+    def __init__(self, sharefile, shnum):
+        self._sharefile = sharefile
+        self.shnum = shnum
+        self.ueb_hash = None
+        self.num_blocks = None
+
+    def _read(self, offset, length):
+        try:
+            data = self._sharefile.read_share_data(offset, length)
+        except EnvironmentError as e:
+            raise CorruptShare("unable to read %d bytes at offset %d: %s"
+                               % (length, offset, e))
+        if len(data) != length:
+            raise CorruptShare("share is truncated: wanted %d bytes at offset"
+                               " %d, got %d" % (length, offset, len(data)))
+        return data
+
+    def _parse_offsets(self):
+        (version,) = struct.unpack(">L", self._read(0, 4))
+        if version == 1:
+            x, fieldsize, fieldstruct = 0x0c, 0x4, ">L"
+        elif version == 2:
+            x, fieldsize, fieldstruct = 0x14, 0x8, ">Q"
+        else:
+            raise CorruptShare("unknown share data version %d" % version)
+        self._fieldsize = fieldsize
+        self._fieldstruct = fieldstruct
+        offsets = {}
+        header = self._read(x, 6*fieldsize)
+        for i, field in enumerate(('data',
+                                   'plaintext_hash_tree', # UNUSED
+                                   'crypttext_hash_tree',
+                                   'block_hashes',
+                                   'share_hashes',
+                                   'uri_extension',
+                                   )):
+            (offsets[field],) = struct.unpack(fieldstruct,
+                                              header[i*fieldsize:
+                                                     (i+1)*fieldsize])
+        return offsets
+
+    def _read_region(self, start, end, what):
+        if end < start:
+            raise CorruptShare("%s has negative size" % what)
+        return self._read(start, end - start)
+
+    def _set_hashes(self, tree, what, **kwargs):
+        try:
+            tree.set_hashes(**kwargs)
+        except (BadHashError, NotEnoughHashesError, IndexError) as e:
+            raise CorruptShare("bad %s: %s" % (what, e))
+
+    def check_hashes(self):
+        # allmydata.uri imports allmydata.storage.server, which imports us
+        from allmydata.uri import unpack_extension
+        offsets = self._parse_offsets()
+        self._data_offset = offsets['data']
+
+        (ueb_length,) = struct.unpack(self._fieldstruct,
+                                      self._read(offsets['uri_extension'],
+                                                 self._fieldsize))
+        if ueb_length > MAX_UEB_SIZE:
+            raise CorruptShare("UEB length %d is too large" % ueb_length)
+        ueb = self._read(offsets['uri_extension'] + self._fieldsize,
+                         ueb_length)
+        self.ueb_hash = uri_extension_hash(ueb)
+        try:
+            d = unpack_extension(ueb)
+            size = d['size']
+            segment_size = d['segment_size']
+            k = d['needed_shares']
+            N = d['total_shares']
+            share_root_hash = d['share_root_hash']
+            crypttext_root_hash = d['crypttext_root_hash']
+        except (ValueError, IndexError, KeyError, AssertionError) as e:
+            raise CorruptShare("unparseable UEB: %r" % (e,))
+        if not (0 < k <= N and segment_size > 0 and size > 0):
+            raise CorruptShare("implausible UEB parameters")
+        if self.shnum >= N:
+            raise CorruptShare("share number %d but only %d shares"
+                               % (self.shnum, N))
+
+        # this is the same geometry that ValidatedExtendedURIProxy derives
+        self.num_blocks = mathutil.div_ceil(size, segment_size)
+        self.block_size = mathutil.div_ceil(segment_size, k)
+        self.share_size = mathutil.div_ceil(size, k)
+        if 'num_segments' in d and d['num_segments'] != self.num_blocks:
+            raise CorruptShare("inconsistent num_segments in UEB")
+
+        sh_data = self._read_region(offsets['share_hashes'],
+                                    offsets['uri_extension'], "share hashes")
+        if len(sh_data) % (2+HASH_SIZE):
+            raise CorruptShare("share hash chain is malformed")
+        share_hashes = {}
+        for i in range(0, len(sh_data), 2+HASH_SIZE):
+            (hashnum,) = struct.unpack(">H", sh_data[i:i+2])
+            share_hashes[hashnum] = sh_data[i+2:i+2+HASH_SIZE]
+        share_hash_tree = IncompleteHashTree(N)
+        share_hash_tree.set_hashes({0: share_root_hash})
+        self._set_hashes(share_hash_tree, "share hash chain",
+                         hashes=share_hashes)
+        share_hash = share_hash_tree.get_leaf(self.shnum)
+        if share_hash is None:
+            raise CorruptShare("share hash chain does not reach this share")
+
+        self.block_hash_tree = IncompleteHashTree(self.num_blocks)
+        self.block_hash_tree.set_hashes({0: share_hash})
+        bh_data = self._read_region(offsets['block_hashes'],
+                                    offsets['share_hashes'], "block hashes")
+        blockhashes = [bh_data[i:i+HASH_SIZE]
+                       for i in range(0, len(bh_data), HASH_SIZE)]
+        if len(blockhashes) < len(self.block_hash_tree):
+            raise CorruptShare("block hash tree is incomplete")
+        self._set_hashes(self.block_hash_tree, "block hash tree",
+                         hashes=dict(enumerate(blockhashes)))
+
+        crypttext_hash_tree = IncompleteHashTree(self.num_blocks)
+        crypttext_hash_tree.set_hashes({0: crypttext_root_hash})
+        ct_data = self._read_region(offsets['crypttext_hash_tree'],
+                                    offsets['block_hashes'],
+                                    "crypttext hashes")
+        ct_hashes = [ct_data[i:i+HASH_SIZE]
+                     for i in range(0, len(ct_data), HASH_SIZE)]
+        if len(ct_hashes) < len(crypttext_hash_tree):
+            raise CorruptShare("crypttext hash tree is incomplete")
+        self._set_hashes(crypttext_hash_tree, "crypttext hash tree",
+                         hashes=dict(enumerate(ct_hashes)))
+
+    def check_block(self, blocknum):
+        if blocknum < self.num_blocks-1:
+            thisblocksize = self.block_size
+        else:
+            thisblocksize = self.share_size % self.block_size
+            if thisblocksize == 0:
+                thisblocksize = self.block_size
+        data = self._read(self._data_offset + blocknum*self.block_size,
+                          thisblocksize)
+        self._set_hashes(self.block_hash_tree, "block %d" % blocknum,
+                         leaves={blocknum: block_hash(data)})
+        return len(data)
+
+
+class ShareScrubber(ShareCrawler):
+    """I read every immutable share on this server and verify its blocks
+    against its block hash tree, share hash chain and UEB, just as a
+    client-side verify would, but without sending any of it over the
+    network. The outcome for each share (whether it is intact, the hash of
+    its UEB, and why it is not) is kept in a small sqlite database, from
+    which get_results() answers RIStorageServer.get_scrub_results().
+
+    Large shares are not read in one go: I check the time after each block,
+    and if this time slice is over, I remember where I was and pick up from
+    the same block in the next slice, so the usual allowed_cpu_percentage
+    throttle applies even to multi-gigabyte shares.
+
+    Mutable shares are skipped, since a server cannot check their
+    signatures any better than their hashes without knowing the public key
+    that they claim. Packed shares (see allmydata.storage.packs) are not
+    scrubbed yet either.
+
+    My state includes the following keys::
+
+     cycle-to-date: examined-shares, examined-bytes, good-shares,
+                    corrupt-shares, skipped-shares (counts for this cycle)
+     history: maps cyclenum to the cycle-to-date dict of the last 10
+              cycles, plus cycle-start-finish-times
+     scrub-position: None, or (prefixdir, si_b32, shnum, blocknum) of the
+                     next block to check in a partly-scrubbed share
+    """
+
+    slow_start = 15*60 # wait 15 minutes after startup
+    allowed_cpu_percentage = .05
+    minimum_cycle_time = 7*24*60*60 # not more than once per week
+
+    def __init__(self, server, statefile, dbfile,
+                 allowed_cpu_percentage=None):
+        self.db = get_scrubberdb(dbfile)
+        self._deadline = None
+        ShareCrawler.__init__(self, server, statefile, allowed_cpu_percentage)
+
+    def add_initial_state(self):
+        so_far = self.create_empty_cycle_dict()
+        self.state.setdefault("cycle-to-date", so_far)
+        for k in so_far:
+            self.state["cycle-to-date"].setdefault(k, so_far[k])
+        self.state.setdefault("history", {})
+        self.state.setdefault("scrub-position", None)
+
+    def create_empty_cycle_dict(self):
+        return {"examined-shares": 0,
+                "examined-bytes": 0,
+                "good-shares": 0,
+                "corrupt-shares": 0,
+                "skipped-shares": 0,
+                }
+
+    def save_state(self):
+        # commit the results along with the position, so that a restart
+        # repeats as little work as possible
+        self.db.commit()
+        ShareCrawler.save_state(self)
+
+    def started_cycle(self, cycle):
+        self.state["cycle-to-date"] = self.create_empty_cycle_dict()
+        self.state["scrub-position"] = None
+
+    def process_prefixdir(self, cycle, prefix, prefixdir, buckets,
+                          start_slice):
+        # process_bucket() needs to know when to give up, in the middle of
+        # a large share
+        self._deadline = start_slice + self.cpu_slice
+        ShareCrawler.process_prefixdir(self, cycle, prefix, prefixdir,
+                                       buckets, start_slice)
+
+    def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
+        bucketdir = os.path.join(prefixdir, storage_index_b32)
+        start_shnum, start_block = 0, 0
+        position = self.state["scrub-position"]
+        if position is not None and position[:2] == (prefixdir,
+                                                     storage_index_b32):
+            start_shnum, start_block = position[2:]
+        try:
+            names = os.listdir(bucketdir)
+        except EnvironmentError:
+            # deleted since the prefix was listed
+            names = []
+        shnums = sorted([int(fn) for fn in names if NUM_RE.match(fn)])
+        for shnum in shnums:
+            if shnum < start_shnum:
+                continue
+            first_block = 0
+            if shnum == start_shnum:
+                first_block = start_block
+            self.scrub_share(prefixdir, storage_index_b32, shnum,
+                             os.path.join(bucketdir, "%d" % shnum),
+                             first_block)
+        self.state["scrub-position"] = None
+
+    def scrub_share(self, prefixdir, storage_index_b32, shnum, filename,
+                    first_block=0):
+        so_far = self.state["cycle-to-date"]
+        v = None
+        try:
+            try:
+                sf = get_share_file(filename)
+            except (UnknownMutableContainerVersionError,
+                    UnknownImmutableContainerVersionError,
+                    struct.error, EnvironmentError) as e:
+                raise CorruptShare("unreadable share container: %s" % (e,))
+            if sf.sharetype != "immutable":
+                so_far["skipped-shares"] += 1
+                return
+            v = ShareVerifier(sf, shnum)
+            v.check_hashes()
+            for blocknum in range(first_block, v.num_blocks):
+                v.check_block(blocknum)
+                if (blocknum+1 < v.num_blocks
+                    and time.time() >= self._deadline):
+                    self.state["scrub-position"] = (prefixdir,
+                                                    storage_index_b32,
+                                                    shnum, blocknum+1)
+                    raise TimeSliceExceeded()
+        except CorruptShare as e:
+            log.msg(format="scrubber found corrupt share %(si)s-%(shnum)d:"
+                    " %(reason)s",
+                    si=storage_index_b32, shnum=shnum, reason=str(e),
+                    facility="tahoe.storage", level=log.WEIRD,
+                    umid="bQ5Lz8")
+            ueb_hash = None
+            if v is not None:
+                ueb_hash = v.ueb_hash
+            self.db.add_result(storage_index_b32, shnum, time.time(),
+                               False, ueb_hash, str(e))
+            so_far["corrupt-shares"] += 1
+        else:
+            self.db.add_result(storage_index_b32, shnum, time.time(),
+                               True, v.ueb_hash, None)
+            so_far["good-shares"] += 1
+        so_far["examined-shares"] += 1
+        try:
+            so_far["examined-bytes"] += os.stat(filename).st_size
+        except EnvironmentError:
+            pass
+
+    def finished_cycle(self, cycle):
+        start = self.state["current-cycle-start-time"]
+        h = self.state["cycle-to-date"].copy()
+        h["cycle-start-finish-times"] = (start, time.time())
+        history = self.state["history"]
+        history[cycle] = h
+        while len(history) > 10:
+            del history[min(history.keys())]
+        # any share that was not seen in this cycle has gone away
+        self.db.remove_results_before(start)
+
+    def share_removed(self, storage_index, shnum):
+        self.db.remove_share(si_b2a(storage_index), shnum)
+
+    def get_results(self, storage_index):
+        """Return a dict mapping shnum to the outcome of the last scrub of
+        that share (see ScrubberDB.get_results), for each share of the given
+        storage index that has been scrubbed."""
+        return self.db.get_results(si_b2a(storage_index))
+
+    def get_corrupt_shares(self, limit=None):
+        return self.db.get_corrupt_shares(limit)
+
+    def get_corrupt_share_count(self):
+        return self.db.get_corrupt_share_count()
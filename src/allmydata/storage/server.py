@@ -4,8 +4,10 @@ from foolscap.api import Referenceable
 from twisted.application import service
 
 from zope.interface import implementer
-from allmydata.interfaces import RIStorageServer, IStatsProducer
+from allmydata.interfaces import RIStorageServer, IStatsProducer, \
+     ServerBusyError
 from allmydata.util import fileutil, idlib, log, time_format
+from allmydata.util.histogram import WindowedHistogram
 import allmydata # for __full_version__
 
 from allmydata.storage.common import si_b2a, si_a2b, storage_index_to_dir
@@ -17,6 +19,19 @@ from allmydata.mutable.layout import MAX_MUTABLE_SHARE_SIZE
 from allmydata.storage.immutable import ShareFile, BucketWriter, BucketReader
 from allmydata.storage.crawler import BucketCountingCrawler
 from allmydata.storage.expirer import LeaseCheckingCrawler
+from allmydata.storage.leasedb import get_leasedb, compare_leases
+from allmydata.storage.inventory import ShareInventory
+from allmydata.storage.filehandles import FileHandleCache
+from allmydata.storage.diskio import DiskIOPool
+from allmydata.storage.space import DEFAULT_REFRESH_INTERVAL, \
+     DEFAULT_REFRESH_BYTES
+from allmydata.storage.disks import ShareDisks
+from allmydata.storage.packs import PackStore, PackedShareFile
+from allmydata.storage.durability import CloseSyncer
+from allmydata.storage.scrubber import ShareScrubber
+from allmydata.storage.journal import ShareJournal
+from allmydata.storage.admission import AdmissionController
+from allmydata.storage.resumable import SuspendedUploads
 
 # storage/
 # storage/shares/incoming
@@ -28,9 +43,30 @@ from allmydata.storage.expirer import LeaseCheckingCrawler
 # Where "$START" denotes the first 10 bits worth of $STORAGEINDEX (that's 2
 # base-32 chars).
 
+# With extra_share_dirs=, each additional share directory (usually one per
+# disk) has the same $START/$STORAGEINDEX/$SHARENUM and incoming/ layout, and
+# holds all of the shares of the storage indexes that were placed on it.
+
+# With packed_shares.enabled=, small immutable shares are kept in the pack
+# files in storage/packs/ (see allmydata.storage.packs) instead.
+
 # $SHARENUM matches this regex:
 NUM_RE=re.compile("^[0-9]+$")
 
+# get_latencies() and the storage_server.latencies.* stats describe the
+# operations of this last period of time
+LATENCY_WINDOW = "1h"
+
+class _LogRecorder(object):
+    """I stand in for the StorageServer as the parent of MutableShareFiles
+    that are used in a disk I/O thread, where foolscap logging must not be
+    used. I keep their log messages in 'messages', for the server to emit
+    from the reactor thread."""
+    def __init__(self, messages):
+        self.messages = messages
+    def log(self, *args, **kwargs):
+        self.messages.append((args, kwargs))
+
 
 
 @implementer(RIStorageServer, IStatsProducer)
@@ -45,7 +81,36 @@ class StorageServer(service.MultiService, Referenceable):
                  expiration_mode="age",
                  expiration_override_lease_duration=None,
                  expiration_cutoff_date=None,
-                 expiration_sharetypes=("mutable", "immutable")):
+                 expiration_sharetypes=("mutable", "immutable"),
+                 leasedb_enabled=False,
+                 inventory_enabled=False,
+                 inventory_max_buckets=None,
+                 handle_cache_enabled=False,
+                 handle_cache_max_handles=None,
+                 threaded_io_enabled=False,
+                 threaded_io_max_threads=None,
+                 space_cache_enabled=False,
+                 space_cache_refresh_interval=None,
+                 space_cache_refresh_bytes=None,
+                 extra_share_dirs=(),
+                 share_placement="most-free",
+                 packed_shares_enabled=False,
+                 packed_shares_max_size=None,
+                 packed_shares_pack_size=None,
+                 close_sync="none",
+                 close_sync_window=None,
+                 close_sync_max_batch=None,
+                 scrubber_enabled=False,
+                 scrubber_cpu_percentage=None,
+                 journal_enabled=False,
+                 journal_full_scan_interval=None,
+                 admission_enabled=False,
+                 admission_max_client_bytes=None,
+                 admission_max_client_buckets=None,
+                 admission_max_bytes=None,
+                 mutable_growth_factor=None,
+                 resumable_uploads_enabled=False,
+                 resumable_uploads_grace_period=None):
         service.MultiService.__init__(self)
         assert isinstance(nodeid, str)
         assert len(nodeid) == 20
@@ -54,6 +119,10 @@ class StorageServer(service.MultiService, Referenceable):
         sharedir = os.path.join(storedir, "shares")
         fileutil.make_dirs(sharedir)
         self.sharedir = sharedir
+        self.sharedirs = [sharedir]
+        for d in extra_share_dirs:
+            fileutil.make_dirs(d)
+            self.sharedirs.append(d)
         # we don't actually create the corruption-advisory dir until necessary
         self.corruption_advisory_dir = os.path.join(storedir,
                                                     "corruption-advisories")
@@ -64,9 +133,90 @@ class StorageServer(service.MultiService, Referenceable):
         if self.stats_provider:
             self.stats_provider.register_producer(self)
         self.incomingdir = os.path.join(sharedir, 'incoming')
-        self._clean_incomplete()
-        fileutil.make_dirs(self.incomingdir)
         self._active_writers = weakref.WeakKeyDictionary()
+        # self.disks decides which share directory each bucket lives in, and
+        # keeps track of the space promised to uploads in progress on each
+        # one. When the space cache is enabled, it also avoids a statvfs()
+        # call for every allocation.
+        max_age = max_delta = 0
+        if space_cache_enabled:
+            max_age = space_cache_refresh_interval
+            if max_age is None:
+                max_age = DEFAULT_REFRESH_INTERVAL
+            max_delta = space_cache_refresh_bytes
+            if max_delta is None:
+                max_delta = DEFAULT_REFRESH_BYTES
+        self.disks = ShareDisks(self.sharedirs, share_placement,
+                                self.reserved_space, self.readonly_storage,
+                                max_age, max_delta)
+        self._clean_incomplete()
+        for incomingdir in self.disks.incomingdirs:
+            fileutil.make_dirs(incomingdir)
+        # when the lease database is enabled, it (rather than the lease
+        # records in each share file) is the source of truth for leases
+        self.leasedb = None
+        if leasedb_enabled:
+            self.leasedb = get_leasedb(os.path.join(storedir, "leasedb.sqlite"))
+        # when packed shares are enabled, small immutable shares are appended
+        # to a few large pack files. Their leases are kept in the lease
+        # database, since the packs are never rewritten in place.
+        self.packs = None
+        if packed_shares_enabled:
+            if self.leasedb is None:
+                raise ValueError("packed shares need the lease database"
+                                 " ([storage]leasedb.enabled = true)")
+            self.packs = PackStore(os.path.join(storedir, "packs"),
+                                   packed_shares_max_size,
+                                   packed_shares_pack_size)
+        # when the share inventory is enabled, it answers "which shares do
+        # we have for this storage index" without touching the disk
+        self.inventory = None
+        if inventory_enabled:
+            self.inventory = ShareInventory(self._get_bucket_shnums_from_disk,
+                                            inventory_max_buckets)
+        # when the handle cache is enabled, share files stay open between
+        # reads
+        self.handles = None
+        if handle_cache_enabled:
+            self.handles = FileHandleCache(handle_cache_max_handles)
+        # when threaded I/O is enabled, reads and writes of share data are
+        # done in a pool of threads rather than in the reactor
+        self.diskio = None
+        if threaded_io_enabled:
+            self.diskio = DiskIOPool(threaded_io_max_threads,
+                                     observer=self.add_latency)
+            self.diskio.setServiceParent(self)
+        # unless the close_sync policy is "none", closed immutable shares
+        # are fsync()ed into place before the close is acknowledged
+        self.syncer = None
+        if close_sync != "none":
+            self.syncer = CloseSyncer(close_sync, close_sync_window,
+                                      close_sync_max_batch, diskio=self.diskio,
+                                      observer=self.add_latency)
+        # when the share journal is enabled, every share creation, write,
+        # deletion and lease change is noted in it, so that the crawlers
+        # can visit just the buckets which have changed
+        self.journal = None
+        if journal_enabled:
+            self.journal = ShareJournal(os.path.join(storedir, "journal"))
+        # when admission control is enabled, each client may only have so
+        # many uploads in flight, and is told to come back later (and to
+        # use other servers meanwhile) when it has too many
+        self.admission = None
+        if admission_enabled:
+            self.admission = AdmissionController(admission_max_client_bytes,
+                                                 admission_max_client_buckets,
+                                                 admission_max_bytes)
+        # mutable share containers which need to grow are grown by at least
+        # this factor, so that a share which is written a piece at a time
+        # does not have to move its extra leases at every write
+        self.mutable_growth_factor = mutable_growth_factor
+        # when resumable uploads are enabled, an immutable upload whose
+        # client goes away is kept for a while instead of being aborted, so
+        # that the client can finish it when it comes back
+        self.suspended = None
+        if resumable_uploads_enabled:
+            self.suspended = SuspendedUploads(resumable_uploads_grace_period)
         log.msg("StorageServer created", facility="tahoe.storage")
 
         if reserved_space:
@@ -74,17 +224,15 @@ class StorageServer(service.MultiService, Referenceable):
                 log.msg("warning: [storage]reserved_space= is set, but this platform does not support an API to get disk statistics (statvfs(2) or GetDiskFreeSpaceEx), so this reservation cannot be honored",
                         umin="0wZ27w", level=log.UNUSUAL)
 
-        self.latencies = {"allocate": [], # immutable
-                          "write": [],
-                          "close": [],
-                          "read": [],
-                          "get": [],
-                          "writev": [], # mutable
-                          "readv": [],
-                          "add-lease": [], # both
-                          "renew": [],
-                          "cancel": [],
-                          }
+        self.latencies = {} # category -> WindowedHistogram
+        for category in ["allocate", "write", "close", "read", "get", # immutable
+                         "get-multi", "allocate-multi",
+                         "writev", "readv", # mutable
+                         "add-lease", "renew", "cancel", # both
+                         "io-wait", "io-queue-depth", # threaded I/O
+                         "sync", "sync-batch-size", # close_sync
+                         ]:
+            self.latencies[category] = WindowedHistogram()
         self.add_bucket_counter()
 
         statefile = os.path.join(self.storedir, "lease_checker.state")
@@ -96,68 +244,84 @@ class StorageServer(service.MultiService, Referenceable):
                                    expiration_cutoff_date,
                                    expiration_sharetypes)
         self.lease_checker.setServiceParent(self)
+        if journal_full_scan_interval is not None:
+            for crawler in (self.bucket_counter, self.lease_checker):
+                crawler.full_scan_interval = journal_full_scan_interval
+
+        # when the scrubber is enabled, it reads every immutable share in
+        # the background and checks it against its own hashes
+        self.scrubber = None
+        if scrubber_enabled:
+            self.add_scrubber(scrubber_cpu_percentage)
 
     def __repr__(self):
         return "<StorageServer %s>" % (idlib.shortnodeid_b2a(self.my_nodeid),)
 
+    def stopService(self):
+        if self.suspended is not None:
+            self.suspended.close()
+        if self.handles is not None:
+            self.handles.close_all()
+        if self.packs is not None:
+            self.packs.close()
+        d = service.MultiService.stopService(self)
+        if self.journal is not None:
+            # after the crawlers have saved their state
+            self.journal.close()
+        return d
+
     def have_shares(self):
         # quick test to decide if we need to commit to an implicit
         # permutation-seed or if we should use a new one
-        return bool(set(os.listdir(self.sharedir)) - set(["incoming"]))
+        for sharedir in self.sharedirs:
+            if set(os.listdir(sharedir)) - set(["incoming"]):
+                return True
+        if self.packs is not None and self.packs.get_bucket_count():
+            return True
+        return False
 
     def add_bucket_counter(self):
         statefile = os.path.join(self.storedir, "bucket_counter.state")
         self.bucket_counter = BucketCountingCrawler(self, statefile)
         self.bucket_counter.setServiceParent(self)
 
+    def add_scrubber(self, allowed_cpu_percentage=None):
+        statefile = os.path.join(self.storedir, "scrubber.state")
+        dbfile = os.path.join(self.storedir, "scrubber.sqlite")
+        self.scrubber = ShareScrubber(self, statefile, dbfile,
+                                      allowed_cpu_percentage)
+        self.scrubber.setServiceParent(self)
+
+    def journal_event(self, event, storage_index, shnum=None):
+        if self.journal is not None:
+            self.journal.record(event, storage_index, shnum)
+
     def count(self, name, delta=1):
         if self.stats_provider:
             self.stats_provider.count("storage_server." + name, delta)
 
     def add_latency(self, category, latency):
-        a = self.latencies[category]
-        a.append(latency)
-        if len(a) > 1000:
-            self.latencies[category] = a[-1000:]
+        self.latencies[category].add(latency)
 
-    def get_latencies(self):
+    def get_latencies(self, window=LATENCY_WINDOW):
         """Return a dict, indexed by category, that contains a dict of
-        latency numbers for each category. If there are sufficient samples
-        for unambiguous interpretation, each dict will contain the
+        latency numbers for each category, covering the operations of the
+        last 'window' (one of '1m', '5m' or '1h'). If there are sufficient
+        samples for unambiguous interpretation, each dict will contain the
         following keys: mean, 01_0_percentile, 10_0_percentile,
         50_0_percentile (median), 90_0_percentile, 95_0_percentile,
         99_0_percentile, 99_9_percentile.  If there are insufficient
         samples for a given percentile to be interpreted unambiguously
         that percentile will be reported as None. If no samples have been
         collected for the given category, then that category name will
-        not be present in the return value. """
+        not be present in the return value. Percentiles are accurate to
+        about one percent. """
         # note that Amazon's Dynamo paper says they use 99.9% percentile.
         output = {}
         for category in self.latencies:
-            if not self.latencies[category]:
-                continue
-            stats = {}
-            samples = self.latencies[category][:]
-            count = len(samples)
-            stats["samplesize"] = count
-            samples.sort()
-            if count > 1:
-                stats["mean"] = sum(samples) / count
-            else:
-                stats["mean"] = None
-
-            orderstatlist = [(0.01, "01_0_percentile", 100), (0.1, "10_0_percentile", 10),\
-                             (0.50, "50_0_percentile", 10), (0.90, "90_0_percentile", 10),\
-                             (0.95, "95_0_percentile", 20), (0.99, "99_0_percentile", 100),\
-                             (0.999, "99_9_percentile", 1000)]
-
-            for percentile, percentilestring, minnumtoobserve in orderstatlist:
-                if count >= minnumtoobserve:
-                    stats[percentilestring] = samples[int(percentile*count)]
-                else:
-                    stats[percentilestring] = None
-
-            output[category] = stats
+            stats = self.latencies[category].get_stats(window)
+            if stats["samplesize"]:
+                output[category] = stats
         return output
 
     def log(self, *args, **kwargs):
@@ -166,19 +330,56 @@ class StorageServer(service.MultiService, Referenceable):
         return log.msg(*args, **kwargs)
 
     def _clean_incomplete(self):
-        fileutil.rm_dir(self.incomingdir)
+        for incomingdir in self.disks.incomingdirs:
+            fileutil.rm_dir(incomingdir)
 
     def get_stats(self):
         # remember: RIStatsProvider requires that our return dict
         # contains numeric values.
         stats = { 'storage_server.allocated': self.allocated_size(), }
         stats['storage_server.reserved_space'] = self.reserved_space
+        if self.inventory is not None:
+            for name,v in self.inventory.get_stats().items():
+                stats['storage_server.inventory.%s' % name] = v
+        if self.handles is not None:
+            for name,v in self.handles.get_stats().items():
+                stats['storage_server.handle_cache.%s' % name] = v
+        if self.packs is not None:
+            for name,v in self.packs.get_stats().items():
+                stats['storage_server.packs.%s' % name] = v
+        if self.syncer is not None:
+            for name,v in self.syncer.get_stats().items():
+                stats['storage_server.close_sync.%s' % name] = v
+        if self.journal is not None:
+            for name,v in self.journal.get_stats().items():
+                stats['storage_server.journal.%s' % name] = v
+        if self.admission is not None:
+            for name,v in self.admission.get_stats().items():
+                stats['storage_server.admission.%s' % name] = v
+        if self.suspended is not None:
+            for name,v in self.suspended.get_stats().items():
+                stats['storage_server.resumable_uploads.%s' % name] = v
+        if self.scrubber is not None:
+            stats['storage_server.scrubber.corrupt_shares'] = \
+                self.scrubber.get_corrupt_share_count()
         for category,ld in self.get_latencies().items():
             for name,v in ld.items():
                 stats['storage_server.latencies.%s.%s' % (category, name)] = v
+        for window in ("1m", "5m"):
+            for category,ld in self.get_latencies(window).items():
+                for name,v in ld.items():
+                    stats['storage_server.latencies_%s.%s.%s'
+                          % (window, category, name)] = v
 
         try:
-            disk = fileutil.get_disk_stats(self.sharedir, self.reserved_space)
+            # with several share directories, these are totals over all of
+            # their disks
+            disk = {}
+            for sharedir in self.sharedirs:
+                d = fileutil.get_disk_stats(sharedir, self.reserved_space)
+                for k in ('total', 'used', 'free_for_root', 'free_for_nonroot',
+                          'avail'):
+                    disk[k] = disk.get(k, 0) + d[k]
             writeable = disk['avail'] > 0
 
             # spacetime predictors should use disk_avail / (d(disk_used)/dt)
@@ -200,6 +401,9 @@ class StorageServer(service.MultiService, Referenceable):
         stats['storage_server.accepting_immutable_shares'] = int(writeable)
         s = self.bucket_counter.get_state()
         bucket_count = s.get("last-complete-bucket-count")
+        if bucket_count and self.packs is not None:
+            # the crawler only sees buckets in the share directories
+            bucket_count += self.packs.get_bucket_count()
         if bucket_count:
             stats['storage_server.total_bucket_count'] = bucket_count
         return stats
@@ -208,30 +412,35 @@ class StorageServer(service.MultiService, Referenceable):
         """Returns available space for share storage in bytes, or None if no
         API to get this information is available."""
 
-        if self.readonly_storage:
-            return 0
-        return fileutil.get_available_space(self.sharedir, self.reserved_space)
+        return self.disks.get_available_space()
 
     def allocated_size(self):
-        space = 0
-        for bw in self._active_writers:
-            space += bw.allocated_size()
-        return space
+        return self.disks.get_reserved()
 
     def remote_get_version(self):
         remaining_space = self.get_available_space()
         if remaining_space is None:
             # We're on a platform that has no API to get disk stats.
             remaining_space = 2**64
+        # a share has to fit on a single disk
+        max_share_size = self.disks.get_largest_available_space()
+        if max_share_size is None:
+            max_share_size = 2**64
 
         version = { "http://allmydata.org/tahoe/protocols/storage/v1" :
-                    { "maximum-immutable-share-size": remaining_space,
+                    { "maximum-immutable-share-size": max_share_size,
                       "maximum-mutable-share-size": MAX_MUTABLE_SHARE_SIZE,
                       "available-space": remaining_space,
                       "tolerates-immutable-read-overrun": True,
                       "delete-mutable-shares-with-zero-length-writev": True,
                       "fills-holes-with-zero-bytes": True,
                       "prevents-read-past-end-of-share-data": True,
+                      "supports-allocate-buckets-multi": True,
+                      "supports-get-buckets-multi": True,
+                      "supports-immutable-readv": True,
+                      "supports-scrub-results": self.scrubber is not None,
+                      "supports-resumable-uploads":
+                          self.suspended is not None,
                       },
                     "application-version": str(allmydata.__full_version__),
                     }
@@ -244,6 +453,23 @@ class StorageServer(service.MultiService, Referenceable):
         # owner_num is not for clients to set, but rather it should be
         # curried into the PersonalStorageServer instance that is dedicated
         # to a particular owner.
+        (alreadygot, bucketwriters, busy) = self._allocate_buckets(
+            storage_index, renew_secret, cancel_secret, sharenums,
+            allocated_size, canary, owner_num)
+        if busy is not None and not bucketwriters and not alreadygot:
+            # say so, rather than leave the client to think we are full. If
+            # we hold some of the shares, the client needs to hear about
+            # them (and that their leases were renewed) more than it needs
+            # the hint.
+            raise busy
+        return alreadygot, bucketwriters
+
+    def _allocate_buckets(self, storage_index, renew_secret, cancel_secret,
+                          sharenums, allocated_size, canary, owner_num):
+        """Do the work of allocate_buckets(). Return (alreadygot,
+        bucketwriters, busy), where 'busy' is a ServerBusyError if some of
+        the shares were refused because the client has too many uploads in
+        flight here, and None otherwise."""
         start = time.time()
         self.count("allocate")
         alreadygot = set()
@@ -264,71 +490,193 @@ class StorageServer(service.MultiService, Referenceable):
 
         max_space_per_bucket = allocated_size
 
-        remaining_space = self.get_available_space()
+        packs = None
+        if (self.packs is not None and not self.no_storage
+            and max_space_per_bucket <= self.packs.max_share_size):
+            # small shares are uploaded into incoming/ as usual, and are
+            # then appended to a pack file, which lives on the first disk
+            packs = self.packs
+            disknum = 0
+        else:
+            # all of the shares of a storage index go on the same disk
+            disknum = self.disks.place(storage_index, max_space_per_bucket)
+        incomingdir = self.disks.incomingdirs[disknum]
+        sharedir = self.sharedirs[disknum]
+        remaining_space = self.disks.get_remaining_space(disknum)
         limited = remaining_space is not None
-        if limited:
-            # this is a bit conservative, since some of this allocated_size()
-            # has already been written to disk, where it will show up in
-            # get_available_space.
-            remaining_space -= self.allocated_size()
         # self.readonly_storage causes remaining_space <= 0
+        if self.admission is not None:
+            client = self.admission.get_client(canary)
+        busy = None
 
         # fill alreadygot with all shares that we have, not just the ones
         # they asked about: this will save them a lot of work. Add or update
         # leases for all of them: if they want us to hold shares for this
         # file, they'll want us to hold leases for this file.
-        for (shnum, fn) in self._get_bucket_shares(storage_index):
-            alreadygot.add(shnum)
-            sf = ShareFile(fn)
-            sf.add_or_renew_lease(lease_info)
+        if self.leasedb is not None:
+            alreadygot.update(self._sync_leasedb(storage_index))
+            self.leasedb.add_or_renew_leases(si_s, alreadygot, lease_info)
+        else:
+            for (shnum, fn) in self._get_bucket_shares(storage_index):
+                alreadygot.add(shnum)
+                sf = ShareFile(fn)
+                sf.add_or_renew_lease(lease_info)
+        if alreadygot:
+            self.journal_event("lease", storage_index)
 
         for shnum in sharenums:
-            incominghome = os.path.join(self.incomingdir, si_dir, "%d" % shnum)
-            finalhome = os.path.join(self.sharedir, si_dir, "%d" % shnum)
-            if os.path.exists(finalhome):
+            incominghome = os.path.join(incomingdir, si_dir, "%d" % shnum)
+            finalhome = os.path.join(sharedir, si_dir, "%d" % shnum)
+            if self._share_exists(storage_index, shnum, finalhome):
                 # great! we already have it. easy.
                 pass
-            elif os.path.exists(incominghome):
+            elif (self.suspended is not None
+                  and self.suspended.is_suspended(storage_index, shnum)):
+                # this client may be coming back for an upload that it
+                # started before its connection was lost
+                bw = self.suspended.resume(storage_index, shnum, lease_info,
+                                           max_space_per_bucket)
+                if bw is not None:
+                    bw.resume(canary)
+                    bucketwriters[shnum] = bw
+            elif self._share_is_incoming(storage_index, shnum, incominghome):
                 # Note that we don't create BucketWriters for shnums that
                 # have a partial share (in incoming/), so if a second upload
                 # occurs while the first is still in progress, the second
                 # uploader will use different storage servers.
                 pass
             elif (not limited) or (remaining_space >= max_space_per_bucket):
+                if self.admission is not None:
+                    try:
+                        self.admission.check(client, max_space_per_bucket)
+                    except ServerBusyError as e:
+                        # this client has enough uploads in flight
+                        busy = e
+                        break
                 # ok! we need to create the new share file.
                 bw = BucketWriter(self, incominghome, finalhome,
-                                  max_space_per_bucket, lease_info, canary)
+                                  max_space_per_bucket, lease_info, canary,
+                                  storage_index, shnum, diskio=self.diskio,
+                                  packs=packs, syncer=self.syncer,
+                                  suspender=self.suspended)
                 if self.no_storage:
                     bw.throw_out_all_data = True
                 bucketwriters[shnum] = bw
                 self._active_writers[bw] = 1
+                self.disks.reserve(disknum, bw, max_space_per_bucket)
+                if self.admission is not None:
+                    self.admission.charge(client, bw, max_space_per_bucket)
+                if self.inventory is not None:
+                    self.inventory.add_incoming(storage_index, shnum)
                 if limited:
                     remaining_space -= max_space_per_bucket
             else:
                 # bummer! not enough space to accept this bucket
                 pass
 
-        if bucketwriters:
-            fileutil.make_dirs(os.path.join(self.sharedir, si_dir))
+        if bucketwriters and packs is None:
+            fileutil.make_dirs(os.path.join(sharedir, si_dir))
+            self.disks.add_bucket(storage_index, disknum)
 
         self.add_latency("allocate", time.time() - start)
-        return alreadygot, bucketwriters
+        if busy is not None:
+            log.msg("storage: allocate_buckets %s refused: %s" % (si_s, busy))
+        return alreadygot, bucketwriters, busy
+
+    def remote_allocate_buckets_multi(self, requests, canary, owner_num=0):
+        start = time.time()
+        self.count("allocate-multi")
+        log.msg("storage: allocate_buckets_multi (%d storage indexes)"
+                % len(requests))
+        results = []
+        for (storage_index, renew_secret, cancel_secret,
+             sharenums, allocated_size) in requests:
+            # a busy refusal only applies to the shares of this request
+            # which we could not accept: a later one may be for smaller
+            # shares, or for shares we already hold
+            (alreadygot, bucketwriters, busy) = self._allocate_buckets(
+                storage_index, renew_secret, cancel_secret,
+                sharenums, allocated_size, canary, owner_num)
+            retry_after = None
+            if busy is not None:
+                retry_after = float(busy.retry_after)
+            results.append((alreadygot, bucketwriters, retry_after))
+        self.add_latency("allocate-multi", time.time() - start)
+        return results
+
+    def _share_exists(self, storage_index, shnum, finalhome):
+        if self.packs is not None and self.packs.has_share(storage_index, shnum):
+            return True
+        if self.inventory is not None:
+            return shnum in self.inventory.get_shnums(storage_index)
+        return os.path.exists(finalhome)
+
+    def _share_is_incoming(self, storage_index, shnum, incominghome):
+        if self.inventory is not None:
+            return self.inventory.is_incoming(storage_index, shnum)
+        return os.path.exists(incominghome)
+
+    def _open_share_file(self, filename):
+        f = open(filename, 'rb')
+        header = f.read(32)
+        f.close()
+        if header[:32] == MutableShareFile.MAGIC:
+            # note: if the share has been migrated, the renew_lease()
+            # call will throw an exception, with information to help the
+            # client update the lease.
+            return MutableShareFile(filename, self, self.handles)
+        elif header[:4] == struct.pack(">L", 1):
+            return ShareFile(filename, handles=self.handles)
+        return None # non-sharefile
 
     def _iter_share_files(self, storage_index):
         for shnum, filename in self._get_bucket_shares(storage_index):
-            f = open(filename, 'rb')
-            header = f.read(32)
-            f.close()
-            if header[:32] == MutableShareFile.MAGIC:
-                sf = MutableShareFile(filename, self)
-                # note: if the share has been migrated, the renew_lease()
-                # call will throw an exception, with information to help the
-                # client update the lease.
-            elif header[:4] == struct.pack(">L", 1):
-                sf = ShareFile(filename)
-            else:
+            sf = self._open_share_file(filename)
+            if sf is not None:
+                yield sf
+
+    def _sync_leasedb(self, storage_index):
+        """Bring the lease database up to date with the shares of this
+        bucket that are present on disk, and return a dict mapping shnum to
+        sharetype for all of them. Shares that the database has not seen
+        before (because they predate it) are migrated by copying the leases
+        out of their share files, and shares which have vanished from disk
+        are forgotten."""
+        si_s = si_b2a(storage_index)
+        known = self.leasedb.get_shares(si_s)
+        present = {}
+        for shnum, filename in self._get_bucket_shares(storage_index):
+            if shnum in known:
+                present[shnum] = known[shnum]
+                continue
+            sf = self._open_share_file(filename)
+            if sf is None:
                 continue # non-sharefile
-            yield sf
+            self.leasedb.import_share(si_s, shnum, sf.sharetype,
+                                      list(sf.get_leases()))
+            present[shnum] = sf.sharetype
+        if self.packs is not None:
+            for shnum in self.packs.get_shnums(storage_index):
+                if shnum not in known:
+                    # it lost its lease records somehow
+                    self.leasedb.import_share(si_s, shnum, "immutable", [])
+                present[shnum] = "immutable"
+        for shnum in set(known) - set(present):
+            self.leasedb.remove_share(si_s, shnum)
+        return present
+
+    def check_leasedb(self, storage_index):
+        """Compare the lease database against the lease records in the share
+        files of one bucket, and return a list of discrepancies (which will
+        be empty if they are consistent). This does not modify either of
+        them. This method is not for client use."""
+        si_s = si_b2a(storage_index)
+        sharefiles = {}
+        for shnum, filename in self._get_bucket_shares_from_disk(storage_index):
+            sf = self._open_share_file(filename)
+            if sf is not None:
+                sharefiles[shnum] = sf
+        return compare_leases(self.leasedb, si_s, sharefiles)
 
     def remote_add_lease(self, storage_index, renew_secret, cancel_secret,
                          owner_num=1):
@@ -338,8 +686,14 @@ class StorageServer(service.MultiService, Referenceable):
         lease_info = LeaseInfo(owner_num,
                                renew_secret, cancel_secret,
                                new_expire_time, self.my_nodeid)
-        for sf in self._iter_share_files(storage_index):
-            sf.add_or_renew_lease(lease_info)
+        if self.leasedb is not None:
+            shares = self._sync_leasedb(storage_index)
+            self.leasedb.add_or_renew_leases(si_b2a(storage_index),
+                                             sorted(shares), lease_info)
+        else:
+            for sf in self._iter_share_files(storage_index):
+                sf.add_or_renew_lease(lease_info)
+        self.journal_event("lease", storage_index)
         self.add_latency("add-lease", time.time() - start)
         return None
 
@@ -348,23 +702,107 @@ class StorageServer(service.MultiService, Referenceable):
         self.count("renew")
         new_expire_time = time.time() + 31*24*60*60
         found_buckets = False
-        for sf in self._iter_share_files(storage_index):
-            found_buckets = True
-            sf.renew_lease(renew_secret, new_expire_time)
+        if self.leasedb is not None:
+            shares = self._sync_leasedb(storage_index)
+            found_buckets = bool(shares)
+            self._renew_leases_in_leasedb(storage_index, shares,
+                                          renew_secret, new_expire_time)
+        else:
+            for sf in self._iter_share_files(storage_index):
+                found_buckets = True
+                sf.renew_lease(renew_secret, new_expire_time)
+        if found_buckets:
+            self.journal_event("lease", storage_index)
         self.add_latency("renew", time.time() - start)
         if not found_buckets:
             raise IndexError("no such lease to renew")
 
+    def _renew_leases_in_leasedb(self, storage_index, shares, renew_secret,
+                                 new_expire_time):
+        si_s = si_b2a(storage_index)
+        missing = self.leasedb.renew_leases(si_s, sorted(shares),
+                                            renew_secret, new_expire_time)
+        if not missing:
+            return
+        shnum = missing[0]
+        if shares[shnum] != "mutable":
+            raise IndexError("unable to renew non-existent lease")
+        # Like MutableShareFile.renew_lease, give the client a chance to
+        # update the leases on a share which has been migrated from its
+        # original server to a new one.
+        accepting_nodeids = self.leasedb.get_lease_nodeids(si_s, shnum)
+        msg = ("Unable to renew non-existent lease. I have leases accepted by"
+               " nodeids: ")
+        msg += ",".join([("'%s'" % idlib.nodeid_b2a(anid))
+                         for anid in accepting_nodeids])
+        msg += " ."
+        raise IndexError(msg)
+
     def bucket_writer_closed(self, bw, consumed_size):
         if self.stats_provider:
             self.stats_provider.count('storage_server.bytes_added', consumed_size)
         del self._active_writers[bw]
+        disknum = self.disks.release(bw)
+        if self.admission is not None:
+            self.admission.release(bw)
+        if disknum is not None:
+            self.disks.consumed(disknum, consumed_size)
+        if self.inventory is not None and bw.storage_index is not None:
+            self.inventory.remove_incoming(bw.storage_index, bw.shnum)
+            # packed shares are found through the pack store instead
+            if consumed_size and not bw.packed:
+                self.inventory.add_share(bw.storage_index, bw.shnum)
+        if consumed_size and bw.storage_index is not None:
+            self.journal_event("create", bw.storage_index, bw.shnum)
+        if (self.leasedb is not None and consumed_size
+            and bw.storage_index is not None):
+            # the share has been moved into its final home (an aborted
+            # upload reports a consumed_size of zero)
+            si_s = si_b2a(bw.storage_index)
+            self.leasedb.add_share(si_s, bw.shnum, "immutable")
+            self.leasedb.add_or_renew_leases(si_s, [bw.shnum],
+                                             bw.get_lease_info())
+
+    def share_removed(self, storage_index, shnum):
+        """Tell me that a share file has been deleted by something other
+        than a client request, such as the lease checker."""
+        self.journal_event("delete", storage_index, shnum)
+        if self.inventory is not None:
+            self.inventory.remove_share(storage_index, shnum)
+        if self.packs is not None and self.packs.has_share(storage_index, shnum):
+            self.packs.remove_share(storage_index, shnum)
+        if self.scrubber is not None:
+            self.scrubber.share_removed(storage_index, shnum)
+        if self.handles is not None:
+            bucketdir = self.disks.get_bucket_dir(storage_index)
+            if bucketdir is not None:
+                self.handles.invalidate(os.path.join(bucketdir, "%d" % shnum))
 
     def _get_bucket_shares(self, storage_index):
         """Return a list of (shnum, pathname) tuples for files that hold
         shares for this storage_index. In each tuple, 'shnum' will always be
         the integer form of the last component of 'pathname'."""
-        storagedir = os.path.join(self.sharedir, storage_index_to_dir(storage_index))
+        if self.inventory is None:
+            return self._get_bucket_shares_from_disk(storage_index)
+        shnums = self.inventory.get_shnums(storage_index)
+        if not shnums:
+            return iter([])
+        storagedir = self.disks.get_bucket_dir(storage_index)
+        if storagedir is None:
+            return iter([])
+        return iter([(shnum, os.path.join(storagedir, "%d" % shnum))
+                     for shnum in sorted(shnums)])
+
+    def _get_bucket_shnums_from_disk(self, storage_index):
+        return [shnum for (shnum, filename)
+                in self._get_bucket_shares_from_disk(storage_index)]
+
+    def _get_bucket_shares_from_disk(self, storage_index):
+        return self._list_bucket_dir(self.disks.get_bucket_dir(storage_index))
+
+    def _list_bucket_dir(self, storagedir):
+        if storagedir is None:
+            return
         try:
             for f in os.listdir(storagedir):
                 if NUM_RE.match(f):
@@ -379,13 +817,52 @@ class StorageServer(service.MultiService, Referenceable):
         self.count("get")
         si_s = si_b2a(storage_index)
         log.msg("storage: get_buckets %s" % si_s)
+        bucketreaders = self._get_bucket_readers(storage_index)
+        self.add_latency("get", time.time() - start)
+        return bucketreaders
+
+    def _get_bucket_readers(self, storage_index):
         bucketreaders = {} # k: sharenum, v: BucketReader
         for shnum, filename in self._get_bucket_shares(storage_index):
             bucketreaders[shnum] = BucketReader(self, filename,
-                                                storage_index, shnum)
-        self.add_latency("get", time.time() - start)
+                                                storage_index, shnum,
+                                                handles=self.handles,
+                                                diskio=self.diskio)
+        if self.packs is not None:
+            for shnum in self.packs.get_shnums(storage_index):
+                sf = PackedShareFile(self.packs, storage_index, shnum)
+                bucketreaders[shnum] = BucketReader(self, None,
+                                                    storage_index, shnum,
+                                                    diskio=self.diskio,
+                                                    sharefile=sf)
         return bucketreaders
 
+    def remote_get_buckets_multi(self, storage_indexes):
+        start = time.time()
+        self.count("get-multi")
+        log.msg("storage: get_buckets_multi (%d storage indexes)"
+                % len(storage_indexes))
+        results = {} # k: storage_index, v: dict of BucketReaders
+        for storage_index in storage_indexes:
+            bucketreaders = self._get_bucket_readers(storage_index)
+            # buckets that we do not hold are left out, to keep the response
+            # small: most queries are for files that live elsewhere
+            if bucketreaders:
+                results[storage_index] = bucketreaders
+        self.add_latency("get-multi", time.time() - start)
+        return results
+
+    def remote_get_scrub_results(self, storage_indexes):
+        self.count("get-scrub-results")
+        results = {} # k: storage_index, v: dict of scrub results
+        if self.scrubber is None:
+            return results
+        for storage_index in storage_indexes:
+            shares = self.scrubber.get_results(storage_index)
+            if shares:
+                results[storage_index] = shares
+        return results
+
     def get_leases(self, storage_index):
         """Provide an iterator that yields all of the leases attached to this
         bucket. Each lease is returned as a LeaseInfo instance.
@@ -395,12 +872,16 @@ class StorageServer(service.MultiService, Referenceable):
 
         # since all shares get the same lease data, we just grab the leases
         # from the first share
-        try:
-            shnum, filename = self._get_bucket_shares(storage_index).next()
-            sf = ShareFile(filename)
+        if self.leasedb is not None:
+            shares = self._sync_leasedb(storage_index)
+            if not shares:
+                return iter([])
+            return iter(self.leasedb.get_leases(si_b2a(storage_index),
+                                                min(shares)))
+        for shnum, filename in self._get_bucket_shares(storage_index):
+            sf = ShareFile(filename, handles=self.handles)
             return sf.get_leases()
-        except StopIteration:
-            return iter([])
+        return iter([])
 
     def remote_slot_testv_and_readv_and_writev(self, storage_index,
                                                secrets,
@@ -410,21 +891,70 @@ class StorageServer(service.MultiService, Referenceable):
         self.count("writev")
         si_s = si_b2a(storage_index)
         log.msg("storage: slot_writev %s" % si_s)
-        si_dir = storage_index_to_dir(storage_index)
         (write_enabler, renew_secret, cancel_secret) = secrets
+        if self.leasedb is not None:
+            self._sync_leasedb(storage_index)
+
+        ownerid = 1 # TODO
+        expire_time = time.time() + 31*24*60*60   # one month
+        lease_info = LeaseInfo(ownerid,
+                               renew_secret, cancel_secret,
+                               expire_time, self.my_nodeid)
+
+        # new shares go on the disk which already holds the bucket, or on
+        # the one chosen by the placement policy
+        disknum = self.disks.place(storage_index)
+        bucketdir = os.path.join(self.sharedirs[disknum],
+                                 storage_index_to_dir(storage_index))
+
+        # the share files are tested, read, and written by _slot_writev_io,
+        # which may run in a disk I/O thread. It records which shares it
+        # changed, how much they grew (if the cached free space needs to be
+        # told), and what it wants logged, so that the lease database, share
+        # inventory and log can then be updated from the reactor thread, even
+        # if it fails part-way through.
+        changes = {"disk": disknum, "measure_growth": self.disks.is_caching(),
+                   "created": [], "written": [], "deleted": [], "grown": 0,
+                   "log": []}
+        if self.diskio is not None:
+            # the inventory and the disk index cannot be used from a thread,
+            # so the share files are found by listing the directory instead
+            d = self.diskio.run(storage_index, self._slot_writev_io,
+                                lambda si: self._list_bucket_dir(bucketdir),
+                                bucketdir, storage_index, secrets,
+                                test_and_write_vectors, read_vector,
+                                lease_info, changes)
+            def _done(res):
+                self._slot_writev_bookkeeping(storage_index, lease_info,
+                                              changes)
+                self.add_latency("writev", time.time() - start)
+                return res
+            d.addBoth(_done)
+            return d
+        try:
+            res = self._slot_writev_io(self._get_bucket_shares, bucketdir,
+                                       storage_index, secrets,
+                                       test_and_write_vectors, read_vector,
+                                       lease_info, changes)
+        finally:
+            self._slot_writev_bookkeeping(storage_index, lease_info, changes)
+        # all done
+        self.add_latency("writev", time.time() - start)
+        return res
+
+    def _slot_writev_io(self, get_bucket_shares, bucketdir, storage_index,
+                        secrets, test_and_write_vectors, read_vector,
+                        lease_info, changes):
+        si_s = si_b2a(storage_index)
+        (write_enabler, renew_secret, cancel_secret) = secrets
+        recorder = _LogRecorder(changes["log"])
         # shares exist if there is a file for them
-        bucketdir = os.path.join(self.sharedir, si_dir)
         shares = {}
-        if os.path.isdir(bucketdir):
-            for sharenum_s in os.listdir(bucketdir):
-                try:
-                    sharenum = int(sharenum_s)
-                except ValueError:
-                    continue
-                filename = os.path.join(bucketdir, sharenum_s)
-                msf = MutableShareFile(filename, self)
-                msf.check_write_enabler(write_enabler, si_s)
-                shares[sharenum] = msf
+        for sharenum, filename in get_bucket_shares(storage_index):
+            msf = MutableShareFile(filename, recorder, self.handles,
+                                   self.mutable_growth_factor)
+            msf.check_write_enabler(write_enabler, si_s)
+            shares[sharenum] = msf
         # write_enabler is good for all existing shares.
 
         # Now evaluate test vectors.
@@ -433,15 +963,15 @@ class StorageServer(service.MultiService, Referenceable):
             (testv, datav, new_length) = test_and_write_vectors[sharenum]
             if sharenum in shares:
                 if not shares[sharenum].check_testv(testv):
-                    self.log("testv failed: [%d]: %r" % (sharenum, testv))
+                    recorder.log("testv failed: [%d]: %r" % (sharenum, testv))
                     testv_is_good = False
                     break
             else:
                 # compare the vectors against an empty share, in which all
                 # reads return empty strings.
                 if not EmptyShare().check_testv(testv):
-                    self.log("testv failed (empty): [%d] %r" % (sharenum,
-                                                                testv))
+                    recorder.log("testv failed (empty): [%d] %r" % (sharenum,
+                                                                    testv))
                     testv_is_good = False
                     break
 
@@ -450,12 +980,6 @@ class StorageServer(service.MultiService, Referenceable):
         for sharenum, share in shares.items():
             read_data[sharenum] = share.readv(read_vector)
 
-        ownerid = 1 # TODO
-        expire_time = time.time() + 31*24*60*60   # one month
-        lease_info = LeaseInfo(ownerid,
-                               renew_secret, cancel_secret,
-                               expire_time, self.my_nodeid)
-
         if testv_is_good:
             # now apply the write vectors
             for sharenum in test_and_write_vectors:
@@ -463,37 +987,77 @@ class StorageServer(service.MultiService, Referenceable):
                 if new_length == 0:
                     if sharenum in shares:
                         shares[sharenum].unlink()
+                        changes["deleted"].append(sharenum)
                 else:
-                    if sharenum not in shares:
+                    new_share = sharenum not in shares
+                    if new_share:
                         # allocate a new share
                         allocated_size = 2000 # arbitrary, really
                         share = self._allocate_slot_share(bucketdir, secrets,
                                                           sharenum,
                                                           allocated_size,
-                                                          owner_num=0)
+                                                          owner_num=0,
+                                                          parent=recorder)
                         shares[sharenum] = share
-                    shares[sharenum].writev(datav, new_length)
-                    # and update the lease
-                    shares[sharenum].add_or_renew_lease(lease_info)
+                        changes["created"].append(sharenum)
+                    if changes["measure_growth"]:
+                        # the cached free space does not include this
+                        old_size = os.path.getsize(shares[sharenum].home)
+                        shares[sharenum].writev(datav, new_length)
+                        changes["grown"] += max(0, os.path.getsize(
+                            shares[sharenum].home) - old_size)
+                    else:
+                        shares[sharenum].writev(datav, new_length)
+                    # and update the lease. When the lease database is in
+                    # use, new share files still get their first lease, so
+                    # that they remain self-describing.
+                    if self.leasedb is None or new_share:
+                        shares[sharenum].add_or_renew_lease(lease_info)
+                    changes["written"].append(sharenum)
 
             if new_length == 0:
                 # delete empty bucket directories
                 if not os.listdir(bucketdir):
                     os.rmdir(bucketdir)
 
-
-        # all done
-        self.add_latency("writev", time.time() - start)
         return (testv_is_good, read_data)
 
+    def _slot_writev_bookkeeping(self, storage_index, lease_info, changes):
+        si_s = si_b2a(storage_index)
+        for (args, kwargs) in changes["log"]:
+            self.log(*args, **kwargs)
+        self.disks.consumed(changes["disk"], changes["grown"])
+        if changes["created"]:
+            self.disks.add_bucket(storage_index, changes["disk"])
+        for sharenum in changes["deleted"]:
+            self.share_removed(storage_index, sharenum)
+            if self.leasedb is not None:
+                self.leasedb.remove_share(si_s, sharenum)
+        for sharenum in changes["written"]:
+            if sharenum in changes["created"]:
+                self.journal_event("create", storage_index, sharenum)
+            else:
+                self.journal_event("write", storage_index, sharenum)
+        for sharenum in changes["created"]:
+            if self.inventory is not None:
+                self.inventory.add_share(storage_index, sharenum)
+            if self.leasedb is not None:
+                self.leasedb.add_share(si_s, sharenum, "mutable")
+        if self.leasedb is not None and changes["written"]:
+            self.leasedb.add_or_renew_leases(si_s, changes["written"],
+                                             lease_info)
+
     def _allocate_slot_share(self, bucketdir, secrets, sharenum,
-                             allocated_size, owner_num=0):
+                             allocated_size, owner_num=0, parent=None):
         (write_enabler, renew_secret, cancel_secret) = secrets
         my_nodeid = self.my_nodeid
         fileutil.make_dirs(bucketdir)
         filename = os.path.join(bucketdir, "%d" % sharenum)
+        if parent is None:
+            parent = self
         share = create_mutable_sharefile(filename, my_nodeid, write_enabler,
-                                         self)
+                                         parent, self.handles,
+                                         self.mutable_growth_factor)
         return share
 
     def remote_slot_readv(self, storage_index, shares, readv):
@@ -502,25 +1066,29 @@ class StorageServer(service.MultiService, Referenceable):
         si_s = si_b2a(storage_index)
         lp = log.msg("storage: slot_readv %s %s" % (si_s, shares),
                      facility="tahoe.storage", level=log.OPERATIONAL)
-        si_dir = storage_index_to_dir(storage_index)
-        # shares exist if there is a file for them
-        bucketdir = os.path.join(self.sharedir, si_dir)
-        if not os.path.isdir(bucketdir):
+        def _done(datavs):
+            log.msg("returning shares %s" % (datavs.keys(),),
+                    facility="tahoe.storage", level=log.NOISY, parent=lp)
             self.add_latency("readv", time.time() - start)
-            return {}
+            return datavs
+        if self.diskio is not None:
+            # the inventory and the disk index cannot be used from a thread
+            bucketdir = self.disks.get_bucket_dir(storage_index)
+            d = self.diskio.run(storage_index, self._slot_readv_io,
+                                lambda si: self._list_bucket_dir(bucketdir),
+                                storage_index, shares, readv)
+            d.addCallback(_done)
+            return d
+        return _done(self._slot_readv_io(self._get_bucket_shares,
+                                         storage_index, shares, readv))
+
+    def _slot_readv_io(self, get_bucket_shares, storage_index, shares, readv):
+        # shares exist if there is a file for them
         datavs = {}
-        for sharenum_s in os.listdir(bucketdir):
-            try:
-                sharenum = int(sharenum_s)
-            except ValueError:
-                continue
+        for sharenum, filename in get_bucket_shares(storage_index):
             if sharenum in shares or not shares:
-                filename = os.path.join(bucketdir, sharenum_s)
-                msf = MutableShareFile(filename, self)
+                msf = MutableShareFile(filename, handles=self.handles)
                 datavs[sharenum] = msf.readv(readv)
-        log.msg("returning shares %s" % (datavs.keys(),),
-                facility="tahoe.storage", level=log.NOISY, parent=lp)
-        self.add_latency("readv", time.time() - start)
         return datavs
 
     def remote_advise_corrupt_share(self, share_type, storage_index, shnum,
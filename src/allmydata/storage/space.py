@@ -0,0 +1,118 @@
+import time, weakref
+
+from allmydata.util import fileutil
+
+# when caching is enabled, statvfs() is called again after this many seconds
+DEFAULT_REFRESH_INTERVAL = 60
+# ... or once this many bytes have been added to the share filesystem
+DEFAULT_REFRESH_BYTES = 100*1000*1000
+
+class SpaceAccountant(object):
+    """I decide how much space a StorageServer has left for new shares.
+
+    That is the free space on the share filesystem (less the configured
+    reservation), minus the space that has been promised to uploads which
+    are still in progress. Each promise is recorded with reserve() when a
+    BucketWriter is created, and is given back with release() when the
+    upload is closed or aborted (or when the BucketWriter is garbage
+    collected without being either), so the total is always available
+    without walking the list of active writers.
+
+    The free space itself comes from a statvfs() call. If 'max_age' is zero
+    (the default), a fresh one is made for every question, just as the
+    server used to. Otherwise the answer is remembered, and only refreshed
+    once it is 'max_age' seconds old, or once 'max_delta' or more bytes
+    have been added to the share filesystem (as reported to consumed())
+    since it was taken. Until then, those added bytes are subtracted from
+    the remembered answer. Space which is freed in the meantime (by
+    deleted shares, or by other programs) is not noticed until the next
+    refresh, so the cached estimate is never more optimistic than the
+    disk.
+    """
+
+    def __init__(self, sharedir, reserved_space=0, readonly=False,
+                 max_age=0, max_delta=None):
+        self._sharedir = sharedir
+        self._reserved_space = reserved_space
+        self._readonly = readonly
+        self.max_age = max_age
+        self.max_delta = max_delta
+        self._reservations = {} # id(owner) -> (weakref to owner, size)
+        self._reserved = 0
+        self._avail = None
+        self._fetched_at = None
+        self._consumed = 0 # bytes added since the last statvfs
+        self.refreshes = 0
+
+    def reserve(self, owner, size):
+        """Promise 'size' bytes to 'owner' (usually a BucketWriter), until
+        release(owner) is called or the owner goes away."""
+        key = id(owner)
+        ref = weakref.ref(owner, lambda ref: self._forget(key))
+        self.release(owner)
+        self._reservations[key] = (ref, size)
+        self._reserved += size
+
+    def release(self, owner):
+        self._forget(id(owner))
+
+    def has_reservation(self, owner):
+        return id(owner) in self._reservations
+
+    def _forget(self, key):
+        if key in self._reservations:
+            (ref, size) = self._reservations.pop(key)
+            self._reserved -= size
+
+    def get_reserved(self):
+        """Return the number of bytes promised to uploads in progress."""
+        return self._reserved
+
+    def consumed(self, size):
+        """Note that 'size' bytes have been added to the share filesystem
+        (by a closed upload, or a mutable write), which a cached statvfs()
+        result does not know about yet."""
+        self._consumed += size
+
+    def _is_stale(self, now):
+        if self._fetched_at is None:
+            return True
+        if now - self._fetched_at >= self.max_age:
+            return True
+        if self.max_delta is not None and self._consumed >= self.max_delta:
+            return True
+        return False
+
+    def get_available_space(self, now=None):
+        """Return the free space on the share filesystem less the reserved
+        space (but not less any reservations: see get_remaining_space), or
+        None if this platform offers no API to find it."""
+        if self._readonly:
+            return 0
+        if now is None:
+            now = time.time()
+        if self._is_stale(now):
+            self._avail = fileutil.get_available_space(self._sharedir,
+                                                       self._reserved_space)
+            self._fetched_at = now
+            self._consumed = 0
+            self.refreshes += 1
+        if self._avail is None:
+            return None
+        return max(self._avail - self._consumed, 0)
+
+    def get_remaining_space(self, now=None):
+        """Return how many more bytes can be promised to new uploads, or
+        None if that is unknown."""
+        avail = self.get_available_space(now)
+        if avail is None:
+            return None
+        # this is a bit conservative, since some of the reserved space has
+        # already been written to disk, where it will show up in the
+        # statvfs results.
+        return avail - self._reserved
+
+    def is_caching(self):
+        """Return True if statvfs() results are kept between questions, in
+        which case callers should report the bytes they add."""
+        return self.max_age > 0
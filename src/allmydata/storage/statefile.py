@@ -0,0 +1,218 @@
+import copy, struct
+import cPickle as pickle
+
+from allmydata.util import fileutil
+
+# A StateFile holds a dict, which may contain other dicts, in a file which
+# is mostly appended to. The file starts with MAGIC, and then holds a series
+# of records, each of which is a 4-byte big-endian length and a pickled list
+# of changes:
+#
+#  ("set", path, value)
+#  ("del", path)
+#  ("extend", path, items)
+#
+# where 'path' is a tuple of the keys which lead from the top-level dict to
+# the value that changed (so the empty path means the whole dict). Loading
+# the file replays the changes in order. Saving compares the dict with what
+# was last saved, and appends a record with just the values which differ.
+# When the appended records add up to more than the size of the dict itself
+# (plus some slack), the file is rewritten with a single record that sets
+# the whole dict. A record that was only partly written (because of a crash)
+# is ignored, which leaves the dict as it was at the previous save.
+
+MAGIC = "tahoe-state-v2\n"
+LENGTH = struct.Struct(">L")
+
+_IMMUTABLE = (int, long, float, str, unicode, bool, type(None))
+
+def _flatten(d, path, leaves):
+    # a non-empty dict is represented by its leaves; everything else
+    # (including an empty dict) is a leaf
+    if type(d) is dict and d:
+        for k, v in d.iteritems():
+            _flatten(v, path + (k,), leaves)
+    else:
+        leaves[path] = d
+    return leaves
+
+def _set(d, path, value):
+    for k in path[:-1]:
+        if type(d.get(k)) is not dict:
+            d[k] = {}
+        d = d[k]
+    d[path[-1]] = value
+
+def _delete(d, path):
+    for k in path[:-1]:
+        d = d.get(k)
+        if type(d) is not dict:
+            return
+    d.pop(path[-1], None)
+
+def _get(d, path):
+    for k in path:
+        d = d[k]
+    return d
+
+def _copy(value):
+    if isinstance(value, _IMMUTABLE):
+        return value
+    return copy.deepcopy(value)
+
+def apply_changes(state, changes):
+    """Apply a list of changes (as written by StateFile) to 'state', and
+    return the result."""
+    for change in changes:
+        if change[0] == "set":
+            (what, path, value) = change
+            if not path:
+                state = value
+            else:
+                _set(state, path, value)
+        elif change[0] == "del":
+            if not change[1]:
+                state = {}
+            else:
+                _delete(state, change[1])
+        elif change[0] == "extend":
+            (what, path, items) = change
+            _get(state, path).extend(items)
+        else:
+            raise ValueError("unknown state change %r" % (change[0],))
+    return state
+
+class StateFile(object):
+    """I keep a crawler's state dict in 'filename', writing only the parts
+    which have changed since the last save.
+
+    The cost of a save is proportional to the number of values in the dict
+    (which are compared with the ones last saved, in memory) and to the size
+    of the ones that changed (which are written), rather than to the size of
+    the whole dict. Lists which have only been appended to are saved by
+    writing the new items. A file in the older format, a plain pickle of
+    the dict, is read, and replaced by the new format at the next save.
+    """
+
+    compact_slack = 64*1024 # bytes
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._saved = None # path -> leaf, as last saved or loaded
+        self._rewrite = True
+        self._snapshot_size = 0
+        self._log_size = 0
+
+    def load(self):
+        """Return the dict stored in my file, or None if there is none (or
+        if it could not be read)."""
+        self._saved = None
+        self._rewrite = True
+        try:
+            f = open(self.filename, "rb")
+        except EnvironmentError:
+            return None
+        with f:
+            data = f.read()
+        if not data.startswith(MAGIC):
+            try:
+                state = pickle.loads(data)
+            except Exception:
+                return None
+            if type(state) is not dict:
+                return None
+            # converted to the new format by the next save
+            self._remember(state)
+            return state
+        state = {}
+        offset = len(MAGIC)
+        first = True
+        try:
+            while offset + LENGTH.size <= len(data):
+                (length,) = LENGTH.unpack_from(data, offset)
+                end = offset + LENGTH.size + length
+                if end > len(data):
+                    break
+                changes = pickle.loads(data[offset + LENGTH.size:end])
+                state = apply_changes(state, changes)
+                if first:
+                    self._snapshot_size = end - len(MAGIC)
+                    first = False
+                offset = end
+        except Exception:
+            return None
+        if type(state) is not dict:
+            return None
+        self._remember(state)
+        self._log_size = offset - len(MAGIC) - self._snapshot_size
+        # a partly-written record at the end is dropped by rewriting the
+        # file, since appending after it would hide everything that follows
+        self._rewrite = (offset != len(data))
+        return state
+
+    def _remember(self, state):
+        self._saved = dict([(path, _copy(value)) for (path, value)
+                            in _flatten(state, (), {}).iteritems()])
+
+    def get_changes(self, state):
+        """Return the list of changes that would turn the dict I last saved
+        (or loaded) into 'state'."""
+        leaves = _flatten(state, (), {})
+        saved = self._saved or {}
+        deletes = []
+        changes = []
+        for path in saved:
+            if path not in leaves:
+                deletes.append(("del", path))
+        for path, value in leaves.iteritems():
+            if path in saved:
+                old = saved[path]
+                if type(old) is type(value) and old == value:
+                    continue
+                if (type(old) is list and type(value) is list
+                    and old and len(value) > len(old)
+                    and value[:len(old)] == old):
+                    changes.append(("extend", path, value[len(old):]))
+                    continue
+            changes.append(("set", path, value))
+        # delete first, in case a value is replaced by a dict (or vice versa)
+        return deletes + changes
+
+    def save(self, state):
+        """Write whatever has changed in 'state' since the last save."""
+        if self._rewrite or self._saved is None:
+            self._write_snapshot(state)
+            return
+        changes = self.get_changes(state)
+        if not changes:
+            return
+        record = self._pack(changes)
+        if self._log_size + len(record) > (self._snapshot_size
+                                           + self.compact_slack):
+            self._write_snapshot(state)
+            return
+        with open(self.filename, "ab") as f:
+            f.write(record)
+        self._log_size += len(record)
+        for change in changes:
+            if change[0] == "del":
+                del self._saved[change[1]]
+            else:
+                path = change[1]
+                self._saved[path] = _copy(_get(state, path))
+
+    def _pack(self, changes):
+        data = pickle.dumps(changes, pickle.HIGHEST_PROTOCOL)
+        return LENGTH.pack(len(data)) + data
+
+    def _write_snapshot(self, state):
+        record = self._pack([("set", (), state)])
+        tmpfile = self.filename + ".tmp"
+        with open(tmpfile, "wb") as f:
+            f.write(MAGIC)
+            f.write(record)
+        fileutil.move_into_place(tmpfile, self.filename)
+        self._snapshot_size = len(record)
+        self._log_size = 0
+        self._rewrite = False
+        self._remember(state)
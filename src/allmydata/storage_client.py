@@ -29,17 +29,20 @@ the foolscap-based server implemented in src/allmydata/storage/*.py .
 # 6: implement other sorts of IStorageClient classes: S3, etc
 
 
-import re, time, hashlib
+import re, time, hashlib, weakref
+from collections import OrderedDict
 from zope.interface import implementer
 from twisted.internet import defer
 from twisted.application import service
 
-from foolscap.api import eventually
-from allmydata.interfaces import IStorageBroker, IDisplayableServer, IServer
+from foolscap.api import eventually, Referenceable
+from allmydata.interfaces import IStorageBroker, IDisplayableServer, IServer, \
+     MAX_BUCKET_QUERIES
 from allmydata.util import log, base32, connection_status
 from allmydata.util.assertutil import precondition
 from allmydata.util.observer import ObserverList
-from allmydata.util.rrefutil import add_version_to_remote_reference
+from allmydata.util.rrefutil import add_version_to_remote_reference, \
+     get_retry_after
 from allmydata.util.hashutil import permute_server_hash
 
 # who is responsible for de-duplication?
@@ -67,6 +70,10 @@ class StorageFarmBroker(service.MultiService):
     I'm also responsible for subscribing to the IntroducerClient to find out
     about new servers as they are announced by the Introducer.
     """
+
+    # how many storage indexes to remember the permuted server order of
+    permuted_cache_size = 100
+
     def __init__(self, permute_peers, tub_maker, preferred_peers=()):
         service.MultiService.__init__(self)
         assert permute_peers # False not implemented yet
@@ -80,6 +87,13 @@ class StorageFarmBroker(service.MultiService):
         # them for it.
         self.servers = {}
         self._static_server_ids = set() # ignore announcements for these
+        # for get_servers_for_psi(): the permuted order of all of the known
+        # servers (connected or not) for recently-used storage indexes, and
+        # the (is_unpreferred, permutation_seed, serverid, server) tuples to
+        # build it from. Both are thrown away when a server is added or
+        # replaced.
+        self._permuted = OrderedDict() # psi -> [(serverid, IServer)]
+        self._permutation_seeds = None
         self.introducer_client = None
         self._threshold_listeners = [] # tuples of (threshold, Deferred)
         self._connected_high_water_mark = 0
@@ -96,6 +110,7 @@ class StorageFarmBroker(service.MultiService):
             s.setServiceParent(self)
             self.servers[server_id] = s
             s.start_connecting(self._trigger_connections)
+        self._servers_changed()
 
     def when_connected_enough(self, threshold):
         """
@@ -114,10 +129,12 @@ class StorageFarmBroker(service.MultiService):
         s.rref = rref
         s._is_connected = True
         self.servers[serverid] = s
+        self._servers_changed()
 
     def test_add_server(self, server_id, s):
         s.on_status_changed(lambda _: self._got_connection())
         self.servers[server_id] = s
+        self._servers_changed()
 
     def use_introducer(self, introducer_client):
         self.introducer_client = ic = introducer_client
@@ -161,6 +178,7 @@ class StorageFarmBroker(service.MultiService):
             # replacement
             del self.servers[server_id]
             old.stop_connecting()
+            forget_server_state(old.get_rref())
             old.disownServiceParent()
             # NOTE: this disownServiceParent() returns a Deferred that
             # doesn't fire until Tub.stopService fires, which will wait for
@@ -177,6 +195,7 @@ class StorageFarmBroker(service.MultiService):
         # now we forget about them and start using the new one
         s.setServiceParent(self)
         self.servers[server_id] = s
+        self._servers_changed()
         s.start_connecting(self._trigger_connections)
         # the descriptor will manage their own Reconnector, and each time we
         # need servers, we'll ask them if they're connected or not.
@@ -192,17 +211,47 @@ class StorageFarmBroker(service.MultiService):
         for dsc in self.servers.values():
             dsc.try_to_connect()
 
+    def _servers_changed(self):
+        self._permuted.clear()
+        self._permutation_seeds = None
+
     def get_servers_for_psi(self, peer_selection_index):
         # return a list of server objects (IServers)
         assert self.permute_peers == True
-        connected_servers = self.get_connected_servers()
-        preferred_servers = frozenset(s for s in connected_servers if s.get_longname() in self.preferred_peers)
-        def _permuted(server):
-            seed = server.get_permutation_seed()
-            is_unpreferred = server not in preferred_servers
-            return (is_unpreferred,
-                    permute_server_hash(peer_selection_index, seed))
-        return sorted(connected_servers, key=_permuted)
+        # The order depends only on which servers we know about, so it is
+        # kept for the storage indexes we've used lately: the same file is
+        # usually looked up several times in a row (servermap update, then
+        # retrieve or publish; or check, then repair). Servers connect and
+        # disconnect much more often than they are announced, so they are
+        # filtered out afterwards instead of being part of the cached order.
+        if (self._permutation_seeds is not None and
+            len(self._permutation_seeds) != len(self.servers)):
+            # somebody has been at self.servers directly
+            self._servers_changed()
+        permuted = self._permuted.pop(peer_selection_index, None)
+        if permuted is None:
+            permuted = self._permute(peer_selection_index)
+        self._permuted[peer_selection_index] = permuted
+        if len(self._permuted) > self.permuted_cache_size:
+            self._permuted.popitem(last=False)
+        servers = self.servers
+        return [s for (serverid, s) in permuted
+                if servers.get(serverid) is s and s.is_connected()]
+
+    def _permute(self, peer_selection_index):
+        if self._permutation_seeds is None:
+            self._permutation_seeds = [
+                (s.get_longname() not in self.preferred_peers,
+                 s.get_permutation_seed(), serverid, s)
+                for (serverid, s) in self.servers.items()]
+        # the preferred servers first, then permuted by hash
+        keyed = [(is_unpreferred,
+                  permute_server_hash(peer_selection_index, seed),
+                  serverid, s)
+                 for (is_unpreferred, seed, serverid, s)
+                 in self._permutation_seeds]
+        keyed.sort()
+        return [(serverid, s) for (is_unpreferred, h, serverid, s) in keyed]
 
     def get_all_serverids(self):
         return frozenset(self.servers.keys())
@@ -432,6 +481,9 @@ class NativeStorageServer(service.MultiService):
         # use s.get_rref().callRemote() and not worry about it being None.
         self._is_connected = False
         self.remote_host = None
+        # whatever we knew about its free space may be out of date by the
+        # time we reconnect
+        forget_server_state(self.rref)
 
     def stop_connecting(self):
         # used when this descriptor has been superceded by another
@@ -443,3 +495,234 @@ class NativeStorageServer(service.MultiService):
 
 class UnknownServerTypeError(Exception):
     pass
+
+
+def get_buckets(rref, storage_index):
+    """Ask the storage server behind 'rref' which shares it holds for
+    'storage_index'. This returns a Deferred that fires with the same
+    {shnum: RIBucketReader} dictionary as rref.callRemote('get_buckets').
+
+    If the server supports get_buckets_multi(), queries for different
+    storage indexes are coalesced: while one query is in flight, any others
+    for the same server are held back, and are then sent together in a
+    single remote call. A query to an idle server is sent immediately. This
+    makes a big difference for deep-check and bulk downloads, which would
+    otherwise send one query per file to every server."""
+    version = getattr(rref, "version", None) or {}
+    v1 = version.get("http://allmydata.org/tahoe/protocols/storage/v1", {})
+    if not v1.get("supports-get-buckets-multi", False):
+        return rref.callRemote("get_buckets", storage_index)
+    batcher = _bucket_query_batchers.get(rref)
+    if batcher is None:
+        batcher = _bucket_query_batchers[rref] = _BucketQueryBatcher(rref)
+    return batcher.get_buckets(storage_index)
+
+# one batcher per RemoteReference, which goes away with the connection
+_bucket_query_batchers = weakref.WeakKeyDictionary()
+
+def allocate_buckets(rref, storage_index, renew_secret, cancel_secret,
+                     sharenums, allocated_size):
+    """Ask the storage server behind 'rref' to allocate buckets for
+    'storage_index'. This returns a Deferred that fires with an
+    (alreadygot, allocated, retry_after) tuple. The first two are as
+    returned by rref.callRemote('allocate_buckets'). 'retry_after' is None,
+    unless the server refused some of the shares because we have too many
+    uploads in flight there, in which case it is how many seconds the
+    server asked us to wait.
+
+    If the server supports allocate_buckets_multi(), every request is sent
+    with it, so that a busy hint never hides the shares the server already
+    holds. Requests are coalesced in the same way as get_buckets() queries,
+    which saves a round trip per file when many uploads are running at
+    once."""
+    version = getattr(rref, "version", None) or {}
+    v1 = version.get("http://allmydata.org/tahoe/protocols/storage/v1", {})
+    if not v1.get("supports-allocate-buckets-multi", False):
+        d = rref.callRemote("allocate_buckets", storage_index,
+                            renew_secret, cancel_secret, sharenums,
+                            allocated_size, canary=Referenceable())
+        d.addCallback(lambda (alreadygot, allocated):
+                      (alreadygot, allocated, None))
+        def _busy(f):
+            retry_after = get_retry_after(f)
+            if retry_after is None:
+                return f
+            return (set(), {}, retry_after)
+        d.addErrback(_busy)
+        return d
+    batcher = _allocate_query_batchers.get(rref)
+    if batcher is None:
+        batcher = _allocate_query_batchers[rref] = _AllocateQueryBatcher(rref)
+    return batcher.allocate_buckets(storage_index, renew_secret,
+                                    cancel_secret, sharenums, allocated_size)
+
+_allocate_query_batchers = weakref.WeakKeyDictionary()
+
+class _QueryBatcher(object):
+    """I send a query to one server right away if it is idle. Otherwise I
+    hold it back until the query in flight is answered, and then send all
+    of the queries that are waiting (up to MAX_BUCKET_QUERIES of them) in a
+    single remote call, made by my subclass's _send()."""
+
+    def __init__(self, rref):
+        self._rref = rref
+        self._pending = [] # (request, Deferred)
+        self._in_flight = False
+
+    def _add(self, request):
+        d = defer.Deferred()
+        self._pending.append((request, d))
+        if not self._in_flight:
+            self._send_next_batch()
+        return d
+
+    def _send_next_batch(self):
+        batch = self._pending[:MAX_BUCKET_QUERIES]
+        self._pending = self._pending[MAX_BUCKET_QUERIES:]
+        self._in_flight = True
+        d = self._send(batch)
+        d.addBoth(self._batch_done)
+
+    def _batch_done(self, ignored):
+        self._in_flight = False
+        if self._pending:
+            self._send_next_batch()
+
+    def _failed(self, f, batch):
+        for (request, d) in batch:
+            d.errback(f)
+
+class _BucketQueryBatcher(_QueryBatcher):
+    def get_buckets(self, storage_index):
+        return self._add(storage_index)
+
+    def _send(self, batch):
+        if len(batch) == 1:
+            (storage_index, ign) = batch[0]
+            d = self._rref.callRemote("get_buckets", storage_index)
+            d.addCallback(lambda buckets: {storage_index: buckets})
+        else:
+            storage_indexes = []
+            for (storage_index, ign) in batch:
+                if storage_index not in storage_indexes:
+                    storage_indexes.append(storage_index)
+            d = self._rref.callRemote("get_buckets_multi", storage_indexes)
+        def _got(results):
+            for (storage_index, d) in batch:
+                # each caller gets their own dict, in case they modify it
+                d.callback(dict(results.get(storage_index, {})))
+        d.addCallbacks(_got, self._failed, errbackArgs=(batch,))
+        d.addErrback(log.err, format="error in _BucketQueryBatcher._send",
+                     level=log.WEIRD, umid="Fb4JqQ")
+        return d
+
+class _AllocateQueryBatcher(_QueryBatcher):
+    def allocate_buckets(self, *request):
+        return self._add(request)
+
+    def _send(self, batch):
+        # the buckets all share the one canary
+        d = self._rref.callRemote("allocate_buckets_multi",
+                                  [request for (request, ign) in batch],
+                                  canary=Referenceable())
+        def _got(results):
+            for ((request, d), result) in zip(batch, results):
+                d.callback(result)
+        d.addCallbacks(_got, self._failed, errbackArgs=(batch,))
+        d.addErrback(log.err, format="error in _AllocateQueryBatcher._send",
+                     level=log.WEIRD, umid="p0Jd2w")
+        return d
+
+
+def note_server_busy(rref, retry_after):
+    """Remember that the storage server behind 'rref' has said that it is
+    too busy for us, and has asked us not to come back for 'retry_after'
+    seconds. Uploads and downloads use is_server_busy() to prefer other
+    servers until then."""
+    if rref is None:
+        return
+    busy_until = time.time() + retry_after
+    _busy_until[rref] = max(busy_until, _busy_until.get(rref, 0))
+
+def is_server_busy(rref):
+    """Return True if the storage server behind 'rref' told us that it was
+    busy, and the time it asked us to wait has not yet passed."""
+    if rref is None or not _busy_until:
+        return False
+    busy_until = _busy_until.get(rref)
+    if busy_until is None:
+        return False
+    if time.time() >= busy_until:
+        del _busy_until[rref]
+        return False
+    return True
+
+# like the batchers, this is forgotten along with the connection
+_busy_until = weakref.WeakKeyDictionary()
+
+
+# how long a server's answer to allocate_buckets() is taken to hold
+SERVER_STATE_LIFETIME = 5*60 # seconds
+
+class _ServerState(object):
+    """What recent uploads have learned about one storage server."""
+    def __init__(self):
+        self.full_size = None # smallest share it recently had no room for
+        self.full_until = 0
+        self.latency = None # of allocate_buckets(), smoothed, in seconds
+
+def note_allocation(rref, allocated_size, allocated, refused, elapsed):
+    """Remember how the storage server behind 'rref' answered a request to
+    allocate shares of 'allocated_size' bytes: 'allocated' and 'refused' are
+    the numbers of new shares it accepted and did not accept, and 'elapsed'
+    is how many seconds it took to answer. A server which accepted none of
+    them is assumed to be full, for shares that big or bigger, for the next
+    SERVER_STATE_LIFETIME seconds (or until it accepts a share that big).
+    Upload server selection uses is_server_full() and
+    get_allocation_latency() to ask other servers first."""
+    if rref is None:
+        return
+    state = _server_states.setdefault(rref, _ServerState())
+    if state.latency is None:
+        state.latency = elapsed
+    else:
+        state.latency = 0.7 * state.latency + 0.3 * elapsed
+    now = time.time()
+    if allocated:
+        if state.full_size is not None and state.full_size <= allocated_size:
+            state.full_size = None
+    elif refused:
+        if state.full_size is None or now >= state.full_until:
+            state.full_size = allocated_size
+        else:
+            state.full_size = min(state.full_size, allocated_size)
+        state.full_until = now + SERVER_STATE_LIFETIME
+
+def is_server_full(rref, allocated_size):
+    """Return True if the storage server behind 'rref' has recently had no
+    room for a share of 'allocated_size' bytes (or less)."""
+    state = _server_states.get(rref) if rref is not None else None
+    if state is None or state.full_size is None:
+        return False
+    if time.time() >= state.full_until:
+        state.full_size = None
+        return False
+    return state.full_size <= allocated_size
+
+def get_allocation_latency(rref):
+    """Return how many seconds the storage server behind 'rref' has recently
+    been taking to answer allocate_buckets(), or None if we don't know."""
+    state = _server_states.get(rref) if rref is not None else None
+    if state is None:
+        return None
+    return state.latency
+
+def forget_server_state(rref):
+    """Forget what uploads have learned about the storage server behind
+    'rref', because the connection to it has been lost or replaced."""
+    if rref is not None:
+        _server_states.pop(rref, None)
+
+# rref -> _ServerState, shared by all uploads, and forgotten along with the
+# connection (a reconnection, or a new announcement, means a new rref)
+_server_states = weakref.WeakKeyDictionary()
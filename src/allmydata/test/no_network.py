@@ -113,6 +113,14 @@ class LocalWrapper:
             if methname == "get_buckets":
                 for shnum in res:
                     res[shnum] = LocalWrapper(res[shnum])
+            if methname == "allocate_buckets_multi":
+                for (alreadygot, allocated, retry_after) in res:
+                    for shnum in allocated:
+                        allocated[shnum] = LocalWrapper(allocated[shnum])
+            if methname == "get_buckets_multi":
+                for buckets in res.values():
+                    for shnum in buckets:
+                        buckets[shnum] = LocalWrapper(buckets[shnum])
             return res
         d.addCallback(_return_membrane)
         if self.post_call_notifier:
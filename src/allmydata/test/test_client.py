@@ -272,6 +272,323 @@ class Basic(testutil.ReallyEqualMixin, testutil.NonASCIIPathMixin, unittest.Test
         with self.assertRaises(ValueError):
             yield client.create_client(basedir)
 
+    @defer.inlineCallbacks
+    def test_leasedb(self):
+        """
+        leasedb.enabled option is propagated
+        """
+        basedir = "client.Basic.test_leasedb"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "leasedb.enabled = true\n")
+        c = yield client.create_client(basedir)
+        ss = c.getServiceNamed("storage")
+        self.assertNotEqual(ss.leasedb, None)
+        self.assertTrue(os.path.exists(os.path.join(basedir, "storage",
+                                                    "leasedb.sqlite")))
+
+    @defer.inlineCallbacks
+    def test_handle_cache(self):
+        """
+        handle_cache.* options are propagated
+        """
+        basedir = "client.Basic.test_handle_cache"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "handle_cache.enabled = true\n" + \
+                           "handle_cache.max_handles = 10\n")
+        c = yield client.create_client(basedir)
+        ss = c.getServiceNamed("storage")
+        self.assertEqual(ss.handles.max_handles, 10)
+
+    @defer.inlineCallbacks
+    def test_threaded_io(self):
+        """
+        threaded_io.* options are propagated
+        """
+        basedir = "client.Basic.test_threaded_io"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "threaded_io.enabled = true\n" + \
+                           "threaded_io.max_threads = 2\n")
+        c = yield client.create_client(basedir)
+        ss = c.getServiceNamed("storage")
+        self.assertEqual(ss.diskio.max_threads, 2)
+
+    @defer.inlineCallbacks
+    def test_space_cache(self):
+        """
+        space_cache.* options are propagated
+        """
+        basedir = "client.Basic.test_space_cache"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "space_cache.enabled = true\n" + \
+                           "space_cache.refresh_interval = 30\n" + \
+                           "space_cache.refresh_bytes = 1MB\n")
+        c = yield client.create_client(basedir)
+        ss = c.getServiceNamed("storage")
+        self.assertTrue(ss.disks.is_caching())
+        self.assertEqual(ss.disks.spaces[0].max_age, 30)
+        self.assertEqual(ss.disks.spaces[0].max_delta, 1000*1000)
+
+    @defer.inlineCallbacks
+    def test_extra_share_dirs(self):
+        """
+        extra_share_dirs and share_placement are propagated
+        """
+        basedir = "client.Basic.test_extra_share_dirs"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "extra_share_dirs = disk1, disk2\n" + \
+                           "share_placement = round-robin\n")
+        c = yield client.create_client(basedir)
+        ss = c.getServiceNamed("storage")
+        self.assertEqual(ss.sharedirs,
+                         [os.path.abspath(os.path.join(basedir, "storage", "shares")),
+                          os.path.abspath(os.path.join(basedir, "disk1")),
+                          os.path.abspath(os.path.join(basedir, "disk2"))])
+        self.assertEqual(ss.disks.placement, "round-robin")
+
+    @defer.inlineCallbacks
+    def test_packed_shares(self):
+        """
+        packed_shares.* options are propagated
+        """
+        basedir = "client.Basic.test_packed_shares"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "leasedb.enabled = true\n" + \
+                           "packed_shares.enabled = true\n" + \
+                           "packed_shares.max_share_size = 16KiB\n" + \
+                           "packed_shares.pack_size = 1MB\n")
+        c = yield client.create_client(basedir)
+        ss = c.getServiceNamed("storage")
+        self.assertEqual(ss.packs.max_share_size, 16*1024)
+        self.assertEqual(ss.packs.pack_size, 1000*1000)
+
+    @defer.inlineCallbacks
+    def test_close_sync(self):
+        """
+        close_sync.* options are propagated
+        """
+        basedir = "client.Basic.test_close_sync"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "close_sync = group\n" + \
+                           "close_sync.window = 0.02\n" + \
+                           "close_sync.max_batch = 10\n")
+        c = yield client.create_client(basedir)
+        ss = c.getServiceNamed("storage")
+        self.assertTrue(ss.syncer.is_grouped())
+        self.assertEqual(ss.syncer.window, 0.02)
+        self.assertEqual(ss.syncer.max_batch, 10)
+
+    @defer.inlineCallbacks
+    def test_scrubber(self):
+        """
+        scrubber.* options are propagated
+        """
+        basedir = "client.Basic.test_scrubber"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n")
+        c = yield client.create_client(basedir)
+        ss = c.getServiceNamed("storage")
+        self.assertEqual(ss.scrubber, None)
+
+        basedir = "client.Basic.test_scrubber_enabled"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "scrubber.enabled = true\n" + \
+                           "scrubber.cpu_percentage = 2.5\n")
+        c = yield client.create_client(basedir)
+        ss = c.getServiceNamed("storage")
+        self.assertEqual(ss.scrubber.allowed_cpu_percentage, 0.025)
+        self.assertTrue(os.path.exists(os.path.join(basedir, "storage",
+                                                    "scrubber.sqlite")))
+
+    @defer.inlineCallbacks
+    def test_journal(self):
+        """
+        journal.* options are propagated
+        """
+        basedir = "client.Basic.test_journal"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n")
+        c = yield client.create_client(basedir)
+        ss = c.getServiceNamed("storage")
+        self.assertEqual(ss.journal, None)
+
+        basedir = "client.Basic.test_journal_enabled"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "journal.enabled = true\n" + \
+                           "journal.full_scan_interval = 2 days\n")
+        c = yield client.create_client(basedir)
+        ss = c.getServiceNamed("storage")
+        self.assertTrue(os.path.isdir(os.path.join(basedir, "storage",
+                                                   "journal")))
+        self.assertEqual(ss.bucket_counter.full_scan_interval, 2*24*60*60)
+        self.assertEqual(ss.lease_checker.full_scan_interval, 2*24*60*60)
+
+    @defer.inlineCallbacks
+    def test_admission(self):
+        """
+        admission.* options are propagated
+        """
+        basedir = "client.Basic.test_admission"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n")
+        c = yield client.create_client(basedir)
+        ss = c.getServiceNamed("storage")
+        self.assertEqual(ss.admission, None)
+
+        basedir = "client.Basic.test_admission_enabled"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "admission.enabled = true\n" + \
+                           "admission.max_bytes = 1GB\n" + \
+                           "admission.max_client_buckets = 50\n" + \
+                           "admission.max_client_bytes = 100MB\n")
+        c = yield client.create_client(basedir)
+        ss = c.getServiceNamed("storage")
+        self.assertEqual(ss.admission.max_bytes, 1000*1000*1000)
+        self.assertEqual(ss.admission.max_client_buckets, 50)
+        self.assertEqual(ss.admission.max_client_bytes, 100*1000*1000)
+
+    @defer.inlineCallbacks
+    def test_mutable_growth_factor(self):
+        basedir = "client.Basic.test_mutable_growth_factor"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "mutable.growth_factor = 1.5\n")
+        c = yield client.create_client(basedir)
+        ss = c.getServiceNamed("storage")
+        self.assertEqual(ss.mutable_growth_factor, 1.5)
+
+        basedir = "client.Basic.test_mutable_growth_factor_bad"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "mutable.growth_factor = 0.5\n")
+        with self.assertRaises(ValueError):
+            yield client.create_client(basedir)
+
+    @defer.inlineCallbacks
+    def test_resumable_uploads(self):
+        """
+        resumable_uploads.* options are propagated
+        """
+        basedir = "client.Basic.test_resumable_uploads"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n")
+        c = yield client.create_client(basedir)
+        ss = c.getServiceNamed("storage")
+        self.assertEqual(ss.suspended, None)
+
+        basedir = "client.Basic.test_resumable_uploads_enabled"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "resumable_uploads.enabled = true\n" + \
+                           "resumable_uploads.grace_period = 600\n")
+        c = yield client.create_client(basedir)
+        ss = c.getServiceNamed("storage")
+        self.assertEqual(ss.suspended.grace_period, 600)
+
+    @defer.inlineCallbacks
+    def test_worker_pool(self):
+        """
+        worker_pool.* options are propagated
+        """
+        basedir = "client.Basic.test_worker_pool"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), BASECONFIG)
+        c = yield client.create_client(basedir)
+        self.assertEqual(c.worker_pool, None)
+
+        basedir = "client.Basic.test_worker_pool_enabled"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "worker_pool.enabled = true\n" + \
+                           "worker_pool.max_workers = 3\n" + \
+                           "worker_pool.processes = false\n")
+        c = yield client.create_client(basedir)
+        self.assertEqual(c.worker_pool.max_workers, 3)
+        self.assertEqual(c.worker_pool.use_processes, False)
+        self.assertIdentical(c.getServiceNamed("worker-pool"), c.worker_pool)
+
+    @defer.inlineCallbacks
+    def test_pipeline_max_bytes(self):
+        """
+        upload.pipeline_max_bytes is propagated to the uploader
+        """
+        basedir = "client.Basic.test_pipeline_max_bytes"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), BASECONFIG)
+        c = yield client.create_client(basedir)
+        self.assertEqual(c.getServiceNamed("uploader").window_budget.max_bytes,
+                         32*1000*1000)
+
+        basedir = "client.Basic.test_pipeline_max_bytes_set"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "upload.pipeline_max_bytes = 4MiB\n")
+        c = yield client.create_client(basedir)
+        self.assertEqual(c.getServiceNamed("uploader").window_budget.max_bytes,
+                         4*1024*1024)
+
     @defer.inlineCallbacks
     def test_web_apiauthtoken(self):
         """
@@ -2,6 +2,7 @@ from __future__ import print_function
 
 import time
 import os.path
+import cPickle as pickle
 from twisted.trial import unittest
 from twisted.application import service
 from twisted.internet import defer
@@ -9,7 +10,10 @@ from foolscap.api import eventually, fireEventually
 
 from allmydata.util import fileutil, hashutil, pollmixin
 from allmydata.storage.server import StorageServer, si_b2a
-from allmydata.storage.crawler import ShareCrawler, TimeSliceExceeded
+from allmydata.storage.crawler import ShareCrawler, TimeSliceExceeded, \
+     BucketCountingCrawler
+from allmydata.storage.journal import ShareJournal
+from allmydata.storage.statefile import StateFile
 
 from allmydata.test.test_storage import FakeCanary
 from allmydata.test.common_util import StallMixin
@@ -438,3 +442,129 @@ class Basic(unittest.TestCase, StallMixin, pollmixin.PollMixin):
         d.addCallback(_check)
         return d
 
+
+    def test_incremental(self):
+        self.basedir = "crawler/Basic/incremental"
+        fileutil.make_dirs(self.basedir)
+        serverid = "\x00" * 20
+        ss = StorageServer(self.basedir, serverid, journal_enabled=True)
+        ss.setServiceParent(self.s)
+        # use a small journal, so it is easy to outrun
+        ss.journal.close()
+        ss.journal = ShareJournal(os.path.join(self.basedir, "journal2"),
+                                  segment_events=2, max_segments=3)
+
+        sis = [self.write(i, ss, serverid) for i in range(10)]
+        statefile = os.path.join(self.basedir, "statefile")
+        c = BucketCountingCrawler(ss, statefile)
+        listed = []
+        original_list_prefix = c.list_prefix
+        def list_prefix(prefix):
+            listed.append(prefix)
+            return original_list_prefix(prefix)
+        c.list_prefix = list_prefix
+
+        # the first cycle must look at everything
+        c.start_current_prefix(time.time())
+        s = c.get_state()
+        self.failIf(s["current-cycle-incremental"])
+        self.failUnlessEqual(s["last-complete-bucket-count"], 10)
+        self.failUnlessEqual(len(listed), len(c.prefixes))
+        self.failUnlessEqual(s["journal-checkpoint"], 10)
+
+        # the next one only looks at the prefixes that have changed
+        new_sis = [self.write(i, ss, serverid) for i in range(10, 12)]
+        del listed[:]
+        c.start_current_prefix(time.time())
+        s = c.get_state()
+        self.failUnless(s["current-cycle-incremental"])
+        self.failUnlessEqual(s["last-complete-bucket-count"], 12)
+        self.failUnlessEqual(sorted(listed),
+                             sorted(set([si[:2] for si in new_sis])))
+        self.failUnlessEqual(s["journal-checkpoint"], 12)
+        # and the journal segments it has finished with are gone
+        self.failUnlessEqual(ss.journal.get_first_seq(), 11)
+
+        # a new crawler picks up where the old one left off
+        c2 = BucketCountingCrawler(ss, statefile)
+        self.failUnless(c2.should_be_incremental(time.time()))
+        # but not once a full crawl is due
+        c2.full_scan_interval = 0
+        self.failIf(c2.should_be_incremental(time.time()))
+
+        # if the journal has dropped events, a full crawl is done
+        sis += new_sis + [self.write(i, ss, serverid) for i in range(12, 20)]
+        self.failIf(ss.journal.has_since(12))
+        del listed[:]
+        c.start_current_prefix(time.time())
+        s = c.get_state()
+        self.failIf(s["current-cycle-incremental"])
+        self.failUnlessEqual(s["last-complete-bucket-count"], 20)
+        self.failUnlessEqual(len(listed), len(c.prefixes))
+        self.failUnlessEqual(s["journal-checkpoint"], 20)
+        ss.journal.close()
+
+class State(unittest.TestCase):
+    def test_statefile(self):
+        basedir = "crawler/State/statefile"
+        fileutil.make_dirs(basedir)
+        fn = os.path.join(basedir, "state")
+        sf = StateFile(fn)
+        self.failUnlessEqual(sf.load(), None)
+        state = {"version": 1,
+                 "counts": dict([(i, i) for i in range(1000)]),
+                 "histogram": {(0, 86400): 3},
+                 "corrupt": [],
+                 "empty": {},
+                 }
+        sf.save(state)
+        full_size = os.path.getsize(fn)
+        self.failUnlessEqual(StateFile(fn).load(), state)
+
+        # small changes are appended, without rewriting the whole thing
+        state["counts"][5] += 1
+        state["histogram"][(86400, 172800)] = 1
+        state["corrupt"].append(("si", 0))
+        state["empty"]["now"] = {"full": True}
+        del state["version"]
+        sf.save(state)
+        size = os.path.getsize(fn)
+        self.failUnless(size - full_size < 500, (size, full_size))
+        self.failUnlessEqual(StateFile(fn).load(), state)
+
+        state["corrupt"].append(("si", 1))
+        state["empty"] = {}
+        state["counts"] = "gone"
+        changes = sf.get_changes(state)
+        self.failUnlessIn(("extend", ("corrupt",), [("si", 1)]), changes)
+        self.failUnlessIn(("set", ("empty",), {}), changes)
+        self.failUnlessIn(("set", ("counts",), "gone"), changes)
+        sf.save(state)
+        self.failUnlessEqual(sf.get_changes(state), [])
+        self.failUnlessEqual(StateFile(fn).load(), state)
+
+        # the appended changes are folded together once they add up
+        sf.compact_slack = 0
+        state["counts"] = dict([(i, -i) for i in range(1000)])
+        sf.save(state)
+        rewritten_size = os.path.getsize(fn)
+        for i in range(1000):
+            state["counts"][i] += 1
+            sf.save(state)
+        self.failUnless(os.path.getsize(fn) < 3*rewritten_size)
+        self.failUnlessEqual(StateFile(fn).load(), state)
+
+        # a partly-written change is ignored
+        old_state = StateFile(fn).load()
+        with open(fn, "ab") as f:
+            f.write("\x00\x00\x01\x00partial")
+        sf2 = StateFile(fn)
+        self.failUnlessEqual(sf2.load(), old_state)
+        old_state["version"] = 2
+        sf2.save(old_state)
+        self.failUnlessEqual(StateFile(fn).load(), old_state)
+
+        # the old format, a plain pickle, can still be read
+        with open(fn, "wb") as f:
+            pickle.dump({"version": 1}, f)
+        self.failUnlessEqual(StateFile(fn).load(), {"version": 1})
@@ -10,6 +10,7 @@ from twisted.trial import unittest
 from twisted.internet import defer, reactor
 from allmydata import uri
 from allmydata.storage.server import storage_index_to_dir
+from allmydata.storage.immutable import BucketReader
 from allmydata.util import base32, fileutil, spans, log, hashutil
 from allmydata.util.consumer import download_to_data, MemoryConsumer
 from allmydata.immutable import upload, layout
@@ -21,6 +22,7 @@ from allmydata.immutable.downloader.common import BadSegmentNumberError, \
      BadCiphertextHashError, COMPLETE, OVERDUE, DEAD
 from allmydata.immutable.downloader.status import DownloadStatus
 from allmydata.immutable.downloader.fetcher import SegmentFetcher
+from allmydata.immutable.downloader.share import Share
 from allmydata.codec import CRSDecoder
 from foolscap.eventual import eventually, fireEventually, flushEventualQueue
 
@@ -613,6 +615,103 @@ class DownloadTest(_Base, unittest.TestCase):
         d.addCallback(_got_data)
         return d
 
+    def test_download_readv(self):
+        self.basedir = self.mktemp()
+        self.set_up_grid(num_clients=2)
+        calls = {"read": 0, "readv": 0}
+        original_read = BucketReader.remote_read
+        original_readv = BucketReader.remote_readv
+        def remote_read(br, *args):
+            calls["read"] += 1
+            return original_read(br, *args)
+        def remote_readv(br, *args):
+            calls["readv"] += 1
+            return original_readv(br, *args)
+        self.patch(BucketReader, "remote_read", remote_read)
+        self.patch(BucketReader, "remote_readv", remote_readv)
+        def _set_readv(supported):
+            for c in self.g.clients:
+                for s in c.storage_broker.get_connected_servers():
+                    v1 = s.get_version()["http://allmydata.org/tahoe/protocols/storage/v1"]
+                    v1["supports-immutable-readv"] = supported
+
+        data = (plaintext*100)[:30000]
+        u = upload.Data(data, None)
+        u.max_segment_size = 6000 # 5 segs, so each needs its own hashes
+        d = self.g.clients[0].upload(u)
+        def _uploaded(ur):
+            self.uri = ur.get_uri()
+            # first as an older server would be used, with one read() per
+            # range
+            _set_readv(False)
+            n = self.g.clients[0].create_node_from_uri(self.uri)
+            return download_to_data(n)
+        d.addCallback(_uploaded)
+        def _got_data_without_readv(res):
+            self.failUnlessEqual(res, data)
+            self.failUnlessEqual(calls["readv"], 0)
+            self.without_readv = calls["read"]
+            calls["read"] = 0
+            _set_readv(True)
+            # a different client, so that nothing is cached
+            n = self.g.clients[1].create_node_from_uri(self.uri)
+            return download_to_data(n)
+        d.addCallback(_got_data_without_readv)
+        def _got_data_with_readv(res):
+            self.failUnlessEqual(res, data)
+            self.failUnless(calls["readv"] > 0, (calls, self.without_readv))
+            # each block and the hashes for it arrive together
+            with_readv = calls["read"] + calls["readv"]
+            self.failUnless(with_readv * 2 < self.without_readv,
+                            (calls, self.without_readv))
+        d.addCallback(_got_data_with_readv)
+        return d
+
+    def test_download_readv_error(self):
+        self.basedir = self.mktemp()
+        self.set_up_grid(num_clients=2)
+        for c in self.g.clients:
+            for s in c.storage_broker.get_connected_servers():
+                v1 = s.get_version()["http://allmydata.org/tahoe/protocols/storage/v1"]
+                v1["supports-immutable-readv"] = True
+        # the share which asks first for several ranges at once is broken
+        broken = []
+        failed = []
+        original_readv = BucketReader.remote_readv
+        def remote_readv(br, readv):
+            if not broken:
+                broken.append(br)
+            if br in broken:
+                failed.append(len(readv))
+                raise IOError("disk error")
+            return original_readv(br, readv)
+        fails = []
+        original_fail = Share._fail
+        def _fail(share, f, level=log.WEIRD):
+            fails.append(share._shnum)
+            return original_fail(share, f, level)
+
+        data = (plaintext*100)[:30000]
+        u = upload.Data(data, None)
+        u.max_segment_size = 6000 # 5 segs, so each needs its own hashes
+        d = self.g.clients[0].upload(u)
+        def _uploaded(ur):
+            self.patch(BucketReader, "remote_readv", remote_readv)
+            self.patch(Share, "_fail", _fail)
+            # a different client, so that nothing is cached
+            n = self.g.clients[1].create_node_from_uri(ur.get_uri())
+            return download_to_data(n)
+        d.addCallback(_uploaded)
+        def _got_data(res):
+            self.failUnlessEqual(res, data)
+            self.failUnless(failed, failed)
+            self.failUnless(max(failed) > 1, failed)
+            # the share was abandoned once for each failed readv, rather
+            # than once for each range in it
+            self.failUnlessEqual(fails, [broken[0].shnum] * len(failed))
+        d.addCallback(_got_data)
+        return d
+
     def test_download_segment(self):
         self.basedir = self.mktemp()
         self.set_up_grid()
@@ -2,13 +2,15 @@ from zope.interface import implementer
 from twisted.trial import unittest
 from twisted.internet import defer
 from twisted.python.failure import Failure
-from foolscap.api import fireEventually
+from foolscap.api import fireEventually, flushEventualQueue
 from allmydata import uri
 from allmydata.immutable import encode, upload, checker
-from allmydata.util import hashutil
+from allmydata.util import hashutil, workerpool
 from allmydata.util.assertutil import _assert
 from allmydata.util.consumer import download_to_data
-from allmydata.interfaces import IStorageBucketWriter, IStorageBucketReader
+from allmydata.mutable.publish import MutableData
+from allmydata.interfaces import IStorageBucketWriter, IStorageBucketReader, \
+     UploadUnhappinessError
 from allmydata.test.no_network import GridTestMixin
 
 class LostPeerError(Exception):
@@ -156,6 +158,34 @@ class FakeBucketReaderWriterProxy(object):
         d.addCallback(_try)
         return d
 
+class PausingBucketWriterProxy(FakeBucketReaderWriterProxy):
+    # put_block() does not finish until the test says so
+    def __init__(self, *args, **kwargs):
+        FakeBucketReaderWriterProxy.__init__(self, *args, **kwargs)
+        self.pending = {} # segmentnum -> Deferred
+
+    def put_block(self, segmentnum, data):
+        d = defer.Deferred()
+        self.pending[segmentnum] = d
+        d.addCallback(lambda ign:
+                      FakeBucketReaderWriterProxy.put_block(self, segmentnum,
+                                                            data))
+        return d
+
+    def finish_block(self, segmentnum, failure=None):
+        d = self.pending.pop(segmentnum)
+        if failure:
+            d.errback(failure)
+        else:
+            d.callback(None)
+
+class FakeProgress(object):
+    def __init__(self):
+        self.progress = []
+    def set_progress_total(self, total):
+        pass
+    def set_progress(self, done):
+        self.progress.append(done)
 
 def make_data(length):
     data = "happy happy joy joy" * 100
@@ -349,6 +379,144 @@ class Encode(unittest.TestCase):
         # 5 segments: 25, 25, 25, 25, 1
         return self.do_encode(25, 101, 100, 5, 15, 8)
 
+    @defer.inlineCallbacks
+    def test_piece_aligned_reads(self):
+        # EncryptAnUploadable ends its ciphertext chunks at the boundaries
+        # of the pieces the Encoder cuts each segment into, which lets the
+        # Encoder use them without copying
+        u = upload.Data(make_data(100), convergence="some convergence string")
+        u.set_default_encoding_parameters({'max_segment_size': 30,
+                                           'k': 3, 'happy': 7, 'n': 10})
+        eu = upload.EncryptAnUploadable(u)
+        e = encode.Encoder()
+        yield e.set_encrypted_uploadable(eu)
+        e._crypttext_hasher = hashutil.crypttext_hasher()
+        chunks = yield eu.read_encrypted(30, hash_only=False)
+        self.failUnlessEqual([len(c) for c in chunks], [10, 10, 10])
+        pieces = e._assemble_pieces(chunks, 3, 10,
+                                    hashutil.crypttext_segment_hasher(),
+                                    False)
+        for (piece, chunk) in zip(pieces, chunks):
+            self.failUnlessIdentical(piece, chunk)
+        yield eu.read_encrypted(60, hash_only=False)
+        # the 10-byte tail segment is cut into pieces of 4 bytes
+        chunks = yield eu.read_encrypted(12, hash_only=False)
+        self.failUnlessEqual([len(c) for c in chunks if c], [4, 4, 2])
+
+    def test_assemble_pieces(self):
+        # other IEncryptedUploadables may return chunks of any size
+        e = encode.Encoder()
+        e._crypttext_hasher = hashutil.crypttext_hasher()
+        data = "abcdefghijklmnopqrstuvwxyz"
+        for chunks in [[data[:24]], [data[:5], data[5:11], data[11:24]],
+                       [data[:8], "", data[8:16], data[16:24]]]:
+            pieces = e._assemble_pieces(chunks, 3, 8,
+                                        hashutil.crypttext_segment_hasher(),
+                                        False)
+            self.failUnlessEqual(pieces, [data[:8], data[8:16], data[16:24]])
+        # a short read is padded, if it is allowed
+        pieces = e._assemble_pieces([data[:5], data[5:10]], 3, 8,
+                                    hashutil.crypttext_segment_hasher(),
+                                    True)
+        self.failUnlessEqual(pieces, [data[:8], data[8:10] + "\x00"*6,
+                                      "\x00"*8])
+
+    @defer.inlineCallbacks
+    def start_paused_encode(self, max_segments_in_flight):
+        # 5 segments of 30 bytes, 3-of-10, sent to shareholders which only
+        # acknowledge a block when told to
+        progress = FakeProgress()
+        e = encode.Encoder(progress=progress,
+                           max_segments_in_flight=max_segments_in_flight)
+        u = upload.Data(make_data(150), convergence="some convergence string")
+        u.set_default_encoding_parameters({'max_segment_size': 30,
+                                           'k': 3, 'happy': 7, 'n': 10})
+        yield e.set_encrypted_uploadable(upload.EncryptAnUploadable(u))
+        self.failUnlessEqual(e.get_param("num_segments"), 5)
+        shareholders = {}
+        servermap = {}
+        for shnum in range(10):
+            peer = PausingBucketWriterProxy(peerid="peer%d" % shnum)
+            shareholders[shnum] = peer
+            servermap[shnum] = set([peer.get_peerid()])
+        e.set_shareholders(shareholders, servermap)
+        d = e.start()
+        yield flushEventualQueue()
+        defer.returnValue((e, d, shareholders, progress))
+
+    def _pending(self, shareholders):
+        return sorted(set([segnum for peer in shareholders.values()
+                           for segnum in peer.pending]))
+
+    @defer.inlineCallbacks
+    def _finish_segment(self, shareholders, segnum):
+        for peer in shareholders.values():
+            if segnum in peer.pending:
+                peer.finish_block(segnum)
+        yield flushEventualQueue()
+
+    @defer.inlineCallbacks
+    def test_pipeline(self):
+        (e, d, shareholders, progress) = yield self.start_paused_encode(3)
+        # three segments are encoded and sent before any is acknowledged
+        self.failUnlessEqual(self._pending(shareholders), [0, 1, 2])
+        self.failUnlessEqual(progress.progress, [])
+        # acknowledging a later segment does not count as progress until
+        # the earlier ones are done too, and does not free up a slot
+        yield self._finish_segment(shareholders, 1)
+        self.failUnlessEqual(self._pending(shareholders), [0, 2])
+        self.failUnlessEqual(progress.progress, [])
+        yield self._finish_segment(shareholders, 0)
+        self.failUnlessEqual(self._pending(shareholders), [2, 3, 4])
+        self.failUnlessEqual(progress.progress, [60])
+        for segnum in [2, 3, 4]:
+            yield self._finish_segment(shareholders, segnum)
+        self.failUnlessEqual(progress.progress, [60, 90, 120, 150])
+        verifycap = yield d
+        self.failUnlessEqual(len(verifycap.uri_extension_hash), 32)
+        for peer in shareholders.values():
+            self.failUnless(peer.closed)
+            self.failUnlessEqual(sorted(peer.blocks), [0, 1, 2, 3, 4])
+
+    @defer.inlineCallbacks
+    def test_no_pipeline(self):
+        (e, d, shareholders, progress) = yield self.start_paused_encode(1)
+        for segnum in range(5):
+            self.failUnlessEqual(self._pending(shareholders), [segnum])
+            yield self._finish_segment(shareholders, segnum)
+        yield d
+
+    @defer.inlineCallbacks
+    def test_pipeline_abort(self):
+        (e, d, shareholders, progress) = yield self.start_paused_encode(2)
+        self.failUnlessEqual(self._pending(shareholders), [0, 1])
+        e.abort()
+        yield self._finish_segment(shareholders, 0)
+        # segment 1 is still in flight, but nothing more is read
+        self.failUnlessEqual(self._pending(shareholders), [1])
+        failure = None
+        try:
+            yield d
+        except encode.UploadAborted as e:
+            failure = e
+        self.failUnless(failure)
+
+    @defer.inlineCallbacks
+    def test_pipeline_lost_shareholders(self):
+        (e, d, shareholders, progress) = yield self.start_paused_encode(3)
+        # losing shareholders while several segments are in flight: once
+        # there are too few left, the upload fails
+        for shnum in range(4):
+            shareholders[shnum].finish_block(
+                0, Failure(LostPeerError("I went away")))
+        yield flushEventualQueue()
+        failure = None
+        try:
+            yield d
+        except UploadUnhappinessError as e:
+            failure = e
+        self.failUnless(failure)
+
 
 class Roundtrip(GridTestMixin, unittest.TestCase):
 
@@ -408,3 +576,26 @@ class Roundtrip(GridTestMixin, unittest.TestCase):
             self.failUnlessEqual(newdata, DATA)
         d.addCallback(_downloaded)
         return d
+
+    @defer.inlineCallbacks
+    def test_worker_pool(self):
+        # with a worker pool, encoding, encryption and hashing (and, for
+        # mutable files, decryption) move there, with the same results
+        pool = workerpool.WorkerPool(2)
+        pool.startService()
+        self.addCleanup(lambda: pool.running and pool.stopService())
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        DATA = "p"*124
+        n = yield self.upload(DATA)
+        newdata = yield download_to_data(n)
+        self.failUnlessEqual(newdata, DATA)
+        mn = yield self.c0.create_mutable_file(MutableData(DATA))
+        newdata = yield mn.download_best_version()
+        self.failUnlessEqual(newdata, DATA)
+        ur = yield self.c0.upload(upload.Data(DATA*1000, convergence=""))
+        yield pool.stopService()
+        # the same file, encoded without the pool, gets the same cap
+        ur2 = yield self.c0.upload(upload.Data(DATA*1000, convergence=""))
+        self.failUnlessEqual(ur.get_uri(), ur2.get_uri())
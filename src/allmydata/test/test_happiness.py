@@ -2,7 +2,7 @@
 
 from twisted.trial import unittest
 from hypothesis import given
-from hypothesis.strategies import text, sets
+from hypothesis.strategies import text, sets, lists, integers
 from allmydata.immutable import happiness_upload
 
 
@@ -39,6 +39,39 @@ class HappinessUtils(unittest.TestCase):
             happiness_upload._servermap_flow_graph(set(), set(), {})
         )
 
+    @given(lists(lists(integers(min_value=0, max_value=7), max_size=10),
+                 max_size=10))
+    def test_maximum_matching(self, peer_edges):
+        """
+        maximum_matching() finds the same matching as running the
+        Edmonds-Karp algorithm over the whole residual network
+        """
+        # source, peers, 8 shares, sink
+        num_peers = len(peer_edges)
+        sink = num_peers + 8 + 1
+        graph = [range(1, num_peers + 1)]
+        for edges in peer_edges:
+            graph.append([num_peers + 1 + share for share in edges])
+        for share in range(8):
+            graph.append([sink])
+        graph.append([])
+
+        flow = [[0 for _ in graph] for _ in graph]
+        residual, capacity = happiness_upload.residual_network(graph, flow)
+        path = happiness_upload.augmenting_path_for(residual)
+        while path:
+            for (u, v) in path:
+                flow[u][v] += 1
+                flow[v][u] -= 1
+            residual, capacity = happiness_upload.residual_network(graph, flow)
+            path = happiness_upload.augmenting_path_for(residual)
+        expected = dict([(share, peer)
+                         for peer in graph[0]
+                         for share in graph[peer]
+                         if flow[peer][share] == 1])
+
+        self.assertEqual(happiness_upload.maximum_matching(graph), expected)
+
 
 class Happiness(unittest.TestCase):
 
@@ -211,6 +244,20 @@ class Happiness(unittest.TestCase):
         assert set(places.values()).issubset(peers)
         assert happiness == min(len(peers), len(shares))
 
+    def test_large_grid(self):
+        # 255 shares and 2N servers, some of which have shares already
+        peers = set(["peer%d" % i for i in range(510)])
+        shares = set(range(255))
+        peers_to_shares = dict([("peer%d" % i, set([i % 255, (i * 7) % 255]))
+                                for i in range(0, 510, 3)])
+        readonly_peers = set(["peer%d" % i for i in range(0, 510, 9)])
+
+        places = happiness_upload.share_placement(peers, readonly_peers,
+                                                  shares, peers_to_shares)
+        happiness = happiness_upload.calculate_happiness(places)
+        self.assertEqual(set(places.keys()), shares)
+        self.assertEqual(happiness, 255)
+
     def test_everything_broken(self):
         peers = set()
         shares = {u'0', u'1', u'2', u'3'}
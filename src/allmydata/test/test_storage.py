@@ -1,22 +1,33 @@
 
-import time, os.path, platform, stat, re, json, struct, shutil
+import time, os.path, platform, stat, re, json, struct, shutil, threading
 
 from twisted.trial import unittest
 
-from twisted.internet import defer
+from twisted.internet import defer, task
+from twisted.python.failure import Failure
 from twisted.application import service
-from foolscap.api import fireEventually
+from foolscap.api import fireEventually, RemoteException
 import itertools
-from allmydata import interfaces
-from allmydata.util import fileutil, hashutil, base32, pollmixin, time_format
+from allmydata import interfaces, uri
+from allmydata.immutable import upload
+from allmydata.util import fileutil, hashutil, base32, pollmixin, time_format, \
+     idlib
 from allmydata.storage.server import StorageServer
 from allmydata.storage.mutable import MutableShareFile
-from allmydata.storage.immutable import BucketWriter, BucketReader
+from allmydata.storage.immutable import BucketWriter, BucketReader, ShareFile
 from allmydata.storage.common import DataTooLargeError, storage_index_to_dir, \
-     UnknownMutableContainerVersionError, UnknownImmutableContainerVersionError
+     UnknownMutableContainerVersionError, UnknownImmutableContainerVersionError, \
+     si_a2b, si_b2a
 from allmydata.storage.lease import LeaseInfo
+from allmydata.storage.inventory import ShareInventory
+from allmydata.storage.filehandles import FileHandleCache
+from allmydata.storage.diskio import DiskIOPool
+from allmydata.storage.space import SpaceAccountant
+from allmydata.storage.packs import PackStore, RECORD_HEADER_SIZE
 from allmydata.storage.crawler import BucketCountingCrawler
 from allmydata.storage.expirer import LeaseCheckingCrawler
+from allmydata.storage.crawler import TimeSliceExceeded
+from allmydata.storage.journal import ShareJournal, JournalTruncated
 from allmydata.immutable.layout import WriteBucketProxy, WriteBucketProxy_v2, \
      ReadBucketProxy
 from allmydata.mutable.layout import MDMFSlotWriteProxy, MDMFSlotReadProxy, \
@@ -27,10 +38,12 @@ from allmydata.mutable.layout import MDMFSlotWriteProxy, MDMFSlotReadProxy, \
                                      SIGNATURE_SIZE, \
                                      VERIFICATION_KEY_SIZE, \
                                      SHARE_HASH_CHAIN_SIZE
-from allmydata.interfaces import BadWriteEnablerError
-from allmydata.test.common import LoggingServiceParent, ShouldFailMixin
+from allmydata.interfaces import BadWriteEnablerError, ServerBusyError
+from allmydata.util.rrefutil import get_retry_after
+from allmydata.test.common import LoggingServiceParent, ShouldFailMixin, \
+     TEST_DATA, _corrupt_share_data, _corrupt_share_hashes
 from allmydata.test.common_web import WebRenderingMixin
-from allmydata.test.no_network import NoNetworkServer
+from allmydata.test.no_network import NoNetworkServer, GridTestMixin
 from allmydata.web.storage import StorageStatus, remove_prefix
 
 class Marker:
@@ -104,6 +117,10 @@ class Bucket(unittest.TestCase):
         self.failUnlessEqual(br.remote_read(0, 25), "a"*25)
         self.failUnlessEqual(br.remote_read(25, 25), "b"*25)
         self.failUnlessEqual(br.remote_read(50, 7), "c"*7)
+        # several ranges at once, in any order
+        self.failUnlessEqual(br.remote_readv([(50, 7), (0, 3), (45, 10)]),
+                             ["c"*7, "a"*3, "b"*5 + "c"*5])
+        self.failUnlessEqual(br.remote_readv([]), [])
 
     def test_read_past_end_of_share_data(self):
         # test vector for immutable files (hard-coded contents of an immutable share
@@ -343,6 +360,12 @@ class Server(unittest.TestCase):
         sv1 = ver['http://allmydata.org/tahoe/protocols/storage/v1']
         self.failUnlessIn('available-space', sv1)
 
+    def test_declares_get_buckets_multi(self):
+        ss = self.create("test_declares_get_buckets_multi")
+        ver = ss.remote_get_version()
+        sv1 = ver['http://allmydata.org/tahoe/protocols/storage/v1']
+        self.failUnless(sv1.get('supports-get-buckets-multi'), sv1)
+
     def allocate(self, ss, storage_index, sharenums, size, canary=None):
         renew_secret = hashutil.tagged_hash("blah", "%d" % self._lease_secret.next())
         cancel_secret = hashutil.tagged_hash("blah", "%d" % self._lease_secret.next())
@@ -376,6 +399,62 @@ class Server(unittest.TestCase):
         reader = readers[shnum]
         self.failUnlessEqual(reader.remote_read(2**32, 2), "ab")
 
+    def test_declares_immutable_readv(self):
+        ss = self.create("test_declares_immutable_readv")
+        ver = ss.remote_get_version()
+        sv1 = ver['http://allmydata.org/tahoe/protocols/storage/v1']
+        self.failUnless(sv1.get('supports-immutable-readv'), sv1)
+
+    def test_declares_allocate_buckets_multi(self):
+        ss = self.create("test_declares_allocate_buckets_multi")
+        ver = ss.remote_get_version()
+        sv1 = ver['http://allmydata.org/tahoe/protocols/storage/v1']
+        self.failUnless(sv1.get('supports-allocate-buckets-multi'), sv1)
+
+    def test_allocate_buckets_multi(self):
+        ss = self.create("test_allocate_buckets_multi")
+        already,writers = self.allocate(ss, "si1", [0], 10)
+        writers[0].remote_write(0, "a"*10)
+        writers[0].remote_close()
+        canary = FakeCanary()
+        res = ss.remote_allocate_buckets_multi(
+            [("si1", "rs1", "cs1", set([0, 1]), 10),
+             ("si2", "rs2", "cs2", set([0, 1, 2]), 10),
+             ], canary)
+        self.failUnlessEqual(len(res), 2)
+        (already1, writers1, retry1) = res[0]
+        self.failUnlessEqual(already1, set([0]))
+        self.failUnlessEqual(set(writers1.keys()), set([1]))
+        self.failUnlessEqual(retry1, None)
+        (already2, writers2, retry2) = res[1]
+        self.failUnlessEqual(already2, set())
+        self.failUnlessEqual(set(writers2.keys()), set([0, 1, 2]))
+        self.failUnlessEqual(retry2, None)
+        self.failUnlessEqual(ss.remote_allocate_buckets_multi([], canary), [])
+        # the writers all share the one canary
+        for wb in writers1.values() + writers2.values():
+            wb.remote_abort()
+
+    def test_get_buckets_multi(self):
+        ss = self.create("test_get_buckets_multi")
+        already,writers = self.allocate(ss, "si1", [0,1], 10)
+        for i,wb in writers.items():
+            wb.remote_write(0, "%10d" % i)
+            wb.remote_close()
+        already,writers = self.allocate(ss, "si2", [5], 10)
+        wb = writers[5]
+        wb.remote_write(0, "%10d" % 5)
+        wb.remote_close()
+        # incoming shares are not visible
+        self.allocate(ss, "si3", [0], 10)
+
+        res = ss.remote_get_buckets_multi(["si1", "si2", "si3", "si4"])
+        self.failUnlessEqual(set(res.keys()), set(["si1", "si2"]))
+        self.failUnlessEqual(set(res["si1"].keys()), set([0,1]))
+        self.failUnlessEqual(set(res["si2"].keys()), set([5]))
+        self.failUnlessEqual(res["si2"][5].remote_read(0, 10), "%10d" % 5)
+        self.failUnlessEqual(ss.remote_get_buckets_multi([]), {})
+
     def test_dont_overfill_dirs(self):
         """
         This test asserts that if you add a second share whose storage index
@@ -777,6 +856,1537 @@ class Server(unittest.TestCase):
 
 
 
+class StorageServerMixin(object):
+    """I create StorageServers in storage/CLASSNAME/TESTNAME for a TestCase,
+    with the keyword arguments in 'server_kwargs' (which enable the feature
+    being tested) plus any given to create()."""
+
+    server_kwargs = {}
+
+    def setUp(self):
+        self.sparent = LoggingServiceParent()
+        self.sparent.startService()
+        self._lease_secret = itertools.count()
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def workdir(self, name):
+        return os.path.join("storage", self.__class__.__name__, name)
+
+    def create(self, name, **kwargs):
+        server_kwargs = dict(self.server_kwargs)
+        server_kwargs.update(kwargs)
+        ss = StorageServer(self.workdir(name), "\x00" * 20, **server_kwargs)
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def si(self, n):
+        return hashutil.tagged_hash("si", "%d" % n)[:16]
+
+    def secrets(self):
+        return (hashutil.tagged_hash("blah", "%d" % self._lease_secret.next()),
+                hashutil.tagged_hash("blah", "%d" % self._lease_secret.next()))
+
+class LeaseDBServer(StorageServerMixin, unittest.TestCase):
+
+    server_kwargs = {"leasedb_enabled": True}
+
+    def allocate(self, ss, storage_index, renew_secret, cancel_secret,
+                 sharenums=range(3)):
+        already,writers = ss.remote_allocate_buckets(storage_index,
+                                                     renew_secret,
+                                                     cancel_secret,
+                                                     sharenums, 100,
+                                                     FakeCanary())
+        for wb in writers.values():
+            wb.remote_write(0, "a"*100)
+            wb.remote_close()
+        return already, writers
+
+    def file_leases(self, ss, storage_index):
+        return [list(sf.get_leases())
+                for sf in ss._iter_share_files(storage_index)]
+
+    def test_immutable_leases(self):
+        ss = self.create("test_immutable_leases")
+        si_s = si_b2a("si0")
+        rs0,cs0 = self.secrets()
+        self.allocate(ss, "si0", rs0, cs0)
+        self.failUnlessEqual(ss.leasedb.get_shares(si_s),
+                             {0: "immutable", 1: "immutable", 2: "immutable"})
+        leases = list(ss.get_leases("si0"))
+        self.failUnlessEqual([l.renew_secret for l in leases], [rs0])
+
+        # additional leases go into the database, not the share files
+        rs1,cs1 = self.secrets()
+        ss.remote_add_lease("si0", rs1, cs1)
+        leases = list(ss.get_leases("si0"))
+        self.failUnlessEqual([l.renew_secret for l in leases], [rs0, rs1])
+        for shnum in range(3):
+            self.failUnlessEqual(len(ss.leasedb.get_leases(si_s, shnum)), 2)
+        for file_leases in self.file_leases(ss, "si0"):
+            self.failUnlessEqual([l.renew_secret for l in file_leases], [rs0])
+
+        # so do renewals
+        old_expiration = leases[0].expiration_time
+        ss.leasedb.cursor.execute("UPDATE leases SET expiration_time=?",
+                                  (old_expiration - 1000,))
+        ss.remote_renew_lease("si0", rs0)
+        leases = list(ss.get_leases("si0"))
+        self.failUnless(leases[0].expiration_time >= old_expiration)
+        self.failUnlessEqual(leases[1].expiration_time, old_expiration - 1000)
+        self.failUnlessRaises(IndexError, ss.remote_renew_lease, "si0", cs0)
+        self.failUnlessRaises(IndexError, ss.remote_renew_lease, "si1", rs0)
+
+        # allocating an existing bucket adds a lease too
+        rs2,cs2 = self.secrets()
+        already,writers = self.allocate(ss, "si0", rs2, cs2)
+        self.failUnlessEqual(already, set([0, 1, 2]))
+        self.failUnlessEqual(writers, {})
+        self.failUnlessEqual(len(list(ss.get_leases("si0"))), 3)
+        self.failUnlessEqual(ss.check_leasedb("si0"), [])
+
+    def test_aborted_upload(self):
+        ss = self.create("test_aborted_upload")
+        rs0,cs0 = self.secrets()
+        already,writers = ss.remote_allocate_buckets("si0", rs0, cs0, [0, 1],
+                                                     100, FakeCanary())
+        writers[0].remote_close()
+        writers[1].remote_abort()
+        self.failUnlessEqual(ss.leasedb.get_shares(si_b2a("si0")),
+                             {0: "immutable"})
+
+    def test_mutable_leases(self):
+        ss = self.create("test_mutable_leases")
+        si_s = si_b2a("si1")
+        we = hashutil.tagged_hash("we", "si1")
+        rs0,cs0 = self.secrets()
+        writev = ss.remote_slot_testv_and_readv_and_writev
+        data = "\x00" * 100
+        writev("si1", (we, rs0, cs0), {0: ([], [(0, data)], None),
+                                      1: ([], [(0, data)], None)}, [])
+        self.failUnlessEqual(ss.leasedb.get_shares(si_s),
+                             {0: "mutable", 1: "mutable"})
+        # new mutable share files get their first lease
+        for file_leases in self.file_leases(ss, "si1"):
+            self.failUnlessEqual([l.renew_secret for l in file_leases], [rs0])
+
+        rs1,cs1 = self.secrets()
+        ss.remote_add_lease("si1", rs1, cs1)
+        self.failUnlessEqual(len(ss.leasedb.get_leases(si_s, 0)), 2)
+        for file_leases in self.file_leases(ss, "si1"):
+            self.failUnlessEqual(len(file_leases), 1)
+
+        # renewing a missing lease names the nodeids that accepted the
+        # existing ones, like MutableShareFile.renew_lease does
+        e = self.failUnlessRaises(IndexError,
+                                  ss.remote_renew_lease, "si1", cs0)
+        self.failUnlessIn("I have leases accepted by nodeids:", str(e))
+        self.failUnlessIn(idlib.nodeid_b2a("\x00" * 20), str(e))
+        self.failUnlessEqual(ss.check_leasedb("si1"), [])
+
+        # deleting a share removes it from the database
+        writev("si1", (we, rs0, cs0), {0: ([], [], 0)}, [])
+        self.failUnlessEqual(ss.leasedb.get_shares(si_s), {1: "mutable"})
+        self.failUnlessEqual(ss.leasedb.get_leases(si_s, 0), [])
+
+    def test_migration(self):
+        # shares that were created before the lease database was enabled
+        # have their leases migrated out of the share files
+        ss = self.create("test_migration", leasedb_enabled=False)
+        self.failUnlessEqual(ss.leasedb, None)
+        rs0,cs0 = self.secrets()
+        rs1,cs1 = self.secrets()
+        self.allocate(ss, "si0", rs0, cs0)
+        ss.remote_add_lease("si0", rs1, cs1)
+        self.allocate(ss, "si2", rs0, cs0)
+        ss.disownServiceParent()
+        del ss
+
+        ss = self.create("test_migration")
+        self.failUnlessEqual(ss.leasedb.get_share_count(), 0)
+        problems = ss.check_leasedb("si0")
+        self.failUnlessEqual(len(problems), 3)
+        self.failUnlessIn("on disk but missing from leasedb", problems[0])
+
+        leases = list(ss.get_leases("si0"))
+        self.failUnlessEqual([l.renew_secret for l in leases], [rs0, rs1])
+        self.failUnlessEqual(ss.leasedb.get_share_count(), 3)
+        self.failUnlessEqual(ss.check_leasedb("si0"), [])
+
+        # renewals of migrated leases don't touch the share files
+        file_leases_before = self.file_leases(ss, "si2")
+        ss.leasedb.cursor.execute("UPDATE leases SET expiration_time=0")
+        ss.remote_renew_lease("si2", rs0)
+        self.failUnlessEqual(ss.leasedb.get_share_count(), 6)
+        file_leases_after = self.file_leases(ss, "si2")
+        self.failUnlessEqual(
+            [[l.expiration_time for l in ls] for ls in file_leases_before],
+            [[l.expiration_time for l in ls] for ls in file_leases_after])
+        for shnum in range(3):
+            [l] = ss.leasedb.get_leases(si_b2a("si2"), shnum)
+            self.failUnless(l.expiration_time > time.time())
+
+        # shares which disappear from disk are noticed too
+        os.unlink(os.path.join(ss.sharedir, storage_index_to_dir("si2"), "1"))
+        self.failUnlessEqual(
+            ss.check_leasedb("si2"),
+            ["%s sh1: in leasedb but missing from disk" % si_b2a("si2")])
+        self.failUnlessEqual(len(list(ss.get_leases("si2"))), 1)
+        self.failUnlessEqual(ss.check_leasedb("si2"), [])
+
+    def test_expiration_cutoff(self):
+        # the cutoff used for the index scan must agree with the per-share
+        # expiration rules in LeaseCheckingCrawler.process_share
+        ss = self.create("test_expiration_cutoff",
+                         expiration_enabled=True,
+                         expiration_mode="age",
+                         expiration_override_lease_duration=2000)
+        lc = ss.lease_checker
+        now = time.time()
+        DAY = 24*60*60
+        cutoff = lc.get_expiration_cutoff(now)
+        self.failUnlessEqual(cutoff, now + 31*DAY - 2000)
+        lc.override_lease_duration = None
+        self.failUnlessEqual(lc.get_expiration_cutoff(now), (now + 31*DAY)/2.0)
+        lc.mode = "cutoff-date"
+        lc.cutoff_date = int(now) - 5*DAY
+        self.failUnlessEqual(lc.get_expiration_cutoff(now),
+                             int(now) + 26*DAY)
+
+    def test_expire_from_leasedb(self):
+        ss = self.create("test_expire_from_leasedb",
+                         expiration_enabled=True,
+                         expiration_mode="age",
+                         expiration_override_lease_duration=2000)
+        lc = ss.lease_checker
+        rs0,cs0 = self.secrets()
+        rs1,cs1 = self.secrets()
+        self.allocate(ss, "si0", rs0, cs0, sharenums=[0])
+        self.allocate(ss, "si1", rs0, cs0, sharenums=[0])
+        ss.remote_add_lease("si1", rs1, cs1)
+        sharefile = os.path.join(ss.sharedir, storage_index_to_dir("si0"), "0")
+        share_size = os.stat(sharefile).st_size
+
+        # back-date the leases granted with rs0, so they look 1000s old
+        now = time.time()
+        ss.leasedb.cursor.execute("UPDATE leases SET expiration_time=?"
+                                  " WHERE owner_num=0",
+                                  (int(now) - 1000,))
+        ss.leasedb.connection.commit()
+        # the leases granted with rs1 (owner_num=1) are still valid
+        lc.expire_from_leasedb(now)
+
+        self.failIf(os.path.exists(sharefile))
+        self.failUnlessEqual(ss.leasedb.get_shares(si_b2a("si0")), {})
+        self.failUnlessEqual(ss.check_leasedb("si0"), [])
+        leases = list(ss.get_leases("si1"))
+        self.failUnlessEqual([l.renew_secret for l in leases], [rs1])
+        self.failUnlessEqual(len(ss.remote_get_buckets("si1")), 1)
+
+        rec = lc.state["cycle-to-date"]["space-recovered"]
+        self.failUnlessEqual(rec["actual-shares"], 1)
+        self.failUnlessEqual(rec["actual-shares-immutable"], 1)
+        self.failUnlessEqual(rec["original-shares"], 1)
+        self.failUnlessEqual(rec["configured-sharebytes"], share_size)
+
+    def test_expire_in_batches(self):
+        ss = self.create("test_expire_in_batches",
+                         expiration_enabled=True,
+                         expiration_mode="age",
+                         expiration_override_lease_duration=2000)
+        lc = ss.lease_checker
+        lc.expire_batch_size = 2
+        rs,cs = self.secrets()
+        self.allocate(ss, "si0", rs, cs, sharenums=range(5))
+        ss.leasedb.cursor.execute("UPDATE leases SET expiration_time=?",
+                                  (int(time.time()) - 1000,))
+        ss.leasedb.connection.commit()
+        lc.started_cycle(0)
+        # each slice is over after its first batch, which is committed
+        lc.cpu_slice = -1.0
+        for remaining in [3, 1, 0, 0]:
+            self.failUnlessRaises(TimeSliceExceeded,
+                                  lc.prepare_cycle, 0, time.time())
+            self.failUnlessEqual(len(ss.leasedb.get_shares(si_b2a("si0"))),
+                                 remaining)
+            self.failUnlessEqual(len(ss.remote_get_buckets("si0")), remaining)
+        # the slice which finds nothing left to expire is done with it
+        lc.cpu_slice = 1.0
+        lc.prepare_cycle(0, time.time())
+        self.failUnlessEqual(lc.state["expiring-as-of"], None)
+        rec = lc.state["cycle-to-date"]["space-recovered"]
+        self.failUnlessEqual(rec["actual-shares"], 5)
+        # and later slices of the cycle have nothing more to do
+        lc.cpu_slice = -1.0
+        lc.prepare_cycle(0, time.time())
+
+
+class Inventory(StorageServerMixin, unittest.TestCase):
+
+    server_kwargs = {"inventory_enabled": True}
+
+    def test_lru(self):
+        loads = []
+        def loader(storage_index):
+            loads.append(storage_index)
+            return {"si0": [0, 1], "si1": [2]}.get(storage_index, [])
+        inv = ShareInventory(loader, max_buckets=2)
+        self.failUnlessEqual(inv.get_shnums("si0"), set([0, 1]))
+        self.failUnlessEqual(inv.get_shnums("si0"), set([0, 1]))
+        self.failUnlessEqual(inv.get_shnums("missing"), set())
+        self.failUnlessEqual(inv.get_shnums("missing"), set())
+        self.failUnlessEqual(loads, ["si0", "missing"])
+        # si0 is now the least recently used, so it gets evicted
+        self.failUnlessEqual(inv.get_shnums("si1"), set([2]))
+        self.failUnlessEqual(inv.get_shnums("si0"), set([0, 1]))
+        self.failUnlessEqual(loads, ["si0", "missing", "si1", "si0"])
+        self.failUnlessEqual(inv.get_stats(),
+                             {"hits": 2, "misses": 4, "evictions": 2,
+                              "cached_buckets": 2, "incoming_shares": 0})
+
+        # changes to uncached buckets are left for the loader to find
+        inv.add_share("si0", 5)
+        inv.add_share("si2", 5)
+        inv.remove_share("si1", 2)
+        self.failUnlessEqual(inv.get_shnums("si0"), set([0, 1, 5]))
+        self.failUnlessEqual(inv.get_shnums("si2"), set())
+        inv.invalidate("si0")
+        self.failUnlessEqual(inv.get_shnums("si0"), set([0, 1]))
+
+    def test_immutable(self):
+        ss = self.create("test_immutable")
+        listdirs = []
+        ss._get_bucket_shnums_from_disk = \
+            lambda si: listdirs.append(si) or \
+            StorageServer._get_bucket_shnums_from_disk(ss, si)
+        ss.inventory._loader = ss._get_bucket_shnums_from_disk
+        canary = FakeCanary()
+
+        self.failUnlessEqual(ss.remote_get_buckets("si0"), {})
+        already,writers = ss.remote_allocate_buckets("si0", "rs0", "cs0",
+                                                     [0, 1, 2], 10, canary)
+        self.failUnlessEqual((already, set(writers)), (set(), set([0, 1, 2])))
+        # shares that are still being uploaded are not offered to a second
+        # uploader, and are not visible to downloaders
+        already2,writers2 = ss.remote_allocate_buckets("si0", "rs1", "cs1",
+                                                       [0, 1, 2], 10, canary)
+        self.failUnlessEqual((already2, writers2), (set(), {}))
+        self.failUnlessEqual(ss.remote_get_buckets("si0"), {})
+
+        for shnum in (0, 1):
+            writers[shnum].remote_write(0, "a"*10)
+            writers[shnum].remote_close()
+        writers[2].remote_abort()
+        self.failUnlessEqual(set(ss.remote_get_buckets("si0")), set([0, 1]))
+        already,writers = ss.remote_allocate_buckets("si0", "rs1", "cs1",
+                                                     [0, 1, 2], 10, canary)
+        self.failUnlessEqual((already, set(writers)), (set([0, 1]), set([2])))
+        writers[2].remote_close()
+        self.failUnlessEqual(set(ss.remote_get_buckets("si0")), set([0, 1, 2]))
+        self.failUnlessEqual(len(list(ss.get_leases("si0"))), 2)
+
+        # all of that took a single trip to the disk
+        self.failUnlessEqual(listdirs, ["si0"])
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.inventory.misses"], 1)
+        self.failUnless(stats["storage_server.inventory.hits"] > 5)
+        self.failUnlessEqual(stats["storage_server.inventory.incoming_shares"],
+                             0)
+
+    def test_mutable(self):
+        ss = self.create("test_mutable")
+        secrets = (hashutil.tagged_hash("we", "si1"),
+                   hashutil.tagged_hash("rs", "si1"),
+                   hashutil.tagged_hash("cs", "si1"))
+        writev = ss.remote_slot_testv_and_readv_and_writev
+        readv = ss.remote_slot_readv
+        self.failUnlessEqual(readv("si1", [], [(0, 10)]), {})
+        writev("si1", secrets, {0: ([], [(0, "data")], None),
+                                1: ([], [(0, "data")], None)}, [])
+        self.failUnlessEqual(readv("si1", [], [(0, 10)]),
+                             {0: ["data"], 1: ["data"]})
+        writev("si1", secrets, {0: ([], [], 0)}, [])
+        self.failUnlessEqual(readv("si1", [], [(0, 10)]), {1: ["data"]})
+        self.failUnlessEqual(ss.inventory.get_stats()["misses"], 1)
+
+    def test_expired_share(self):
+        ss = self.create("test_expired_share", expiration_enabled=True,
+                         expiration_mode="age",
+                         expiration_override_lease_duration=0)
+        already,writers = ss.remote_allocate_buckets("si0", "rs0", "cs0",
+                                                     [0], 10, FakeCanary())
+        writers[0].remote_close()
+        self.failUnlessEqual(set(ss.remote_get_buckets("si0")), set([0]))
+        si_s = si_b2a("si0")
+        bucketdir = os.path.join(ss.sharedir, storage_index_to_dir("si0"))
+        ss.lease_checker.process_bucket(0, si_s[:2], os.path.dirname(bucketdir),
+                                        si_s)
+        self.failIf(os.path.exists(os.path.join(bucketdir, "0")))
+        self.failUnlessEqual(ss.remote_get_buckets("si0"), {})
+
+
+class HandleCache(StorageServerMixin, unittest.TestCase):
+
+    server_kwargs = {"handle_cache_enabled": True}
+
+    def test_lru(self):
+        basedir = os.path.join("storage", "HandleCache", "test_lru")
+        fileutil.make_dirs(basedir)
+        fns = []
+        for i in range(3):
+            fn = os.path.join(basedir, str(i))
+            fileutil.write(fn, "data%d" % i)
+            fns.append(fn)
+        handles = FileHandleCache(max_handles=2)
+        f0 = handles.get(fns[0])
+        handles.release(fns[0], f0)
+        f = handles.get(fns[0])
+        self.failUnlessIdentical(f, f0)
+        handles.release(fns[0], f)
+        for fn in fns[1:]:
+            handles.release(fn, handles.get(fn))
+        # fns[0] was the least recently used, so it got closed
+        self.failUnless(f0.closed)
+        f0 = handles.get(fns[0])
+        f0.seek(0)
+        self.failUnlessEqual(f0.read(), "data0")
+        self.failUnlessEqual(handles.get_stats(),
+                             {"hits": 1, "misses": 4, "evictions": 1,
+                              "invalidations": 0, "open_handles": 3})
+
+        # a handle that is invalidated while checked out is not closed
+        # under its reader, but is not cached afterwards either
+        handles.invalidate(fns[0])
+        self.failIf(f0.closed)
+        handles.release(fns[0], f0)
+        self.failUnless(f0.closed)
+        handles.invalidate(fns[1])
+        self.failUnlessEqual(handles.get_stats()["invalidations"], 1)
+
+        # two readers of the same file get separate handles
+        f2a = handles.get(fns[2])
+        f2b = handles.get(fns[2])
+        self.failIfIdentical(f2a, f2b)
+        handles.release(fns[2], f2a)
+        handles.release(fns[2], f2b)
+        self.failUnless(f2b.closed)
+        self.failIf(f2a.closed)
+        handles.close_all()
+        self.failUnless(f2a.closed)
+        self.failUnlessEqual(handles.get_stats()["open_handles"], 0)
+
+    def test_immutable(self):
+        ss = self.create("test_immutable")
+        canary = FakeCanary()
+        rs0, cs0, rs1, cs1 = [hashutil.tagged_hash("blah", tag)
+                              for tag in ("rs0", "cs0", "rs1", "cs1")]
+        already,writers = ss.remote_allocate_buckets("si0", rs0, cs0,
+                                                     [0], 100, canary)
+        writers[0].remote_write(0, "a"*100)
+        writers[0].remote_close()
+        ss.remote_add_lease("si0", rs1, cs1)
+
+        readers = ss.remote_get_buckets("si0")
+        for i in range(5):
+            self.failUnlessEqual(readers[0].remote_read(10*i, 10), "a"*10)
+        stats = ss.get_stats()
+        # the share file was opened once, for add_lease
+        self.failUnlessEqual(stats["storage_server.handle_cache.misses"], 1)
+        self.failUnless(stats["storage_server.handle_cache.hits"] >= 5)
+        self.failUnlessEqual(stats["storage_server.handle_cache.open_handles"],
+                             1)
+
+        # truncating the lease list, and deleting the share, both drop the
+        # cached handle
+        fn = os.path.join(ss.sharedir, storage_index_to_dir("si0"), "0")
+        ShareFile(fn, handles=ss.handles).cancel_lease(cs1)
+        self.failUnlessEqual(ss.handles.get_stats()["open_handles"], 0)
+        self.failUnlessEqual(readers[0].remote_read(0, 10), "a"*10)
+        ShareFile(fn, handles=ss.handles).cancel_lease(cs0)
+        self.failIf(os.path.exists(fn))
+        self.failUnlessEqual(ss.handles.get_stats()["open_handles"], 0)
+
+    def test_mutable(self):
+        ss = self.create("test_mutable")
+        secrets = (hashutil.tagged_hash("we", "si1"),
+                   hashutil.tagged_hash("rs", "si1"),
+                   hashutil.tagged_hash("cs", "si1"))
+        writev = ss.remote_slot_testv_and_readv_and_writev
+        readv = ss.remote_slot_readv
+        writev("si1", secrets, {0: ([], [(0, "a"*10)], None)}, [])
+        for i in range(3):
+            self.failUnlessEqual(readv("si1", [0], [(0, 10)]), {0: ["a"*10]})
+        self.failUnless(ss.handles.get_stats()["hits"] > 0)
+
+        # writes through another handle are visible to the cached one
+        writev("si1", secrets, {0: ([], [(0, "b"*10)], None)}, [])
+        self.failUnlessEqual(readv("si1", [0], [(0, 10)]), {0: ["b"*10]})
+
+        # growing the container moves the leases, and drops the handle
+        invalidations = ss.handles.get_stats()["invalidations"]
+        writev("si1", secrets, {0: ([], [(10, "c"*5000)], None)}, [])
+        self.failUnlessEqual(ss.handles.get_stats()["invalidations"],
+                             invalidations+1)
+        self.failUnlessEqual(readv("si1", [0], [(5, 10)]),
+                             {0: ["b"*5 + "c"*5]})
+
+        # deleting the share closes it too
+        writev("si1", secrets, {0: ([], [], 0)}, [])
+        self.failUnlessEqual(readv("si1", [], [(0, 10)]), {})
+        self.failUnlessEqual(ss.handles.get_stats()["open_handles"], 0)
+
+class ThreadedIO(StorageServerMixin, unittest.TestCase, ShouldFailMixin):
+
+    server_kwargs = {"threaded_io_enabled": True}
+
+    def test_pool(self):
+        observed = []
+        pool = DiskIOPool(max_threads=3,
+                          observer=lambda *args: observed.append(args))
+        pool.setServiceParent(self.sparent)
+        events = []
+        def job(key, i):
+            # later jobs are quicker, so they would overtake earlier ones
+            # if they were allowed to run at the same time
+            time.sleep(0.001 * (5 - i))
+            events.append((key, i))
+            return i
+        def fail():
+            raise ValueError("boom")
+        dl = []
+        for i in range(5):
+            for key in ("a", "b", "c"):
+                dl.append(pool.run(key, job, key, i))
+        d0 = pool.run("a", fail)
+        dl.append(self.assertFailure(d0, ValueError))
+        # a failure does not wedge the queue
+        dl.append(pool.run("a", job, "a", 5))
+        self.failUnlessEqual(pool.get_queue_depth(), 17)
+        d = defer.gatherResults(dl)
+        def _check(res):
+            self.failUnlessEqual(res[-1], 5)
+            for key in ("a", "b", "c"):
+                self.failUnlessEqual([i for (k, i) in events if k == key],
+                                     range(6 if key == "a" else 5))
+            self.failUnlessEqual(pool.get_queue_depth(), 0)
+            depths = [v for (cat, v) in observed if cat == "io-queue-depth"]
+            self.failUnlessEqual(depths, range(1, 18))
+            waits = [v for (cat, v) in observed if cat == "io-wait"]
+            self.failUnlessEqual(len(waits), 17)
+        d.addCallback(_check)
+        return d
+
+    def test_immutable(self):
+        ss = self.create("test_immutable")
+        canary = FakeCanary()
+        already,writers = ss.remote_allocate_buckets("si0", "rs0", "cs0",
+                                                     [0, 1], 100, canary)
+        # the client pipelines its writes and the close, without waiting
+        # for each one to be acknowledged
+        dl = []
+        for i in range(10):
+            dl.append(writers[0].remote_write(10*i, chr(ord("a")+i)*10))
+        dl.append(writers[0].remote_close())
+        dl.append(writers[1].remote_write(0, "z"*10))
+        dl.append(writers[1].remote_abort())
+        incoming = os.path.join(ss.incomingdir, storage_index_to_dir("si0"))
+        d = defer.gatherResults(dl)
+        def _written(ign):
+            self.failUnlessEqual(set(ss.remote_get_buckets("si0")), set([0]))
+            self.failIf(os.path.exists(incoming))
+            self.failUnlessEqual(ss.allocated_size(), 0)
+            reader = ss.remote_get_buckets("si0")[0]
+            return reader.remote_read(25, 20)
+        d.addCallback(_written)
+        def _read(data):
+            self.failUnlessEqual(data, "c"*5 + "d"*10 + "e"*5)
+            latencies = ss.get_latencies()
+            self.failUnless(latencies["io-wait"]["samplesize"] > 0)
+            self.failUnless(latencies["io-queue-depth"]["samplesize"] > 0)
+        d.addCallback(_read)
+        return d
+
+    def test_mutable(self):
+        ss = self.create("test_mutable", inventory_enabled=True,
+                         leasedb_enabled=True, handle_cache_enabled=True)
+        secrets = (hashutil.tagged_hash("we", "si1"),
+                   hashutil.tagged_hash("rs", "si1"),
+                   hashutil.tagged_hash("cs", "si1"))
+        writev = ss.remote_slot_testv_and_readv_and_writev
+        readv = ss.remote_slot_readv
+        si_s = si_b2a("si1")
+        d = writev("si1", secrets, {0: ([], [(0, "data")], None),
+                                    1: ([], [(0, "data")], None)}, [])
+        def _created(res):
+            self.failUnlessEqual(res, (True, {}))
+            # the bookkeeping is done by the time the answer is delivered
+            self.failUnlessEqual(ss.leasedb.get_shares(si_s),
+                                 {0: "mutable", 1: "mutable"})
+            self.failUnlessEqual(len(ss.leasedb.get_leases(si_s, 0)), 1)
+            self.failUnlessEqual(ss.inventory.get_shnums("si1"), set([0, 1]))
+            return readv("si1", [], [(0, 10)])
+        d.addCallback(_created)
+        def _read(res):
+            self.failUnlessEqual(res, {0: ["data"], 1: ["data"]})
+            return writev("si1", secrets,
+                          {0: ([(0, 4, "eq", "data")], [], 0)}, [(0, 2)])
+        d.addCallback(_read)
+        def _deleted(res):
+            self.failUnlessEqual(res, (True, {0: ["da"], 1: ["da"]}))
+            self.failUnlessEqual(ss.leasedb.get_shares(si_s), {1: "mutable"})
+            self.failUnlessEqual(ss.inventory.get_shnums("si1"), set([1]))
+            return readv("si1", [], [(0, 10)])
+        d.addCallback(_deleted)
+        d.addCallback(lambda res:
+                      self.failUnlessEqual(res, {1: ["data"]}))
+        return d
+
+    def test_mutable_log(self):
+        ss = self.create("test_mutable_log")
+        logged = []
+        def _log(*args, **kwargs):
+            logged.append((threading.current_thread(), args, kwargs))
+        self.patch(ss, "log", _log)
+        secrets = (hashutil.tagged_hash("we", "si1"),
+                   hashutil.tagged_hash("rs", "si1"),
+                   hashutil.tagged_hash("cs", "si1"))
+        bad_secrets = (hashutil.tagged_hash("we", "bad"),) + secrets[1:]
+        writev = ss.remote_slot_testv_and_readv_and_writev
+        d = writev("si1", secrets, {0: ([], [(0, "data")], None)}, [])
+        d.addCallback(lambda res: self.failUnlessEqual(res, (True, {})))
+        d.addCallback(lambda ign:
+                      writev("si1", secrets,
+                             {0: ([(0, 4, "eq", "atad")], [], None)}, []))
+        d.addCallback(lambda res: self.failUnlessEqual(res, (False, {0: []})))
+        d.addCallback(lambda ign:
+                      self.shouldFail(BadWriteEnablerError, "bad enabler",
+                                      None, writev, "si1", bad_secrets,
+                                      {0: ([], [(0, "data")], None)}, []))
+        def _check(ign):
+            # the messages from the I/O threads are logged by the reactor
+            self.failUnlessEqual(len(logged), 2)
+            self.failUnlessIn("testv failed", logged[0][1][0])
+            self.failUnlessIn("bad write enabler", logged[1][2]["format"])
+            for (thread, args, kwargs) in logged:
+                self.failUnlessIdentical(thread, threading.current_thread())
+        d.addCallback(_check)
+        return d
+
+class SpaceCache(StorageServerMixin, unittest.TestCase):
+
+    server_kwargs = {"space_cache_enabled": True}
+
+    def setUp(self):
+        StorageServerMixin.setUp(self)
+        self.statvfs_calls = 0
+        self.avail = 100000
+        def call_get_disk_stats(whichdir, reserved_space=0):
+            self.statvfs_calls += 1
+            return {'avail': max(self.avail - reserved_space, 0)}
+        self.patch(fileutil, 'get_disk_stats', call_get_disk_stats)
+
+    def test_accountant(self):
+        space = SpaceAccountant("unused", reserved_space=1000, max_age=60,
+                                max_delta=5000)
+        self.failUnless(space.is_caching())
+        self.failUnlessEqual(space.get_available_space(now=0), 99000)
+        self.avail = 50000
+        # the disk is not asked again until the answer is old
+        self.failUnlessEqual(space.get_available_space(now=59), 99000)
+        self.failUnlessEqual(self.statvfs_calls, 1)
+        self.failUnlessEqual(space.get_available_space(now=60), 49000)
+        self.failUnlessEqual(self.statvfs_calls, 2)
+
+        # bytes that we add are subtracted in the meantime, until there
+        # are enough of them to make it worth asking again
+        space.consumed(3000)
+        self.failUnlessEqual(space.get_available_space(now=61), 46000)
+        space.consumed(2000)
+        self.failUnlessEqual(space.get_available_space(now=62), 49000)
+        self.failUnlessEqual(self.statvfs_calls, 3)
+
+        # reservations are subtracted from the remaining space, and are
+        # given back when released, or when their owner goes away
+        owner1, owner2 = Marker(), Marker()
+        space.reserve(owner1, 10000)
+        space.reserve(owner2, 20000)
+        self.failUnlessEqual(space.get_reserved(), 30000)
+        self.failUnlessEqual(space.get_remaining_space(now=63), 19000)
+        space.release(owner1)
+        space.release(owner1)
+        self.failUnlessEqual(space.get_reserved(), 20000)
+        del owner2
+        self.failUnlessEqual(space.get_reserved(), 0)
+        self.failUnlessEqual(space.get_remaining_space(now=64), 49000)
+        self.failUnlessEqual(space.refreshes, 3)
+
+        # with no max_age, every question goes to the disk
+        space = SpaceAccountant("unused")
+        self.failIf(space.is_caching())
+        space.get_available_space()
+        space.get_available_space()
+        self.failUnlessEqual(self.statvfs_calls, 5)
+        space = SpaceAccountant("unused", readonly=True)
+        self.failUnlessEqual(space.get_remaining_space(), 0)
+
+    def test_server(self):
+        ss = self.create("test_server", reserved_space=10000)
+        canary = FakeCanary()
+        calls = self.statvfs_calls
+        for i in range(10):
+            already,writers = ss.remote_allocate_buckets("si%d" % i, "rs",
+                                                         "cs", [0], 1000,
+                                                         canary)
+            self.failUnlessEqual(set(writers), set([0]))
+            writers[0].remote_write(0, "a"*1000)
+            writers[0].remote_close()
+        self.failUnlessEqual(ss.allocated_size(), 0)
+        version = ss.remote_get_version()
+        v1 = version["http://allmydata.org/tahoe/protocols/storage/v1"]
+        # the statvfs() made when the server started served all of that,
+        # and the closed shares have been subtracted from its answer
+        self.failUnlessEqual(self.statvfs_calls, calls)
+        self.failUnless(v1["available-space"] <= 90000 - 10*1000,
+                        v1["available-space"])
+
+        # a reservation still in progress limits further allocations
+        already,writers = ss.remote_allocate_buckets("big", "rs", "cs",
+                                                     [0], 50000, canary)
+        self.failUnlessEqual(ss.allocated_size(), 50000)
+        already,writers2 = ss.remote_allocate_buckets("big2", "rs", "cs",
+                                                      [0], 50000, canary)
+        self.failUnlessEqual(writers2, {})
+        writers[0].remote_abort()
+        self.failUnlessEqual(ss.allocated_size(), 0)
+
+        # growing a mutable share is counted too
+        avail = ss.get_available_space()
+        secrets = (hashutil.tagged_hash("we", "mut"),
+                   hashutil.tagged_hash("rs", "mut"),
+                   hashutil.tagged_hash("cs", "mut"))
+        ss.remote_slot_testv_and_readv_and_writev(
+            "mut", secrets, {0: ([], [(0, "a"*5000)], None)}, [])
+        self.failUnless(ss.get_available_space() <= avail - 5000)
+        self.failUnlessEqual(self.statvfs_calls, calls)
+
+class MultiDisk(StorageServerMixin, unittest.TestCase):
+
+    def setUp(self):
+        StorageServerMixin.setUp(self)
+        self.avail = {} # disk name -> free bytes
+        def call_get_disk_stats(whichdir, reserved_space=0):
+            avail = self.avail[os.path.basename(whichdir.rstrip(os.sep))]
+            return {'avail': max(avail - reserved_space, 0)}
+        self.patch(fileutil, 'get_disk_stats', call_get_disk_stats)
+
+    def create(self, name, **kwargs):
+        workdir = self.workdir(name)
+        extra = [os.path.join(workdir, "disk1"), os.path.join(workdir, "disk2")]
+        self.avail = {"shares": 10000, "disk1": 50000, "disk2": 30000}
+        return StorageServerMixin.create(self, name, extra_share_dirs=extra,
+                                         **kwargs)
+
+    def allocate(self, ss, storage_index, sharenums, size):
+        canary = FakeCanary()
+        already,writers = ss.remote_allocate_buckets(storage_index, "rs", "cs",
+                                                     sharenums, size, canary)
+        for bw in writers.values():
+            bw.remote_write(0, "a"*size)
+            bw.remote_close()
+        return already, writers
+
+    def where(self, ss, storage_index):
+        return [d for d in ss.sharedirs
+                if os.path.isdir(os.path.join(d, storage_index_to_dir(storage_index)))]
+
+    def test_most_free(self):
+        ss = self.create("test_most_free")
+        self.failUnlessEqual(len(ss.sharedirs), 3)
+        self.allocate(ss, "si1", [0, 1], 1000)
+        self.failUnlessEqual(self.where(ss, "si1"), [ss.sharedirs[1]])
+        self.avail["disk2"] = 90000
+        self.allocate(ss, "si2", [0], 1000)
+        self.failUnlessEqual(self.where(ss, "si2"), [ss.sharedirs[2]])
+        # more shares of a bucket go where the first ones are
+        self.allocate(ss, "si1", [2], 1000)
+        self.failUnlessEqual(self.where(ss, "si1"), [ss.sharedirs[1]])
+        # and they can all be read back
+        b = ss.remote_get_buckets("si1")
+        self.failUnlessEqual(set(b.keys()), set([0, 1, 2]))
+        self.failUnlessEqual(b[2].remote_read(0, 1000), "a"*1000)
+        self.failUnlessEqual(ss.remote_get_buckets("none"), {})
+        # the totals cover every disk
+        self.failUnlessEqual(ss.get_available_space(), 10000+50000+90000)
+        version = ss.remote_get_version()
+        v1 = version["http://allmydata.org/tahoe/protocols/storage/v1"]
+        self.failUnlessEqual(v1["maximum-immutable-share-size"], 90000)
+
+    def test_round_robin(self):
+        ss = self.create("test_round_robin", share_placement="round-robin")
+        for i in range(4):
+            self.allocate(ss, "si%d" % i, [0], 1000)
+        self.failUnlessEqual(self.where(ss, "si0"), [ss.sharedirs[0]])
+        self.failUnlessEqual(self.where(ss, "si1"), [ss.sharedirs[1]])
+        self.failUnlessEqual(self.where(ss, "si2"), [ss.sharedirs[2]])
+        self.failUnlessEqual(self.where(ss, "si3"), [ss.sharedirs[0]])
+        # disks which are too full are skipped
+        self.allocate(ss, "big", [0], 20000)
+        self.failUnlessEqual(self.where(ss, "big"), [ss.sharedirs[1]])
+        self.failUnlessRaises(ValueError, self.create, "bad",
+                              share_placement="fullest")
+
+    def test_mutable(self):
+        ss = self.create("test_mutable")
+        secrets = (hashutil.tagged_hash("we", "mut"),
+                   hashutil.tagged_hash("rs", "mut"),
+                   hashutil.tagged_hash("cs", "mut"))
+        writev = ss.remote_slot_testv_and_readv_and_writev
+        res = writev("mut", secrets, {0: ([], [(0, "data")], None),
+                                      1: ([], [(0, "data")], None)}, [])
+        self.failUnlessEqual(res, (True, {}))
+        self.failUnlessEqual(self.where(ss, "mut"), [ss.sharedirs[1]])
+        self.failUnlessEqual(ss.remote_slot_readv("mut", [], [(0, 4)]),
+                             {0: ["data"], 1: ["data"]})
+        # a new server finds the shares again
+        ss2 = StorageServer(ss.storedir, "\x00" * 20,
+                            extra_share_dirs=ss.sharedirs[1:])
+        self.failUnlessEqual(ss2.remote_slot_readv("mut", [], [(0, 4)]),
+                             {0: ["data"], 1: ["data"]})
+
+    def test_crawler(self):
+        ss = self.create("test_crawler")
+        self.allocate(ss, "si1", [0], 1000)
+        self.avail["disk2"] = 90000
+        self.allocate(ss, "si2", [0], 1000)
+        # copy a bucket onto a second disk, as an operator might
+        bucket = storage_index_to_dir("si2")
+        shutil.copytree(os.path.join(ss.sharedirs[2], bucket),
+                        os.path.join(ss.sharedirs[0], bucket))
+        c = ss.bucket_counter
+        prefix1 = storage_index_to_dir("si1").split(os.sep)[0]
+        prefix2 = storage_index_to_dir("si2").split(os.sep)[0]
+        buckets = set()
+        for prefix in set([prefix1, prefix2]):
+            (names, locations) = c.list_prefix(prefix)
+            buckets.update(names)
+            for name in names:
+                self.failUnlessEqual(locations[name],
+                                     [os.path.join(d, prefix)
+                                      for d in self.where(ss, si_a2b(name))])
+        self.failUnlessEqual(buckets, set([si_b2a("si1"), si_b2a("si2")]))
+
+class PackedShares(StorageServerMixin, unittest.TestCase):
+
+    server_kwargs = {"leasedb_enabled": True, "packed_shares_enabled": True,
+                     "packed_shares_max_size": 1000}
+
+    def allocate(self, ss, storage_index, sharenums, size, secrets=None):
+        if secrets is None:
+            secrets = self.secrets()
+        rs,cs = secrets
+        already,writers = ss.remote_allocate_buckets(storage_index, rs, cs,
+                                                     sharenums, size,
+                                                     FakeCanary())
+        for shnum, bw in writers.items():
+            bw.remote_write(0, chr(ord("a") + shnum) * size)
+            bw.remote_close()
+        return already, writers
+
+    def test_store(self):
+        packdir = os.path.join(self.workdir("test_store"), "packs")
+        packs = PackStore(packdir, pack_size=300)
+        si0, si1 = self.si(0), self.si(1)
+        self.failUnlessEqual(packs.add_share(si0, 0, "a"*100),
+                             RECORD_HEADER_SIZE + 100)
+        packs.add_share(si0, 1, "b"*100)
+        packs.add_share(si1, 0, "c"*200)
+        packs.add_share(si1, 1, "d"*100)
+        self.failUnlessEqual(packs.get_shnums(si0), [0, 1])
+        self.failUnlessEqual(packs.get_shnums(self.si(2)), [])
+        self.failUnlessEqual(packs.read_share_data(si1, 0, 190, 20), "c"*10)
+        self.failUnlessEqual(packs.read_share_data(si1, 0, 300, 20), "")
+        stats = packs.get_stats()
+        self.failUnlessEqual(stats["packs"], 2)
+        self.failUnlessEqual(stats["shares"], 4)
+        self.failUnlessEqual(stats["dead_bytes"], 0)
+
+        # deleted shares stay in their pack until it is compacted
+        packs.remove_share(si0, 0)
+        self.failIf(packs.has_share(si0, 0))
+        self.failUnlessEqual(packs.compact(), 0)
+        packs.remove_share(si1, 0)
+        self.failUnlessEqual(packs.get_stats()["dead_bytes"],
+                             2*RECORD_HEADER_SIZE + 300)
+        self.failUnlessEqual(packs.compact(), 2*RECORD_HEADER_SIZE + 300)
+        self.failUnlessEqual(packs.get_stats()["dead_bytes"], 0)
+        self.failUnlessEqual(packs.read_share_data(si0, 1, 0, 200), "b"*100)
+        packs.close()
+
+        # everything can be found again after a restart, including shares
+        # that were written but not indexed before a crash
+        packs.add_share(si1, 2, "e"*50)
+        packs.close()
+        idx = sorted([f for f in os.listdir(packdir) if f.endswith(".idx")])[-1]
+        idx = os.path.join(packdir, idx)
+        fileutil.write(idx, fileutil.read(idx)[:-10])
+        pack = idx[:-len("idx")] + "pack"
+        fileutil.write(pack, "shr1partial", mode="ab")
+        packs = PackStore(packdir, pack_size=300)
+        self.failUnlessEqual(packs.get_shnums(si0), [1])
+        self.failUnlessEqual(packs.get_shnums(si1), [1, 2])
+        self.failUnlessEqual(packs.read_share_data(si1, 2, 0, 100), "e"*50)
+        self.failUnlessEqual(packs.get_stats()["dead_bytes"], 0)
+        packs.close()
+
+    def test_server(self):
+        ss = self.create("test_server")
+        si0, si1 = self.si(0), self.si(1)
+        already,writers = self.allocate(ss, si0, [0, 1, 2], 500)
+        self.failUnlessEqual(set(writers), set([0, 1, 2]))
+        # large shares still get files of their own
+        self.allocate(ss, si1, [0], 2000)
+        self.failIf(os.path.exists(os.path.join(ss.sharedir,
+                                                storage_index_to_dir(si0))))
+        self.failUnless(os.path.exists(os.path.join(ss.sharedir,
+                                                    storage_index_to_dir(si1),
+                                                    "0")))
+        self.failUnlessEqual(ss.packs.get_shnums(si0), [0, 1, 2])
+        self.failUnlessEqual(ss.allocated_size(), 0)
+
+        already,writers = self.allocate(ss, si0, [2, 3], 500)
+        self.failUnlessEqual(already, set([0, 1, 2]))
+        self.failUnlessEqual(set(writers), set([3]))
+        b = ss.remote_get_buckets(si0)
+        self.failUnlessEqual(set(b), set([0, 1, 2, 3]))
+        self.failUnlessEqual(b[1].remote_read(0, 1000), "b"*500)
+        self.failUnlessEqual(b[3].remote_read(490, 20), "d"*10)
+        self.failUnlessEqual(set(ss.remote_get_buckets_multi([si0, si1])),
+                             set([si0, si1]))
+        self.failUnlessEqual(ss.leasedb.get_shares(si_b2a(si0)),
+                             {0: "immutable", 1: "immutable", 2: "immutable",
+                              3: "immutable"})
+        rs,cs = self.secrets()
+        ss.remote_add_lease(si0, rs, cs)
+        self.failUnlessEqual(len(list(ss.get_leases(si0))), 3)
+        self.failUnless(ss.have_shares())
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.packs.shares"], 4)
+
+        self.failUnlessRaises(ValueError, StorageServer,
+                              self.workdir("no_leasedb"), "\x00" * 20,
+                              packed_shares_enabled=True)
+
+    def test_expire(self):
+        ss = self.create("test_expire", expiration_enabled=True,
+                         expiration_mode="age",
+                         expiration_override_lease_duration=2000)
+        ss.packs.pack_size = 1000
+        lc = ss.lease_checker
+        si0, si1 = self.si(0), self.si(1)
+        self.allocate(ss, si0, [0, 1], 500)
+        self.allocate(ss, si1, [0], 500, secrets=self.secrets())
+        self.failUnlessEqual(ss.packs.get_stats()["packs"], 2)
+        now = time.time()
+        ss.leasedb.cursor.execute("UPDATE leases SET expiration_time=?"
+                                  " WHERE storage_index=?",
+                                  (int(now) - 1000, si_b2a(si0)))
+        ss.leasedb.connection.commit()
+        lc.started_cycle(0)
+        lc.prepare_cycle(0, time.time())
+
+        self.failUnlessEqual(ss.remote_get_buckets(si0), {})
+        self.failUnlessEqual(ss.leasedb.get_shares(si_b2a(si0)), {})
+        rec = lc.state["cycle-to-date"]["space-recovered"]
+        self.failUnlessEqual(rec["actual-shares"], 2)
+        self.failUnlessEqual(rec["actual-sharebytes"], 1000)
+        # the first pack held nothing else, so it has been deleted
+        stats = ss.packs.get_stats()
+        self.failUnlessEqual(stats["compactions"], 1)
+        self.failUnlessEqual(stats["packs"], 1)
+        self.failUnlessEqual(stats["dead_bytes"], 0)
+        b = ss.remote_get_buckets(si1)
+        self.failUnlessEqual(b[0].remote_read(0, 10), "a"*10)
+
+    def test_inventory(self):
+        ss = self.create("test_inventory", inventory_enabled=True)
+        si0 = self.si(0)
+        rs,cs = self.secrets()
+        already,writers = ss.remote_allocate_buckets(si0, rs, cs, [0, 1], 500,
+                                                     FakeCanary())
+        self.failUnlessEqual(set(writers), set([0, 1]))
+        self.failUnlessEqual(ss.inventory.get_stats()["incoming_shares"], 2)
+        writers[0].remote_write(0, "a"*500)
+        writers[0].remote_close()
+        writers[1].remote_abort()
+        # neither share is incoming any more: the closed one is in a pack,
+        # and the aborted one may be uploaded again
+        self.failUnlessEqual(ss.inventory.get_stats()["incoming_shares"], 0)
+        self.failUnlessEqual(ss.packs.get_shnums(si0), [0])
+        already,writers = self.allocate(ss, si0, [0, 1], 500)
+        self.failUnlessEqual(already, set([0]))
+        self.failUnlessEqual(set(writers), set([1]))
+        self.failUnlessEqual(ss.inventory.get_stats()["incoming_shares"], 0)
+        self.failUnlessEqual(set(ss.remote_get_buckets(si0)), set([0, 1]))
+
+class CloseSync(StorageServerMixin, unittest.TestCase, pollmixin.PollMixin):
+
+    def setUp(self):
+        StorageServerMixin.setUp(self)
+        self.synced = []
+        self.patch(fileutil, 'fsync_path', self.synced.append)
+
+    def upload(self, ss, storage_index, sharenums, size=100):
+        already,writers = ss.remote_allocate_buckets(storage_index, "rs", "cs",
+                                                     sharenums, size,
+                                                     FakeCanary())
+        dl = []
+        for bw in writers.values():
+            bw.remote_write(0, "a"*size)
+            dl.append(defer.maybeDeferred(bw.remote_close))
+        return writers, dl
+
+    def test_fsync(self):
+        ss = self.create("test_fsync", close_sync="fsync")
+        writers, dl = self.upload(ss, "si1", [0])
+        bucketdir = os.path.join(ss.sharedir, storage_index_to_dir("si1"))
+        # the data is synced before the share is moved into place
+        self.failUnlessEqual(self.synced[0], writers[0].incominghome)
+        self.failUnlessEqual(sorted(self.synced[1:]),
+                             [os.path.dirname(bucketdir), bucketdir])
+        self.failUnless(os.path.exists(os.path.join(bucketdir, "0")))
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.close_sync.closes"], 1)
+        self.failUnlessEqual(stats["storage_server.close_sync.batches"], 1)
+        self.failUnlessEqual(stats["storage_server.close_sync.fsyncs"], 3)
+        self.failUnlessEqual(ss.get_latencies()["sync"]["samplesize"], 1)
+        self.failUnlessRaises(ValueError, self.create, "bad",
+                              close_sync="sometimes")
+
+    def _test_group(self, name, **kwargs):
+        ss = self.create(name, close_sync="group", close_sync_window=0.01,
+                         **kwargs)
+        clock = ss.syncer._reactor = task.Clock()
+        writers1, dl1 = self.upload(ss, "si1", range(5))
+        writers2, dl2 = self.upload(ss, "si2", range(2))
+        # with threaded I/O, each close joins the batch once its data has
+        # been synced in an I/O thread
+        d = self.poll(lambda: (ss.diskio is None or
+                               ss.diskio.get_queue_depth() == 0))
+        def _flush(ign):
+            self.failUnlessEqual(ss.syncer.get_stats()["batches"], 0)
+            clock.advance(0.01)
+            return defer.gatherResults(dl1 + dl2)
+        d.addCallback(_flush)
+        def _check(res):
+            bucketdirs = [os.path.join(ss.sharedir, storage_index_to_dir(si))
+                          for si in ("si1", "si2")]
+            for bucketdir, writers in zip(bucketdirs, (writers1, writers2)):
+                for shnum in writers:
+                    self.failUnless(os.path.exists(os.path.join(bucketdir,
+                                                                "%d" % shnum)))
+            # one fsync for the data of each share, but the directories are
+            # only synced once for the whole batch
+            dirs = set(bucketdirs + [os.path.dirname(d) for d in bucketdirs])
+            self.failUnlessEqual(len(self.synced), 7 + len(dirs))
+            self.failUnlessEqual(set(self.synced[7:]), dirs)
+            stats = ss.get_stats()
+            self.failUnlessEqual(stats["storage_server.close_sync.closes"], 7)
+            self.failUnlessEqual(stats["storage_server.close_sync.batches"], 1)
+            latencies = ss.get_latencies()
+            self.failUnlessEqual(latencies["sync-batch-size"]["samplesize"], 1)
+            self.failUnlessEqual(latencies["close"]["samplesize"], 7)
+            self.failUnlessEqual(ss.allocated_size(), 0)
+        d.addCallback(_check)
+        return d
+
+    def test_group(self):
+        return self._test_group("test_group")
+
+    def test_group_threaded(self):
+        return self._test_group("test_group_threaded", threaded_io_enabled=True)
+
+    def test_group_max_batch(self):
+        ss = self.create("test_group_max_batch", close_sync="group",
+                         close_sync_max_batch=3)
+        writers, dl = self.upload(ss, "si1", range(7))
+        d = defer.gatherResults(dl)
+        def _check(res):
+            self.failUnlessEqual(ss.syncer.get_stats()["batches"], 3)
+            self.failUnlessEqual(ss.syncer.get_stats()["closes"], 7)
+        d.addCallback(_check)
+        return d
+
+    def test_group_packed(self):
+        ss = self.create("test_group_packed", close_sync="group",
+                         leasedb_enabled=True, packed_shares_enabled=True)
+        writers, dl = self.upload(ss, self.si(1), range(5))
+        d = defer.gatherResults(dl)
+        def _check(res):
+            # the pack and its index are synced once for the batch, and
+            # packed shares need no separate data fsync
+            packdir = ss.packs.packdir
+            self.failUnlessEqual(sorted(self.synced),
+                                 sorted([os.path.join(packdir, "00000000.idx"),
+                                         os.path.join(packdir, "00000000.pack"),
+                                         packdir]))
+            b = ss.remote_get_buckets(self.si(1))
+            self.failUnlessEqual(b[4].remote_read(0, 100), "a"*100)
+        d.addCallback(_check)
+        return d
+
+class Journal(StorageServerMixin, unittest.TestCase):
+
+    server_kwargs = {"journal_enabled": True}
+
+    def test_journal(self):
+        basedir = os.path.join("storage", "Journal", "test_journal")
+        j = ShareJournal(basedir, segment_events=3, max_segments=3)
+        self.failUnlessEqual(j.get_last_seq(), 0)
+        for i in range(5):
+            j.record("create", self.si(i), i)
+        j.record("lease", self.si(0))
+        self.failUnlessEqual(j.get_last_seq(), 6)
+        self.failUnlessEqual(j.get_stats(), {"events": 6, "segments": 2})
+        events = list(j.get_events(0))
+        self.failUnlessEqual([e[0] for e in events], range(1, 7))
+        self.failUnlessEqual(events[1], (2, "create", si_b2a(self.si(1)), 1))
+        self.failUnlessEqual(events[5], (6, "lease", si_b2a(self.si(0)), None))
+        self.failUnlessEqual([e[0] for e in j.get_events(2, 4)], [3, 4])
+
+        # a reader's checkpoint lets the segments before it be deleted
+        j.set_checkpoint("reader", 4)
+        self.failUnlessEqual(j.get_first_seq(), 4)
+        self.failUnless(j.has_since(3))
+        self.failIf(j.has_since(2))
+        self.failUnlessRaises(JournalTruncated, list, j.get_events(1))
+        self.failUnlessEqual([e[0] for e in j.get_events(4)], [5, 6])
+
+        # but too many segments are deleted whatever the readers say
+        for i in range(9):
+            j.record("write", self.si(i), 0)
+        self.failUnlessEqual(j.get_stats(), {"events": 15, "segments": 3})
+        self.failIf(j.has_since(4))
+        self.failUnlessEqual(j.get_first_seq(), 7)
+
+        # a partly-written event is discarded when the journal is reopened
+        j.close()
+        last = os.path.join(basedir, "%020d.journal" % 13)
+        with open(last, "ab") as f:
+            f.write("16 create")
+        j = ShareJournal(basedir, segment_events=3, max_segments=3)
+        self.failUnlessEqual(j.get_last_seq(), 15)
+        j.record("delete", self.si(1), 1)
+        self.failUnlessEqual(list(j.get_events(15)),
+                             [(16, "delete", si_b2a(self.si(1)), 1)])
+        j.close()
+
+    def test_server(self):
+        ss = self.create("test_server")
+        si0, si1 = self.si(0), self.si(1)
+        rs, cs = "r"*32, "c"*32
+        rs2, cs2 = "R"*32, "C"*32
+        already,writers = ss.remote_allocate_buckets(si0, rs, cs,
+                                                     set([0, 1]), 10,
+                                                     FakeCanary())
+        for bw in writers.values():
+            bw.remote_write(0, "a"*10)
+            bw.remote_close()
+        already,writers = ss.remote_allocate_buckets(si0, rs, cs,
+                                                     set([0, 1]), 10,
+                                                     FakeCanary())
+        self.failUnlessEqual(writers, {})
+        ss.remote_add_lease(si0, rs2, cs2)
+        ss.remote_renew_lease(si0, rs2)
+
+        secrets = ("w"*32, rs, cs)
+        rc = ss.remote_slot_testv_and_readv_and_writev
+        rc(si1, secrets, {0: ([], [(0, "data")], None)}, [])
+        rc(si1, secrets, {0: ([], [(4, "more")], None)}, [])
+        rc(si1, secrets, {0: ([], [], 0)}, [])
+
+        events = [(event, si_s, shnum) for (seq, event, si_s, shnum)
+                  in ss.journal.get_events(0)]
+        si0_s, si1_s = si_b2a(si0), si_b2a(si1)
+        self.failUnlessEqual(sorted(events[:2]), [("create", si0_s, 0),
+                                                  ("create", si0_s, 1)])
+        self.failUnlessEqual(events[2:], [("lease", si0_s, None),
+                                          ("lease", si0_s, None),
+                                          ("lease", si0_s, None),
+                                          ("create", si1_s, 0),
+                                          ("write", si1_s, 0),
+                                          ("delete", si1_s, 0),
+                                          ])
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.journal.events"], 8)
+        self.failUnlessEqual(stats["storage_server.journal.segments"], 1)
+        # the crawlers which can use the journal have registered with it
+        self.failUnless(ss.bucket_counter.journal is ss.journal)
+        self.failUnless(ss.lease_checker.journal is None)
+
+class ClientCanary(FakeCanary):
+    def __init__(self, tubid):
+        FakeCanary.__init__(self)
+        self.tubid = tubid
+    def getRemoteTubID(self):
+        return self.tubid
+
+class Admission(StorageServerMixin, unittest.TestCase):
+
+    server_kwargs = {"admission_enabled": True}
+
+    def allocate(self, ss, storage_index, sharenums, size, client):
+        return ss.remote_allocate_buckets(storage_index, "rs"+storage_index,
+                                          "cs"+storage_index, sharenums,
+                                          size, ClientCanary(client))
+
+    def test_client_buckets(self):
+        ss = self.create("test_client_buckets", admission_max_client_buckets=2)
+        already,writers = self.allocate(ss, "si1", set([0, 1, 2]), 10, "alice")
+        # as many as fit are accepted, and the rest look like a full server
+        self.failUnlessEqual(len(writers), 2)
+        # but once nothing fits, the client is told to come back later
+        e = self.failUnlessRaises(ServerBusyError, self.allocate,
+                                  ss, "si2", set([0]), 10, "alice")
+        self.failUnless(e.retry_after > 0)
+        # other clients are not affected
+        already,writers2 = self.allocate(ss, "si2", set([0]), 10, "bob")
+        self.failUnlessEqual(len(writers2), 1)
+        # nor is a client which already has everything it asked for
+        already,writers3 = self.allocate(ss, "si1", set([0, 1]), 10, "alice")
+        self.failUnlessEqual(writers3, {})
+
+        writers.values()[0].remote_write(0, "a"*10)
+        writers.values()[0].remote_close()
+        writers.values()[1].remote_abort()
+        already,writers = self.allocate(ss, "si2", set([0, 1]), 10, "alice")
+        self.failUnlessEqual(len(writers), 1) # bob has share 0
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.admission.clients"], 2)
+        self.failUnlessEqual(stats["storage_server.admission.in_flight_bytes"],
+                             20)
+        self.failUnlessEqual(stats["storage_server.admission.admitted"], 4)
+        self.failUnlessEqual(stats["storage_server.admission.refused"], 2)
+
+    def test_allocate_buckets_multi(self):
+        ss = self.create("test_allocate_buckets_multi",
+                         admission_max_client_buckets=2)
+        res = ss.remote_allocate_buckets_multi(
+            [("si1", "rs1", "cs1", set([0, 1]), 10),
+             ("si2", "rs2", "cs2", set([0]), 10),
+             ("si1", "rs1", "cs1", set([0, 1]), 10)],
+            ClientCanary("alice"))
+        self.failUnlessEqual(len(res), 3)
+        self.failUnlessEqual(len(res[0][1]), 2)
+        self.failUnlessEqual(res[0][2], None)
+        # a busy refusal only affects the request it was for
+        (already, writers, retry_after) = res[1]
+        self.failUnlessEqual(writers, {})
+        self.failUnless(retry_after > 0, retry_after)
+        self.failUnlessEqual(res[2], (set(), {}, None))
+
+    def test_busy_with_existing_shares(self):
+        ss = self.create("test_busy_with_existing_shares",
+                         admission_max_client_buckets=1)
+        already,writers = self.allocate(ss, "si1", set([0]), 10, "alice")
+        writers[0].remote_write(0, "a"*10)
+        writers[0].remote_close()
+        already,writers2 = self.allocate(ss, "si2", set([0]), 10, "alice")
+        self.failUnlessEqual(len(writers2), 1)
+        # alice uploads si1 again while busy with si2: the share we already
+        # hold is reported, rather than hidden behind a busy error
+        already,writers = self.allocate(ss, "si1", set([0, 1]), 10, "alice")
+        self.failUnlessEqual(already, set([0]))
+        self.failUnlessEqual(writers, {})
+        # allocate_buckets_multi reports both
+        res = ss.remote_allocate_buckets_multi(
+            [("si1", "rssi1", "cssi1", set([0, 1]), 10)],
+            ClientCanary("alice"))
+        (already, writers, retry_after) = res[0]
+        self.failUnlessEqual(already, set([0]))
+        self.failUnlessEqual(writers, {})
+        self.failUnless(retry_after > 0, retry_after)
+
+    def test_fair_share(self):
+        ss = self.create("test_fair_share", admission_max_bytes=1000)
+        already,writers = self.allocate(ss, "si1", set(range(12)), 100,
+                                        "alice")
+        # alice may use all of the server while nobody else wants it
+        self.failUnlessEqual(len(writers), 10)
+        # but bob is still let in, up to his half
+        already,writers2 = self.allocate(ss, "si2", set(range(12)), 100, "bob")
+        self.failUnlessEqual(len(writers2), 5)
+        self.failUnlessRaises(ServerBusyError, self.allocate,
+                              ss, "si3", set([0]), 100, "alice")
+        self.failUnlessRaises(ServerBusyError, self.allocate,
+                              ss, "si3", set([0]), 100, "bob")
+        # once alice is below her share, she may have more
+        for bw in writers.values()[:6]:
+            bw.remote_abort()
+        already,writers = self.allocate(ss, "si3", set([0]), 100, "alice")
+        self.failUnlessEqual(len(writers), 1)
+
+    def test_client_bytes(self):
+        ss = self.create("test_client_bytes",
+                         admission_max_client_bytes=250)
+        already,writers = self.allocate(ss, "si1", set(range(3)), 100, "alice")
+        self.failUnlessEqual(len(writers), 2)
+        self.failUnlessEqual(ss.admission.get_client_usage("alice"), (2, 200))
+        # without any finished uploads to go by, the longest wait is asked
+        e = self.failUnlessRaises(ServerBusyError, self.allocate,
+                                  ss, "si2", set([0]), 100, "alice")
+        self.failUnlessEqual(e.retry_after, ss.admission.max_retry_after)
+        # but once some have finished, the wait is estimated from them
+        for bw in writers.values():
+            bw.remote_abort()
+        e = self.failUnlessRaises(ServerBusyError, self.allocate,
+                                  ss, "si2", set([0]), 300, "alice")
+        self.failUnless(e.retry_after < ss.admission.max_retry_after)
+        self.failUnlessEqual(ss.admission.get_client_usage("alice"), (0, 0))
+
+    def test_retry_after(self):
+        f = Failure(ServerBusyError(7.5))
+        self.failUnlessEqual(get_retry_after(f), 7.5)
+        self.failUnlessEqual(get_retry_after(Failure(RemoteException(f))), 7.5)
+        # a failure which came over the wire only has the message
+        f.value = str(f.value)
+        self.failUnlessEqual(get_retry_after(f), 7.5)
+        self.failUnlessEqual(get_retry_after(Failure(ValueError())), None)
+
+class ResumableUploads(StorageServerMixin, unittest.TestCase):
+
+    server_kwargs = {"resumable_uploads_enabled": True,
+                     "resumable_uploads_grace_period": 100}
+
+    def create(self, name):
+        ss = StorageServerMixin.create(self, name)
+        self.clock = ss.suspended._reactor = task.Clock()
+        return ss
+
+    def allocate(self, ss, storage_index, sharenums, size, canary,
+                 renew_secret="r"*32):
+        return ss.remote_allocate_buckets(storage_index, renew_secret,
+                                          "c"*32, sharenums, size, canary)
+
+    def disconnect(self, canary):
+        for (f,args,kwargs) in canary.disconnectors.values():
+            f(*args, **kwargs)
+
+    def test_resume(self):
+        ss = self.create("test_resume")
+        sv1 = ss.remote_get_version()['http://allmydata.org/tahoe/protocols/storage/v1']
+        self.failUnless(sv1["supports-resumable-uploads"])
+        canary = FakeCanary()
+        already,writers = self.allocate(ss, "si1", set([0, 1, 2]), 100, canary)
+        writers[0].remote_write(0, "a"*25)
+        writers[0].remote_write(50, "a"*10)
+        writers[1].remote_write(0, "b"*60)
+        writers[1].remote_write(60, "b"*40)
+        self.disconnect(canary)
+        self.failUnlessEqual(ss.get_stats()["storage_server.resumable_uploads.suspended"], 3)
+        self.failUnlessEqual(ss.allocated_size(), 300)
+
+        # somebody else can't take them over
+        already,writers2 = self.allocate(ss, "si1", set([0, 1, 2]), 100,
+                                         FakeCanary(), renew_secret="x"*32)
+        self.failUnlessEqual(writers2, {})
+        already,writers2 = self.allocate(ss, "si1", set([0, 1, 2]), 200,
+                                         FakeCanary())
+        self.failUnlessEqual(writers2, {})
+
+        # but the original client gets them back, with what it wrote
+        canary = FakeCanary()
+        already,writers2 = self.allocate(ss, "si1", set([0, 1, 2]), 100,
+                                         canary)
+        self.failUnlessEqual(writers2, writers)
+        self.failUnlessEqual(writers[0].remote_get_written_size(), 25)
+        self.failUnlessEqual(writers[1].remote_get_written_size(), 100)
+        self.failUnlessEqual(writers[2].remote_get_written_size(), 0)
+        writers[0].remote_write(25, "a"*75)
+        for bw in writers.values():
+            bw.remote_close()
+        b = ss.remote_get_buckets("si1")
+        self.failUnlessEqual(b[0].remote_read(0, 100), "a"*100)
+        self.failUnlessEqual(b[1].remote_read(0, 100), "b"*100)
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.resumable_uploads.suspended"], 0)
+        self.failUnlessEqual(stats["storage_server.resumable_uploads.suspends"], 3)
+        self.failUnlessEqual(stats["storage_server.resumable_uploads.resumes"], 3)
+        self.failUnlessEqual(ss.allocated_size(), 0)
+
+        # a resumed upload can be suspended again
+        canary = FakeCanary()
+        already,writers = self.allocate(ss, "si2", set([0]), 100, canary)
+        self.disconnect(canary)
+        canary = FakeCanary()
+        already,writers = self.allocate(ss, "si2", set([0]), 100, canary)
+        self.failUnlessEqual(writers.keys(), [0])
+        self.disconnect(canary)
+        self.failUnlessEqual(ss.get_stats()["storage_server.resumable_uploads.suspends"], 5)
+
+    def test_expire(self):
+        ss = self.create("test_expire")
+        canary = FakeCanary()
+        already,writers = self.allocate(ss, "si1", set([0]), 100, canary)
+        writers[0].remote_write(0, "a"*25)
+        incominghome = writers[0].incominghome
+        self.disconnect(canary)
+        self.clock.advance(99)
+        self.failUnless(os.path.exists(incominghome))
+        self.clock.advance(1)
+        self.failIf(os.path.exists(incominghome))
+        self.failUnlessEqual(ss.allocated_size(), 0)
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.resumable_uploads.suspended"], 0)
+        self.failUnlessEqual(stats["storage_server.resumable_uploads.expirations"], 1)
+        # and now the share can be uploaded from scratch
+        already,writers2 = self.allocate(ss, "si1", set([0]), 100, FakeCanary())
+        self.failUnlessEqual(writers2.keys(), [0])
+        self.failIfIdentical(writers2[0], writers[0])
+        self.failUnlessEqual(writers2[0].remote_get_written_size(), 0)
+
+    def test_wbp_skips_written_data(self):
+        class RemoteBucket(object):
+            def __init__(self):
+                self.writes = []
+            def callRemote(self, methname, *args):
+                if methname == "write":
+                    self.writes.append(args)
+                return defer.succeed(None)
+        rb = RemoteBucket()
+        wbp = WriteBucketProxy(rb, None, 200, 50, 4, 3, 500)
+        wbp.set_resume_offset(0x24 + 75)
+        wbp.put_header()
+        for segnum in range(4):
+            wbp.put_block(segnum, chr(ord("a")+segnum)*50)
+        # the header and the first block are skipped, and the second is sent
+        # in full, even though the server has half of it
+        self.failUnlessEqual([offset for (offset, data) in rb.writes],
+                             [0x24 + 50, 0x24 + 100, 0x24 + 150])
+        self.failUnlessEqual(wbp.skipped_bytes, 0x24 + 50)
+
+class Scrubber(GridTestMixin, unittest.TestCase):
+
+    def upload(self):
+        c0 = self.g.clients[0]
+        # lots of small blocks
+        c0.encoding_params['max_segment_size'] = 12
+        d = c0.upload(upload.Data(TEST_DATA, convergence=""))
+        def _stash_uri(ur):
+            self.uri = ur.get_uri()
+            self.si = uri.from_string(self.uri).get_storage_index()
+        d.addCallback(_stash_uri)
+        return d
+
+    def scrub(self, ss):
+        ss.add_scrubber()
+        ss.scrubber.cpu_slice = 500 # finish in a single slice
+        ss.scrubber.start_current_prefix(time.time())
+        return ss.scrubber
+
+    def test_scrub(self):
+        self.basedir = "storage/Scrubber/scrub"
+        self.set_up_grid()
+        d = self.upload()
+        def _corrupt(ign):
+            for (shnum, serverid, sharefile) in self.find_uri_shares(self.uri):
+                if shnum == 0:
+                    self.corrupt_share((shnum, serverid, sharefile),
+                                       _corrupt_share_data)
+                elif shnum == 1:
+                    self.corrupt_share((shnum, serverid, sharefile),
+                                       _corrupt_share_hashes)
+        d.addCallback(_corrupt)
+        def _scrub(ign):
+            vcap = uri.from_string(self.uri).get_verify_cap()
+            good = corrupt = 0
+            for (i, ss, storedir) in self.iterate_servers():
+                v = ss.remote_get_version()
+                v1 = v["http://allmydata.org/tahoe/protocols/storage/v1"]
+                self.failIf(v1["supports-scrub-results"])
+                self.failUnlessEqual(ss.remote_get_scrub_results([self.si]),
+                                     {})
+
+                sc = self.scrub(ss)
+                v = ss.remote_get_version()
+                v1 = v["http://allmydata.org/tahoe/protocols/storage/v1"]
+                self.failUnless(v1["supports-scrub-results"])
+                results = ss.remote_get_scrub_results([self.si, "x"*16])
+                self.failUnlessEqual(results.keys(), [self.si])
+                for shnum, r in results[self.si].items():
+                    self.failUnlessEqual(r["ueb-hash"],
+                                         vcap.uri_extension_hash)
+                    if shnum in (0, 1):
+                        self.failIf(r["ok"], (shnum, r))
+                        self.failUnless(r["reason"])
+                        corrupt += 1
+                        self.failUnlessEqual(
+                            [(si_s, n) for (si_s, n, reason)
+                             in sc.get_corrupt_shares()],
+                            [(si_b2a(self.si), shnum)])
+                        stats = ss.get_stats()
+                        self.failUnlessEqual(
+                            stats["storage_server.scrubber.corrupt_shares"],
+                            1)
+                    else:
+                        self.failUnless(r["ok"], (shnum, r))
+                        self.failUnlessEqual(r["reason"], None)
+                        good += 1
+                so_far = sc.get_state()["history"][0]
+                self.failUnlessEqual(so_far["examined-shares"],
+                                     len(results[self.si]))
+            self.failUnlessEqual((good, corrupt), (8, 2))
+
+            # the results go away with the shares
+            for (i, ss, storedir) in self.iterate_servers():
+                for shnum in ss.remote_get_scrub_results([self.si])[self.si]:
+                    ss.share_removed(self.si, shnum)
+                self.failUnlessEqual(ss.remote_get_scrub_results([self.si]),
+                                     {})
+        d.addCallback(_scrub)
+        return d
+
+    def test_paced(self):
+        self.basedir = "storage/Scrubber/paced"
+        self.set_up_grid()
+        d = self.upload()
+        def _scrub(ign):
+            ss = self.g.servers_by_number[0]
+            ss.add_scrubber()
+            sc = ss.scrubber
+            # give up after every block
+            sc.cpu_slice = -1.0
+            resumes = 0
+            while True:
+                try:
+                    sc.start_current_prefix(time.time())
+                    break
+                except TimeSliceExceeded:
+                    position = sc.get_state()["scrub-position"]
+                    if position is not None:
+                        resumes += 1
+                        self.failUnlessEqual((position[1], position[3]),
+                                             (si_b2a(self.si), resumes))
+                        # a restart picks up from the same block
+                        sc.save_state()
+                        sc.disownServiceParent()
+                        ss.add_scrubber()
+                        sc = ss.scrubber
+                        sc.cpu_slice = -1.0
+                        self.failUnlessEqual(
+                            sc.get_state()["scrub-position"], position)
+            # TEST_DATA is 56 bytes, so each share has five blocks
+            self.failUnlessEqual(resumes, 4)
+            results = ss.remote_get_scrub_results([self.si])[self.si]
+            self.failUnlessEqual(len(results), 1)
+            self.failUnless(results.values()[0]["ok"])
+            h = sc.get_state()["history"][0]
+            self.failUnlessEqual((h["examined-shares"], h["good-shares"]),
+                                 (1, 1))
+        d.addCallback(_scrub)
+        return d
+
+
 class MutableServer(unittest.TestCase):
 
     def setUp(self):
@@ -789,9 +2399,9 @@ class MutableServer(unittest.TestCase):
         basedir = os.path.join("storage", "MutableServer", name)
         return basedir
 
-    def create(self, name):
+    def create(self, name, **kwargs):
         workdir = self.workdir(name)
-        ss = StorageServer(workdir, "\x00" * 20)
+        ss = StorageServer(workdir, "\x00" * 20, **kwargs)
         ss.setServiceParent(self.sparent)
         return ss
 
@@ -936,6 +2546,52 @@ class MutableServer(unittest.TestCase):
         read_answer = read("si1", [0], [(0,10)])
         self.failUnlessEqual(read_answer, {})
 
+    def test_container_growth(self):
+        ss = self.create("test_container_growth", mutable_growth_factor=2)
+        self.allocate(ss, "si1", "we1", 0, set([0]), 100)
+        rstaraw = ss.remote_slot_testv_and_readv_and_writev
+        secrets = ( self.write_enabler("we1"),
+                    self.renew_secret("we1"),
+                    self.cancel_secret("we1") )
+        # fill the four lease slots in the header, so that the rest go in
+        # the extra lease area after the data
+        for i in range(1, 6):
+            ss.remote_add_lease("si1", self.renew_secret(i),
+                                self.cancel_secret(i))
+        fn = os.path.join(ss.sharedir, storage_index_to_dir("si1"), "0")
+        msf = MutableShareFile(fn)
+        def container_size():
+            with open(fn, "rb") as f:
+                return msf._get_container_size(f)
+
+        segment = "".join([chr(i) for i in range(250)]) * 4
+        sizes = []
+        for i in range(10):
+            answer = rstaraw("si1", secrets,
+                             {0: ([], [(i*1000, segment)], None)},
+                             [])
+            self.failUnlessEqual(answer, (True, {0:[]}))
+            sizes.append(container_size())
+        # the container doubles when it is outgrown, rather than being made
+        # exactly big enough for each write
+        self.failUnlessEqual(sizes, [1000, 2000, 4000, 4000, 8000,
+                                     8000, 8000, 8000, 16000, 16000])
+        self.failUnlessEqual(len(list(msf.get_leases())), 7)
+        read_answer = ss.remote_slot_readv("si1", [0], [(0, 20000)])
+        self.failUnlessEqual(read_answer, {0: [segment * 10]})
+
+        # a write past the end of the data, but inside the slack, fills the
+        # gap with zeroes
+        answer = rstaraw("si1", secrets, {0: ([], [], 5000)}, [])
+        answer = rstaraw("si1", secrets,
+                         {0: ([], [(6000, "hello")], None)},
+                         [])
+        self.failUnlessEqual(container_size(), 16000)
+        read_answer = ss.remote_slot_readv("si1", [0], [(4990, 2000)])
+        self.failUnlessEqual(read_answer,
+                             {0: [segment[-10:] + "\x00"*1000 + "hello"]})
+        self.failUnlessEqual(len(list(msf.get_leases())), 7)
+
     def test_allocate(self):
         ss = self.create("test_allocate")
         self.allocate(ss, "si1", "we1", self._lease_secret.next(),
@@ -2805,6 +4461,11 @@ class Stats(unittest.TestCase):
         ss.setServiceParent(self.sparent)
         return ss
 
+    def failUnlessClose(self, value, expected, output):
+        # percentiles are accurate to about one percent
+        self.failUnless(abs(value - expected) <= 0.011 * expected + 1e-9,
+                        output)
+
     def test_latencies(self):
         ss = self.create("test_latencies")
         for i in range(10000):
@@ -2821,47 +4482,47 @@ class Stats(unittest.TestCase):
 
         self.failUnlessEqual(sorted(output.keys()),
                              sorted(["allocate", "renew", "cancel", "write", "get"]))
-        self.failUnlessEqual(len(ss.latencies["allocate"]), 1000)
-        self.failUnless(abs(output["allocate"]["mean"] - 9500) < 1, output)
-        self.failUnless(abs(output["allocate"]["01_0_percentile"] - 9010) < 1, output)
-        self.failUnless(abs(output["allocate"]["10_0_percentile"] - 9100) < 1, output)
-        self.failUnless(abs(output["allocate"]["50_0_percentile"] - 9500) < 1, output)
-        self.failUnless(abs(output["allocate"]["90_0_percentile"] - 9900) < 1, output)
-        self.failUnless(abs(output["allocate"]["95_0_percentile"] - 9950) < 1, output)
-        self.failUnless(abs(output["allocate"]["99_0_percentile"] - 9990) < 1, output)
-        self.failUnless(abs(output["allocate"]["99_9_percentile"] - 9999) < 1, output)
-
-        self.failUnlessEqual(len(ss.latencies["renew"]), 1000)
-        self.failUnless(abs(output["renew"]["mean"] - 500) < 1, output)
-        self.failUnless(abs(output["renew"]["01_0_percentile"] -  10) < 1, output)
-        self.failUnless(abs(output["renew"]["10_0_percentile"] - 100) < 1, output)
-        self.failUnless(abs(output["renew"]["50_0_percentile"] - 500) < 1, output)
-        self.failUnless(abs(output["renew"]["90_0_percentile"] - 900) < 1, output)
-        self.failUnless(abs(output["renew"]["95_0_percentile"] - 950) < 1, output)
-        self.failUnless(abs(output["renew"]["99_0_percentile"] - 990) < 1, output)
-        self.failUnless(abs(output["renew"]["99_9_percentile"] - 999) < 1, output)
-
-        self.failUnlessEqual(len(ss.latencies["write"]), 20)
-        self.failUnless(abs(output["write"]["mean"] - 9) < 1, output)
+        self.failUnlessEqual(output["allocate"]["samplesize"], 10000)
+        self.failUnless(abs(output["allocate"]["mean"] - 4999.5) < 1e-6, output)
+        self.failUnlessClose(output["allocate"]["01_0_percentile"], 100, output)
+        self.failUnlessClose(output["allocate"]["10_0_percentile"], 1000, output)
+        self.failUnlessClose(output["allocate"]["50_0_percentile"], 5000, output)
+        self.failUnlessClose(output["allocate"]["90_0_percentile"], 9000, output)
+        self.failUnlessClose(output["allocate"]["95_0_percentile"], 9500, output)
+        self.failUnlessClose(output["allocate"]["99_0_percentile"], 9900, output)
+        self.failUnlessClose(output["allocate"]["99_9_percentile"], 9990, output)
+
+        self.failUnlessEqual(output["renew"]["samplesize"], 1000)
+        self.failUnless(abs(output["renew"]["mean"] - 499.5) < 1e-6, output)
+        self.failUnlessClose(output["renew"]["01_0_percentile"],  10, output)
+        self.failUnlessClose(output["renew"]["10_0_percentile"], 100, output)
+        self.failUnlessClose(output["renew"]["50_0_percentile"], 500, output)
+        self.failUnlessClose(output["renew"]["90_0_percentile"], 900, output)
+        self.failUnlessClose(output["renew"]["95_0_percentile"], 950, output)
+        self.failUnlessClose(output["renew"]["99_0_percentile"], 990, output)
+        self.failUnlessClose(output["renew"]["99_9_percentile"], 999, output)
+
+        self.failUnlessEqual(output["write"]["samplesize"], 20)
+        self.failUnless(abs(output["write"]["mean"] - 9.5) < 1e-6, output)
         self.failUnless(output["write"]["01_0_percentile"] is None, output)
-        self.failUnless(abs(output["write"]["10_0_percentile"] -  2) < 1, output)
-        self.failUnless(abs(output["write"]["50_0_percentile"] - 10) < 1, output)
-        self.failUnless(abs(output["write"]["90_0_percentile"] - 18) < 1, output)
-        self.failUnless(abs(output["write"]["95_0_percentile"] - 19) < 1, output)
+        self.failUnlessClose(output["write"]["10_0_percentile"],  2, output)
+        self.failUnlessClose(output["write"]["50_0_percentile"], 10, output)
+        self.failUnlessClose(output["write"]["90_0_percentile"], 18, output)
+        self.failUnlessClose(output["write"]["95_0_percentile"], 19, output)
         self.failUnless(output["write"]["99_0_percentile"] is None, output)
         self.failUnless(output["write"]["99_9_percentile"] is None, output)
 
-        self.failUnlessEqual(len(ss.latencies["cancel"]), 10)
-        self.failUnless(abs(output["cancel"]["mean"] - 9) < 1, output)
+        self.failUnlessEqual(output["cancel"]["samplesize"], 10)
+        self.failUnless(abs(output["cancel"]["mean"] - 9) < 1e-6, output)
         self.failUnless(output["cancel"]["01_0_percentile"] is None, output)
-        self.failUnless(abs(output["cancel"]["10_0_percentile"] -  2) < 1, output)
-        self.failUnless(abs(output["cancel"]["50_0_percentile"] - 10) < 1, output)
-        self.failUnless(abs(output["cancel"]["90_0_percentile"] - 18) < 1, output)
+        self.failUnlessClose(output["cancel"]["10_0_percentile"],  2, output)
+        self.failUnlessClose(output["cancel"]["50_0_percentile"], 10, output)
+        self.failUnlessClose(output["cancel"]["90_0_percentile"], 18, output)
         self.failUnless(output["cancel"]["95_0_percentile"] is None, output)
         self.failUnless(output["cancel"]["99_0_percentile"] is None, output)
         self.failUnless(output["cancel"]["99_9_percentile"] is None, output)
 
-        self.failUnlessEqual(len(ss.latencies["get"]), 1)
+        self.failUnlessEqual(output["get"]["samplesize"], 1)
         self.failUnless(output["get"]["mean"] is None, output)
         self.failUnless(output["get"]["01_0_percentile"] is None, output)
         self.failUnless(output["get"]["10_0_percentile"] is None, output)
@@ -2871,6 +4532,24 @@ class Stats(unittest.TestCase):
         self.failUnless(output["get"]["99_0_percentile"] is None, output)
         self.failUnless(output["get"]["99_9_percentile"] is None, output)
 
+    def test_latency_windows(self):
+        ss = self.create("test_latency_windows")
+        now = time.time()
+        # an old slow read, and a recent fast one
+        ss.latencies["read"].add(2.0, now - 10*60)
+        ss.add_latency("read", 0.5)
+        self.failUnlessEqual(ss.get_latencies("1m")["read"]["samplesize"], 1)
+        self.failUnlessEqual(ss.get_latencies("5m")["read"]["samplesize"], 1)
+        self.failUnlessEqual(ss.get_latencies("1h")["read"]["samplesize"], 2)
+        self.failUnlessEqual(ss.get_latencies()["read"]["mean"], 1.25)
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.latencies.read.samplesize"],
+                             2)
+        self.failUnlessEqual(stats["storage_server.latencies_1m.read.samplesize"],
+                             1)
+        self.failUnlessEqual(stats["storage_server.latencies_5m.read.samplesize"],
+                             1)
+
 def remove_tags(s):
     s = re.sub(r'<[^>]*>', ' ', s)
     s = re.sub(r'\s+', ' ', s)
@@ -3437,6 +5116,55 @@ class LeaseCrawler(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
         d.addCallback(_check_html)
         return d
 
+    def test_expire_with_leasedb(self):
+        basedir = "storage/LeaseCrawler/expire_with_leasedb"
+        fileutil.make_dirs(basedir)
+        ss = InstrumentedStorageServer(basedir, "\x00" * 20,
+                                       expiration_enabled=True,
+                                       expiration_mode="age",
+                                       expiration_override_lease_duration=2000,
+                                       leasedb_enabled=True)
+        lc = ss.lease_checker
+        lc.slow_start = 0
+        self.make_shares(ss)
+        [immutable_si_0, immutable_si_1, mutable_si_2, mutable_si_3] = self.sis
+
+        # the first lease of each share looks 1000s old. Only the database
+        # is changed: the lease records in the share files are ignored.
+        now = time.time()
+        for rs in (self.renew_secrets[0], self.renew_secrets[1],
+                   self.renew_secrets[3], self.renew_secrets[4]):
+            ss.leasedb.cursor.execute("UPDATE leases SET expiration_time=?"
+                                      " WHERE renew_secret=?",
+                                      (int(now) - 1000, buffer(rs)))
+        ss.leasedb.connection.commit()
+
+        ss.setServiceParent(self.s)
+        def _wait():
+            return bool(lc.get_state()["last-cycle-finished"] is not None)
+        d = self.poll(_wait)
+
+        def _after_first_cycle(ignored):
+            def count_shares(si):
+                return len(list(ss._iter_share_files(si)))
+            self.failUnlessEqual(count_shares(immutable_si_0), 0)
+            self.failUnlessEqual(count_shares(immutable_si_1), 1)
+            self.failUnlessEqual(count_shares(mutable_si_2), 0)
+            self.failUnlessEqual(count_shares(mutable_si_3), 1)
+            self.failUnlessEqual(len(list(ss.get_leases(immutable_si_1))), 1)
+            self.failUnlessEqual(len(list(ss.get_leases(mutable_si_3))), 1)
+            self.failUnlessEqual(ss.leasedb.get_share_count(), 2)
+
+            last = lc.get_state()["history"][0]
+            rec = last["space-recovered"]
+            self.failUnlessEqual(rec["actual-shares"], 2)
+            self.failUnlessEqual(rec["actual-shares-mutable"], 1)
+            self.failUnlessEqual(rec["actual-shares-immutable"], 1)
+            # the surviving shares each have one lease left
+            self.failUnlessEqual(last["leases-per-share-histogram"], {1: 2})
+        d.addCallback(_after_first_cycle)
+        return d
+
     def test_expire_cutoff_date(self):
         basedir = "storage/LeaseCrawler/expire_cutoff_date"
         fileutil.make_dirs(basedir)
@@ -3966,6 +5694,36 @@ class LeaseCrawler(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
         d = self.render1(page, args={"t": ["json"]})
         return d
 
+    def test_scrubber(self):
+        basedir = "storage/WebStatus/scrubber"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20, scrubber_enabled=True)
+        ss.setServiceParent(self.s)
+        ss.scrubber.db.add_result("aaaa", 3, time.time(), False, None,
+                                  "share is truncated")
+        ss.scrubber.db.add_result("bbbb", 0, time.time(), False, None,
+                                  "bad block hash")
+        w = StorageStatus(ss)
+        w.max_corrupt_shares = 1
+        d = self.render1(w)
+        def _check_html(html):
+            s = remove_tags(html)
+            self.failUnlessIn("Share Scrubber", s)
+            self.failUnlessIn("Next crawl in", s)
+            self.failUnlessIn("Corrupt shares (the first 1 of 2):", s)
+            self.failUnlessIn("SI aaaa shnum 3: share is truncated", s)
+            self.failIfIn("bbbb", s)
+        d.addCallback(_check_html)
+        d.addCallback(lambda ign: self.render_json(w))
+        def _check_json(raw):
+            data = json.loads(raw)
+            self.failUnlessIn("scrubber", data)
+            self.failUnlessEqual(data["scrubber-corrupt-shares"],
+                                 [["aaaa", 3, "share is truncated"]])
+            self.failUnlessEqual(data["scrubber-corrupt-share-count"], 2)
+        d.addCallback(_check_json)
+        return d
+
 class WebStatus(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
 
     def setUp(self):
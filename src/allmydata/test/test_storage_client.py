@@ -3,10 +3,18 @@ from mock import Mock
 from allmydata.util import base32, yamlutil
 
 from twisted.trial import unittest
-from twisted.internet.defer import succeed, inlineCallbacks
+from twisted.internet.defer import succeed, inlineCallbacks, gatherResults, \
+     Deferred
+from twisted.python.failure import Failure
+from foolscap.api import DeadReferenceError
 
 from allmydata.storage_client import NativeStorageServer
 from allmydata.storage_client import StorageFarmBroker
+from allmydata.storage_client import get_buckets, allocate_buckets
+from allmydata.storage_client import note_allocation, is_server_full, \
+     get_allocation_latency
+from allmydata import storage_client
+from allmydata.interfaces import MAX_BUCKET_QUERIES, ServerBusyError
 
 
 class NativeStorageServerWithVersion(NativeStorageServer):
@@ -113,6 +121,55 @@ storage:
         self.assertEqual(s.get_permutation_seed(),
                          hashlib.sha256(server_id).digest())
 
+    def test_permuted_order_cached(self):
+        hashed = []
+        def permute_server_hash(psi, seed):
+            hashed.append(seed)
+            return hashlib.sha1(psi + seed).digest()
+        self.patch(storage_client, "permute_server_hash", permute_server_hash)
+        broker = StorageFarmBroker(True, None, preferred_peers=["3"])
+        def add_server(k):
+            ann = {"anonymous-storage-FURL": "pb://abcde@nowhere/fake",
+                   "permutation-seed-base32": base32.b2a(k)}
+            broker.test_add_rref(k, "rref", ann)
+        def permuted(psi):
+            return [s.get_serverid() for s in broker.get_servers_for_psi(psi)]
+        def expected(psi):
+            return sorted(broker.get_connected_servers(),
+                          key=lambda s: (s.get_serverid() != "3",
+                                         hashlib.sha1(psi + s.get_permutation_seed()).digest()))
+        for k in ["%d" % i for i in range(8)]:
+            add_server(k)
+        order = permuted("one")
+        self.assertEqual(order,
+                         [s.get_serverid() for s in expected("one")])
+        self.assertEqual(order[0], "3")
+        self.assertEqual(len(hashed), 8)
+        self.assertEqual(permuted("one"), order)
+        self.assertEqual(len(hashed), 8)
+
+        # disconnecting doesn't change the order of the others
+        broker.servers[order[1]]._is_connected = False
+        self.assertEqual(permuted("one"), order[:1] + order[2:])
+        self.assertEqual(len(hashed), 8)
+        broker.servers[order[1]]._is_connected = True
+
+        # but a new server means starting again
+        add_server("8")
+        self.assertEqual(permuted("one"),
+                         [s.get_serverid() for s in expected("one")])
+        self.assertEqual(len(hashed), 17)
+
+        # only so many storage indexes are remembered
+        self.patch(broker, "permuted_cache_size", 2)
+        permuted("two")
+        permuted("three")
+        self.assertEqual(len(hashed), 35)
+        permuted("three")
+        self.assertEqual(len(hashed), 35)
+        permuted("one")
+        self.assertEqual(len(hashed), 44)
+
     @inlineCallbacks
     def test_threshold_reached(self):
         introducer = Mock()
@@ -164,3 +221,239 @@ storage:
 
         yield done
         self.assertTrue(done.called)
+
+
+class FakeBucketRRef(object):
+    def __init__(self, shares, multi):
+        self.shares = shares # storage_index -> {shnum: bucket}
+        self.calls = []
+        self.waiting = []
+        v1 = {}
+        if multi:
+            v1["supports-get-buckets-multi"] = True
+        self.version = {"http://allmydata.org/tahoe/protocols/storage/v1": v1}
+
+    def callRemote(self, methname, *args):
+        self.calls.append((methname, args))
+        if methname == "get_buckets":
+            res = dict(self.shares.get(args[0], {}))
+        elif methname == "get_buckets_multi":
+            res = dict([(si, dict(self.shares[si]))
+                        for si in args[0] if si in self.shares])
+        else:
+            raise NotImplementedError(methname)
+        # the test decides when the response arrives
+        d = Deferred()
+        self.waiting.append((d, res))
+        return d
+
+    def respond(self):
+        # answer the oldest outstanding call
+        (d, res) = self.waiting.pop(0)
+        d.callback(res)
+
+class TestGetBuckets(unittest.TestCase):
+    SHARES = {"si1": {0: "b0", 1: "b1"}, "si2": {7: "b7"}}
+
+    def test_coalesced(self):
+        rref = FakeBucketRRef(self.SHARES, multi=True)
+        # a query to an idle server is sent right away
+        d1 = get_buckets(rref, "si1")
+        self.assertEqual(rref.calls, [("get_buckets", ("si1",))])
+        # while it is in flight, the others are held back
+        dl = [get_buckets(rref, si) for si in ["si2", "si3", "si2"]]
+        self.assertEqual(len(rref.calls), 1)
+        rref.respond()
+        self.assertEqual(self.successResultOf(d1), {0: "b0", 1: "b1"})
+        self.assertEqual(rref.calls[1:],
+                         [("get_buckets_multi", (["si2", "si3"],))])
+        rref.respond()
+        self.assertEqual([self.successResultOf(d) for d in dl],
+                         [{7: "b7"}, {}, {7: "b7"}])
+
+    def test_batch_size(self):
+        rref = FakeBucketRRef(self.SHARES, multi=True)
+        get_buckets(rref, "si1")
+        sis = ["si%d" % i for i in range(MAX_BUCKET_QUERIES+10)]
+        dl = [get_buckets(rref, si) for si in sis]
+        rref.respond()
+        rref.respond()
+        rref.respond()
+        self.successResultOf(gatherResults(dl))
+        self.assertEqual([methname for (methname, args) in rref.calls],
+                         ["get_buckets", "get_buckets_multi",
+                          "get_buckets_multi"])
+        self.assertEqual(len(rref.calls[1][1][0]), MAX_BUCKET_QUERIES)
+        self.assertEqual(len(rref.calls[2][1][0]), 10)
+
+    def test_failure(self):
+        rref = FakeBucketRRef(self.SHARES, multi=True)
+        get_buckets(rref, "si1")
+        d2 = get_buckets(rref, "si2")
+        d3 = get_buckets(rref, "si3")
+        rref.respond()
+        (d, res) = rref.waiting.pop(0)
+        d.errback(DeadReferenceError())
+        self.failureResultOf(d2, DeadReferenceError)
+        self.failureResultOf(d3, DeadReferenceError)
+        # the batcher is idle again
+        get_buckets(rref, "si1")
+        self.assertEqual(rref.calls[-1], ("get_buckets", ("si1",)))
+
+    def test_old_server(self):
+        rref = FakeBucketRRef(self.SHARES, multi=False)
+        dl = [get_buckets(rref, si) for si in ["si1", "si2"]]
+        rref.respond()
+        rref.respond()
+        self.assertEqual([self.successResultOf(d) for d in dl],
+                         [{0: "b0", 1: "b1"}, {7: "b7"}])
+        self.assertEqual(rref.calls, [("get_buckets", ("si1",)),
+                                      ("get_buckets", ("si2",))])
+
+
+class FakeAllocateRRef(object):
+    def __init__(self, multi, busy=()):
+        self.busy = busy # storage indexes to refuse
+        self.calls = []
+        self.waiting = []
+        v1 = {}
+        if multi:
+            v1["supports-allocate-buckets-multi"] = True
+        self.version = {"http://allmydata.org/tahoe/protocols/storage/v1": v1}
+
+    def _allocate(self, storage_index, renew_secret, cancel_secret,
+                  sharenums, allocated_size):
+        if storage_index in self.busy:
+            return (set(), {}, 5.0)
+        return (set(), dict([(shnum, "bw-%s-%d" % (storage_index, shnum))
+                             for shnum in sharenums]), None)
+
+    def callRemote(self, methname, *args, **kwargs):
+        self.assertCanary(kwargs)
+        self.calls.append((methname, args))
+        if methname == "allocate_buckets":
+            (alreadygot, allocated, retry_after) = self._allocate(*args)
+            res = (alreadygot, allocated)
+            if retry_after is not None:
+                res = Failure(ServerBusyError(retry_after))
+        elif methname == "allocate_buckets_multi":
+            res = [self._allocate(*request) for request in args[0]]
+        else:
+            raise NotImplementedError(methname)
+        d = Deferred()
+        self.waiting.append((d, res))
+        return d
+
+    def assertCanary(self, kwargs):
+        assert set(kwargs.keys()) == set(["canary"]), kwargs
+
+    def respond(self):
+        (d, res) = self.waiting.pop(0)
+        d.callback(res)
+
+class TestAllocateBuckets(unittest.TestCase):
+    def allocate(self, rref, storage_index, sharenums):
+        return allocate_buckets(rref, storage_index, "rs", "cs",
+                                set(sharenums), 100)
+
+    def test_coalesced(self):
+        rref = FakeAllocateRRef(multi=True, busy=["si3"])
+        d1 = self.allocate(rref, "si1", [0])
+        self.assertEqual(rref.calls,
+                         [("allocate_buckets_multi",
+                           ([("si1", "rs", "cs", set([0]), 100)],))])
+        d2 = self.allocate(rref, "si2", [1, 2])
+        d3 = self.allocate(rref, "si3", [0])
+        self.assertEqual(len(rref.calls), 1)
+        rref.respond()
+        self.assertEqual(self.successResultOf(d1),
+                         (set(), {0: "bw-si1-0"}, None))
+        self.assertEqual(rref.calls[1],
+                         ("allocate_buckets_multi",
+                          ([("si2", "rs", "cs", set([1, 2]), 100),
+                            ("si3", "rs", "cs", set([0]), 100)],)))
+        rref.respond()
+        self.assertEqual(self.successResultOf(d2),
+                         (set(), {1: "bw-si2-1", 2: "bw-si2-2"}, None))
+        # a busy hint is delivered along with the rest of the answer
+        self.assertEqual(self.successResultOf(d3), (set(), {}, 5.0))
+
+    def test_failure(self):
+        rref = FakeAllocateRRef(multi=True)
+        self.allocate(rref, "si1", [0])
+        d2 = self.allocate(rref, "si2", [0])
+        rref.respond()
+        (d, res) = rref.waiting.pop(0)
+        d.errback(DeadReferenceError())
+        self.failureResultOf(d2, DeadReferenceError)
+
+    def test_old_server(self):
+        rref = FakeAllocateRRef(multi=False, busy=["si3"])
+        dl = [self.allocate(rref, si, [0]) for si in ["si1", "si2", "si3"]]
+        rref.respond()
+        rref.respond()
+        rref.respond()
+        # the ServerBusyError is turned into a busy hint
+        self.assertEqual([self.successResultOf(d) for d in dl],
+                         [(set(), {0: "bw-si1-0"}, None),
+                          (set(), {0: "bw-si2-0"}, None),
+                          (set(), {}, 5.0)])
+        self.assertEqual([methname for (methname, args) in rref.calls],
+                         ["allocate_buckets"] * 3)
+
+
+class FakeVersionedRRef(object):
+    def __init__(self):
+        self.version = {"http://allmydata.org/tahoe/protocols/storage/v1": {}}
+        self.disconnect_watchers = []
+    def getLocationHints(self):
+        return []
+    def notifyOnDisconnect(self, cb):
+        self.disconnect_watchers.append(cb)
+
+class TestServerState(unittest.TestCase):
+    def test_full(self):
+        rref = FakeAllocateRRef(multi=True)
+        self.failIf(is_server_full(rref, 100))
+        note_allocation(rref, 1000, 0, 3, 0.5)
+        self.failUnless(is_server_full(rref, 1000))
+        self.failUnless(is_server_full(rref, 2000))
+        # it might still have room for smaller shares
+        self.failIf(is_server_full(rref, 999))
+        note_allocation(rref, 500, 0, 1, 0.5)
+        self.failUnless(is_server_full(rref, 999))
+        # asking for no shares tells us nothing about its space
+        note_allocation(rref, 100, 0, 0, 0.5)
+        self.failUnless(is_server_full(rref, 999))
+        # and accepting one means that it has room after all
+        note_allocation(rref, 600, 1, 0, 0.5)
+        self.failIf(is_server_full(rref, 999))
+
+    def test_expiry(self):
+        self.patch(storage_client, "SERVER_STATE_LIFETIME", -1)
+        rref = FakeAllocateRRef(multi=True)
+        note_allocation(rref, 1000, 0, 3, 0.5)
+        self.failIf(is_server_full(rref, 1000))
+
+    def test_latency(self):
+        rref = FakeAllocateRRef(multi=True)
+        self.assertEqual(get_allocation_latency(rref), None)
+        self.assertEqual(get_allocation_latency(None), None)
+        note_allocation(rref, 1000, 1, 0, 1.0)
+        self.assertEqual(get_allocation_latency(rref), 1.0)
+        note_allocation(rref, 1000, 1, 0, 2.0)
+        self.assertAlmostEqual(get_allocation_latency(rref), 1.3)
+
+    def test_forgotten_on_disconnect(self):
+        ann = {"anonymous-storage-FURL": "pb://w2hqnbaa25yw4qgcvghl5psa3srpfgw3@tcp:127.0.0.1:51309/vucto2z4fxment3vfxbqecblbf6zyp6x",
+               "permutation-seed-base32": "w2hqnbaa25yw4qgcvghl5psa3srpfgw3",
+               }
+        nss = NativeStorageServer("server_id", ann, None, {})
+        rref = FakeVersionedRRef()
+        nss._got_versioned_service(rref, None)
+        note_allocation(rref, 1000, 0, 1, 1.0)
+        self.failUnless(is_server_full(rref, 1000))
+        [lost] = rref.disconnect_watchers
+        lost()
+        self.failIf(is_server_full(rref, 1000))
+        self.assertEqual(get_allocation_latency(rref), None)
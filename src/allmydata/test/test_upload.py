@@ -8,17 +8,20 @@ from twisted.internet import defer, task
 from foolscap.api import fireEventually
 
 import allmydata # for __full_version__
-from allmydata import uri, monitor, client
+from allmydata import uri, monitor, client, history
 from allmydata.immutable import upload, encode
-from allmydata.interfaces import FileTooLargeError, UploadUnhappinessError
+from allmydata.interfaces import FileTooLargeError, UploadUnhappinessError, \
+     ServerBusyError
 from allmydata.util import log, base32
 from allmydata.util.assertutil import precondition
 from allmydata.util.deferredutil import DeferredListShouldSucceed
+from allmydata.util.consumer import download_to_data
 from allmydata.test.no_network import GridTestMixin
 from allmydata.test.common_util import ShouldFailMixin
 from allmydata.util.happinessutil import servers_of_happiness, \
     shares_by_server, merge_servers
-from allmydata.storage_client import StorageFarmBroker
+from allmydata.storage_client import StorageFarmBroker, is_server_busy, \
+     is_server_full, get_allocation_latency
 from allmydata.storage.server import storage_index_to_dir
 from allmydata.client import _Client
 
@@ -106,6 +109,9 @@ class FakeStorageServer:
         self.allocated = []
         self._alloc_queries = 0
         self._get_queries = 0
+        self.busy_refusals = 0
+        self.full_refusals = 0
+        self.partial = {} # (storage_index, shnum) -> FakeBucketWriter
         self.version = {
             "http://allmydata.org/tahoe/protocols/storage/v1" :
             {
@@ -121,6 +127,13 @@ class FakeStorageServer:
                 },
                 "application-version": str(allmydata.__full_version__),
             }
+        if mode == "resume":
+            v1 = self.version["http://allmydata.org/tahoe/protocols/storage/v1"]
+            v1["supports-resumable-uploads"] = True
+        if mode == "busy, holding some":
+            v1 = self.version["http://allmydata.org/tahoe/protocols/storage/v1"]
+            v1["supports-allocate-buckets-multi"] = True
+            self.held = set() # shnums, left here by the test
 
 
     def callRemote(self, methname, *args, **kwargs):
@@ -143,10 +156,27 @@ class FakeStorageServer:
             if self._alloc_queries == 1:
                 raise ServerError
         self._alloc_queries += 1
+        if self.mode == "busy":
+            if sharenums:
+                self.busy_refusals += 1
+                raise ServerBusyError(30)
+            return (set(), {},)
         if self.mode == "full":
+            if sharenums:
+                self.full_refusals += 1
             return (set(), {},)
         elif self.mode == "already got them":
             return (set(sharenums), {},)
+        elif self.mode == "resume":
+            # partial shares (left in self.partial by the test) are handed
+            # back, and new ones are kept there
+            buckets = {}
+            for shnum in sharenums:
+                key = (storage_index, shnum)
+                if key not in self.partial:
+                    self.partial[key] = FakeBucketWriter(share_size)
+                buckets[shnum] = self.partial[key]
+            return (set(), buckets)
         else:
             for shnum in sharenums:
                 self.allocated.append( (storage_index, shnum) )
@@ -155,15 +185,32 @@ class FakeStorageServer:
                           for shnum in sharenums]),
                     )
 
+    def allocate_buckets_multi(self, requests, canary):
+        # only the "busy, holding some" servers announce this: they report
+        # the shares they hold, and are too busy to take any more
+        self._alloc_queries += 1
+        results = []
+        for (storage_index, renew_secret, cancel_secret, sharenums,
+             share_size) in requests:
+            if set(sharenums) - self.held:
+                self.busy_refusals += 1
+                results.append((set(self.held), {}, 30.0))
+            else:
+                results.append((set(self.held), {}, None))
+        return results
+
     def get_buckets(self, storage_index, **kw):
         # this should map shnum to a BucketReader but there isn't a
         # handy FakeBucketReader and we don't actually read the shares
         # back anyway (just the keys)
-        return {
+        buckets = {
             shnum: None
             for (si, shnum) in self.allocated
             if si == storage_index
         }
+        if self.mode == "busy, holding some":
+            buckets.update(dict([(shnum, None) for shnum in self.held]))
+        return buckets
 
 
 
@@ -173,6 +220,7 @@ class FakeBucketWriter:
         self.data = StringIO()
         self.closed = False
         self._size = size
+        self.bytes_received = 0
 
     def callRemote(self, methname, *args, **kwargs):
         def _call():
@@ -197,6 +245,10 @@ class FakeBucketWriter:
                      (offset, len(data), self._size))
         self.data.seek(offset)
         self.data.write(data)
+        self.bytes_received += len(data)
+
+    def remote_get_written_size(self):
+        return len(self.data.getvalue())
 
     def remote_close(self):
         precondition(not self.closed)
@@ -354,6 +406,58 @@ class GoodServer(unittest.TestCase, ShouldFailMixin, SetDEPMixin):
         d.addCallback(self._check_large, SIZE_LARGE)
         return d
 
+    def test_upload_many(self):
+        # these servers do not know about the batched queries, so the
+        # uploads fall back to one query per file. The servers are too small
+        # for the gigantic file, which fails without affecting the others
+        uploadables = [upload.Data(self.get_data(SIZE_LARGE), convergence=""),
+                       GiganticUploadable(2**64),
+                       upload.Data(self.get_data(SIZE_SMALL), convergence=""),
+                       upload.Data(self.get_data(SIZE_LARGE-1),
+                                   convergence="")]
+        d = self.u.upload_many(uploadables, max_concurrent=2)
+        def _check(results):
+            r = results.get_results()
+            self.failUnlessEqual(len(r), 4)
+            self._check_large(r[0].get_uri(), SIZE_LARGE)
+            self.failUnless(isinstance(r[1], Failure), r[1])
+            self.failUnless(r[1].check(UploadUnhappinessError), r[1])
+            self._check_small(r[2].get_uri(), SIZE_SMALL)
+            self._check_large(r[3].get_uri(), SIZE_LARGE-1)
+            uris = results.get_uris()
+            self.failUnlessEqual(uris[1], None)
+            self.failUnlessEqual(uris[3], r[3].get_uri())
+            self.failUnlessEqual(results.get_total_size(),
+                                 2*SIZE_LARGE - 1 + SIZE_SMALL)
+            timings = results.get_timings()
+            self.failUnlessIn("total", timings)
+            self.failUnlessIn("peer_selection", timings)
+        d.addCallback(_check)
+        return d
+
+    def test_data_large_write_windows(self):
+        h = history.History(None)
+        self.u = upload.Uploader(history=h)
+        self.u.running = True
+        self.u.parent = self.node
+        data = self.get_data(SIZE_LARGE)
+        d = upload_data(self.u, data)
+        def _check(results):
+            [status] = list(h.list_all_upload_statuses())
+            windows = status.get_write_windows()
+            self.failUnless(windows)
+            for (name, window, throughput, rtt) in windows:
+                self.failUnless(window > 0, window)
+                self.failIfEqual(rtt, None)
+            # the windows belong to the uploader, for the next upload to
+            # start from, but the pipelines which used them are gone
+            budget = self.u.window_budget
+            for w in budget._windows.values():
+                self.failIfEqual(w.get_rtt(), None)
+                self.failUnlessEqual(len(w.pipelines), 0)
+        d.addCallback(_check)
+        return d
+
     def test_data_large_odd_segments(self):
         data = self.get_data(SIZE_LARGE)
         segsize = int(SIZE_LARGE / 2.5)
@@ -541,6 +645,116 @@ class ServerErrors(unittest.TestCase, ShouldFailMixin, SetDEPMixin):
         d.addCallback(_check)
         return d
 
+    def test_busy(self):
+        self.make_node(dict([(i, "busy") for i in range(3)] +
+                            [(i, "good") for i in range(3, 10)]))
+        self.set_encoding_parameters(3, 7, 10)
+        servers = self.node.last_servers
+        d = upload_data(self.u, DATA)
+        d.addCallback(extract_uri)
+        d.addCallback(self._check_large, SIZE_LARGE)
+        def _check_busy(ign):
+            # the shares went elsewhere, and the busy servers are left
+            # alone for a while
+            for s in servers[:3]:
+                self.failUnlessEqual(s.allocated, [])
+                self.failUnless(is_server_busy(s))
+            for s in servers[3:]:
+                self.failIf(is_server_busy(s))
+            self.failUnlessEqual([s.busy_refusals for s in servers[:3]],
+                                 [1, 1, 1])
+            return upload_data(self.u, DATA + "more")
+        d.addCallback(_check_busy)
+        def _check_avoided(ign):
+            # the second upload did not ask them to take any shares
+            self.failUnlessEqual([s.busy_refusals for s in servers[:3]],
+                                 [1, 1, 1])
+        d.addCallback(_check_avoided)
+        return d
+
+    def test_busy_holding_some(self):
+        # each server already holds one share, and is too busy to take the
+        # second one we ask it for: the shares it holds still count, and
+        # its refusal is neither an error nor a sign that it is full
+        self.make_node("busy, holding some", num_servers=3)
+        self.set_encoding_parameters(3, 3, 6)
+        servers = self.node.last_servers
+        for (i, s) in enumerate(servers):
+            s.held = set([i])
+        d = upload_data(self.u, DATA)
+        d.addCallback(extract_uri)
+        d.addCallback(self._check_large, SIZE_LARGE)
+        def _check(ign):
+            for s in servers:
+                self.failUnlessEqual(s.allocated, [])
+                self.failUnless(s.busy_refusals > 0)
+                self.failUnless(is_server_busy(s))
+                self.failIf(is_server_full(s, 1))
+        d.addCallback(_check)
+        return d
+
+    def test_full_servers_avoided(self):
+        self.make_node(dict([(i, "full") for i in range(3)] +
+                            [(i, "good") for i in range(3, 10)]))
+        self.set_encoding_parameters(3, 7, 10)
+        servers = self.node.last_servers
+        d = upload_data(self.u, DATA)
+        d.addCallback(extract_uri)
+        d.addCallback(self._check_large, SIZE_LARGE)
+        def _check_full(ign):
+            self.failUnlessEqual([s.full_refusals for s in servers[:3]],
+                                 [1, 1, 1])
+            for s in servers[:3]:
+                self.failUnless(is_server_full(s, 2**40))
+                self.failIf(is_server_full(s, 10))
+            for s in servers[3:]:
+                self.failIf(is_server_full(s, 1))
+                self.failIfEqual(get_allocation_latency(s), None)
+            return upload_data(self.u, DATA + "more")
+        d.addCallback(_check_full)
+        def _check_avoided(ign):
+            # the second upload did not ask them to take any shares
+            self.failUnlessEqual([s.full_refusals for s in servers[:3]],
+                                 [1, 1, 1])
+        d.addCallback(_check_avoided)
+        return d
+
+    def test_resume(self):
+        self.make_node("resume")
+        # several segments, so that there are some whole blocks to skip
+        self.set_encoding_parameters(3, 7, 10, max_segsize=3000)
+        servers = self.node.last_servers
+        # convergent, so that both uploads use the same storage index
+        DATA_UPLOADABLE = lambda: upload.Data(DATA * 40, convergence="")
+        d = self.u.upload(DATA_UPLOADABLE())
+        def _interrupt(ur):
+            self.uri = ur.get_uri()
+            self.shares = {}
+            for s in servers:
+                for key, bw in s.partial.items():
+                    share = bw.data.getvalue()
+                    self.shares[key] = share
+                    # pretend that the upload was cut off half way through
+                    bw.data = StringIO()
+                    bw.data.write(share[:len(share)//2])
+                    bw.closed = False
+                    bw.bytes_received = 0
+            return self.u.upload(DATA_UPLOADABLE())
+        d.addCallback(_interrupt)
+        def _check_resumed(ur):
+            self.failUnlessEqual(ur.get_uri(), self.uri)
+            for s in servers:
+                for key, bw in s.partial.items():
+                    share = self.shares[key]
+                    self.failUnless(bw.closed)
+                    self.failUnlessEqual(bw.data.getvalue(), share)
+                    # only the second half (and part of the block that
+                    # straddles the middle) was sent again
+                    self.failUnless(bw.bytes_received < len(share) * 0.6,
+                                    (bw.bytes_received, len(share)))
+        d.addCallback(_check_resumed)
+        return d
+
     def test_timeout(self):
         clock = task.Clock()
         self.make_node("timeout")
@@ -2119,6 +2333,36 @@ class EncodingParameters(GridTestMixin, unittest.TestCase, SetDEPMixin,
         return d
 
 
+    @defer.inlineCallbacks
+    def test_upload_many(self):
+        self.basedir = self.mktemp()
+        self.set_up_grid(num_servers=5)
+        client = self.g.clients[0]
+        client.encoding_params['k'] = 2
+        client.encoding_params['happy'] = 5
+        client.encoding_params['n'] = 5
+        datas = ["file %d " % i * 1000 for i in range(8)] + ["tiny"]
+        for wrapper in self.g.wrappers_by_id.values():
+            wrapper._clear_counters()
+        results = yield client.upload_many(
+            [upload.Data(data, convergence="") for data in datas])
+        self.failUnlessEqual(len(results.get_results()), len(datas))
+        # eight files which need servers asked each of the five servers
+        # about existing shares and for space, but most of those queries
+        # were sent together
+        calls = 0
+        for wrapper in self.g.wrappers_by_id.values():
+            counts = wrapper.counter_by_methname
+            self.failUnless(counts.get("allocate_buckets_multi"), counts)
+            calls += sum([counts.get(methname, 0) for methname in
+                          ["get_buckets", "get_buckets_multi",
+                           "allocate_buckets", "allocate_buckets_multi"]])
+        self.failUnless(calls < 8*5*2 // 2, calls)
+        for (data, cap) in zip(datas, results.get_uris()):
+            n = client.create_node_from_uri(cap)
+            got = yield download_to_data(n)
+            self.failUnlessEqual(got, data)
+
     def test_server_selector_bucket_abort(self):
         # If server selection for an upload fails due to an unhappy
         # layout, the server selection process should abort the buckets it
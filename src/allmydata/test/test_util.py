@@ -18,6 +18,7 @@ from allmydata.util import base32, idlib, humanreadable, mathutil, hashutil
 from allmydata.util import assertutil, fileutil, deferredutil, abbreviate
 from allmydata.util import limiter, time_format, pollmixin, cachedir
 from allmydata.util import statistics, dictutil, pipeline, yamlutil
+from allmydata.util import histogram, workerpool
 from allmydata.util import log as tahoe_log
 from allmydata.util.spans import Spans, overlap, DataSpans
 from allmydata.test.common_util import ReallyEqualMixin, TimezoneMixin
@@ -357,6 +358,70 @@ class Statistics(unittest.TestCase):
         self.failUnlessEqual(f(plist, .5, 3), .02734375)
 
 
+class Histogram(unittest.TestCase):
+    def failUnlessClose(self, value, expected):
+        # bucketed values are accurate to about one percent
+        self.failUnless(abs(value - expected) <= 0.011 * expected,
+                        (value, expected))
+
+    def test_histogram(self):
+        h = histogram.Histogram()
+        self.failUnlessEqual(h.percentile(0.5), None)
+        self.failUnlessEqual(h.get_stats()["samplesize"], 0)
+        for i in range(1000):
+            h.add(0.001 * (i+1))
+        self.failUnlessEqual(h.count, 1000)
+        self.failUnlessAlmostEqual(h.get_mean(), 0.5005)
+        self.failUnlessEqual((h.min, h.max), (0.001, 1.0))
+        for fraction in (0.01, 0.1, 0.5, 0.9, 0.99):
+            self.failUnlessClose(h.percentile(fraction),
+                                 0.001 * (int(fraction*1000) + 1))
+        # percentiles never fall outside the observed samples
+        self.failUnless(0.001 <= h.percentile(0.0) < 0.00101)
+        self.failUnless(0.99 < h.percentile(0.9999) <= 1.0)
+        # memory use depends upon the range of the values, not their number
+        for i in range(1000):
+            h.add(0.001 * (i+1))
+        self.failUnless(len(h._buckets) < 400, len(h._buckets))
+
+        # zero, and values that are out of range, are still counted
+        h2 = histogram.Histogram()
+        for value in (0.0, 0.0, 1e-9, 5e9):
+            h2.add(value)
+        self.failUnlessEqual(h2.percentile(0.5), 0.0)
+        self.failUnlessEqual(h2.percentile(0.9), 5e9)
+        h.merge(h2)
+        self.failUnlessEqual((h.count, h.min, h.max), (2004, 0.0, 5e9))
+
+        stats = h2.get_stats()
+        self.failUnlessEqual(stats["samplesize"], 4)
+        self.failUnlessEqual(stats["50_0_percentile"], None)
+        stats = h.get_stats()
+        self.failUnlessClose(stats["50_0_percentile"], 0.5)
+        self.failUnlessClose(stats["99_9_percentile"], 1.0)
+
+    def test_windows(self):
+        h = histogram.WindowedHistogram()
+        now = 100000.0
+        for minute in range(119, -1, -1):
+            # one sample per minute for two hours, oldest first
+            h.add(float(minute+1), now - 60*minute)
+        def count(window):
+            return h.get_stats(window, now)["samplesize"]
+        self.failUnlessEqual(count("1m"), 1)
+        self.failUnlessEqual(count("5m"), 5)
+        self.failUnlessEqual(count("1h"), 60)
+        self.failUnlessClose(h.get_histogram("5m", now).percentile(0.5), 3.0)
+        # the samples from the first hour were forgotten as the second
+        # hour's were added
+        self.failUnless(len(h._slots) <= 360, len(h._slots))
+        # later queries see fewer samples
+        self.failUnlessEqual(h.get_stats("5m", now + 600)["samplesize"], 0)
+        # clocks which step backwards do not lose samples
+        h.add(7.0, now - 3600)
+        self.failUnlessEqual(count("1m"), 2)
+
+
 class Asserts(unittest.TestCase):
     def should_assert(self, func, *args, **kwargs):
         try:
@@ -475,6 +540,15 @@ class FileUtil(ReallyEqualMixin, unittest.TestCase):
         fileutil.write_atomically(fn, "two", mode="") # non-binary
         self.failUnlessEqual(fileutil.read(fn), "two")
 
+    def test_fsync_path(self):
+        basedir = "util/FileUtil/test_fsync_path"
+        fileutil.make_dirs(basedir)
+        self.touch(basedir, "here")
+        fileutil.fsync_path(os.path.join(basedir, "here"))
+        fileutil.fsync_path(basedir)
+        self.failUnlessRaises(OSError, fileutil.fsync_path,
+                              os.path.join(basedir, "missing"))
+
     def test_rename(self):
         basedir = "util/FileUtil/test_rename"
         fileutil.make_dirs(basedir)
@@ -1602,6 +1676,173 @@ class Pipeline(unittest.TestCase):
 
         del d1,d2,d3,d4
 
+    def test_set_capacity(self):
+        self.calls = []
+        p = pipeline.Pipeline(100)
+        d = p.add(150, self.pause, "one")
+        finished = []
+        d.addBoth(finished.append)
+        self.failUnlessEqual(finished, [])
+        # raising the capacity releases the caller which was waiting
+        p.set_capacity(200)
+        self.failUnlessEqual(finished, [None])
+        p.set_capacity(100)
+        d = p.add(10, self.pause, "two")
+        finished = []
+        d.addBoth(finished.append)
+        self.failUnlessEqual(finished, [])
+        self.calls[0][0].callback("one-result")
+        self.failUnlessEqual(finished, [None])
+
+    def test_adaptive_window(self):
+        budget = pipeline.WindowBudget()
+        w = budget.get_window("server1", "s1")
+        self.failUnlessIdentical(budget.get_window("server1", "s1"), w)
+        self.failUnlessEqual(w.get_effective_window(), w.initial_window)
+        self.failUnlessEqual(w.get_throughput(), None)
+        self.failUnlessEqual(w.get_rtt(), None)
+
+        p = pipeline.Pipeline(1)
+        w.add_pipeline(p)
+        self.failUnlessEqual(p.capacity, w.initial_window)
+
+        # 100kB acknowledged after 0.1s: 1MB/s with a 100ms round trip
+        self.failUnlessEqual(w.acked("res", 100*1000, 10.0, now=10.1),
+                             "res")
+        self.failUnlessAlmostEqual(w.get_rtt(), 0.1)
+        self.failUnlessAlmostEqual(w.get_throughput(), 1000*1000)
+        self.failUnlessEqual(w.window, 200*1000)
+        self.failUnlessEqual(p.capacity, 200*1000)
+
+        # a slower write, queued behind that one, keeps the smaller
+        # round-trip time (allowing for drift), and the rate is measured
+        # from the previous ack
+        w.acked(None, 10*1000, 10.05, now=10.3)
+        self.failUnlessAlmostEqual(w.get_rtt(), 0.101)
+        self.failUnlessAlmostEqual(w.get_throughput(), 950*1000)
+
+        # a second pipeline to the same server shares the window
+        p2 = pipeline.Pipeline(1)
+        w.add_pipeline(p2)
+        self.failUnlessEqual(p.capacity, w.window // 2)
+        self.failUnlessEqual(p2.capacity, w.window // 2)
+        w.remove_pipeline(p2)
+        self.failUnlessEqual(p.capacity, w.window)
+
+        # the window stays within its limits
+        w.acked(None, 1, 20.0, now=20.0001)
+        w.acked(None, 1, 30.0, now=30.0001)
+        for i in range(200):
+            w.acked(None, 1, 40.0+i, now=40.0001+i)
+        self.failUnlessEqual(w.window, w.min_window)
+        w2 = budget.get_window("server2", "s2")
+        w2.acked(None, 10**9, 300.0, now=301.0)
+        self.failUnlessEqual(w2.window, w2.max_window)
+
+    def test_window_budget(self):
+        budget = pipeline.WindowBudget(max_bytes=1000*1000)
+        w1 = budget.get_window("server1", "s1")
+        w2 = budget.get_window("server2", "s2")
+        p1 = pipeline.Pipeline(1)
+        p2 = pipeline.Pipeline(1)
+        w1.add_pipeline(p1)
+        w2.add_pipeline(p2)
+        # both servers can hold 1MB, which is too much for the two together
+        w1.acked(None, 500*1000, 1.0, now=2.0)
+        w2.acked(None, 500*1000, 1.0, now=2.0)
+        self.failUnlessEqual(w1.window, 1000*1000)
+        self.failUnlessEqual(w1.get_effective_window(), 500*1000)
+        self.failUnlessEqual(p1.capacity, 500*1000)
+        self.failUnlessEqual(p2.capacity, 500*1000)
+        # once one server is idle, the other may have its whole window
+        w2.remove_pipeline(p2)
+        self.failUnlessEqual(w1.get_effective_window(), 1000*1000)
+        self.failUnlessEqual(p1.capacity, 1000*1000)
+
+    def test_window_budget_several_shares(self):
+        budget = pipeline.WindowBudget(max_bytes=1000*1000)
+        w = budget.get_window("server1", "s1")
+        # a new server holding three shares starts each of their pipelines
+        # at no less than the old fixed depth, not a third of the window
+        pipelines = [pipeline.Pipeline(1) for i in range(3)]
+        for p in pipelines:
+            w.add_pipeline(p)
+        self.failUnless(w.initial_window < 3*budget.min_pipeline_capacity)
+        for p in pipelines:
+            self.failUnlessEqual(p.capacity, budget.min_pipeline_capacity)
+        # and the floor holds when the budget scales the window down
+        w2 = budget.get_window("server2", "s2")
+        p2 = pipeline.Pipeline(1)
+        w2.add_pipeline(p2)
+        w.acked(None, 10**6, 1.0, now=2.0)
+        w2.acked(None, 10**6, 1.0, now=2.0)
+        self.failUnlessEqual(w.get_effective_window(), 500*1000)
+        for p in pipelines:
+            self.failUnlessEqual(p.capacity, 500*1000 // 3)
+        w.acked(None, 1, 3.0, now=3.0001)
+        for i in range(200):
+            w.acked(None, 1, 4.0+i, now=4.0001+i)
+        self.failUnlessEqual(w.window, w.min_window)
+        for p in pipelines:
+            self.failUnlessEqual(p.capacity, budget.min_pipeline_capacity)
+
+class WorkerPool(unittest.TestCase):
+    def test_jobs(self):
+        import zfec
+        from pycryptopp.cipher.aes import AES
+        inshares = ["a"*10, "b"*10, "c"*10]
+        shares = workerpool.fec_encode(3, 10, inshares, range(10))
+        self.failUnlessEqual(shares,
+                             zfec.Encoder(3, 10).encode(inshares, range(10)))
+        self.failUnlessEqual(workerpool.fec_decode(3, 10,
+                                                   [shares[1], shares[4],
+                                                    shares[9]],
+                                                   [1, 4, 9]),
+                             inshares)
+        key = "k"*16
+        data = os.urandom(1000)
+        stream = AES(key).process(data)
+        for offset in [0, 1, 15, 16, 17, 500]:
+            self.failUnlessEqual(workerpool.aes_ctr(key, offset,
+                                                    data[offset:]),
+                                 stream[offset:])
+        self.failUnlessEqual(workerpool.hash_blocks(inshares),
+                             [hashutil.block_hash(b) for b in inshares])
+
+    def test_no_pool(self):
+        self.failUnlessEqual(workerpool.get_worker_pool(), None)
+        d = workerpool.run(workerpool.hash_blocks, ["a"])
+        d.addCallback(self.failUnlessEqual, [hashutil.block_hash("a")])
+        return d
+
+    @defer.inlineCallbacks
+    def _test_pool(self, use_processes):
+        pool = workerpool.WorkerPool(2, use_processes=use_processes)
+        pool.startService()
+        try:
+            self.failUnlessIdentical(workerpool.get_worker_pool(), pool)
+            shares = yield workerpool.run(workerpool.fec_encode, 2, 3,
+                                          ["ab", "cd"], [0, 1, 2])
+            self.failUnlessEqual(shares[:2], ["ab", "cd"])
+            hashes = yield workerpool.run(workerpool.hash_blocks, ["ab"])
+            self.failUnlessEqual(hashes, [hashutil.block_hash("ab")])
+            # failures make it back too
+            try:
+                yield pool.run(int, "not a number")
+            except ValueError:
+                pass
+            else:
+                self.fail("should have raised ValueError")
+        finally:
+            yield pool.stopService()
+        self.failUnlessEqual(workerpool.get_worker_pool(), None)
+
+    def test_threads(self):
+        return self._test_pool(False)
+
+    def test_processes(self):
+        return self._test_pool(True)
+
 class SampleError(Exception):
     pass
 
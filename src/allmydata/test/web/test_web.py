@@ -36,7 +36,7 @@ from allmydata.nodemaker import NodeMaker
 from allmydata.frontends.magic_folder import QueuedItem
 from allmydata.web import status
 from allmydata.web.common import WebError, MultiFormatPage
-from allmydata.util import fileutil, base32, hashutil
+from allmydata.util import fileutil, base32, hashutil, histogram
 from allmydata.util.consumer import download_to_data
 from allmydata.util.encodingutil import to_str
 from ...util.connection_status import ConnectionStatus
@@ -111,6 +111,16 @@ class FakeUploader(service.Service):
         d.addCallback(_got_data)
         return d
 
+    def upload_many(self, uploadables, **kw):
+        results = upload.BatchUploadResults(len(uploadables))
+        d = defer.succeed(None)
+        for (i, uploadable) in enumerate(uploadables):
+            d.addCallback(lambda ign, u=uploadable: self.upload(u))
+            d.addCallback(results.set_result, i)
+        d.addCallback(lambda ign: results.set_total_time(0.0))
+        d.addCallback(lambda ign: results)
+        return d
+
     def get_helper_info(self):
         return (self.helper_furl, self.helper_connected)
 
@@ -262,6 +272,7 @@ class FakeStorageServer(service.MultiService):
         self.nickname = nickname
         self.bucket_counter = FakeBucketCounter()
         self.lease_checker = FakeLeaseChecker()
+        self.scrubber = None
     def get_stats(self):
         return {"storage_server.accepting_immutable_shares": False}
     def on_status_changed(self, cb):
@@ -577,21 +588,24 @@ class WebMixin(testutil.TimezoneMixin):
         form.append('')
         form.append('UTF-8')
         form.append(sep)
-        for name, value in fields.iteritems():
-            if isinstance(value, tuple):
-                filename, value = value
-                form.append('Content-Disposition: form-data; name="%s"; '
-                            'filename="%s"' % (name, filename.encode("utf-8")))
-            else:
-                form.append('Content-Disposition: form-data; name="%s"' % name)
-            form.append('')
-            if isinstance(value, unicode):
-                value = value.encode("utf-8")
-            else:
-                value = str(value)
-            assert isinstance(value, str)
-            form.append(value)
-            form.append(sep)
+        for name, values in fields.iteritems():
+            if not isinstance(values, list):
+                values = [values]
+            for value in values:
+                if isinstance(value, tuple):
+                    filename, value = value
+                    form.append('Content-Disposition: form-data; name="%s"; '
+                                'filename="%s"' % (name, filename.encode("utf-8")))
+                else:
+                    form.append('Content-Disposition: form-data; name="%s"' % name)
+                form.append('')
+                if isinstance(value, unicode):
+                    value = value.encode("utf-8")
+                else:
+                    value = str(value)
+                assert isinstance(value, str)
+                form.append(value)
+                form.append(sep)
         form[-1] += "--"
         body = ""
         headers = {}
@@ -1138,6 +1152,16 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
         self.failUnlessReallyEqual(drrm.render_time(None, 0.000123), "123us")
         self.failUnlessReallyEqual(drrm.render_rate(None, None), "")
         self.failUnlessReallyEqual(drrm.render_rate(None, 2500000), "2.50MBps")
+        h = histogram.Histogram()
+        h.add(0.25)
+        self.failUnlessReallyEqual(drrm.render_histogram(h), "250ms")
+        h.add(2.5)
+        h.add(0.0021)
+        # the median is approximate
+        summary = drrm.render_histogram(h)
+        self.failUnless(summary.startswith("3 responses: min 2.1ms, median 2"),
+                        summary)
+        self.failUnless(summary.endswith("ms, max 2.50s"), summary)
         self.failUnlessReallyEqual(drrm.render_rate(None, 30100), "30.1kBps")
         self.failUnlessReallyEqual(drrm.render_rate(None, 123), "123Bps")
 
@@ -2602,6 +2626,30 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
         d.addCallback(self.failUnlessCHKURIHasContents, self.NEWFILE_CONTENTS)
         return d
 
+    @inlineCallbacks
+    def test_POST_upload_many(self):
+        res = yield self.POST("/uri", t="upload-many",
+                              file=[("one.txt", self.NEWFILE_CONTENTS),
+                                    ("two.txt", "other contents\n")])
+        data = json.loads(res)
+        self.failUnlessEqual([f["filename"] for f in data["files"]],
+                             ["one.txt", "two.txt"])
+        self.failUnlessEqual(data["total_size"],
+                             len(self.NEWFILE_CONTENTS) + len("other contents\n"))
+        self.failUnlessIn("total", data["timings"])
+        yield self.failUnlessCHKURIHasContents(str(data["files"][0]["uri"]),
+                                               self.NEWFILE_CONTENTS)
+        yield self.failUnlessCHKURIHasContents(str(data["files"][1]["uri"]),
+                                               "other contents\n")
+
+    def test_POST_upload_many_no_files(self):
+        d = self.POST("/uri", t="upload-many")
+        d.addBoth(self.shouldFail, error.Error,
+                  "POST_upload_many_no_files",
+                  "400 Bad Request",
+                  "t=upload-many requires one or more file= fields")
+        return d
+
     @inlineCallbacks
     def test_POST_upload_no_link_whendone(self):
         body, headers = self.build_form(t="upload", when_done="/",
@@ -252,6 +252,18 @@ def move_into_place(source, dest):
         remove_if_possible(dest)
     os.rename(source, dest)
 
+def fsync_path(path):
+    """Flush a file's contents, or a directory's entries, to stable
+    storage. Directories cannot be opened (or synced) on Windows, where this
+    does nothing for them."""
+    if "win32" in sys.platform.lower() and os.path.isdir(path):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
 def write_atomically(target, contents, mode="b"):
     with open(target+".tmp", "w"+mode) as f:
         f.write(contents)
@@ -0,0 +1,160 @@
+import math, time
+from collections import deque
+
+# Values are counted in logarithmically-sized buckets, in the style of
+# HdrHistogram: each bucket is RATIO times wider than the one before it, so
+# any value between MIN_VALUE and MAX_VALUE is remembered to within about
+# one percent, no matter how many samples have been recorded. Values below
+# MIN_VALUE (including zero) share the first bucket, and values above
+# MAX_VALUE share the last one.
+MIN_VALUE = 1e-6
+MAX_VALUE = 1e6
+RATIO = 1.02
+_LOG_RATIO = math.log(RATIO)
+NUM_BUCKETS = 2 + int(math.log(MAX_VALUE / MIN_VALUE) / _LOG_RATIO)
+
+# (fraction, stats key, minimum number of samples needed to report it)
+PERCENTILES = [(0.01, "01_0_percentile", 100),
+               (0.1, "10_0_percentile", 10),
+               (0.50, "50_0_percentile", 10),
+               (0.90, "90_0_percentile", 10),
+               (0.95, "95_0_percentile", 20),
+               (0.99, "99_0_percentile", 100),
+               (0.999, "99_9_percentile", 1000)]
+
+def bucket_for(value):
+    if value < MIN_VALUE:
+        return 0
+    return min(1 + int(math.log(value / MIN_VALUE) / _LOG_RATIO),
+               NUM_BUCKETS - 1)
+
+def bucket_value(bucket):
+    """Return the value that stands in for every sample in the given bucket:
+    the geometric middle of its range."""
+    if bucket == 0:
+        return 0.0
+    return MIN_VALUE * RATIO ** (bucket - 0.5)
+
+
+class Histogram(object):
+    """I summarize a stream of non-negative numbers (usually latencies, in
+    seconds) in a fixed amount of memory. add() is O(1), and percentile()
+    is O(buckets), however many samples have been added. The count, mean,
+    minimum and maximum are exact; percentiles are accurate to about one
+    percent."""
+
+    def __init__(self):
+        self._buckets = {} # bucket number -> count. Sparse, since most
+                           # sources only ever hit a few dozen buckets.
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        b = bucket_for(value)
+        self._buckets[b] = self._buckets.get(b, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Add all of the samples in another Histogram to this one."""
+        for b, n in other._buckets.iteritems():
+            self._buckets[b] = self._buckets.get(b, 0) + n
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def get_mean(self):
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def percentile(self, fraction):
+        """Return the value below which 'fraction' of the samples fall (so
+        percentile(0.5) is the median), or None if there are no samples."""
+        if not self.count:
+            return None
+        rank = int(fraction * self.count)
+        seen = 0
+        for b in sorted(self._buckets):
+            seen += self._buckets[b]
+            if seen > rank:
+                if b == NUM_BUCKETS - 1:
+                    # the overflow bucket has no upper bound
+                    return self.max
+                return min(max(bucket_value(b), self.min), self.max)
+        return self.max
+
+    def get_stats(self):
+        """Return a dict with the sample count ('samplesize'), the 'mean'
+        (None unless there are at least two samples), and the percentiles
+        listed in PERCENTILES, each of which is None unless there are
+        enough samples for it to mean anything."""
+        stats = {"samplesize": self.count}
+        if self.count > 1:
+            stats["mean"] = self.get_mean()
+        else:
+            stats["mean"] = None
+        for fraction, name, minimum in PERCENTILES:
+            if self.count >= minimum:
+                stats[name] = self.percentile(fraction)
+            else:
+                stats[name] = None
+        return stats
+
+
+class WindowedHistogram(object):
+    """I am a Histogram of only the samples that were added recently.
+
+    Samples are collected into one Histogram per 'slot_length' seconds, and
+    the slots which are too old to be of interest to any of my 'windows'
+    are discarded, so my memory use is bounded by the length of the longest
+    window, not by the number of samples."""
+
+    slot_length = 10 # seconds
+    # window name -> length in seconds
+    windows = {"1m": 60,
+               "5m": 5*60,
+               "1h": 60*60,
+               }
+
+    def __init__(self):
+        self._slots = deque() # (slot number, Histogram), oldest first
+        self._max_slots = max(self.windows.values()) // self.slot_length
+
+    def _slot_for(self, now):
+        if now is None:
+            now = time.time()
+        return int(now // self.slot_length)
+
+    def add(self, value, now=None):
+        slot = self._slot_for(now)
+        # if the clock went backwards, count the sample in the newest slot
+        if not self._slots or slot > self._slots[-1][0]:
+            self._slots.append((slot, Histogram()))
+            while self._slots[0][0] <= slot - self._max_slots:
+                self._slots.popleft()
+        self._slots[-1][1].add(value)
+
+    def get_histogram(self, window, now=None):
+        """Return a new Histogram of the samples added in the last 'window'
+        (a key of my 'windows' dict). The current, partly-filled slot
+        counts towards the window, so it may reach up to 'slot_length'
+        seconds further back than requested."""
+        first = self._slot_for(now) - self.windows[window] // self.slot_length
+        h = Histogram()
+        for slot, slot_h in self._slots:
+            if slot > first:
+                h.merge(slot_h)
+        return h
+
+    def get_stats(self, window, now=None):
+        return self.get_histogram(window, now).get_stats()
@@ -1,4 +1,6 @@
 
+import time, weakref
+
 from twisted.internet import defer
 from twisted.python.failure import Failure
 from twisted.python import log
@@ -105,6 +107,22 @@ class Pipeline:
         d.addErrback(self._flushed_error)
         return d
 
+    def set_capacity(self, capacity):
+        """Change how full I may get. A caller of add() who is blocked is
+        released if I am now below my capacity."""
+        self.capacity = capacity
+        if not self.failure:
+            self._release_waiting()
+
+    def _release_waiting(self):
+        while self.waiting and (self.gauge < self.capacity):
+            d = self.waiting.pop(0)
+            d.callback(None)
+            # the d.callback() might trigger a new call to add(), which
+            # will raise our gauge and might cause the pipeline to be
+            # filled. So the while() loop gets a chance to tell the
+            # caller to stop.
+
     def _flushed_error(self, f):
         precondition(self.failure) # should have been set by _call_finished
         return self.failure
@@ -120,15 +138,135 @@ class Pipeline:
                 d = self.waiting.pop(0)
                 d.errback(self.failure)
         else:
-            while self.waiting and (self.gauge < self.capacity):
-                d = self.waiting.pop(0)
-                d.callback(None)
-                # the d.callback() might trigger a new call to add(), which
-                # will raise our gauge and might cause the pipeline to be
-                # filled. So the while() loop gets a chance to tell the
-                # caller to stop.
+            self._release_waiting()
         return res
 
     def _eat_pipeline_errors(self, f):
         f.trap(PipelineError)
         return None
+
+
+class AdaptiveWindow(object):
+    """I decide how many bytes of writes to one server may be in flight at
+    once, from how quickly that server has been acknowledging them.
+
+    Each acknowledged write gives a sample of the round-trip time (from when
+    it was sent to when it was acknowledged) and of the rate at which the
+    server takes data (its size, over the time since the previous write to
+    the same server was acknowledged, or since it was sent if that is
+    later). The window is 'gain' times the product of the two: the number
+    of bytes which the connection to the server can hold, with some room to
+    find out whether it could take more. I keep the smallest round-trip
+    time I have seen (which is the one least inflated by writes queued
+    ahead of it), and the largest rate (which is the one least held back by
+    the uploader having nothing to send). Both are allowed to drift, so
+    that I can follow a server which gets slower.
+
+    All the Pipelines which write to the server (one for each share being
+    uploaded to it) share my window equally, subject to the WindowBudget I
+    belong to.
+    """
+
+    initial_window = 50*1000
+    min_window = 16*1024
+    max_window = 16*1024*1024
+    gain = 2.0
+    rate_decay = 0.95 # per sample
+    rtt_drift = 1.01 # per sample
+
+    def __init__(self, name, budget):
+        self.name = name
+        self._budget = budget
+        self.window = self.initial_window
+        self.scale = 1.0 # the share of my window that the budget allows
+        self.min_rtt = None
+        self.rate = None # bytes per second
+        self._last_ack = None
+        self.pipelines = weakref.WeakKeyDictionary()
+
+    def add_pipeline(self, p):
+        self.pipelines[p] = None
+        self._budget.update()
+
+    def remove_pipeline(self, p):
+        if p in self.pipelines:
+            del self.pipelines[p]
+            self._budget.update()
+
+    def acked(self, res, size, sent_at, now=None):
+        """Record that a write of 'size' bytes, sent at 'sent_at', has been
+        acknowledged. Returns 'res', so that I can be used as a callback."""
+        if now is None:
+            now = time.time()
+        rtt = max(now - sent_at, 1e-6)
+        if self.min_rtt is None:
+            self.min_rtt = rtt
+        else:
+            self.min_rtt = min(rtt, self.min_rtt * self.rtt_drift)
+        start = sent_at
+        if self._last_ack is not None:
+            start = max(sent_at, self._last_ack)
+        self._last_ack = now
+        if now > start:
+            sample = size / (now - start)
+            self.rate = max(sample, (self.rate or 0) * self.rate_decay)
+        if self.rate is not None:
+            window = int(self.gain * self.rate * self.min_rtt)
+            window = max(self.min_window, min(self.max_window, window))
+            old = self.window
+            self.window = window
+            # don't bother the pipelines with small changes
+            if abs(window - old) * 8 > old:
+                self._budget.update()
+        return res
+
+    def get_effective_window(self):
+        """Return how many bytes of writes may be in flight to my server,
+        after the budget has had its say."""
+        return int(self.window * self.scale)
+
+    def get_throughput(self):
+        return self.rate
+
+    def get_rtt(self):
+        return self.min_rtt
+
+class WindowBudget(object):
+    """I hold the AdaptiveWindows of all the servers that a client uploads
+    to, and keep the total of their windows (which is how much memory the
+    data in flight may take) below 'max_bytes'. If the windows of the
+    servers which are being written to add up to more than that, each one
+    is scaled down in proportion. Each Pipeline may still have at least
+    'min_pipeline_capacity' bytes in flight (the fixed depth that every
+    share's pipeline had before windows adapted), so that a server which
+    holds several shares is not held below one block per share."""
+
+    max_bytes = 32*1000*1000
+    min_pipeline_capacity = 50*1000
+
+    def __init__(self, max_bytes=None):
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        self._windows = {} # serverid -> AdaptiveWindow
+
+    def get_window(self, serverid, name):
+        if serverid not in self._windows:
+            self._windows[serverid] = AdaptiveWindow(name, self)
+        return self._windows[serverid]
+
+    def update(self):
+        """Set the capacity of every Pipeline from the current windows."""
+        active = [w for w in self._windows.values() if w.pipelines]
+        total = sum([w.window for w in active])
+        scale = 1.0
+        if total > self.max_bytes:
+            scale = float(self.max_bytes) / total
+        for w in active:
+            w.scale = scale
+            pipelines = w.pipelines.keys()
+            if not pipelines:
+                continue
+            capacity = max(self.min_pipeline_capacity,
+                           int(w.window * scale / len(pipelines)))
+            for p in pipelines:
+                p.set_capacity(capacity)
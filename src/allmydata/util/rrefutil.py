@@ -1,7 +1,12 @@
+import re
 
 from twisted.internet import address
 from foolscap.api import Violation, RemoteException, DeadReferenceError, \
      SturdyRef
+from allmydata.interfaces import ServerBusyError
+
+# used when a server says it is busy, but not for how long
+DEFAULT_RETRY_AFTER = 10.0
 
 def add_version_to_remote_reference(rref, default):
     """I try to add a .version attribute to the given RemoteReference. I call
@@ -25,6 +30,23 @@ def trap_and_discard(f, *errorTypes):
 def trap_deadref(f):
     return trap_and_discard(f, DeadReferenceError)
 
+def get_retry_after(f):
+    """If the Failure 'f' says that a storage server was too busy to do what
+    was asked (with a ServerBusyError, which may have come over the wire or
+    be wrapped in a RemoteException), return the number of seconds that the
+    server asked us to wait before trying again. Otherwise return None."""
+    if f.check(RemoteException):
+        f = f.value.failure
+    if not f.check(ServerBusyError):
+        return None
+    if isinstance(f.value, ServerBusyError):
+        return f.value.retry_after
+    # a copied failure only has the message
+    m = re.search(r"retry after ([0-9.]+) seconds", str(f.value))
+    if m:
+        return float(m.group(1))
+    return DEFAULT_RETRY_AFTER
+
 
 def connection_hints_for_furl(furl):
     hints = []
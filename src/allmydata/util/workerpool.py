@@ -0,0 +1,133 @@
+"""
+A pool of workers for the CPU-heavy parts of uploading and downloading:
+erasure coding, AES-CTR and block hashing. Without one, all of that runs on
+the reactor thread, so a single node uses at most one core no matter how
+many transfers it is running.
+
+The jobs are the module-level functions below. The ones which spend their
+time in code that releases the GIL (hashlib) run on a pool of threads. The
+others (zfec and pycryptopp hold the GIL while they work) run in a pool of
+worker processes, unless the pool was created with use_processes=False, in
+which case they run on the threads too (which keeps the reactor responsive,
+but does not use more cores).
+
+The pool a node is using is installed (by its startService) as the module's
+current pool, which get_worker_pool() returns. CRSEncoder, CRSDecoder, the
+Encoder, EncryptAnUploadable and the mutable Retrieve use it, if there is
+one, through run(): each job returns a Deferred either way.
+"""
+
+import binascii, multiprocessing
+
+from twisted.application import service
+from twisted.internet import defer, threads
+from twisted.python.threadpool import ThreadPool
+
+from allmydata.util import hashutil, log
+
+_current_pool = None
+
+def get_worker_pool():
+    """Return the WorkerPool that is running, or None."""
+    return _current_pool
+
+def run(f, *args):
+    """Run the job f(*args) on the current WorkerPool, or here and now if
+    there is none. Return a Deferred that fires with its result."""
+    if _current_pool is None:
+        return defer.maybeDeferred(f, *args)
+    return _current_pool.run(f, *args)
+
+# the jobs
+
+_fec_encoders = {} # (k, m) -> zfec.Encoder, in each worker
+_fec_decoders = {}
+
+def fec_encode(k, m, inshares, desired_share_ids):
+    import zfec
+    if (k, m) not in _fec_encoders:
+        _fec_encoders[(k, m)] = zfec.Encoder(k, m)
+    return _fec_encoders[(k, m)].encode(inshares, desired_share_ids)
+
+def fec_decode(k, m, shares, shareids):
+    import zfec
+    if (k, m) not in _fec_decoders:
+        _fec_decoders[(k, m)] = zfec.Decoder(k, m)
+    return _fec_decoders[(k, m)].decode(shares, shareids)
+
+def aes_ctr(key, offset, data):
+    """Encrypt (or decrypt) 'data', which starts 'offset' bytes into an
+    AES-CTR stream that starts with a counter of zero."""
+    from pycryptopp.cipher.aes import AES
+    iv = binascii.unhexlify("%032x" % (offset // 16))
+    cryptor = AES(key, iv=iv)
+    cryptor.process("\x00" * (offset % 16))
+    return cryptor.process(data)
+
+def hash_blocks(blocks):
+    return [hashutil.block_hash(block) for block in blocks]
+
+# jobs which spend most of their time with the GIL released
+RELEASES_GIL = frozenset([hash_blocks])
+
+class WorkerPool(service.Service):
+    """I run jobs on up to 'max_workers' threads and (if 'use_processes')
+    as many worker processes, and deliver their results to the reactor
+    thread."""
+
+    name = "worker-pool"
+    max_workers = None # defaults to the number of CPUs
+    use_processes = True
+
+    def __init__(self, max_workers=None, use_processes=None, reactor=None):
+        if max_workers is not None:
+            self.max_workers = max_workers
+        if self.max_workers is None:
+            try:
+                self.max_workers = multiprocessing.cpu_count()
+            except NotImplementedError:
+                self.max_workers = 1
+        if use_processes is not None:
+            self.use_processes = use_processes
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._threads = ThreadPool(1, self.max_workers, name="worker-pool")
+        self._processes = None
+
+    def startService(self):
+        global _current_pool
+        service.Service.startService(self)
+        if self.use_processes:
+            # start these before the threads: forking a process which has
+            # threads running is asking for trouble
+            self._processes = multiprocessing.Pool(self.max_workers)
+        self._threads.start()
+        if _current_pool is None:
+            _current_pool = self
+        log.msg("worker pool started with %d %s" %
+                (self.max_workers,
+                 self.use_processes and "processes" or "threads"),
+                facility="tahoe.workerpool")
+
+    def stopService(self):
+        global _current_pool
+        if _current_pool is self:
+            _current_pool = None
+        if self._processes is not None:
+            # let the jobs already given to the processes finish, so that the
+            # threads waiting for them are released
+            self._processes.close()
+            self._processes.join()
+            self._processes = None
+        self._threads.stop()
+        return service.Service.stopService(self)
+
+    def run(self, f, *args):
+        """Run the job f(*args) on a worker, and return a Deferred that
+        fires (in the reactor thread) with its result."""
+        if self._processes is not None and f not in RELEASES_GIL:
+            return threads.deferToThreadPool(self._reactor, self._threads,
+                                             self._processes.apply, f, args)
+        return threads.deferToThreadPool(self._reactor, self._threads,
+                                         f, *args)
@@ -80,6 +80,8 @@ class URIHandler(RenderMixin, rend.Page):
                 return unlinked.POSTUnlinkedSSK(req, self.client, mutable_type)
             else:
                 return unlinked.POSTUnlinkedCHK(req, self.client)
+        if t == "upload-many":
+            return unlinked.POSTUnlinkedCHKMany(req, self.client)
         if t == "mkdir":
             return unlinked.POSTUnlinkedCreateDirectory(req, self.client)
         elif t == "mkdir-with-children":
@@ -25,6 +25,15 @@ class RateAndTimeMixin:
     def render_rate(self, ctx, data):
         return abbreviate_rate(data)
 
+    def render_histogram(self, h):
+        # summarize a util.histogram.Histogram of response times
+        if h.count == 1:
+            return self.render_time(None, h.min)
+        return "%d responses: min %s, median %s, max %s" % (
+            h.count, self.render_time(None, h.min),
+            self.render_time(None, h.percentile(0.5)),
+            self.render_time(None, h.max))
+
 class UploadResultsRendererMixin(RateAndTimeMixin):
     # this requires a method named 'upload_results'
 
@@ -207,6 +216,18 @@ class UploadStatusPage(UploadResultsRendererMixin, rend.Page):
     def render_status(self, ctx, data):
         return data.get_status()
 
+    def render_write_windows(self, ctx, data):
+        windows = data.get_write_windows()
+        if not windows:
+            return ""
+        l = T.ul()
+        for (name, window, throughput, rtt) in sorted(windows):
+            l[T.li["[%s]: window %s, throughput %s, round trip %s"
+                   % (name, abbreviate_size(window),
+                      abbreviate_rate(throughput) or "(unknown)",
+                      abbreviate_time(rtt) or "(unknown)")]]
+        return T.li["Write Pipelines:", l]
+
 class DownloadResultsRendererMixin(RateAndTimeMixin):
     # this requires a method named 'download_results'
 
@@ -758,8 +779,7 @@ class RetrieveStatusPage(rend.Page, RateAndTimeMixin):
             return ""
         l = T.ul()
         for server in sorted(per_server.keys(), key=lambda s: s.get_name()):
-            times_s = ", ".join([self.render_time(None, t)
-                                 for t in per_server[server]])
+            times_s = self.render_histogram(per_server[server])
             l[T.li["[%s]: %s" % (server.get_name(), times_s)]]
         return T.li["Per-Server Fetch Response Times: ", l]
 
@@ -868,8 +888,7 @@ class PublishStatusPage(rend.Page, RateAndTimeMixin):
             return ""
         l = T.ul()
         for server in sorted(per_server.keys(), key=lambda s: s.get_name()):
-            times_s = ", ".join([self.render_time(None, t)
-                                 for t in per_server[server]])
+            times_s = self.render_histogram(per_server[server])
             l[T.li["[%s]: %s" % (server.get_name(), times_s)]]
         return T.li["Per-Server Response Times: ", l]
 
@@ -942,17 +961,14 @@ class MapupdateStatusPage(rend.Page, RateAndTimeMixin):
         l = T.ul()
         for server in sorted(per_server.keys(), key=lambda s: s.get_name()):
             times = []
-            for op,started,t in per_server[server]:
-                #times.append("%s/%.4fs/%s/%s" % (op,
-                #                              started,
-                #                              self.render_time(None, started - self.update_status.get_started()),
-                #                              self.render_time(None,t)))
+            for op in ("query", "late", "privkey"):
+                h = per_server[server].get(op)
+                if h is None:
+                    continue
                 if op == "query":
-                    times.append( self.render_time(None, t) )
-                elif op == "late":
-                    times.append( "late(" + self.render_time(None, t) + ")" )
+                    times.append( self.render_histogram(h) )
                 else:
-                    times.append( "privkey(" + self.render_time(None, t) + ")" )
+                    times.append( op + "(" + self.render_histogram(h) + ")" )
             times_s = ", ".join(times)
             l[T.li["[%s]: %s" % (server.get_name(), times_s)]]
         return T.li["Per-Server Response Times: ", l]
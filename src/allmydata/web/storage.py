@@ -18,6 +18,9 @@ class StorageStatus(MultiFormatPage):
     docFactory = getxmlfile("storage_status.xhtml")
     # the default 'data' argument is the StorageServer instance
 
+    # the most corrupt shares that are listed, in the HTML or the JSON
+    max_corrupt_shares = 100
+
     def __init__(self, storage, nickname=""):
         rend.Page.__init__(self, storage)
         self.storage = storage
@@ -30,6 +33,14 @@ class StorageStatus(MultiFormatPage):
              "lease-checker": self.storage.lease_checker.get_state(),
              "lease-checker-progress": self.storage.lease_checker.get_progress(),
              }
+        if self.storage.scrubber is not None:
+            d["scrubber"] = self.storage.scrubber.get_state()
+            d["scrubber-progress"] = self.storage.scrubber.get_progress()
+            d["scrubber-corrupt-shares"] = \
+                self.storage.scrubber.get_corrupt_shares(
+                    limit=self.max_corrupt_shares)
+            d["scrubber-corrupt-share-count"] = \
+                self.storage.scrubber.get_corrupt_share_count()
         return json.dumps(d, indent=1) + "\n"
 
     def data_nickname(self, ctx, storage):
@@ -263,3 +274,46 @@ class StorageStatus(MultiFormatPage):
                              ]]])
 
         return ctx.tag[p]
+
+    def render_scrubber(self, ctx, data):
+        sc = self.storage.scrubber
+        if sc is None:
+            return ""
+        state = sc.get_state()
+        p = T.ul()
+        def add(*pieces):
+            p[T.li[pieces]]
+
+        add(self.format_crawler_progress(sc.get_progress()))
+        def format_counts(s):
+            return ("examined %d shares (%s): %d good, %d corrupt,"
+                    " %d mutable (skipped)"
+                    % (s["examined-shares"],
+                       abbreviate_space(s["examined-bytes"]),
+                       s["good-shares"], s["corrupt-shares"],
+                       s["skipped-shares"]))
+        if state["current-cycle"] is not None:
+            add("Current cycle so far: ",
+                format_counts(state["cycle-to-date"]))
+        h = state["history"]
+        if h:
+            last = h[max(h.keys())]
+            start, end = last["cycle-start-finish-times"]
+            add("Last complete cycle (which took %s and finished %s ago): "
+                % (abbreviate_time(end-start),
+                   abbreviate_time(time.time() - end)),
+                format_counts(last))
+
+        corrupt = sc.get_corrupt_shares(limit=self.max_corrupt_shares)
+        if corrupt:
+            count = sc.get_corrupt_share_count()
+            if count > len(corrupt):
+                title = "Corrupt shares (the first %d of %d):" % (len(corrupt),
+                                                                  count)
+            else:
+                title = "Corrupt shares:"
+            add(title,
+                T.ul[ [T.li["SI %s shnum %d: %s" % c] for c in corrupt] ])
+        else:
+            add("No corrupt shares found")
+        return ctx.tag[T.h2["Share Scrubber"], p]
@@ -1,12 +1,14 @@
 
-import urllib
+import json, urllib
 from twisted.web import http
 from twisted.internet import defer
+from twisted.python.failure import Failure
 from nevow import rend, url, tags as T
 from allmydata.immutable.upload import FileHandle
 from allmydata.mutable.publish import MutableFileHandle
 from allmydata.web.common import getxmlfile, get_arg, boolean_of_arg, \
-     convert_children_json, WebError, get_format, get_mutable_type
+     convert_children_json, WebError, get_format, get_mutable_type, \
+     humanize_failure
 from allmydata.web import status
 
 def PUTUnlinkedCHK(req, client):
@@ -59,6 +61,37 @@ def POSTUnlinkedCHK(req, client):
     return d
 
 
+def POSTUnlinkedCHKMany(req, client):
+    # "POST /uri?t=upload-many", to create several unlinked files
+    if not req.fields or "file" not in req.fields:
+        raise WebError("t=upload-many requires one or more file= fields",
+                       http.BAD_REQUEST)
+    fields = req.fields["file"]
+    if not isinstance(fields, list):
+        fields = [fields]
+    uploadables = [FileHandle(field.file, client.convergence)
+                   for field in fields]
+    d = client.upload_many(uploadables)
+    def _done(batch_results):
+        files = []
+        for (field, res) in zip(fields, batch_results.get_results()):
+            f = {"filename": field.filename}
+            if isinstance(res, Failure):
+                f["error"] = humanize_failure(res)[0]
+            else:
+                f["uri"] = res.get_uri()
+                f["size"] = res.get_file_size()
+            files.append(f)
+        data = {"files": files,
+                "total_size": batch_results.get_total_size(),
+                "timings": batch_results.get_timings(),
+                }
+        req.setHeader("content-type", "text/plain")
+        return json.dumps(data, indent=1) + "\n"
+    d.addCallback(_done)
+    return d
+
+
 class UploadResultsPage(status.UploadResultsRendererMixin, rend.Page):
     """'POST /uri', to create an unlinked file."""
     docFactory = getxmlfile("upload-results.xhtml")